@@ -0,0 +1,31 @@
+"""Index incidents created_at
+
+Revision ID: 9d4b7e2a61c8
+Revises: 5c1e9a7d2b43
+Create Date: 2026-10-19 20:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9d4b7e2a61c8'
+down_revision: Union[str, None] = '5c1e9a7d2b43'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Built concurrently, so the migration does not block writes to incidents
+    with op.get_context().autocommit_block():
+        op.create_index(op.f('ix_incidents_created_at'), 'incidents',
+                        ['created_at'], unique=False,
+                        postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(op.f('ix_incidents_created_at'), table_name='incidents',
+                      postgresql_concurrently=True)
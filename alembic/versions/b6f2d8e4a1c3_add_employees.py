@@ -0,0 +1,37 @@
+"""Add employees
+
+Revision ID: b6f2d8e4a1c3
+Revises: e3a8c5f0b917
+Create Date: 2026-10-19 22:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b6f2d8e4a1c3'
+down_revision: Union[str, None] = 'e3a8c5f0b917'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('employees',
+    sa.Column('employee_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('employee_name', sa.String(length=255), nullable=False),
+    sa.Column('employee_email', sa.String(length=255), nullable=False),
+    sa.Column('hashed_password', sa.String(length=255), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('employee_id')
+    )
+    op.create_index(op.f('ix_employees_employee_email'), 'employees', ['employee_email'], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_employees_employee_email'), table_name='employees')
+    op.drop_table('employees')
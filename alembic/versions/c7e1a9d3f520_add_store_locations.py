@@ -0,0 +1,46 @@
+"""Add the store locations and their spatial index
+
+Revision ID: c7e1a9d3f520
+Revises: b6f2d8e4a1c3
+Create Date: 2026-10-20 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from geoalchemy2 import Geography
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c7e1a9d3f520'
+down_revision: Union[str, None] = 'b6f2d8e4a1c3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute('CREATE EXTENSION IF NOT EXISTS postgis')
+    op.add_column('stores', sa.Column('store_latitude', sa.Float(), nullable=True))
+    op.add_column('stores', sa.Column('store_longitude', sa.Float(), nullable=True))
+    op.add_column('stores', sa.Column(
+        'store_location',
+        Geography(geometry_type='POINT', srid=4326, spatial_index=False),
+        sa.Computed('CAST(ST_SetSRID(ST_MakePoint(store_longitude, '
+                    'store_latitude), 4326) AS geography)', persisted=True),
+        nullable=True))
+    # Built concurrently, so the migration does not block writes to stores
+    with op.get_context().autocommit_block():
+        op.create_index('ix_stores_store_location', 'stores',
+                        ['store_location'], unique=False,
+                        postgresql_using='gist',
+                        postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_stores_store_location', table_name='stores',
+                      postgresql_concurrently=True)
+    op.drop_column('stores', 'store_location')
+    op.drop_column('stores', 'store_longitude')
+    op.drop_column('stores', 'store_latitude')
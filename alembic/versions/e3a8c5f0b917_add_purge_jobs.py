@@ -0,0 +1,59 @@
+"""Add purge jobs and index the parent foreign keys
+
+Revision ID: e3a8c5f0b917
+Revises: 9d4b7e2a61c8
+Create Date: 2026-10-19 21:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e3a8c5f0b917'
+down_revision: Union[str, None] = '9d4b7e2a61c8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Built concurrently, so the migration does not block writes to big tables
+FOREIGN_KEY_INDEXES = (
+    ('ix_stores_region_id', 'stores', 'region_id'),
+    ('ix_store_sections_store_id', 'store_sections', 'store_id'),
+    ('ix_incidents_region_id', 'incidents', 'region_id'),
+    ('ix_incidents_store_id', 'incidents', 'store_id'),
+    ('ix_incidents_store_section_id', 'incidents', 'store_section_id'),
+)
+
+
+def upgrade() -> None:
+    op.create_table('purge_jobs',
+    sa.Column('job_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('target_type', sa.String(length=20), nullable=False),
+    sa.Column('target_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('total_incidents', sa.Integer(), nullable=True),
+    sa.Column('deleted_incidents', sa.Integer(), nullable=False),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('heartbeat_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('job_id')
+    )
+    op.create_index(op.f('ix_purge_jobs_status'), 'purge_jobs', ['status'], unique=False)
+    with op.get_context().autocommit_block():
+        for name, table, column in FOREIGN_KEY_INDEXES:
+            op.create_index(name, table, [column], unique=False,
+                            postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _ in FOREIGN_KEY_INDEXES:
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
+    op.drop_index(op.f('ix_purge_jobs_status'), table_name='purge_jobs')
+    op.drop_table('purge_jobs')
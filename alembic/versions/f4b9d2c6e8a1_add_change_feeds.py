@@ -0,0 +1,125 @@
+"""Add the change sequence and the tombstones of the change feeds
+
+Revision ID: f4b9d2c6e8a1
+Revises: c7e1a9d3f520
+Create Date: 2026-10-20 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f4b9d2c6e8a1'
+down_revision: Union[str, None] = 'c7e1a9d3f520'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# The table, its entity type in the tombstones and its id column
+CHANGED_TABLES = (
+    ('regions', 'region', 'region_id'),
+    ('stores', 'store', 'store_id'),
+    ('store_sections', 'store_section', 'store_section_id'),
+    ('incidents', 'incident', 'incident_id'),
+)
+
+# The transaction id is taken before the sequence value, so a transaction
+# holding a value is always visible in the snapshots the change feeds use
+# to tell which values are settled, see services/change_feed_services.py
+STAMP_CHANGE = """
+CREATE FUNCTION stamp_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_current_xact_id();
+    NEW.change_seq := nextval('change_seq');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql
+"""
+
+# The archive moves incidents out of the table, they are not deleted for the
+# clients. Parent ids absent from a table are left NULL.
+RECORD_TOMBSTONE = """
+CREATE FUNCTION record_tombstone() RETURNS trigger AS $$
+DECLARE
+    deleted jsonb := to_jsonb(OLD);
+BEGIN
+    IF current_setting('app.archiving', true) = 'on' THEN
+        RETURN OLD;
+    END IF;
+    INSERT INTO tombstones (change_seq, entity_type, entity_id, region_id,
+                            store_id, store_section_id)
+    VALUES (nextval('change_seq'), TG_ARGV[0],
+            CAST(deleted ->> TG_ARGV[1] AS uuid),
+            CAST(deleted ->> 'region_id' AS uuid),
+            CAST(deleted ->> 'store_id' AS uuid),
+            CAST(deleted ->> 'store_section_id' AS uuid));
+    RETURN OLD;
+END
+$$ LANGUAGE plpgsql
+"""
+
+
+def upgrade() -> None:
+    op.execute('CREATE SEQUENCE change_seq')
+    for table, _, _ in CHANGED_TABLES:
+        # A constant default fills the existing rows without rewriting the
+        # table, they are all part of a first sync anyway
+        op.add_column(table, sa.Column('change_seq', sa.BigInteger(),
+                                       server_default='0', nullable=False))
+        op.alter_column(table, 'change_seq',
+                        server_default=sa.text("nextval('change_seq')"))
+
+    op.create_table('tombstones',
+    sa.Column('change_seq', sa.BigInteger(), nullable=False),
+    sa.Column('entity_type', sa.String(length=20), nullable=False),
+    sa.Column('entity_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('region_id', postgresql.UUID(as_uuid=True), nullable=True),
+    sa.Column('store_id', postgresql.UUID(as_uuid=True), nullable=True),
+    sa.Column('store_section_id', postgresql.UUID(as_uuid=True), nullable=True),
+    sa.Column('deleted_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('change_seq')
+    )
+    op.create_index('ix_tombstones_entity_type_change_seq', 'tombstones',
+                    ['entity_type', 'change_seq'], unique=False)
+
+    op.execute(STAMP_CHANGE)
+    op.execute(RECORD_TOMBSTONE)
+    for table, entity_type, id_column in CHANGED_TABLES:
+        op.execute(f'CREATE TRIGGER {table}_stamp_change '
+                   f'BEFORE INSERT OR UPDATE ON {table} '
+                   f'FOR EACH ROW EXECUTE FUNCTION stamp_change()')
+        op.execute(f'CREATE TRIGGER {table}_record_tombstone '
+                   f'AFTER DELETE ON {table} FOR EACH ROW EXECUTE FUNCTION '
+                   f"record_tombstone('{entity_type}', '{id_column}')")
+
+    # Built concurrently, so the migration does not block writes to big tables
+    with op.get_context().autocommit_block():
+        for table, _, _ in CHANGED_TABLES:
+            op.create_index(f'ix_{table}_change_seq', table, ['change_seq'],
+                            unique=False, postgresql_concurrently=True)
+        op.create_index('ix_incidents_store_id_change_seq', 'incidents',
+                        ['store_id', 'change_seq'], unique=False,
+                        postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_incidents_store_id_change_seq',
+                      table_name='incidents', postgresql_concurrently=True)
+        for table, _, _ in CHANGED_TABLES:
+            op.drop_index(f'ix_{table}_change_seq', table_name=table,
+                          postgresql_concurrently=True)
+
+    for table, _, _ in CHANGED_TABLES:
+        op.execute(f'DROP TRIGGER {table}_record_tombstone ON {table}')
+        op.execute(f'DROP TRIGGER {table}_stamp_change ON {table}')
+        op.drop_column(table, 'change_seq')
+    op.execute('DROP FUNCTION record_tombstone()')
+    op.execute('DROP FUNCTION stamp_change()')
+    op.drop_index('ix_tombstones_entity_type_change_seq',
+                  table_name='tombstones')
+    op.drop_table('tombstones')
+    op.execute('DROP SEQUENCE change_seq')
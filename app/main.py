@@ -1,26 +1,124 @@
 """The main file for the API"""
-import os
+from contextlib import asynccontextmanager
 
+from database.db import (replica_engine, start_replica_monitor,
+                         stop_replica_monitor)
+from database.slow_query_log import (start_slow_query_log,
+                                     stop_slow_query_log)
 from dotenv import find_dotenv, load_dotenv
-from fastapi import FastAPI, status
+from fastapi import Depends, FastAPI, status
 from fastapi.middleware.cors import CORSMiddleware
+from middleware.admission_control import (ADMISSION_CONTROL,
+                                          AdmissionControlMiddleware)
+from middleware.query_cancellation import QueryCancellationMiddleware
+from middleware.read_your_writes import ReadYourWritesMiddleware
+from middleware.request_profiler import RequestProfilerMiddleware
+from middleware.tracing import TracingMiddleware
+from routers.admin_router import admin_router
+from routers.anomalies_router import anomalies_router
+from routers.auth_router import auth_router, require_employee
+from routers.health_router import health_router
+from routers.hierarchy_router import hierarchy_router
+from routers.incident_feed_router import (incident_feed_router,
+                                          incident_feed_websocket_router)
 from routers.incidents_router import incidents_router
+from routers.metrics_router import metrics_router
+from routers.purges_router import purges_router
 from routers.regions_router import regions_router
+from routers.reports_router import reports_router
+from routers.sketches_router import sketches_router
 from routers.store_sections_router import store_sections_router
 from routers.stores_router import stores_router
+from services.anomaly_services import start_anomaly_job, stop_anomaly_job
+from services.auth_services import AUTH_REQUIRED
+from services.change_feed_services import (start_change_watermark,
+                                          stop_change_watermark)
+from services.executor_services import install_request_executor
+from services.idempotency_services import (start_idempotency_purge,
+                                           stop_idempotency_purge)
+from services.incident_feed_services import (start_incident_feed,
+                                             stop_incident_feed)
+from services.incident_ingestion_services import (start_incident_ingestion,
+                                                  stop_incident_ingestion)
+from services.incident_snapshot_services import (start_incident_snapshots,
+                                               stop_incident_snapshots)
+from services.password_services import (start_password_hasher,
+                                         stop_password_hasher)
+from services.product_sketch_services import (start_product_sketches,
+                                              stop_product_sketches)
+from services.profiler_services import PROFILING
+from services.purge_services import start_purge_worker, stop_purge_worker
+from services.report_services import start_report_jobs, stop_report_jobs
+from services.tracing_services import (TRACING, instrument_application,
+                                      start_span_exporter, stop_span_exporter)
+from services.warmup_services import start_warm_up, stop_warm_up
 
 load_dotenv(find_dotenv())
 
-SECRET_KEY = os.environ.get('SECRET_KEY')
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    """Starts the background workers and drains them on shutdown
+
+    Args:
+        _app (FastAPI): The application instance
+    """
+    await install_request_executor()
+    await start_span_exporter()
+    await start_slow_query_log()
+    await start_replica_monitor()
+    await start_change_watermark()
+    await start_incident_feed()
+    await start_product_sketches()
+    await start_incident_ingestion()
+    await start_incident_snapshots()
+    await start_anomaly_job()
+    await start_idempotency_purge()
+    await start_report_jobs()
+    await start_purge_worker()
+    await start_password_hasher()
+    await start_warm_up()
+    try:
+        yield
+    finally:
+        await stop_warm_up()
+        await stop_password_hasher()
+        await stop_purge_worker()
+        await stop_report_jobs()
+        await stop_idempotency_purge()
+        await stop_anomaly_job()
+        await stop_incident_snapshots()
+        await stop_incident_ingestion()
+        await stop_product_sketches()
+        await stop_incident_feed()
+        await stop_change_watermark()
+        await stop_replica_monitor()
+        await stop_slow_query_log()
+        await stop_span_exporter()
+
 
 app = FastAPI(title='Data Analysis',
               description='The backend for a data analysis application',
-              version='0.1.0'
+              version='0.1.0',
+              lifespan=lifespan
               )
 
 origins = ['http://localhost:3000',
            'https://data-analysis-frontend.vercel.app/']
 
+# The last middleware added runs first: CORS, then the trace, then admission
+# control, then the query guard of the admitted requests, then the profiler
+if PROFILING:
+    app.add_middleware(RequestProfilerMiddleware)
+
+app.add_middleware(QueryCancellationMiddleware)
+
+if ADMISSION_CONTROL:
+    app.add_middleware(AdmissionControlMiddleware)
+
+if TRACING:
+    app.add_middleware(TracingMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -29,6 +127,9 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
+if replica_engine is not None:
+    app.add_middleware(ReadYourWritesMiddleware)
+
 
 @app.get(
     '/',
@@ -45,7 +146,25 @@ async def root():
     return {'Message': 'Hello World'}
 
 
-app.include_router(regions_router)
-app.include_router(stores_router)
-app.include_router(store_sections_router)
-app.include_router(incidents_router)
+# The data endpoints need a bearer token once AUTH_REQUIRED is on. The
+# websocket feed checks the token it offers as a subprotocol.
+employee_only = [Depends(require_employee)] if AUTH_REQUIRED else []
+
+app.include_router(regions_router, dependencies=employee_only)
+app.include_router(stores_router, dependencies=employee_only)
+app.include_router(store_sections_router, dependencies=employee_only)
+app.include_router(hierarchy_router, dependencies=employee_only)
+app.include_router(incident_feed_router, dependencies=employee_only)
+app.include_router(incident_feed_websocket_router)
+app.include_router(incidents_router, dependencies=employee_only)
+app.include_router(metrics_router)
+app.include_router(anomalies_router, dependencies=employee_only)
+app.include_router(sketches_router, dependencies=employee_only)
+app.include_router(reports_router, dependencies=employee_only)
+app.include_router(purges_router, dependencies=employee_only)
+app.include_router(auth_router)
+app.include_router(admin_router)
+app.include_router(health_router)
+
+# Once every route exists, so their endpoints and services get spans
+instrument_application(app)
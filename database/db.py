@@ -1,21 +1,219 @@
 """The file with the database connection logic"""
+import asyncio
+import logging
 import os
+import time
+from typing import Callable, Optional
+
 import psycopg2
 
 from dotenv import find_dotenv, load_dotenv
-from sqlalchemy import create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
+from fastapi import Request
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session, declarative_base, sessionmaker
 
 load_dotenv(find_dotenv())
 
+logger = logging.getLogger(__name__)
+
 DATABASE_URL = os.environ.get('DATABASE_URL')
+DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_LAG_CHECK_INTERVAL = float(
+    os.environ.get('REPLICA_LAG_CHECK_INTERVAL', '1'))
+READ_YOUR_WRITES_SECONDS = float(
+    os.environ.get('READ_YOUR_WRITES_SECONDS', '10'))
+LAST_WRITE_COOKIE = 'last_write_at'
+DATABASE_QUERY_CACHE_SIZE = int(
+    os.environ.get('DATABASE_QUERY_CACHE_SIZE', '500'))
+DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', '5'))
+DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW', '10'))
+DATABASE_POOL_TIMEOUT = float(os.environ.get('DATABASE_POOL_TIMEOUT', '30'))
+# Zero turns server-side prepared statements off, e.g. behind a pgbouncer in
+# transaction pooling mode
+DATABASE_PREPARE_THRESHOLD = int(
+    os.environ.get('DATABASE_PREPARE_THRESHOLD', '5'))
+
+
+def engine_options(_url: str) -> dict:
+    """The create_engine options shared by the primary and the replica
+
+    psycopg 3 (a ``postgresql+psycopg://`` url) prepares a statement on the
+    server once a connection ran it ``DATABASE_PREPARE_THRESHOLD`` times, so
+    the hot queries skip parsing and planning from then on. psycopg2 has no
+    such mode and only gets the compiled statement cache.
+
+    Args:
+        _url (str): The database url
+
+    Returns:
+        dict: The keyword arguments for create_engine
+    """
+    options = {'query_cache_size': DATABASE_QUERY_CACHE_SIZE,
+               'pool_size': DATABASE_POOL_SIZE,
+               'max_overflow': DATABASE_MAX_OVERFLOW,
+               'pool_timeout': DATABASE_POOL_TIMEOUT}
+    if make_url(_url).get_driver_name() == 'psycopg':
+        options['connect_args'] = {
+            'prepare_threshold': DATABASE_PREPARE_THRESHOLD or None}
+    return options
 
-engine = create_engine(DATABASE_URL)
+
+engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+replica_engine = create_engine(
+    DATABASE_REPLICA_URL, **engine_options(DATABASE_REPLICA_URL)) \
+    if DATABASE_REPLICA_URL else None
+
+ReplicaSessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, bind=replica_engine) \
+    if replica_engine is not None else None
+
 Base = declarative_base()
 
+# Zero when the replica has replayed everything it received, otherwise the
+# age of the last replayed transaction. NULL checks make it report zero when
+# pointed at a primary, which is what a single-instance setup wants.
+REPLICA_LAG_QUERY = text("""
+SELECT CASE
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+""")
+
+
+def pool_in_use(_engine=None) -> float:
+    """The share of the connection pool currently checked out
+
+    Args:
+        _engine (Engine): The engine whose pool is measured. Defaults to the
+            primary.
+
+    Returns:
+        float: 0 when the pool is idle, 1 when every connection, overflow
+            included, is in use
+    """
+    pool = (_engine or engine).pool
+    return pool.checkedout() / (DATABASE_POOL_SIZE + DATABASE_MAX_OVERFLOW)
+
+
+def probe_replica_lag() -> float:
+    """Measures the replication lag of the replica
+
+    Returns:
+        float: The lag in seconds
+    """
+    with replica_engine.connect() as conn:
+        return float(conn.execute(REPLICA_LAG_QUERY).scalar())
+
+
+class ReplicaLagMonitor:
+    """Polls the replica's lag so routing never waits on a lag query
+
+    Args:
+        probe (Callable[[], float]): Returns the current lag in seconds
+        max_lag (float): The lag above which reads fall back to the primary
+        interval (float): The seconds between two probes
+    """
+
+    def __init__(
+        self,
+        probe: Callable[[], float] = probe_replica_lag,
+        max_lag: float = REPLICA_MAX_LAG_SECONDS,
+        interval: float = REPLICA_LAG_CHECK_INTERVAL
+    ) -> None:
+        self.probe = probe
+        self.max_lag = max_lag
+        self.interval = interval
+        self.lag_seconds: Optional[float] = None
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def replica_usable(self) -> bool:
+        """Whether the last probe succeeded within the lag threshold"""
+        return self.lag_seconds is not None and self.lag_seconds <= self.max_lag
+
+    def check(self) -> None:
+        """Probes the replica once, treating failures as unusable"""
+        try:
+            self.lag_seconds = self.probe()
+        except Exception:  # pylint: disable=broad-except
+            logger.warning('Replica lag probe failed', exc_info=True)
+            self.lag_seconds = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.to_thread(self.check)
+            await asyncio.sleep(self.interval)
+
+    async def start(self) -> None:
+        """Starts polling"""
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stops polling"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def metrics(self) -> dict:
+        """The lag and routing counters
+
+        Returns:
+            dict: The current metrics
+        """
+        return {
+            'configured': replica_engine is not None,
+            'lag_seconds': self.lag_seconds,
+            'max_lag_seconds': self.max_lag,
+            'replica_reads': self.replica_reads,
+            'primary_reads': self.primary_reads
+        }
+
+
+replica_lag_monitor = ReplicaLagMonitor()
+
+
+def wrote_recently(_request: Request) -> bool:
+    """Whether the client wrote within the read-your-writes window
+
+    Args:
+        _request (Request): The incoming request
+
+    Returns:
+        bool: True if the client's reads should see the primary
+    """
+    last_write = _request.cookies.get(LAST_WRITE_COOKIE)
+    if last_write is None:
+        return False
+    try:
+        return time.time() - float(last_write) < READ_YOUR_WRITES_SECONDS
+    except ValueError:
+        return False
+
+
+def read_session(_prefer_primary: bool = False) -> Session:
+    """Opens a session for read-only work on the replica when it is usable
+
+    Args:
+        _prefer_primary (bool): Force the primary, e.g. to read your own writes
+
+    Returns:
+        Session: A replica or primary session
+    """
+    if (ReplicaSessionLocal is not None and not _prefer_primary
+            and replica_lag_monitor.replica_usable):
+        replica_lag_monitor.replica_reads += 1
+        return ReplicaSessionLocal()
+
+    replica_lag_monitor.primary_reads += 1
+    return SessionLocal()
+
 
 async def get_db():
     """A simple function for getting access to the database
@@ -29,3 +227,34 @@ async def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_read_db(request: Request):
+    """The session dependency for read-only endpoints
+
+    Reads go to the replica unless none is configured, it lags beyond the
+    threshold, or the client wrote recently.
+
+    Args:
+        request (Request): The incoming request
+
+    Yields:
+        db: A replica or primary session
+    """
+    db = read_session(wrote_recently(request))
+
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def start_replica_monitor() -> None:
+    """Starts the replica lag monitor when a replica is configured"""
+    if replica_engine is not None:
+        await replica_lag_monitor.start()
+
+
+async def stop_replica_monitor() -> None:
+    """Stops the replica lag monitor"""
+    await replica_lag_monitor.stop()
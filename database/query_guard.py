@@ -0,0 +1,131 @@
+"""The file with the per-request statement timeouts and query cancellation
+
+A ``QueryGuard`` is set for every request by ``QueryCancellationMiddleware``.
+Each transaction a session opens for the request gets the statement timeout of
+the request's route class, and the connection running a statement is recorded
+so the statement can be cancelled server side once the client has gone.
+"""
+import logging
+import os
+import threading
+from contextvars import ContextVar
+from typing import Any, Optional
+
+from dotenv import find_dotenv, load_dotenv
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+load_dotenv(find_dotenv())
+
+logger = logging.getLogger(__name__)
+
+# In milliseconds, 0 leaves the server's default in place
+STATEMENT_TIMEOUTS = {
+    route_class: int(os.environ.get(
+        f'STATEMENT_TIMEOUT_{route_class.upper()}_MS', default))
+    for route_class, default in (
+        ('hierarchy', 10000),
+        ('crud', 5000),
+        ('listing', 30000),
+        ('analytics', 120000),
+    )
+}
+
+
+class QueryCancelled(Exception):
+    """Raised when a statement is started for a client that has gone"""
+
+
+class QueryGuard:
+    """Tracks the statement a request is running so it can be cancelled
+
+    The statements run on worker threads while ``cancel`` is called from the
+    event loop, hence the lock.
+
+    Args:
+        route_class (str): The route class of the request
+    """
+
+    def __init__(self, route_class: str) -> None:
+        self.route_class = route_class
+        self.statement_timeout = STATEMENT_TIMEOUTS.get(route_class, 0)
+        self.cancelled = False
+        self._connection: Optional[Any] = None
+        self._lock = threading.Lock()
+
+    def attach(self, _dbapi_connection: Any) -> None:
+        """Records the connection a statement is about to run on
+
+        Args:
+            _dbapi_connection (Any): The DBAPI connection
+
+        Raises:
+            QueryCancelled: The client disconnected already
+        """
+        with self._lock:
+            if self.cancelled:
+                raise QueryCancelled('The client disconnected')
+            self._connection = _dbapi_connection
+
+    def detach(self) -> None:
+        """Forgets the connection once its statement finished"""
+        with self._lock:
+            self._connection = None
+
+    def cancel(self) -> bool:
+        """Cancels the running statement and any later one
+
+        Returns:
+            bool: Whether a running statement was cancelled
+        """
+        with self._lock:
+            self.cancelled = True
+            connection = self._connection
+        if connection is None:
+            return False
+
+        try:
+            # Sends a cancel request on a separate socket, like
+            # pg_cancel_backend, so it is safe while the statement runs
+            connection.cancel()
+        except Exception:  # pylint: disable=broad-except
+            logger.warning('Could not cancel a statement', exc_info=True)
+            return False
+        return True
+
+
+current_query_guard: ContextVar[Optional[QueryGuard]] = ContextVar(
+    'current_query_guard', default=None)
+
+
+@event.listens_for(Session, 'after_begin')
+def _set_statement_timeout(_session, _transaction, connection) -> None:
+    guard = current_query_guard.get()
+    if (guard is not None and guard.statement_timeout
+            and connection.dialect.name == 'postgresql'):
+        connection.exec_driver_sql(
+            f'SET LOCAL statement_timeout = {int(guard.statement_timeout)}')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _attach_connection(conn, _cursor, _statement, _parameters, _context,
+                       _executemany) -> None:
+    guard = current_query_guard.get()
+    if guard is not None:
+        guard.attach(conn.connection.dbapi_connection)
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _detach_connection(_conn, _cursor, _statement, _parameters, _context,
+                       _executemany) -> None:
+    guard = current_query_guard.get()
+    if guard is not None:
+        guard.detach()
+
+
+@event.listens_for(Engine, 'handle_error')
+def _detach_connection_on_error(_context) -> None:
+    guard = current_query_guard.get()
+    if guard is not None:
+        guard.detach()
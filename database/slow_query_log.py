@@ -0,0 +1,326 @@
+"""The file with the slow-query log
+
+Every statement running longer than ``SLOW_QUERY_MS`` is recorded against the
+service function that issued it, with the shape of its parameters and its
+duration. Statements are aggregated by service and SQL text, and only the
+``SLOW_QUERY_KEEP`` most expensive are kept.
+
+With ``SLOW_QUERY_EXPLAIN_RATE`` set, a share of the slow read-only
+statements is run again under ``EXPLAIN (ANALYZE, BUFFERS)`` by a background
+thread, on a connection of its own and in a transaction that is rolled back,
+and the plan is kept next to the statement. A statement is explained at most
+once per ``SLOW_QUERY_EXPLAIN_INTERVAL`` seconds.
+"""
+import hashlib
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from dotenv import find_dotenv, load_dotenv
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+load_dotenv(find_dotenv())
+
+logger = logging.getLogger(__name__)
+
+# Zero turns the log off
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '200'))
+SLOW_QUERY_KEEP = int(os.environ.get('SLOW_QUERY_KEEP', '500'))
+SLOW_QUERY_EXPLAIN_RATE = float(
+    os.environ.get('SLOW_QUERY_EXPLAIN_RATE', '0'))
+SLOW_QUERY_EXPLAIN_INTERVAL = float(
+    os.environ.get('SLOW_QUERY_EXPLAIN_INTERVAL', '300'))
+SLOW_QUERY_EXPLAIN_TIMEOUT_MS = int(
+    os.environ.get('SLOW_QUERY_EXPLAIN_TIMEOUT_MS', '30000'))
+SLOW_QUERY_LOG = SLOW_QUERY_MS > 0
+
+_SERVICES_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'services')
+# Run or wrap the calls of the services, they never issue a statement
+_PLUMBING_PATHS = {os.path.join(_SERVICES_PATH, 'executor_services.py'),
+                   os.path.join(_SERVICES_PATH, 'tracing_services.py')}
+# EXPLAIN ANALYZE runs the statement, only plain reads are run twice
+_READ_ONLY = re.compile(r'^\s*(SELECT|WITH)\b', re.IGNORECASE)
+_WRITES = re.compile(
+    r'\b(INSERT|UPDATE|DELETE|MERGE)\b|\bFOR\s+(NO\s+KEY\s+)?(UPDATE|SHARE)\b',
+    re.IGNORECASE)
+
+# The services that submitted the calls running on the executor threads,
+# filled in by services.executor_services.RequestExecutor
+service_of_thread: Dict[int, str] = {}
+
+
+def calling_service(_frame) -> Optional[str]:
+    """The service function a frame runs for
+
+    Args:
+        _frame (FrameType): The innermost frame
+
+    Returns:
+        Optional[str]: ``module.function`` of the outermost ``*_service``
+            function in the stack, or of the innermost function of the
+            services package when none is named so
+    """
+    innermost = None
+    while _frame is not None:
+        code = _frame.f_code
+        if (code.co_filename.startswith(_SERVICES_PATH)
+                and code.co_filename not in _PLUMBING_PATHS):
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            name = f'{module}.{code.co_qualname}'
+            if code.co_name.endswith('_service'):
+                return name
+            innermost = innermost or name
+        _frame = _frame.f_back
+    return innermost
+
+
+def parameters_shape(_parameters: Any) -> Any:
+    """The shape of a statement's parameters, without their values
+
+    Args:
+        _parameters (Any): The DBAPI parameters
+
+    Returns:
+        Any: The type of every parameter, and the length of the lists
+    """
+    if isinstance(_parameters, dict):
+        return {name: parameters_shape(value)
+                for name, value in _parameters.items()}
+    if isinstance(_parameters, (list, tuple)):
+        return f'{type(_parameters).__name__}[{len(_parameters)}]'
+    return type(_parameters).__name__
+
+
+class SlowQueryLog:
+    """The aggregated slow statements and their sampled plans
+
+    Args:
+        threshold (float): The duration from which a statement is slow, in
+            seconds
+        keep (int): The number of distinct statements kept
+        explain_rate (float): The share of slow statements explained
+    """
+
+    def __init__(self, threshold: float = SLOW_QUERY_MS / 1000,
+                 keep: int = SLOW_QUERY_KEEP,
+                 explain_rate: float = SLOW_QUERY_EXPLAIN_RATE) -> None:
+        self.threshold = threshold
+        self.keep = keep
+        self.explain_rate = explain_rate
+        self.recorded = 0
+        self.explained = 0
+        self.explain_failures = 0
+        self._statements: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._explain_queue: queue.Queue = queue.Queue(maxsize=10)
+        self._explaining = threading.local()
+        self._thread: Optional[threading.Thread] = None
+
+    def record(self, _engine: Engine, _statement: str, _parameters: Any,
+               _duration: float, _service: Optional[str],
+               _executemany: bool) -> None:
+        """Aggregates a slow statement and maybe queues its EXPLAIN
+
+        Args:
+            _engine (Engine): The engine the statement ran on
+            _statement (str): The SQL sent to the driver
+            _parameters (Any): The DBAPI parameters
+            _duration (float): The duration in seconds
+            _service (Optional[str]): The service function that issued it
+            _executemany (bool): Whether it ran for many parameter sets
+        """
+        statement_id = hashlib.sha1(
+            f'{_service}\0{_statement}'.encode()).hexdigest()[:16]
+        now = datetime.now()
+        with self._lock:
+            entry = self._statements.get(statement_id)
+            if entry is None:
+                if len(self._statements) >= self.keep:
+                    cheapest = min(
+                        self._statements,
+                        key=lambda key: self._statements[key]['total_seconds'])
+                    del self._statements[cheapest]
+                entry = self._statements[statement_id] = {
+                    'statement_id': statement_id, 'service': _service,
+                    'statement': _statement, 'calls': 0,
+                    'total_seconds': 0.0, 'max_seconds': 0.0,
+                    'plan': None, 'plan_seconds': None,
+                    'plan_captured_at': None, '_explain_queued_at': 0.0}
+            entry['calls'] += 1
+            entry['total_seconds'] += _duration
+            entry['max_seconds'] = max(entry['max_seconds'], _duration)
+            entry['parameters'] = parameters_shape(_parameters)
+            entry['last_seen'] = now
+            self.recorded += 1
+
+            explain = (self.explain_rate and not _executemany
+                       and _engine.dialect.name == 'postgresql'
+                       and time.monotonic() - entry['_explain_queued_at']
+                       > SLOW_QUERY_EXPLAIN_INTERVAL
+                       and random.random() < self.explain_rate
+                       and _READ_ONLY.match(_statement)
+                       and not _WRITES.search(_statement))
+            if explain:
+                entry['_explain_queued_at'] = time.monotonic()
+
+        logger.warning('Slow statement, %.0f ms in %s: %.200s',
+                       _duration * 1000, _service, ' '.join(_statement.split()))
+        if explain:
+            try:
+                self._explain_queue.put_nowait(
+                    (statement_id, _engine, _statement, _parameters))
+            except queue.Full:
+                pass
+
+    @property
+    def explaining(self) -> bool:
+        """Whether the current thread runs an EXPLAIN of the log"""
+        return getattr(self._explaining, 'active', False)
+
+    def _explain(self, _statement_id: str, _engine: Engine, _statement: str,
+                 _parameters: Any) -> None:
+        self._explaining.active = True
+        try:
+            with _engine.connect() as conn:
+                conn.exec_driver_sql(
+                    f'SET LOCAL statement_timeout = '
+                    f'{int(SLOW_QUERY_EXPLAIN_TIMEOUT_MS)}')
+                started = time.perf_counter()
+                plan = conn.exec_driver_sql(
+                    'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + _statement,
+                    _parameters).scalar()
+                duration = time.perf_counter() - started
+                conn.rollback()
+        finally:
+            self._explaining.active = False
+
+        with self._lock:
+            entry = self._statements.get(_statement_id)
+            if entry is not None:
+                entry['plan'] = plan
+                entry['plan_seconds'] = duration
+                entry['plan_captured_at'] = datetime.now()
+            self.explained += 1
+
+    def _run(self) -> None:
+        while True:
+            job = self._explain_queue.get()
+            if job is None:
+                return
+            try:
+                self._explain(*job)
+            except Exception:  # pylint: disable=broad-except
+                self.explain_failures += 1
+                logger.warning('Could not explain a slow statement',
+                               exc_info=True)
+
+    def start(self) -> None:
+        """Starts the EXPLAIN thread when plans are sampled"""
+        if self.explain_rate and self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='slow-query-explain', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Stops the EXPLAIN thread, dropping the statements still queued"""
+        if self._thread is not None:
+            while True:
+                try:
+                    self._explain_queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._explain_queue.put(None)
+            self._thread = None
+
+    def ranking(self, _limit: int) -> List[Dict]:
+        """The statements that took the most time in total
+
+        Args:
+            _limit (int): The number of statements returned
+
+        Returns:
+            List[Dict]: The statements, the most expensive first, without
+                their plans
+        """
+        with self._lock:
+            entries = sorted(self._statements.values(),
+                             key=lambda entry: entry['total_seconds'],
+                             reverse=True)[:_limit]
+            return [{**entry, 'plan': None,
+                     'has_plan': entry['plan'] is not None}
+                    for entry in entries]
+
+    def get(self, _statement_id: str) -> Optional[Dict]:
+        """A statement and its last plan
+
+        Args:
+            _statement_id (str): The id of the statement
+
+        Returns:
+            Optional[Dict]: The statement, if still kept
+        """
+        with self._lock:
+            entry = self._statements.get(_statement_id)
+            if entry is None:
+                return None
+            return {**entry, 'has_plan': entry['plan'] is not None}
+
+    def clear(self) -> None:
+        """Forgets every statement"""
+        with self._lock:
+            self._statements.clear()
+
+    def metrics(self) -> Dict:
+        """The counters of the log
+
+        Returns:
+            Dict: The current metrics
+        """
+        return {'enabled': SLOW_QUERY_LOG, 'threshold_ms': SLOW_QUERY_MS,
+                'statements': len(self._statements),
+                'recorded_total': self.recorded,
+                'explained_total': self.explained,
+                'explain_failures_total': self.explain_failures}
+
+
+slow_query_log = SlowQueryLog()
+
+
+def _start_timer(_conn, _cursor, _statement, _parameters, context,
+                 _executemany) -> None:
+    context.slow_query_started = time.perf_counter()
+
+
+def _record_if_slow(conn, _cursor, statement, parameters, context,
+                    executemany) -> None:
+    duration = time.perf_counter() - context.slow_query_started
+    if duration < slow_query_log.threshold or slow_query_log.explaining:
+        return
+    service = calling_service(sys._getframe(1)) \
+        or service_of_thread.get(threading.get_ident())
+    slow_query_log.record(conn.engine, statement, parameters, duration,
+                          service, executemany)
+
+
+if SLOW_QUERY_LOG:
+    event.listen(Engine, 'before_cursor_execute', _start_timer)
+    event.listen(Engine, 'after_cursor_execute', _record_if_slow)
+
+
+async def start_slow_query_log() -> None:
+    """Starts the thread explaining the sampled slow statements"""
+    slow_query_log.start()
+
+
+async def stop_slow_query_log() -> None:
+    """Stops the thread explaining the sampled slow statements"""
+    slow_query_log.stop()
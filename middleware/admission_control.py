@@ -0,0 +1,266 @@
+"""The middleware that sheds load before the database pool is exhausted
+
+Every request is put in a route class. Each class admits a fixed number of
+concurrent requests and parks a bounded number more in a FIFO queue. Anything
+beyond that, or anything that waits too long, is answered at once with a 503
+and a ``Retry-After`` header instead of queueing inside ``get_db`` for the
+whole pool timeout.
+
+Expensive classes are also refused while the pool is busier than their share
+allows, so cheap hierarchy and CRUD reads keep the connections they need when
+analytics traffic piles up.
+"""
+import asyncio
+import json
+import os
+import re
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, Optional, Tuple
+
+from dotenv import find_dotenv, load_dotenv
+
+from database.db import pool_in_use
+
+load_dotenv(find_dotenv())
+
+ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL', 'on') != 'off'
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', '1'))
+
+
+@dataclass
+class RouteClass:
+    """The limits of one route class
+
+    Args:
+        name (str): The name of the class
+        limit (int): The requests served concurrently
+        queue_size (int): The requests waiting for a slot
+        wait_timeout (float): The longest a request waits, in seconds
+        max_pool_use (Optional[float]): The pool share from which the class
+            is refused, or None for classes that rarely need a connection
+    """
+    name: str
+    limit: int
+    queue_size: int
+    wait_timeout: float
+    max_pool_use: Optional[float]
+
+    @classmethod
+    def from_env(cls, _name: str, _limit: int, _queue_size: int,
+                 _wait_timeout: float,
+                 _max_pool_use: Optional[float]) -> 'RouteClass':
+        """Builds a class, letting ``ADMISSION_<NAME>_*`` override defaults"""
+        prefix = f'ADMISSION_{_name.upper()}_'
+        max_pool_use = os.environ.get(prefix + 'MAX_POOL_USE', _max_pool_use)
+        return cls(
+            _name,
+            int(os.environ.get(prefix + 'LIMIT', _limit)),
+            int(os.environ.get(prefix + 'QUEUE', _queue_size)),
+            float(os.environ.get(prefix + 'WAIT', _wait_timeout)),
+            float(max_pool_use) if max_pool_use is not None else None)
+
+
+ROUTE_CLASSES = {
+    route_class.name: route_class for route_class in (
+        RouteClass.from_env('hierarchy', 32, 64, 2.0, None),
+        RouteClass.from_env('crud', 10, 50, 1.0, 1.0),
+        RouteClass.from_env('listing', 4, 20, 1.0, 0.8),
+        RouteClass.from_env('analytics', 2, 4, 0.5, 0.5),
+    )
+}
+
+# The first matching rule wins. A None class is never limited, which suits
+# long-lived streams and the endpoints used to diagnose an overload. Logins
+# and registrations queue on the bounded pool hashing the passwords instead.
+ROUTE_RULES: Tuple[Tuple[Optional[str], Optional[str], re.Pattern], ...] = tuple(
+    (route_class, method, re.compile(pattern)) for route_class, method, pattern in (
+        (None, None, r'^/(incidents/feed|metrics|health|admin|docs|redoc|openapi\.json)'),
+        (None, 'POST', r'^/auth/(login|register)'),
+        ('hierarchy', 'GET', r'^/hierarchy'),
+        ('analytics', None, r'^/anomalies'),
+        ('analytics', None, r'^/sketches/rebuild'),
+        ('analytics', 'GET', r'^/regions/[^/]+/summary'),
+        ('analytics', 'GET', r'^/stores/density/'),
+        ('listing', 'POST', r'/batch-get/?$'),
+        ('listing', 'GET', r'/changes/?$'),
+        ('listing', 'GET', r'^/incidents/(region|store|store_section|employee)/'),
+        ('listing', 'GET', r'^/(stores/region|store_sections/store)/'),
+        ('listing', 'GET', r'^/regions/?$'),
+        ('listing', 'GET', r'^/stores/(nearby|nearest)'),
+    ))
+
+
+def classify(_method: str, _path: str) -> Optional[str]:
+    """The route class of a request
+
+    Args:
+        _method (str): The HTTP method
+        _path (str): The request path
+
+    Returns:
+        Optional[str]: The class name, or None when the route is not limited
+    """
+    for route_class, method, pattern in ROUTE_RULES:
+        if (method is None or method == _method) and pattern.search(_path):
+            return route_class
+    return 'crud'
+
+
+class AdmissionLimiter:
+    """A concurrency limit with a bounded FIFO wait queue
+
+    Args:
+        route_class (RouteClass): The limits applied
+    """
+
+    def __init__(self, route_class: RouteClass) -> None:
+        self.route_class = route_class
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.rejected_pool = 0
+        self.timed_out = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    async def acquire(self) -> bool:
+        """Takes a slot, waiting in the queue if there is room
+
+        Returns:
+            bool: Whether the request was admitted
+        """
+        max_pool_use = self.route_class.max_pool_use
+        if max_pool_use is not None and pool_in_use() >= max_pool_use:
+            self.rejected += 1
+            self.rejected_pool += 1
+            return False
+
+        if self.active < self.route_class.limit and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            return True
+
+        if len(self._waiters) >= self.route_class.queue_size:
+            self.rejected += 1
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.route_class.wait_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            self.timed_out += 1
+            return False
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before the cancellation
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+        self.admitted += 1
+        return True
+
+    def release(self) -> None:
+        """Hands the slot to the next waiter, or frees it"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self.active -= 1
+
+    def metrics(self) -> Dict:
+        """The occupancy and admission counters
+
+        Returns:
+            Dict: The current metrics
+        """
+        return {
+            'limit': self.route_class.limit,
+            'active': self.active,
+            'waiting': len(self._waiters),
+            'admitted_total': self.admitted,
+            'rejected_total': self.rejected,
+            'rejected_pool_saturated_total': self.rejected_pool,
+            'rejected_wait_timeout_total': self.timed_out
+        }
+
+
+class AdmissionController:
+    """The limiters of every route class
+
+    Args:
+        route_classes (Optional[Dict[str, RouteClass]]): The classes and
+            their limits. Defaults to ROUTE_CLASSES.
+    """
+
+    def __init__(
+        self, route_classes: Optional[Dict[str, RouteClass]] = None
+    ) -> None:
+        self.limiters = {
+            name: AdmissionLimiter(route_class)
+            for name, route_class in (route_classes or ROUTE_CLASSES).items()}
+
+    def metrics(self) -> Dict:
+        """The metrics of every route class and the pool usage
+
+        Returns:
+            Dict: The current metrics
+        """
+        return {
+            'enabled': ADMISSION_CONTROL,
+            'pool_in_use': pool_in_use(),
+            'classes': {name: limiter.metrics()
+                        for name, limiter in self.limiters.items()}
+        }
+
+
+admission_controller = AdmissionController()
+
+
+class AdmissionControlMiddleware:
+    """Admits, queues or rejects every HTTP request by its route class
+
+    Args:
+        app (ASGIApp): The wrapped application
+        controller (AdmissionController): The limiters used
+    """
+
+    def __init__(self, app, controller: AdmissionController = admission_controller) -> None:
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send) -> None:
+        route_class = classify(scope['method'], scope['path']) \
+            if scope['type'] == 'http' else None
+        if route_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        limiter = self.controller.limiters[route_class]
+        if not await limiter.acquire():
+            await self._reject(send, route_class)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
+
+    @staticmethod
+    async def _reject(send, _route_class: str) -> None:
+        body = json.dumps({
+            'detail': f'The server is saturated for {_route_class} requests, '
+                      'retry shortly'}).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': 503,
+            'headers': [(b'content-type', b'application/json'),
+                        (b'content-length', str(len(body)).encode()),
+                        (b'retry-after', str(ADMISSION_RETRY_AFTER).encode())]
+        })
+        await send({'type': 'http.response.body', 'body': body})
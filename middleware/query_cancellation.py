@@ -0,0 +1,65 @@
+"""The middleware that cancels the queries of clients that went away"""
+import asyncio
+import logging
+
+from database.query_guard import QueryGuard, current_query_guard
+from middleware.admission_control import classify
+
+logger = logging.getLogger(__name__)
+
+# Only these classes run long enough for a disconnect to be worth watching
+WATCHED_ROUTE_CLASSES = {'listing', 'analytics'}
+
+
+class QueryCancellationMiddleware:
+    """Sets the request's query guard and cancels its statement on disconnect
+
+    The guard gives every transaction of the request the statement timeout of
+    its route class. For listing and analytics requests the client's receive
+    channel is also watched; when it reports a disconnect, the statement in
+    flight is cancelled server side and no new one is started, so the
+    connection goes back to the pool at once.
+
+    Args:
+        app (ASGIApp): The wrapped application
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        route_class = classify(scope['method'], scope['path']) \
+            if scope['type'] == 'http' else None
+        if route_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        guard = QueryGuard(route_class)
+        token = current_query_guard.set(guard)
+        try:
+            if route_class not in WATCHED_ROUTE_CLASSES:
+                await self.app(scope, receive, send)
+                return
+
+            messages: asyncio.Queue = asyncio.Queue()
+            watcher = asyncio.create_task(
+                self._watch(receive, messages, guard, scope['path']))
+            try:
+                await self.app(scope, receive=messages.get, send=send)
+            finally:
+                watcher.cancel()
+        finally:
+            current_query_guard.reset(token)
+
+    @staticmethod
+    async def _watch(receive, _messages: asyncio.Queue, _guard: QueryGuard,
+                     _path: str) -> None:
+        """Forwards the client's messages to the app until it disconnects"""
+        while True:
+            message = await receive()
+            await _messages.put(message)
+            if message['type'] == 'http.disconnect':
+                if _guard.cancel():
+                    logger.info('Cancelled the query of %s after the client '
+                                'disconnected', _path)
+                return
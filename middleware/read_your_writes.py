@@ -0,0 +1,41 @@
+"""The middleware that remembers when a client last wrote"""
+import time
+
+from database.db import LAST_WRITE_COOKIE, READ_YOUR_WRITES_SECONDS
+
+SAFE_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+# POST endpoints that only read, whose body is too large for a query string
+READ_ONLY_PATH_SUFFIXES = ('/batch-get',)
+
+
+class ReadYourWritesMiddleware:
+    """Sets a short-lived cookie after every successful write
+
+    ``get_read_db`` sends the client's reads to the primary while the cookie
+    is fresh, so a client never reads a replica that has not caught up with
+    its own write yet.
+
+    Args:
+        app (ASGIApp): The wrapped application
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+        self.cookie = (
+            f'{LAST_WRITE_COOKIE}={{}}; Max-Age={int(READ_YOUR_WRITES_SECONDS)}; '
+            'Path=/; HttpOnly; SameSite=Lax')
+
+    async def __call__(self, scope, receive, send) -> None:
+        if (scope['type'] != 'http' or scope['method'] in SAFE_METHODS
+                or scope['path'].endswith(READ_ONLY_PATH_SUFFIXES)):
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_cookie(message) -> None:
+            if message['type'] == 'http.response.start' and message['status'] < 400:
+                message.setdefault('headers', [])
+                message['headers'] = list(message['headers']) + [(
+                    b'set-cookie', self.cookie.format(time.time()).encode())]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
@@ -0,0 +1,74 @@
+"""The middleware that profiles the requests asking for it"""
+import asyncio
+import hmac
+import logging
+import random
+
+from services.profiler_services import (ADMIN_TOKEN, PROFILE_SAMPLE_RATE,
+                                        RequestProfile, current_profile,
+                                        profile_store, sampler)
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = b'x-profile'
+PROFILE_ID_HEADER = b'x-profile-id'
+
+
+def _trigger(_scope) -> str:
+    """Why a request is profiled, or an empty string when it is not"""
+    if ADMIN_TOKEN:
+        for name, value in _scope['headers']:
+            if name == PROFILE_HEADER:
+                if hmac.compare_digest(value, ADMIN_TOKEN.encode()):
+                    return 'header'
+                break
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        return 'sample'
+    return ''
+
+
+class RequestProfilerMiddleware:
+    """Samples the stacks of a request and stores them as a profile
+
+    A profiled request's response carries the ``X-Profile-Id`` header, the
+    id under which ``/admin/profiles`` serves its flame graph.
+
+    Args:
+        app (ASGIApp): The wrapped application
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        trigger = _trigger(scope) if scope['type'] == 'http' else ''
+        if not trigger:
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(scope['method'], scope['path'], trigger)
+
+        async def send_with_profile_id(message) -> None:
+            if message['type'] == 'http.response.start':
+                profile.status_code = message['status']
+                message['headers'] = [
+                    *message.get('headers', []),
+                    (PROFILE_ID_HEADER, str(profile.profile_id).encode())]
+            await send(message)
+
+        token = current_profile.set(profile)
+        profile.start()
+        sampler.add(profile)
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            sampler.remove(profile)
+            profile.finish()
+            current_profile.reset(token)
+            route = scope.get('route')
+            profile.route = getattr(route, 'path', None)
+            try:
+                await asyncio.to_thread(profile_store.save, profile)
+            except OSError:
+                logger.warning('Could not store the profile of %s',
+                               scope['path'], exc_info=True)
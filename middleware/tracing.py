@@ -0,0 +1,55 @@
+"""The middleware that starts the trace of the sampled requests"""
+from services.tracing_services import current_span, start_trace
+
+TRACEPARENT_HEADER = b'traceparent'
+
+
+class TracingMiddleware:
+    """Opens the server span of a request and closes it with the response
+
+    The span is named after the matched route once the router resolved it,
+    and carries the method, path and status code.
+
+    Args:
+        app (ASGIApp): The wrapped application
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        traceparent = next((value.decode('latin-1')
+                            for name, value in scope['headers']
+                            if name == TRACEPARENT_HEADER), None)
+        span = start_trace(f"{scope['method']} {scope['path']}", traceparent)
+        if span is None:
+            await self.app(scope, receive, send)
+            return
+
+        span.attributes.update({'http.request.method': scope['method'],
+                                'url.path': scope['path']})
+
+        async def send_with_status(message) -> None:
+            if message['type'] == 'http.response.start':
+                span.attributes['http.response.status_code'] = \
+                    message['status']
+            await send(message)
+
+        token = current_span.set(span)
+        error = None
+        try:
+            await self.app(scope, receive, send_with_status)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            current_span.reset(token)
+            route = getattr(scope.get('route'), 'path', None)
+            if route is not None:
+                span.name = f"{scope['method']} {route}"
+                span.attributes['http.route'] = route
+            span.finish(error)
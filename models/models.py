@@ -2,10 +2,12 @@
 import uuid
 from datetime import datetime
 
-from sqlalchemy import (Column, DateTime, Float, ForeignKey, Integer,
-                        String, Text)
+from geoalchemy2 import Geography
+from sqlalchemy import (BigInteger, Column, Computed, DateTime, FetchedValue,
+                        Float, ForeignKey, Index, Integer, String, Text,
+                        func)
 from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship
 
 from database.db import Base
 
@@ -21,11 +23,19 @@ class Regions(Base):
     region_id = Column(UUID(as_uuid=True), primary_key=True, index=True,
                        default=uuid.uuid4)
     region_name = Column(String(255), nullable=False)
-    created_at = Column(DateTime, default=datetime.now(), nullable=False)
-    updated_at = Column(DateTime, nullable=True, onupdate=datetime.now())
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
+    updated_at = Column(DateTime, nullable=True, onupdate=datetime.now)
+    # Drawn from the change_seq sequence by a trigger on every insert and
+    # update, the cursor of the change feeds
+    change_seq = Column(BigInteger, server_default=FetchedValue(),
+                        server_onupdate=FetchedValue(), nullable=False,
+                        index=True)
 
-    stores = relationship('Stores', back_populates='region')
-    incidents = relationship('Incidents', back_populates='region')
+    # The database cascades the deletes, the children are never loaded for it
+    stores = relationship('Stores', back_populates='region',
+                          cascade='all, delete', passive_deletes=True)
+    incidents = relationship('Incidents', back_populates='region',
+                             cascade='all, delete', passive_deletes=True)
 
 
 class Stores(Base):
@@ -39,16 +49,34 @@ class Stores(Base):
     store_id = Column(UUID(as_uuid=True), primary_key=True, index=True,
                       default=uuid.uuid4)
     store_name = Column(String(255), nullable=False)
-    # TODO: Add the field for store location
-    created_at = Column(DateTime, default=datetime.now(), nullable=False)
-    updated_at = Column(DateTime, nullable=True, onupdate=datetime.now())
+    store_latitude = Column(Float, nullable=True)
+    store_longitude = Column(Float, nullable=True)
+    # Derived by the database from the coordinates, only the proximity
+    # queries read it
+    store_location = deferred(Column(
+        Geography(geometry_type='POINT', srid=4326, spatial_index=False),
+        Computed('CAST(ST_SetSRID(ST_MakePoint(store_longitude, '
+                 'store_latitude), 4326) AS geography)', persisted=True),
+        nullable=True))
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
+    updated_at = Column(DateTime, nullable=True, onupdate=datetime.now)
+    change_seq = Column(BigInteger, server_default=FetchedValue(),
+                        server_onupdate=FetchedValue(), nullable=False,
+                        index=True)
 
     region_id = Column(UUID, ForeignKey(
-        'regions.region_id', ondelete='CASCADE'))
+        'regions.region_id', ondelete='CASCADE'), index=True)
 
     region = relationship('Regions', back_populates='stores')
-    incidents = relationship('Incidents', back_populates='store')
-    store_sections = relationship('StoreSections', back_populates='store')
+    incidents = relationship('Incidents', back_populates='store',
+                             cascade='all, delete', passive_deletes=True)
+    store_sections = relationship('StoreSections', back_populates='store',
+                                  cascade='all, delete', passive_deletes=True)
+
+    __table_args__ = (
+        Index('ix_stores_store_location', 'store_location',
+              postgresql_using='gist'),
+    )
 
 
 class StoreSections(Base):
@@ -62,12 +90,17 @@ class StoreSections(Base):
     store_section_id = Column(UUID(as_uuid=True), primary_key=True, index=True,
                               default=uuid.uuid4)
     store_section_name = Column(String(255), nullable=False)
-    created_at = Column(DateTime, default=datetime.now(), nullable=False)
-    updated_at = Column(DateTime, nullable=True, onupdate=datetime.now())
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
+    updated_at = Column(DateTime, nullable=True, onupdate=datetime.now)
+    change_seq = Column(BigInteger, server_default=FetchedValue(),
+                        server_onupdate=FetchedValue(), nullable=False,
+                        index=True)
 
-    store_id = Column(UUID, ForeignKey('stores.store_id', ondelete='CASCADE'))
+    store_id = Column(UUID, ForeignKey('stores.store_id', ondelete='CASCADE'),
+                      index=True)
 
-    incidents = relationship('Incidents', back_populates='store_section')
+    incidents = relationship('Incidents', back_populates='store_section',
+                             cascade='all, delete', passive_deletes=True)
     store = relationship('Stores', back_populates='store_sections')
 
 
@@ -89,15 +122,104 @@ class Incidents(Base):
     employee_id = Column(String, nullable=False)
     employee_name = Column(String, nullable=False)
     employee_email = Column(String, nullable=False)
-    created_at = Column(DateTime, default=datetime.now(), nullable=False)
-    updated_at = Column(DateTime, nullable=True, onupdate=datetime.now())
-
+    created_at = Column(DateTime, default=datetime.now, nullable=False,
+                        index=True)
+    updated_at = Column(DateTime, nullable=True, onupdate=datetime.now)
+    change_seq = Column(BigInteger, server_default=FetchedValue(),
+                        server_onupdate=FetchedValue(), nullable=False,
+                        index=True)
+
+    # Indexed so the cascades and the purges do not scan the table
     region_id = Column(UUID, ForeignKey(
-        'regions.region_id', ondelete='CASCADE'))
-    store_id = Column(UUID, ForeignKey('stores.store_id', ondelete='CASCADE'))
+        'regions.region_id', ondelete='CASCADE'), index=True)
+    store_id = Column(UUID, ForeignKey('stores.store_id', ondelete='CASCADE'),
+                      index=True)
     store_section_id = Column(UUID, ForeignKey(
-        'store_sections.store_section_id', ondelete='CASCADE'))
+        'store_sections.store_section_id', ondelete='CASCADE'), index=True)
 
     region = relationship('Regions', back_populates='incidents')
     store = relationship('Stores', back_populates='incidents')
     store_section = relationship('StoreSections', back_populates='incidents')
+
+    # The change feed of one store, the sync of the offline clients
+    __table_args__ = (
+        Index('ix_incidents_store_id_change_seq', 'store_id', 'change_seq'),
+    )
+
+
+class IdempotencyKeys(Base):
+    """The responses stored under client supplied idempotency keys
+
+    Args:
+        Base (_type_): Declarative Base Instance
+    """
+    __tablename__ = 'idempotency_keys'
+
+    idempotency_key = Column(String(255), primary_key=True)
+    request_hash = Column(String(64), nullable=False)
+    status_code = Column(Integer, nullable=False)
+    response_body = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.now, nullable=False,
+                        index=True)
+
+
+class PurgeJobs(Base):
+    """The background purges of large regions, stores and store sections
+
+    Args:
+        Base (_type_): Declarative Base Instance
+    """
+    __tablename__ = 'purge_jobs'
+
+    job_id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    target_type = Column(String(20), nullable=False)
+    target_id = Column(UUID(as_uuid=True), nullable=False)
+    status = Column(String(20), nullable=False, default='queued', index=True)
+    total_incidents = Column(Integer, nullable=True)
+    deleted_incidents = Column(Integer, nullable=False, default=0)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
+    started_at = Column(DateTime, nullable=True)
+    heartbeat_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class Employees(Base):
+    """The model for the employees who log in to the application
+
+    Args:
+        Base (_type_): Declarative Base Instance
+    """
+    __tablename__ = 'employees'
+
+    employee_id = Column(UUID(as_uuid=True), primary_key=True,
+                         default=uuid.uuid4)
+    employee_name = Column(String(255), nullable=False)
+    employee_email = Column(String(255), nullable=False, unique=True,
+                            index=True)
+    hashed_password = Column(String(255), nullable=False)
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
+    updated_at = Column(DateTime, nullable=True, onupdate=datetime.now)
+
+
+class Tombstones(Base):
+    """The model for the deleted rows, kept for the change feeds
+
+    Args:
+        Base (Base): Declarative Base instance
+    """
+    __tablename__ = 'tombstones'
+
+    # Drawn from the same sequence as the rows, by the delete triggers
+    change_seq = Column(BigInteger, primary_key=True)
+    entity_type = Column(String(20), nullable=False)
+    entity_id = Column(UUID(as_uuid=True), nullable=False)
+    region_id = Column(UUID(as_uuid=True), nullable=True)
+    store_id = Column(UUID(as_uuid=True), nullable=True)
+    store_section_id = Column(UUID(as_uuid=True), nullable=True)
+    deleted_at = Column(DateTime, server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index('ix_tombstones_entity_type_change_seq', 'entity_type',
+              'change_seq'),
+    )
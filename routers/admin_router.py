@@ -0,0 +1,160 @@
+"""The router file for the diagnostic endpoints of the operators"""
+import hmac
+import os
+from typing import List, Optional
+from uuid import UUID
+
+from dotenv import find_dotenv, load_dotenv
+from fastapi import (APIRouter, Depends, Header, HTTPException, Query,
+                     status)
+from fastapi.responses import FileResponse
+
+from database.slow_query_log import slow_query_log
+from schemas.profiles_schema import ReadProfile
+from schemas.slow_queries_schema import SlowQuery, SlowQueryPlan
+from services.profiler_services import (list_profiles_service, profile_store,
+                                        retrieve_profile_service)
+
+load_dotenv(find_dotenv())
+
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+
+async def require_admin_token(
+    x_admin_token: Optional[str] = Header(None)
+) -> None:
+    """The dependency guarding the admin endpoints
+
+    Args:
+        x_admin_token (Optional[str]): The ``X-Admin-Token`` header
+
+    Raises:
+        HTTPException: A 403 error code is raised if no admin token is
+            configured or the header does not match it
+    """
+    if not ADMIN_TOKEN or x_admin_token is None or not hmac.compare_digest(
+            x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail='A valid admin token is required')
+
+
+admin_router = APIRouter(prefix='/admin', tags=['Admin'],
+                         dependencies=[Depends(require_admin_token)])
+
+
+@admin_router.get(
+    '/profiles',
+    description='Lists the stored request profiles, the newest first',
+    status_code=status.HTTP_200_OK
+)
+async def list_profiles_endpoint() -> List[ReadProfile]:
+    """The endpoint listing the request profiles
+
+    Returns:
+        List[ReadProfile]: The profiles still in the store
+    """
+    return await list_profiles_service()
+
+
+@admin_router.get(
+    '/profiles/{_profile_id}',
+    description='Retrieves the route, timings and query count of a profile',
+    status_code=status.HTTP_200_OK
+)
+async def retrieve_profile_endpoint(_profile_id: UUID) -> ReadProfile:
+    """The endpoint returning a request profile
+
+    Args:
+        _profile_id (UUID): The id of the profile
+
+    Raises:
+        HTTPException: A 404 error code is raised if the profile is not stored
+
+    Returns:
+        ReadProfile: The profile
+    """
+    profile = await retrieve_profile_service(_profile_id)
+    if profile is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail='Profile not found')
+    return profile
+
+
+@admin_router.get(
+    '/profiles/{_profile_id}/collapsed',
+    description='Downloads the collapsed stacks of a profile, the input of '
+                'flamegraph.pl or speedscope',
+    response_class=FileResponse,
+    status_code=status.HTTP_200_OK
+)
+async def retrieve_profile_stacks_endpoint(_profile_id: UUID) -> FileResponse:
+    """The endpoint serving the flame graph data of a profile
+
+    Args:
+        _profile_id (UUID): The id of the profile
+
+    Raises:
+        HTTPException: A 404 error code is raised if the profile is not stored
+
+    Returns:
+        FileResponse: One ``stack count`` line per distinct stack
+    """
+    path = profile_store.collapsed_path(_profile_id)
+    if path is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail='Profile not found')
+    return FileResponse(path, media_type='text/plain',
+                        filename=f'{_profile_id}.collapsed')
+
+
+@admin_router.get(
+    '/slow-queries',
+    description='Ranks the slow statements of this worker by total time',
+    status_code=status.HTTP_200_OK
+)
+async def list_slow_queries_endpoint(
+    limit: int = Query(20, ge=1, le=500)
+) -> List[SlowQuery]:
+    """The endpoint ranking the slow statements
+
+    Args:
+        limit (int): The number of statements returned. Defaults to 20.
+
+    Returns:
+        List[SlowQuery]: The statements, the most expensive first
+    """
+    return slow_query_log.ranking(limit)
+
+
+@admin_router.get(
+    '/slow-queries/{_statement_id}',
+    description='Retrieves a slow statement with its last captured plan',
+    status_code=status.HTTP_200_OK
+)
+async def retrieve_slow_query_endpoint(_statement_id: str) -> SlowQueryPlan:
+    """The endpoint returning a slow statement and its EXPLAIN output
+
+    Args:
+        _statement_id (str): The id of the statement
+
+    Raises:
+        HTTPException: A 404 error code is raised if the statement is not kept
+
+    Returns:
+        SlowQueryPlan: The statement, its totals and its plan, if any
+    """
+    statement = slow_query_log.get(_statement_id)
+    if statement is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail='Statement not found')
+    return statement
+
+
+@admin_router.delete(
+    '/slow-queries',
+    description='Forgets the slow statements, e.g. after a fix is deployed',
+    status_code=status.HTTP_204_NO_CONTENT
+)
+async def clear_slow_queries_endpoint() -> None:
+    """The endpoint clearing the slow-query log"""
+    slow_query_log.clear()
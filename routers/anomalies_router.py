@@ -0,0 +1,60 @@
+"""The router file for the incident rate anomalies"""
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, status
+
+from schemas.anomalies_schema import AnomalyLevel, AnomalyMetric, AnomalyReport
+from services.anomaly_services import (recompute_anomalies_service,
+                                       retrieve_anomalies_service)
+
+anomalies_router = APIRouter(prefix='/anomalies', tags=['Anomalies'])
+
+
+@anomalies_router.get(
+    '/',
+    description='Retrieves the stores and sections whose incidents spiked',
+    status_code=status.HTTP_200_OK
+)
+async def retrieve_anomalies_endpoint(
+    level: Optional[AnomalyLevel] = None,
+    metric: Optional[AnomalyMetric] = None
+) -> AnomalyReport:
+    """The endpoint returning the latest anomaly report
+
+    Args:
+        level (Optional[AnomalyLevel]): Only return store or section anomalies
+        metric (Optional[AnomalyMetric]): Only return count or loss anomalies
+
+    Raises:
+        HTTPException: A 400 error code is raised if something goes wrong
+
+    Returns:
+        AnomalyReport: The anomalies of the latest run
+    """
+    try:
+        return await retrieve_anomalies_service(
+            level.value if level else None, metric.value if metric else None)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)) from e
+
+
+@anomalies_router.post(
+    '/recompute',
+    description='Reruns the anomaly job',
+    status_code=status.HTTP_200_OK
+)
+async def recompute_anomalies_endpoint() -> AnomalyReport:
+    """The endpoint rerunning the anomaly job
+
+    Raises:
+        HTTPException: A 400 error code is raised if something goes wrong
+
+    Returns:
+        AnomalyReport: The new report
+    """
+    try:
+        return await recompute_anomalies_service()
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)) from e
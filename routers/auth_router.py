@@ -0,0 +1,162 @@
+"""The router file for the employee authentication"""
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from sqlalchemy.orm import Session
+
+from database.db import get_db
+from routers.admin_router import require_admin_token
+from schemas.employees_schema import CreateEmployee, ReadEmployee
+from schemas.jwt_schemas import EmployeeLogin, EmployeeToken, EmployeeTokenData
+from services.auth_services import (AuthNotConfigured, EmployeeExists,
+                                    InvalidCredentials, InvalidToken,
+                                    login_service,
+                                    register_employee_service,
+                                    retrieve_employee_service,
+                                    verify_access_token)
+from services.password_services import PasswordHasherBusy
+
+bearer_scheme = HTTPBearer(auto_error=False)
+
+
+async def require_employee(
+    _credentials: Optional[HTTPAuthorizationCredentials] = Depends(
+        bearer_scheme)
+) -> EmployeeTokenData:
+    """The dependency guarding the endpoints of the employees
+
+    Args:
+        _credentials (Optional[HTTPAuthorizationCredentials]): The bearer
+            token of the ``Authorization`` header
+
+    Raises:
+        HTTPException: A 401 error code is raised if the token is missing,
+            invalid or expired, a 503 error code if no SECRET_KEY is set
+
+    Returns:
+        EmployeeTokenData: The authenticated employee
+    """
+    if _credentials is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail='Not authenticated',
+                            headers={'WWW-Authenticate': 'Bearer'})
+    try:
+        return verify_access_token(_credentials.credentials)
+    except InvalidToken as e:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail='Invalid or expired token',
+                            headers={'WWW-Authenticate': 'Bearer'}) from e
+    except AuthNotConfigured as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail=str(e)) from e
+
+
+auth_router = APIRouter(prefix='/auth', tags=['Auth'])
+
+
+# Only the operators register employees, or anyone could mint a token
+@auth_router.post(
+    '/register',
+    description='Registers an employee, with the admin token',
+    dependencies=[Depends(require_admin_token)],
+    status_code=status.HTTP_201_CREATED
+)
+async def register_employee_endpoint(
+    _employee_data: CreateEmployee,
+    _db: Session = Depends(get_db)
+) -> ReadEmployee:
+    """The endpoint for registering employees
+
+    Args:
+        _employee_data (CreateEmployee): The employee and their password
+        _db (Session, optional): The database session. Defaults to Depends(get_db).
+
+    Raises:
+        HTTPException: A 403 error code is raised without the admin token, a
+            409 error code if the email is taken, a 503 error code if too
+            many passwords are being hashed, a 400 error code for any other
+            error
+
+    Returns:
+        ReadEmployee: The new employee
+    """
+    try:
+        return await register_employee_service(_employee_data, _db)
+    except EmployeeExists as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail=str(e)) from e
+    except PasswordHasherBusy as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail=str(e),
+                            headers={'Retry-After': '1'}) from e
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=str(e)) from e
+
+
+@auth_router.post(
+    '/login',
+    description='Exchanges an email and password for a bearer token',
+    status_code=status.HTTP_200_OK
+)
+async def login_endpoint(
+    _credentials: EmployeeLogin,
+    _db: Session = Depends(get_db)
+) -> EmployeeToken:
+    """The endpoint for logging in
+
+    Args:
+        _credentials (EmployeeLogin): The email and password
+        _db (Session, optional): The database session. Defaults to Depends(get_db).
+
+    Raises:
+        HTTPException: A 401 error code is raised if the credentials are
+            wrong, a 503 error code if too many logins are being checked or
+            no SECRET_KEY is set
+
+    Returns:
+        EmployeeToken: The bearer token
+    """
+    try:
+        return await login_service(_credentials, _db)
+    except InvalidCredentials as e:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail=str(e),
+                            headers={'WWW-Authenticate': 'Bearer'}) from e
+    except PasswordHasherBusy as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail=str(e),
+                            headers={'Retry-After': '1'}) from e
+    except AuthNotConfigured as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail=str(e)) from e
+
+
+@auth_router.get(
+    '/me',
+    description='Retrieves the authenticated employee',
+    status_code=status.HTTP_200_OK
+)
+async def retrieve_me_endpoint(
+    _employee: EmployeeTokenData = Depends(require_employee),
+    _db: Session = Depends(get_db)
+) -> ReadEmployee:
+    """The endpoint returning the authenticated employee
+
+    Args:
+        _employee (EmployeeTokenData, optional): The authenticated employee.
+            Defaults to Depends(require_employee).
+        _db (Session, optional): The database session. Defaults to Depends(get_db).
+
+    Raises:
+        HTTPException: A 404 error code is raised if the employee was removed
+
+    Returns:
+        ReadEmployee: The employee
+    """
+    employee = await retrieve_employee_service(_employee.id, _db)
+    if employee is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail='Employee not found')
+    return employee
@@ -0,0 +1,44 @@
+"""The router file for the liveness and readiness probes"""
+from fastapi import APIRouter, HTTPException, status
+
+from services.warmup_services import WARMUP_RETRY_INTERVAL, warm_up
+
+health_router = APIRouter(prefix='/health', tags=['Health'])
+
+
+@health_router.get(
+    '/live',
+    description='Answers as soon as the worker accepts requests',
+    status_code=status.HTTP_200_OK
+)
+async def liveness_endpoint() -> dict:
+    """The liveness probe
+
+    Returns:
+        dict: The status of the worker
+    """
+    return {'status': 'alive'}
+
+
+@health_router.get(
+    '/ready',
+    description='Answers once the worker is warmed up and until it shuts down',
+    status_code=status.HTTP_200_OK
+)
+async def readiness_endpoint() -> dict:
+    """The readiness probe
+
+    Raises:
+        HTTPException: A 503 error code is raised while warming up or
+            shutting down
+
+    Returns:
+        dict: The status of the worker and how long it took to get ready
+    """
+    if not warm_up.ready:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=warm_up.error or 'Warming up',
+            headers={'Retry-After': str(int(WARMUP_RETRY_INTERVAL))})
+    return {'status': 'ready',
+            'time_to_ready_seconds': warm_up.time_to_ready}
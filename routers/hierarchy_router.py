@@ -0,0 +1,38 @@
+"""The router for the region, store and store section tree"""
+from typing import List
+
+from fastapi import APIRouter, Depends, HTTPException, Response, status
+from sqlalchemy.orm import Session
+
+from database.db import get_read_db
+from schemas.hierarchy_schema import HierarchyRegion
+from services.hierarchy_services import retrieve_hierarchy_service
+
+hierarchy_router = APIRouter(prefix='/hierarchy', tags=['Hierarchy'])
+
+
+@hierarchy_router.get(
+    '/',
+    response_model=List[HierarchyRegion],
+    description='Retrieves every region with its stores and store sections',
+    status_code=status.HTTP_200_OK
+)
+async def retrieve_hierarchy_endpoint(
+    _db: Session = Depends(get_read_db)
+) -> List[HierarchyRegion]:
+    """The endpoint serving the navigation tree
+
+    The JSON is built by PostgreSQL and sent as is.
+
+    Args:
+        _db (Session): The database session
+
+    Returns:
+        List[HierarchyRegion]: The regions, their stores and store sections
+    """
+    try:
+        return Response(await retrieve_hierarchy_service(_db),
+                        media_type='application/json')
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=str(e)) from e
@@ -0,0 +1,124 @@
+"""The router file for the live incident feed"""
+import asyncio
+from typing import Optional
+from uuid import UUID
+
+from fastapi import (APIRouter, Request, WebSocket, WebSocketDisconnect,
+                     status)
+from fastapi.responses import StreamingResponse
+
+from schemas.incidents_schema import IncidentFeedScope
+from services.auth_services import (AUTH_REQUIRED, InvalidToken,
+                                    verify_access_token)
+from services.incident_feed_services import incident_feed_broker
+
+# The event stream is a plain GET and is guarded with the data routers. A
+# browser cannot set headers on a websocket, so it gets its own router and
+# checks the token itself.
+incident_feed_router = APIRouter(prefix='/incidents/feed', tags=['Incidents'])
+incident_feed_websocket_router = APIRouter(prefix='/incidents/feed',
+                                           tags=['Incidents'])
+
+SSE_KEEPALIVE_SECONDS = 15
+BEARER_SUBPROTOCOL = 'bearer'
+
+
+def _websocket_token(_websocket: WebSocket) -> Optional[str]:
+    """The token offered as the subprotocols ``bearer, <token>``
+
+    The header keeps the token out of the URLs written to the access logs.
+    """
+    subprotocols = _websocket.scope.get('subprotocols') or []
+    if BEARER_SUBPROTOCOL not in subprotocols:
+        return None
+    position = subprotocols.index(BEARER_SUBPROTOCOL)
+    return subprotocols[position + 1] \
+        if position + 1 < len(subprotocols) else None
+
+
+@incident_feed_websocket_router.websocket('/ws/{_scope}/{_scope_id}')
+async def incident_feed_websocket_endpoint(
+    _websocket: WebSocket,
+    _scope: IncidentFeedScope,
+    _scope_id: UUID
+) -> None:
+    """The websocket endpoint streaming new, updated and deleted incidents
+
+    Args:
+        _websocket (WebSocket): The websocket connection
+        _scope (IncidentFeedScope): Whether to follow a region, store or section
+        _scope_id (UUID): The id of the region, store or store section
+    """
+    token = _websocket_token(_websocket)
+    if AUTH_REQUIRED:
+        try:
+            if token is None:
+                raise InvalidToken('Not authenticated')
+            verify_access_token(token)
+        except InvalidToken:
+            # Closing before the handshake is answered refuses it with a 403
+            await _websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+            return
+
+    # A browser drops the connection unless an offered subprotocol is chosen
+    await _websocket.accept(
+        subprotocol=BEARER_SUBPROTOCOL if token is not None else None)
+    queue = incident_feed_broker.subscribe(_scope, _scope_id)
+
+    async def wait_for_disconnect() -> None:
+        while (await _websocket.receive())['type'] != 'websocket.disconnect':
+            pass
+
+    disconnect = asyncio.create_task(wait_for_disconnect())
+    try:
+        while True:
+            event = asyncio.create_task(queue.get())
+            done, _ = await asyncio.wait(
+                {event, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnect in done:
+                event.cancel()
+                break
+            await _websocket.send_text(event.result().decode())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        disconnect.cancel()
+        incident_feed_broker.unsubscribe(_scope, _scope_id, queue)
+
+
+@incident_feed_router.get(
+    '/sse/{_scope}/{_scope_id}',
+    description='Streams new, updated and deleted incidents as server-sent events'
+)
+async def incident_feed_sse_endpoint(
+    _request: Request,
+    _scope: IncidentFeedScope,
+    _scope_id: UUID
+) -> StreamingResponse:
+    """The server-sent events endpoint for the live incident feed
+
+    Args:
+        _request (Request): The incoming request
+        _scope (IncidentFeedScope): Whether to follow a region, store or section
+        _scope_id (UUID): The id of the region, store or store section
+
+    Returns:
+        StreamingResponse: The event stream
+    """
+    queue = incident_feed_broker.subscribe(_scope, _scope_id)
+
+    async def stream():
+        try:
+            while not await _request.is_disconnected():
+                try:
+                    payload = await asyncio.wait_for(
+                        queue.get(), SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield b': keepalive\n\n'
+                    continue
+                yield b'data: ' + payload + b'\n\n'
+        finally:
+            incident_feed_broker.unsubscribe(_scope, _scope_id, queue)
+
+    return StreamingResponse(stream(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache'})
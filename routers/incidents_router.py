@@ -1,46 +1,172 @@
 """The router file for the incidents CRUD operations"""
-from typing import List
+from datetime import datetime
+from typing import List, Optional
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import (APIRouter, Depends, Header, HTTPException, Query,
+                     Response, status)
+from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
 
-from database.db import get_db
-from schemas.incidents_schema import (CreateIncident, ReadIncident,
-                                      UpdateIncident)
+from database.db import get_db, get_read_db
+from schemas.batch_schema import BatchGet, BatchGetResult
+from schemas.changes_schema import (CHANGE_FEED_MAX_LIMIT, SINCE_DESCRIPTION,
+                                    ChangedEntity, ChangeFeedResult)
+from schemas.fieldsets_schema import (FIELDS_DESCRIPTION, parse_fields,
+                                     serialise_batch, serialise_changes,
+                                     serialise_many, serialise_one,
+                                     sparse_schema)
+from schemas.incidents_schema import (CreateIncident, QueuedIncident,
+                                      ReadIncident, UpdateIncident)
+from services.change_feed_services import (ChangeFeedNotReady,
+                                          retrieve_changes_service)
+from services.idempotency_services import (IDEMPOTENCY_KEY_HEADER,
+                                           IdempotencyKeyReused,
+                                           IdempotencyKeyTaken,
+                                           find_stored_response,
+                                           replay_response)
+from services.incident_ingestion_services import (IngestionQueueClosed,
+                                                  IngestionQueueFull,
+                                                  incident_ingestion_queue)
 from services.incidents_services import (
-    create_incident_service, delete_an_incident_service,
+    INCIDENT_FIELDS, create_incident_service, delete_an_incident_service,
     retrieve_a_single_incident_service,
     retrieve_all_incidents_in_a_region_service,
     retrieve_all_incidents_in_a_store_section_service,
     retrieve_all_incidents_in_a_store_service,
     retrieve_all_incidents_reported_by_an_employee_service,
-    update_an_incident_service)
+    retrieve_incidents_by_ids_service, update_an_incident_service)
 
 incidents_router = APIRouter(prefix="/incidents", tags=["Incidents"])
 
+RANGE_DESCRIPTION = ('Filters on the creation time. Incidents older than the '
+                     'archive cutoff are only returned when start reaches '
+                     'past it.')
+
+
+def _stored_incident_response(
+    _db: Session, _idempotency_key: str, _incident_data: CreateIncident
+) -> Optional[Response]:
+    """Replays the response stored under an idempotency key, if any
+
+    Raises:
+        HTTPException: A 422 error code is raised if the key was used for a
+            different incident
+    """
+    try:
+        stored = find_stored_response(_db, _idempotency_key, _incident_data)
+    except IdempotencyKeyReused as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=str(e)) from e
+    return replay_response(stored) if stored is not None else None
+
 
 @incidents_router.post(
     '/',
     name="Create An Incident",
     response_model=ReadIncident,
-    status_code=status.HTTP_201_CREATED
+    status_code=status.HTTP_201_CREATED,
+    responses={status.HTTP_202_ACCEPTED: {'model': QueuedIncident}}
 )
 async def create_incident_endpoint(
     _incident_data: CreateIncident,
-    _db: Session = Depends(get_db)
+    _db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(
+        None, alias=IDEMPOTENCY_KEY_HEADER, max_length=255,
+        description='Retries with the same key return the original response')
 ) -> ReadIncident:
     """The endpoint for creating incidents
 
+    In buffered ingestion mode the incident is queued for a batched write and
+    a 202 with the generated id is returned instead. A retry carrying the
+    Idempotency-Key of an earlier request gets that request's response back.
+
     Args:
         incident_data (CreateIncident): The incident data
         db (Session): The database session
+        idempotency_key (Optional[str]): The client supplied key
+
+    Raises:
+        HTTPException: A 503 error code is raised if the queue is full, a
+            422 if the key was used for a different incident and a 409 if a
+            concurrent request holds it
 
     Returns:
         ReadIncident: The incident data
     """
+    if idempotency_key:
+        replay = _stored_incident_response(_db, idempotency_key, _incident_data)
+        if replay is not None:
+            return replay
+
+    if incident_ingestion_queue.enabled:
+        try:
+            incident_id = await incident_ingestion_queue.enqueue(
+                _incident_data, idempotency_key)
+        except (IngestionQueueFull, IngestionQueueClosed) as e:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail=str(e),
+                                headers={'Retry-After': '1'}) from e
+        except IdempotencyKeyReused as e:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                detail=str(e)) from e
+        except IdempotencyKeyTaken as e:
+            # Another worker queued it first, so its 202 and id are stored
+            replay = _stored_incident_response(_db, idempotency_key,
+                                               _incident_data)
+            if replay is None:
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                    detail=str(e)) from e
+            return replay
+        return JSONResponse(
+            status_code=status.HTTP_202_ACCEPTED,
+            content=QueuedIncident(incident_id=incident_id).model_dump(mode='json'))
+
     try:
-        return await create_incident_service(_incident_data, _db)
+        return await create_incident_service(_incident_data, _db, idempotency_key)
+    except IdempotencyKeyTaken as e:
+        # A concurrent retry committed first, so its response is stored now
+        replay = _stored_incident_response(_db, idempotency_key, _incident_data)
+        if replay is None:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                detail=str(e)) from e
+        return replay
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=str(e)) from e
+
+
+@incidents_router.post(
+    '/batch-get',
+    response_model=BatchGetResult[ReadIncident],
+    name="Fetch many incidents",
+    status_code=status.HTTP_200_OK
+)
+async def batch_get_incidents_endpoint(
+    _batch: BatchGet,
+    _db: Session = Depends(get_read_db),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
+) -> BatchGetResult[ReadIncident]:
+    """The endpoint for fetching many incidents by id in one query
+
+    Args:
+        _batch (BatchGet): The ids of the incidents
+        _db (Session): The database session
+        fields (Optional[str]): The fields to return. Defaults to all.
+
+    Returns:
+        BatchGetResult[ReadIncident]: The incidents found and the ids that were not
+    """
+    try:
+        _fields = parse_fields(fields, INCIDENT_FIELDS)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=str(e)) from e
+
+    try:
+        items, missing = await retrieve_incidents_by_ids_service(_batch.ids, _db, _fields)
+        return Response(serialise_batch(ReadIncident, items, missing, _fields),
+                        media_type='application/json')
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=str(e)) from e
@@ -48,25 +174,42 @@ async def create_incident_endpoint(
 
 @incidents_router.get(
     '/region/{_region_id}',
-    response_model=ReadIncident,
-    name="Retrieve A Single Incident",
+    response_model=List[ReadIncident],
+    name="Retrieve all incidents in a region",
     status_code=status.HTTP_200_OK
 )
 async def retrieve_all_incidents_in_a_region_endpoint(
     _region_id: UUID,
-    _db: Session = Depends(get_db)
-) -> ReadIncident:
+    _db: Session = Depends(get_read_db),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+    start: Optional[datetime] = Query(None, description=RANGE_DESCRIPTION),
+    end: Optional[datetime] = Query(None, description=RANGE_DESCRIPTION)
+) -> List[ReadIncident]:
     """The endpoint for reading incidents
 
     Args:
-        incident_id (str): The incident id
+        region_id (str): The region id
         db (Session): The database session
+        fields (Optional[str]): The fields to return. Defaults to all.
+        start (Optional[datetime]): Only incidents created from then on
+        end (Optional[datetime]): Only incidents created before then
 
     Returns:
-        ReadIncident: The incident data
+        List[ReadIncident]: The incident data
     """
     try:
-        return await retrieve_all_incidents_in_a_region_service(_region_id, _db)
+        _fields = parse_fields(fields, INCIDENT_FIELDS)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=str(e)) from e
+
+    try:
+        result = await retrieve_all_incidents_in_a_region_service(
+            _region_id, _db, _fields, start, end)
+        if _fields:
+            return Response(serialise_many(ReadIncident, result, _fields),
+                            media_type='application/json')
+        return result
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=str(e)) from e
@@ -80,19 +223,36 @@ async def retrieve_all_incidents_in_a_region_endpoint(
 )
 async def retrieve_all_incidents_in_a_store_endpoint(
     _store_id: UUID,
-    _db: Session = Depends(get_db)
+    _db: Session = Depends(get_read_db),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+    start: Optional[datetime] = Query(None, description=RANGE_DESCRIPTION),
+    end: Optional[datetime] = Query(None, description=RANGE_DESCRIPTION)
 ) -> List[ReadIncident]:
     """The endpoint for reading incidents
 
     Args:
         store_id (str): The store id
         db (Session): The database session
+        fields (Optional[str]): The fields to return. Defaults to all.
+        start (Optional[datetime]): Only incidents created from then on
+        end (Optional[datetime]): Only incidents created before then
 
     Returns:
         List[ReadIncident]: The incident data
     """
     try:
-        return await retrieve_all_incidents_in_a_store_service(_store_id, _db)
+        _fields = parse_fields(fields, INCIDENT_FIELDS)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=str(e)) from e
+
+    try:
+        result = await retrieve_all_incidents_in_a_store_service(
+            _store_id, _db, _fields, start, end)
+        if _fields:
+            return Response(serialise_many(ReadIncident, result, _fields),
+                            media_type='application/json')
+        return result
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=str(e)) from e
@@ -106,20 +266,36 @@ async def retrieve_all_incidents_in_a_store_endpoint(
 )
 async def retrieve_all_incidents_in_a_store_section_endpoint(
     _store_section_id: UUID,
-    _db: Session = Depends(get_db)
+    _db: Session = Depends(get_read_db),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+    start: Optional[datetime] = Query(None, description=RANGE_DESCRIPTION),
+    end: Optional[datetime] = Query(None, description=RANGE_DESCRIPTION)
 ) -> List[ReadIncident]:
     """The endpoint for reading incidents
 
     Args:
         store_section_id (str): The store section id
         db (Session): The database session
+        fields (Optional[str]): The fields to return. Defaults to all.
+        start (Optional[datetime]): Only incidents created from then on
+        end (Optional[datetime]): Only incidents created before then
 
     Returns:
         List[ReadIncident]: The incident data
     """
     try:
-        return await retrieve_all_incidents_in_a_store_section_service(
-            _store_section_id, _db)
+        _fields = parse_fields(fields, INCIDENT_FIELDS)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=str(e)) from e
+
+    try:
+        result = await retrieve_all_incidents_in_a_store_section_service(
+            _store_section_id, _db, _fields, start, end)
+        if _fields:
+            return Response(serialise_many(ReadIncident, result, _fields),
+                            media_type='application/json')
+        return result
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=str(e)) from e
@@ -133,20 +309,95 @@ async def retrieve_all_incidents_in_a_store_section_endpoint(
 )
 async def retrieve_all_incidents_reported_by_an_employee_endpoint(
     _employee_id: str,
-    _db: Session = Depends(get_db)
+    _db: Session = Depends(get_read_db),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+    start: Optional[datetime] = Query(None, description=RANGE_DESCRIPTION),
+    end: Optional[datetime] = Query(None, description=RANGE_DESCRIPTION)
 ) -> List[ReadIncident]:
     """The endpoint for reading incidents
 
     Args:
         employee_id (str): The employee id
         db (Session): The database session
+        fields (Optional[str]): The fields to return. Defaults to all.
+        start (Optional[datetime]): Only incidents created from then on
+        end (Optional[datetime]): Only incidents created before then
 
     Returns:
         List[ReadIncident]: The incident data
     """
     try:
-        return await retrieve_all_incidents_reported_by_an_employee_service(
-            _employee_id, _db)
+        _fields = parse_fields(fields, INCIDENT_FIELDS)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=str(e)) from e
+
+    try:
+        result = await retrieve_all_incidents_reported_by_an_employee_service(
+            _employee_id, _db, _fields, start, end)
+        if _fields:
+            return Response(serialise_many(ReadIncident, result, _fields),
+                            media_type='application/json')
+        return result
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=str(e)) from e
+
+
+@incidents_router.get(
+    '/changes',
+    response_model=ChangeFeedResult[sparse_schema(ReadIncident, INCIDENT_FIELDS)],
+    name="Retrieve the incidents changed since a cursor",
+    status_code=status.HTTP_200_OK
+)
+async def retrieve_incidents_changes_endpoint(
+    since: Optional[int] = Query(None, ge=0, description=SINCE_DESCRIPTION),
+    limit: int = Query(500, ge=1, le=CHANGE_FEED_MAX_LIMIT),
+    region_id: Optional[UUID] = Query(None, description='Only the incidents of a region'),
+    store_id: Optional[UUID] = Query(None, description='Only the incidents of a store'),
+    store_section_id: Optional[UUID] = Query(
+        None, description='Only the incidents of a store section'),
+    _db: Session = Depends(get_db)
+) -> ChangeFeedResult[ReadIncident]:
+    """The endpoint returning the incidents changed since the last sync
+
+    Args:
+        since (Optional[int]): The cursor of the last sync. Defaults to the beginning.
+        limit (int): The most changes returned. Defaults to 500.
+        region_id (Optional[UUID]): Only the incidents of this region
+        store_id (Optional[UUID]): Only the incidents of this store
+        store_section_id (Optional[UUID]): Only the incidents of this section
+        _db (Session, optional): The database session. Defaults to Depends(get_db).
+
+    Raises:
+        HTTPException: A 422 error code is raised if more than one parent is
+            given, a 503 error code while the feed starts and a 400 error
+            code if something goes wrong
+
+    Returns:
+        ChangeFeedResult[ReadIncident]: The incidents created or updated, the ids
+            deleted and the cursor of the next sync
+    """
+    parents = [(column, parent_id) for column, parent_id in (
+        ('region_id', region_id), ('store_id', store_id),
+        ('store_section_id', store_section_id)) if parent_id is not None]
+    if len(parents) > 1:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail='Filter on one of region_id, store_id and '
+                                   'store_section_id at most')
+
+    try:
+        items, deleted, cursor, has_more = await retrieve_changes_service(
+            ChangedEntity.INCIDENT, since, limit, _db,
+            parents[0] if parents else None)
+        return Response(
+            serialise_changes(ReadIncident, items, deleted, cursor, has_more,
+                              INCIDENT_FIELDS),
+            media_type='application/json')
+    except ChangeFeedNotReady as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail=str(e),
+                            headers={'Retry-After': '1'}) from e
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=str(e)) from e
@@ -154,25 +405,40 @@ async def retrieve_all_incidents_reported_by_an_employee_endpoint(
 
 @incidents_router.get(
     '/{_incident_id}',
-    response_model=List[ReadIncident],
+    response_model=ReadIncident,
     name="Retrieve an incident",
     status_code=status.HTTP_200_OK
 )
 async def retrieve_an_incident_endpoint(
     _incident_id: UUID,
-    _db: Session = Depends(get_db)
-) -> List[ReadIncident]:
+    _db: Session = Depends(get_read_db),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
+) -> ReadIncident:
     """The endpoint for reading incidents
 
     Args:
         incident_id (str): The incident id
         db (Session): The database session
+        fields (Optional[str]): The fields to return. Defaults to all.
 
     Returns:
-        List[ReadIncident]: The incident data
+        ReadIncident: The incident data
     """
     try:
-        return await retrieve_a_single_incident_service(_incident_id, _db)
+        _fields = parse_fields(fields, INCIDENT_FIELDS)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=str(e)) from e
+
+    try:
+        result = await retrieve_a_single_incident_service(
+            _incident_id, _db, _fields)
+        if _fields:
+            if result is None:
+                raise LookupError('Incident not found')
+            return Response(serialise_one(ReadIncident, result, _fields),
+                            media_type='application/json')
+        return result
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=str(e)) from e
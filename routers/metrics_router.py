@@ -0,0 +1,50 @@
+"""The router file for the runtime metrics"""
+from fastapi import APIRouter, status
+
+from database.db import replica_lag_monitor
+from database.slow_query_log import slow_query_log
+from middleware.admission_control import admission_controller
+
+from services.auth_services import token_cache
+from services.cache_services import hierarchy_cache, region_summary_cache
+from services.change_feed_services import change_watermark
+from services.incident_feed_services import incident_feed_broker
+from services.incident_ingestion_services import incident_ingestion_queue
+from services.incident_snapshot_services import incident_snapshots
+from services.password_services import password_hasher
+from services.profiler_services import profile_store
+from services.report_services import report_jobs
+from services.tracing_services import span_exporter
+from services.warmup_services import warm_up
+
+metrics_router = APIRouter(prefix='/metrics', tags=['Metrics'])
+
+
+@metrics_router.get(
+    '/',
+    description='Retrieves the runtime metrics of this worker',
+    status_code=status.HTTP_200_OK
+)
+async def retrieve_metrics_endpoint() -> dict:
+    """The endpoint to read the in-process metrics
+
+    Returns:
+        dict: The metrics grouped by component
+    """
+    return {
+        'incident_ingestion': incident_ingestion_queue.metrics(),
+        'incident_feed': incident_feed_broker.metrics(),
+        'region_summary_cache': region_summary_cache.metrics(),
+        'hierarchy_cache': hierarchy_cache.metrics(),
+        'read_replica': replica_lag_monitor.metrics(),
+        'admission_control': admission_controller.metrics(),
+        'report_jobs': report_jobs.metrics(),
+        'incident_snapshots': incident_snapshots.metrics(),
+        'profiler': profile_store.metrics(),
+        'slow_queries': slow_query_log.metrics(),
+        'tracing': span_exporter.metrics(),
+        'warm_up': warm_up.metrics(),
+        'token_cache': token_cache.metrics(),
+        'password_hasher': password_hasher.metrics(),
+        'change_feed': change_watermark.metrics()
+    }
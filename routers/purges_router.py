@@ -0,0 +1,61 @@
+"""The router file for the background purges of large subtrees"""
+from uuid import UUID
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import JSONResponse
+from sqlalchemy.orm import Session
+
+from database.db import get_db
+from models.models import PurgeJobs
+from schemas.purges_schema import ReadPurgeJob
+from services.purge_services import retrieve_purge_job_service
+
+purges_router = APIRouter(prefix='/purges', tags=['Purges'])
+
+# Documents the answer of a delete whose subtree is purged in the background
+PURGE_ACCEPTED = {status.HTTP_202_ACCEPTED: {
+    'model': ReadPurgeJob,
+    'description': 'The subtree is large, it is purged in the background'}}
+
+
+def purge_accepted(_job: PurgeJobs) -> JSONResponse:
+    """The response of a delete handed over to a purge job
+
+    Args:
+        _job (PurgeJobs): The purge job
+
+    Returns:
+        JSONResponse: A 202 with the job and where to poll it
+    """
+    return JSONResponse(
+        status_code=status.HTTP_202_ACCEPTED,
+        content=ReadPurgeJob.model_validate(_job).model_dump(mode='json'),
+        headers={'Location': f'{purges_router.prefix}/{_job.job_id}'})
+
+
+@purges_router.get(
+    '/{_job_id}',
+    description='Retrieves the progress of a purge job',
+    status_code=status.HTTP_200_OK
+)
+async def retrieve_purge_job_endpoint(
+    _job_id: UUID,
+    _db: Session = Depends(get_db)
+) -> ReadPurgeJob:
+    """The endpoint returning a purge job
+
+    Args:
+        _job_id (UUID): The id of the job
+        _db (Session, optional): The database session. Defaults to Depends(get_db).
+
+    Raises:
+        HTTPException: A 404 error code is raised if the job does not exist
+
+    Returns:
+        ReadPurgeJob: The job and its progress
+    """
+    job = await retrieve_purge_job_service(_job_id, _db)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail='Purge job not found')
+    return job
@@ -1,27 +1,42 @@
 """The routing file for the regions data"""
-from typing import List
+from typing import List, Optional
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
 
-from database.db import get_db
-from schemas.regions_schema import CreateRegion, ReadRegion, UpdateRegion
-from services.regions_service import (create_region_service,
+from database.db import get_db, get_read_db
+from routers.purges_router import PURGE_ACCEPTED, purge_accepted
+from schemas.changes_schema import (CHANGE_FEED_MAX_LIMIT, SINCE_DESCRIPTION,
+                                    ChangedEntity, ChangeFeedResult)
+from schemas.fieldsets_schema import (FIELDS_DESCRIPTION, parse_fields,
+                                     serialise_changes, serialise_many,
+                                     serialise_one, sparse_schema)
+from schemas.regions_schema import (CreateRegion, ReadRegion, RegionSummary,
+                                    UpdateRegion)
+from services.change_feed_services import (ChangeFeedNotReady,
+                                          retrieve_changes_service)
+from services.regions_service import (REGION_FIELDS, create_region_service,
                                       delete_region_service,
                                       retrieve_all_regions_service,
                                       retrieve_one_region_service,
+                                      retrieve_region_summary_service,
                                       update_region_service)
 
 regions_router = APIRouter(prefix='/regions', tags=['Regions'])
 
 
 @regions_router.get('/', description='Retrieves all regions', status_code=status.HTTP_200_OK)
-async def retrieve_all_regions_endpoint(_db: Session = Depends(get_db)) -> List[ReadRegion]:
+async def retrieve_all_regions_endpoint(
+    _db: Session = Depends(get_read_db),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
+) -> List[ReadRegion]:
     """The endpoint to get all regions
 
     Args:
-        _db (Session, optional): The database session. Defaults to Depends(get_db).
+        _db (Session, optional): The database session. Defaults to Depends(get_read_db).
+        fields (Optional[str]): The fields to return. Defaults to all.
 
     Raises:
         HTTPException: A 400 error code is raised if something goes wrong
@@ -30,12 +45,64 @@ async def retrieve_all_regions_endpoint(_db: Session = Depends(get_db)) -> List[
         List[ReadRegion]: A list of all the regions in the database
     """
     try:
-        return await retrieve_all_regions_service(_db)
+        _fields = parse_fields(fields, REGION_FIELDS)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=str(e)) from e
+
+    try:
+        result = await retrieve_all_regions_service(_db, _fields)
+        if _fields:
+            return Response(serialise_many(ReadRegion, result, _fields),
+                            media_type='application/json')
+        return result
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)) from e
 
 
+@regions_router.get(
+    '/changes',
+    response_model=ChangeFeedResult[sparse_schema(ReadRegion, REGION_FIELDS)],
+    description='Retrieves the regions changed since a cursor',
+    status_code=status.HTTP_200_OK
+)
+async def retrieve_regions_changes_endpoint(
+    since: Optional[int] = Query(None, ge=0, description=SINCE_DESCRIPTION),
+    limit: int = Query(500, ge=1, le=CHANGE_FEED_MAX_LIMIT),
+    _db: Session = Depends(get_db)
+) -> ChangeFeedResult[ReadRegion]:
+    """The endpoint returning the regions changed since the last sync
+
+    Args:
+        since (Optional[int]): The cursor of the last sync. Defaults to the beginning.
+        limit (int): The most changes returned. Defaults to 500.
+        _db (Session, optional): The database session. Defaults to Depends(get_db).
+
+    Raises:
+        HTTPException: A 503 error code is raised while the feed starts, a 400
+            error code if something goes wrong
+
+    Returns:
+        ChangeFeedResult[ReadRegion]: The regions created or updated, the ids
+            deleted and the cursor of the next sync
+    """
+    try:
+        items, deleted, cursor, has_more = await retrieve_changes_service(
+            ChangedEntity.REGION, since, limit, _db)
+        return Response(
+            serialise_changes(ReadRegion, items, deleted, cursor, has_more,
+                              REGION_FIELDS),
+            media_type='application/json')
+    except ChangeFeedNotReady as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail=str(e),
+                            headers={'Retry-After': '1'}) from e
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=str(e)) from e
+
+
 @regions_router.get(
     '/{_region_id}',
     description='Retrieves one region',
@@ -43,24 +110,69 @@ async def retrieve_all_regions_endpoint(_db: Session = Depends(get_db)) -> List[
 )
 async def retrieve_one_region_endpoint(
     _region_id: UUID,
-    _db: Session = Depends(get_db)
+    _db: Session = Depends(get_read_db),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
 ) -> ReadRegion:
     """The endpoint function to retrieve a specific region
 
     Args:
         region_id (str): The id of the region
-        _db (Session, optional): The database session. Defaults to Depends(get_db).
+        _db (Session, optional): The database session. Defaults to Depends(get_read_db).
+        fields (Optional[str]): The fields to return. Defaults to all.
 
     Returns:
         ReadRegion: The region retrieved
     """
     try:
-        return await retrieve_one_region_service(_region_id, _db)
+        _fields = parse_fields(fields, REGION_FIELDS)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=str(e)) from e
+
+    try:
+        result = await retrieve_one_region_service(_region_id, _db, _fields)
+        if _fields:
+            if result is None:
+                raise LookupError('Region not found')
+            return Response(serialise_one(ReadRegion, result, _fields),
+                            media_type='application/json')
+        return result
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail=str(e)) from e
 
 
+@regions_router.get(
+    '/{_region_id}/summary',
+    description='Retrieves the dashboard summary of a region',
+    status_code=status.HTTP_200_OK
+)
+async def retrieve_region_summary_endpoint(
+    _region_id: UUID,
+    _db: Session = Depends(get_read_db)
+) -> RegionSummary:
+    """The endpoint returning a region's totals, top stores and trend
+
+    Args:
+        _region_id (UUID): The id of the region
+        _db (Session, optional): The database session. Defaults to Depends(get_read_db).
+
+    Raises:
+        HTTPException: A 404 error code is raised if the region does not exist
+
+    Returns:
+        RegionSummary: The region summary
+    """
+    try:
+        return await retrieve_region_summary_service(_region_id, _db)
+    except LookupError as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=str(e)) from e
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)) from e
+
+
 @regions_router.post(
     '/',
     description='Creates a new region',
@@ -114,21 +226,29 @@ async def update_region_endpoint(
 
 @regions_router.delete(
     '/{_region_id}',
-    description='Deletes a region',
+    description='Deletes a region, a large one in the background',
+    response_model=None,
+    responses=PURGE_ACCEPTED,
     status_code=status.HTTP_204_NO_CONTENT
 )
 async def delete_region_endpoint(
     _region_id: UUID,
     _db: Session = Depends(get_db)
-) -> None:
+) -> Optional[JSONResponse]:
     """The endpoint to delete a region from the database
 
     Args:
         _region_id (str): The id of the region
         _db (Session, optional): A databases session. Defaults to Depends(get_db).
+
+    Returns:
+        Optional[JSONResponse]: The purge job of a large region
     """
     try:
-        return await delete_region_service(_region_id, _db)
+        job = await delete_region_service(_region_id, _db)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)) from e
+    if job is not None:
+        return purge_accepted(job)
+    return None
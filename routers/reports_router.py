@@ -0,0 +1,165 @@
+"""The router file for the asynchronous report jobs"""
+import os
+import re
+from typing import Optional, Tuple
+from uuid import UUID
+
+from fastapi import APIRouter, Header, HTTPException, Response, status
+from fastapi.responses import FileResponse
+
+from schemas.reports_schema import CreateReport, ReadReport, ReportStatus
+from services.report_services import (ReportQueueFull, create_report_service,
+                                      report_jobs, retrieve_report_service)
+
+reports_router = APIRouter(prefix='/reports', tags=['Reports'])
+
+REPORT_MEDIA_TYPE = 'application/gzip'
+
+_BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _byte_range(_header: str, _size: int) -> Optional[Tuple[int, int]]:
+    """The inclusive byte range asked for by a ``Range`` header
+
+    Args:
+        _header (str): The header's value
+        _size (int): The size of the file
+
+    Raises:
+        ValueError: The range cannot be satisfied
+
+    Returns:
+        Optional[Tuple[int, int]]: The first and last byte, or None when the
+            header is not a single byte range and the whole file is served
+    """
+    match = _BYTE_RANGE.match(_header.strip())
+    if match is None or match.groups() == ('', ''):
+        return None
+
+    first, last = match.groups()
+    if first == '':
+        # A suffix range, the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError('Empty suffix range')
+        return max(_size - length, 0), _size - 1
+
+    first = int(first)
+    last = min(int(last), _size - 1) if last else _size - 1
+    if first >= _size or first > last:
+        raise ValueError('Range not satisfiable')
+    return first, last
+
+
+async def _retrieve_report(_report_id: UUID) -> ReadReport:
+    report = await retrieve_report_service(_report_id)
+    if report is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail='Report not found')
+    return report
+
+
+@reports_router.post(
+    '/',
+    description='Queues a report, or returns the job of an identical request',
+    status_code=status.HTTP_202_ACCEPTED
+)
+async def create_report_endpoint(_parameters: CreateReport) -> ReadReport:
+    """The endpoint queueing a report job
+
+    Args:
+        _parameters (CreateReport): The report and its filters
+
+    Raises:
+        HTTPException: A 503 error code is raised if the queue is full
+        HTTPException: A 400 error code is raised if something goes wrong
+
+    Returns:
+        ReadReport: The job to poll
+    """
+    try:
+        return await create_report_service(_parameters)
+    except ReportQueueFull as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e),
+            headers={'Retry-After': '30'}) from e
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)) from e
+
+
+@reports_router.get(
+    '/{_report_id}',
+    description='Retrieves the status of a report job',
+    status_code=status.HTTP_200_OK
+)
+async def retrieve_report_endpoint(_report_id: UUID) -> ReadReport:
+    """The endpoint returning a report job
+
+    Args:
+        _report_id (UUID): The id of the job
+
+    Raises:
+        HTTPException: A 404 error code is raised if the job does not exist
+
+    Returns:
+        ReadReport: The job
+    """
+    return await _retrieve_report(_report_id)
+
+
+@reports_router.get(
+    '/{_report_id}/result',
+    description='Downloads the gzip compressed JSON result of a report, '
+                'supports single byte ranges',
+    status_code=status.HTTP_200_OK,
+    response_class=Response
+)
+async def retrieve_report_result_endpoint(
+    _report_id: UUID,
+    range_header: Optional[str] = Header(None, alias='Range')
+) -> Response:
+    """The endpoint serving the result of a finished report
+
+    Args:
+        _report_id (UUID): The id of the job
+        range_header (Optional[str]): The byte range to send, if any
+
+    Raises:
+        HTTPException: A 404 error code is raised if the job does not exist
+        HTTPException: A 409 error code is raised if the job is not done
+        HTTPException: A 416 error code is raised if the range is invalid
+
+    Returns:
+        Response: The whole result, or the requested part of it
+    """
+    report = await _retrieve_report(_report_id)
+    path = report_jobs.result_path(_report_id)
+    if report.status != ReportStatus.DONE or not os.path.exists(path):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f'The report is {report.status.value}')
+
+    size = os.path.getsize(path)
+    filename = f'report-{_report_id}.json.gz'
+    try:
+        byte_range = _byte_range(range_header, size) if range_header else None
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail=str(e), headers={'Content-Range': f'bytes */{size}'}) from e
+
+    if byte_range is None:
+        return FileResponse(path, media_type=REPORT_MEDIA_TYPE,
+                            filename=filename,
+                            headers={'Accept-Ranges': 'bytes'})
+
+    first, last = byte_range
+    with open(path, 'rb') as result:
+        result.seek(first)
+        content = result.read(last - first + 1)
+    return Response(
+        content, status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type=REPORT_MEDIA_TYPE,
+        headers={'Accept-Ranges': 'bytes',
+                 'Content-Range': f'bytes {first}-{last}/{size}'})
@@ -0,0 +1,114 @@
+"""The router file for the product sketches"""
+from uuid import UUID
+
+from fastapi import APIRouter, HTTPException, Query, status
+
+from schemas.sketches_schema import (DistinctProducts, ProductLoss,
+                                     StoreTopProducts)
+from services.product_sketch_services import (
+    rebuild_product_sketches_service, retrieve_distinct_products_service,
+    retrieve_product_loss_in_a_store_service,
+    retrieve_top_products_in_a_store_service)
+
+sketches_router = APIRouter(prefix='/sketches', tags=['Sketches'])
+
+
+@sketches_router.get(
+    '/stores/{_store_id}/top-products',
+    description='Retrieves the products with the highest loss value in a store',
+    status_code=status.HTTP_200_OK
+)
+async def retrieve_top_products_in_a_store_endpoint(
+    _store_id: UUID,
+    limit: int = Query(20, ge=1, le=100)
+) -> StoreTopProducts:
+    """The endpoint for the heavy hitter products of a store
+
+    Args:
+        _store_id (UUID): The id of the store
+        limit (int): The number of products returned
+
+    Returns:
+        StoreTopProducts: The ranked products with their error bounds
+    """
+    return await retrieve_top_products_in_a_store_service(_store_id, limit)
+
+
+@sketches_router.get(
+    '/stores/{_store_id}/products/{_product}',
+    description='Estimates the loss value of one product in a store',
+    status_code=status.HTTP_200_OK
+)
+async def retrieve_product_loss_in_a_store_endpoint(
+    _store_id: UUID,
+    _product: str
+) -> ProductLoss:
+    """The endpoint for the estimated loss value of a product
+
+    Args:
+        _store_id (UUID): The id of the store
+        _product (str): The product code or name
+
+    Returns:
+        ProductLoss: The estimate with its error bound
+    """
+    return await retrieve_product_loss_in_a_store_service(_store_id, _product)
+
+
+@sketches_router.get(
+    '/stores/{_store_id}/distinct-products',
+    description='Estimates the distinct products with incidents in a store',
+    status_code=status.HTTP_200_OK
+)
+async def retrieve_distinct_products_in_a_store_endpoint(
+    _store_id: UUID
+) -> DistinctProducts:
+    """The endpoint for the distinct product count of a store
+
+    Args:
+        _store_id (UUID): The id of the store
+
+    Returns:
+        DistinctProducts: The estimate with its relative standard error
+    """
+    return await retrieve_distinct_products_service('store', _store_id)
+
+
+@sketches_router.get(
+    '/regions/{_region_id}/distinct-products',
+    description='Estimates the distinct products with incidents in a region',
+    status_code=status.HTTP_200_OK
+)
+async def retrieve_distinct_products_in_a_region_endpoint(
+    _region_id: UUID
+) -> DistinctProducts:
+    """The endpoint for the distinct product count of a region
+
+    Args:
+        _region_id (UUID): The id of the region
+
+    Returns:
+        DistinctProducts: The estimate with its relative standard error
+    """
+    return await retrieve_distinct_products_service('region', _region_id)
+
+
+@sketches_router.post(
+    '/rebuild',
+    description='Rebuilds the sketches from the incidents table',
+    status_code=status.HTTP_200_OK
+)
+async def rebuild_product_sketches_endpoint() -> dict:
+    """The endpoint for rebuilding the sketches
+
+    Raises:
+        HTTPException: A 400 error code is raised if something goes wrong
+
+    Returns:
+        dict: The number of stores and regions sketched
+    """
+    try:
+        return await rebuild_product_sketches_service()
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)) from e
@@ -1,18 +1,30 @@
 """The router file for the store sections CRUD operations"""
-from typing import List
+from typing import List, Optional
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
 
-from database.db import get_db
+from database.db import get_db, get_read_db
+from routers.purges_router import PURGE_ACCEPTED, purge_accepted
+from schemas.batch_schema import BatchGet, BatchGetResult
+from schemas.changes_schema import (CHANGE_FEED_MAX_LIMIT, SINCE_DESCRIPTION,
+                                    ChangedEntity, ChangeFeedResult)
+from schemas.fieldsets_schema import (FIELDS_DESCRIPTION, parse_fields,
+                                     serialise_batch, serialise_changes,
+                                     serialise_many, serialise_one,
+                                     sparse_schema)
 from schemas.store_sections_schema import (CreateStoreSection,
                                            ReadStoreSection,
                                            UpdateStoreSection)
+from services.change_feed_services import (ChangeFeedNotReady,
+                                          retrieve_changes_service)
 from services.store_sections_services import (
-    create_store_section_service, delete_store_section_service,
+    STORE_SECTION_FIELDS, create_store_section_service, delete_store_section_service,
     retrieve_all_store_sections_from_a_store_service,
-    retrieve_single_store_section_service, update_store_section_service)
+    retrieve_single_store_section_service,
+    retrieve_store_sections_by_ids_service, update_store_section_service)
 
 store_sections_router = APIRouter(
     prefix='/store_sections', tags=['Store Sections'])
@@ -44,6 +56,87 @@ async def create_store_section_endpoint(
                             detail=str(e)) from e
 
 
+@store_sections_router.post(
+    '/batch-get',
+    response_model=BatchGetResult[ReadStoreSection],
+    name="Fetch many store sections",
+    status_code=status.HTTP_200_OK
+)
+async def batch_get_store_sections_endpoint(
+    _batch: BatchGet,
+    _db: Session = Depends(get_read_db),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
+) -> BatchGetResult[ReadStoreSection]:
+    """The endpoint for fetching many store sections by id in one query
+
+    Args:
+        _batch (BatchGet): The ids of the store sections
+        _db (Session): The database session
+        fields (Optional[str]): The fields to return. Defaults to all.
+
+    Returns:
+        BatchGetResult[ReadStoreSection]: The store sections found and the ids that were not
+    """
+    try:
+        _fields = parse_fields(fields, STORE_SECTION_FIELDS)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=str(e)) from e
+
+    try:
+        items, missing = await retrieve_store_sections_by_ids_service(_batch.ids, _db, _fields)
+        return Response(serialise_batch(ReadStoreSection, items, missing, _fields),
+                        media_type='application/json')
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=str(e)) from e
+
+
+@store_sections_router.get(
+    '/changes',
+    response_model=ChangeFeedResult[sparse_schema(ReadStoreSection, STORE_SECTION_FIELDS)],
+    name="Retrieve the store sections changed since a cursor",
+    status_code=status.HTTP_200_OK
+)
+async def retrieve_store_sections_changes_endpoint(
+    since: Optional[int] = Query(None, ge=0, description=SINCE_DESCRIPTION),
+    limit: int = Query(500, ge=1, le=CHANGE_FEED_MAX_LIMIT),
+    store_id: Optional[UUID] = Query(None, description='Only the sections of a store'),
+    _db: Session = Depends(get_db)
+) -> ChangeFeedResult[ReadStoreSection]:
+    """The endpoint returning the store sections changed since the last sync
+
+    Args:
+        since (Optional[int]): The cursor of the last sync. Defaults to the beginning.
+        limit (int): The most changes returned. Defaults to 500.
+        store_id (Optional[UUID]): Only the sections of this store
+        _db (Session, optional): The database session. Defaults to Depends(get_db).
+
+    Raises:
+        HTTPException: A 503 error code is raised while the feed starts, a 400
+            error code if something goes wrong
+
+    Returns:
+        ChangeFeedResult[ReadStoreSection]: The store sections created or updated, the ids
+            deleted and the cursor of the next sync
+    """
+    try:
+        items, deleted, cursor, has_more = await retrieve_changes_service(
+            ChangedEntity.STORE_SECTION, since, limit, _db,
+            ('store_id', store_id) if store_id is not None else None)
+        return Response(
+            serialise_changes(ReadStoreSection, items, deleted, cursor, has_more,
+                              STORE_SECTION_FIELDS),
+            media_type='application/json')
+    except ChangeFeedNotReady as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail=str(e),
+                            headers={'Retry-After': '1'}) from e
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=str(e)) from e
+
+
 @store_sections_router.get(
     '/{_store_section_id}',
     response_model=ReadStoreSection,
@@ -52,19 +145,34 @@ async def create_store_section_endpoint(
 )
 async def retrieve_single_store_section_endpoint(
         _store_section_id: UUID,
-        _db: Session = Depends(get_db)
+        _db: Session = Depends(get_read_db),
+        fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
 ) -> ReadStoreSection:
     """The endpoint for reading store sections
 
     Args:
         store_section_id (str): The store section id
         db (Session): The database session
+        fields (Optional[str]): The fields to return. Defaults to all.
 
     Returns:
         ReadStoreSection: The store section data
     """
     try:
-        return await retrieve_single_store_section_service(_store_section_id, _db)
+        _fields = parse_fields(fields, STORE_SECTION_FIELDS)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=str(e)) from e
+
+    try:
+        result = await retrieve_single_store_section_service(
+            _store_section_id, _db, _fields)
+        if _fields:
+            if result is None:
+                raise LookupError('Store section not found')
+            return Response(serialise_one(ReadStoreSection, result, _fields),
+                            media_type='application/json')
+        return result
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=str(e)) from e
@@ -78,19 +186,32 @@ async def retrieve_single_store_section_endpoint(
 )
 async def retrieve_all_store_sections_in_a_store_endpoint(
         _store_id: UUID,
-        _db: Session = Depends(get_db)
+        _db: Session = Depends(get_read_db),
+        fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
 ) -> List[ReadStoreSection]:
     """The endpoint for updating store sections
 
     Args:
         _store_id (str): The store id
         db (Session): The database session
+        fields (Optional[str]): The fields to return. Defaults to all.
 
     Returns:
         List[ReadStoreSection]: The list of store section data
     """
     try:
-        return await retrieve_all_store_sections_from_a_store_service(_store_id, _db)
+        _fields = parse_fields(fields, STORE_SECTION_FIELDS)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=str(e)) from e
+
+    try:
+        result = await retrieve_all_store_sections_from_a_store_service(
+            _store_id, _db, _fields)
+        if _fields:
+            return Response(serialise_many(ReadStoreSection, result, _fields),
+                            media_type='application/json')
+        return result
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=str(e)) from e
@@ -128,12 +249,13 @@ async def update_store_section_endpoint(
     '/{_store_section_id}',
     name="delete_store_section",
     response_model=None,
+    responses=PURGE_ACCEPTED,
     status_code=status.HTTP_204_NO_CONTENT
 )
 async def delete_store_section_endpoint(
         _store_section_id: UUID,
         _db: Session = Depends(get_db)
-) -> None:
+) -> Optional[JSONResponse]:
     """The endpoint for deleting store sections
 
     Args:
@@ -141,10 +263,13 @@ async def delete_store_section_endpoint(
         db (Session): The database session
 
     Returns:
-        None
+        Optional[JSONResponse]: The purge job of a large section
     """
     try:
-        return await delete_store_section_service(_store_section_id, _db)
+        job = await delete_store_section_service(_store_section_id, _db)
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=str(e)) from e
+    if job is not None:
+        return purge_accepted(job)
+    return None
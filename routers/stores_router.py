@@ -1,37 +1,258 @@
 """The router for the stores"""
-from typing import List
+from datetime import datetime
+from typing import List, Optional
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
 
-from database.db import get_db
-from schemas.stores_schema import ReadStore, CreateStore, UpdateStore
-from services.stores_services import (create_store_service,
+from database.db import get_db, get_read_db
+from routers.purges_router import PURGE_ACCEPTED, purge_accepted
+from schemas.batch_schema import BatchGet, BatchGetResult
+from schemas.changes_schema import (CHANGE_FEED_MAX_LIMIT, SINCE_DESCRIPTION,
+                                    ChangedEntity, ChangeFeedResult)
+from schemas.fieldsets_schema import (FIELDS_DESCRIPTION, parse_fields,
+                                     serialise_batch, serialise_changes,
+                                     serialise_many, serialise_one,
+                                     sparse_schema)
+from schemas.stores_schema import (DensityTile, NearbyStore, ReadStore,
+                                   CreateStore, StoreLocation, UpdateStore)
+from services.change_feed_services import (ChangeFeedNotReady,
+                                          retrieve_changes_service)
+from services.store_locations_services import (
+    retrieve_density_tile_service, retrieve_nearest_stores_service,
+    retrieve_stores_within_service)
+from services.stores_services import (STORE_FIELDS, create_store_service,
                                       delete_store_service,
                                       retrieve_all_stores_in_a_region_service,
                                       retrieve_one_store_service,
+                                      retrieve_stores_by_ids_service,
+                                      update_store_location_service,
                                       update_store_service)
 
 stores_router = APIRouter(prefix='/stores', tags=['Stores'])
 
+LATITUDE = Query(..., ge=-90, le=90, description='The latitude, in degrees')
+LONGITUDE = Query(..., ge=-180, le=180,
+                  description='The longitude, in degrees')
+
+
+@stores_router.post(
+    '/batch-get',
+    response_model=BatchGetResult[ReadStore],
+    name="Fetch many stores",
+    status_code=status.HTTP_200_OK
+)
+async def batch_get_stores_endpoint(
+    _batch: BatchGet,
+    _db: Session = Depends(get_read_db),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
+) -> BatchGetResult[ReadStore]:
+    """The endpoint for fetching many stores by id in one query
+
+    Args:
+        _batch (BatchGet): The ids of the stores
+        _db (Session): The database session
+        fields (Optional[str]): The fields to return. Defaults to all.
+
+    Returns:
+        BatchGetResult[ReadStore]: The stores found and the ids that were not
+    """
+    try:
+        _fields = parse_fields(fields, STORE_FIELDS)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=str(e)) from e
+
+    try:
+        items, missing = await retrieve_stores_by_ids_service(_batch.ids, _db, _fields)
+        return Response(serialise_batch(ReadStore, items, missing, _fields),
+                        media_type='application/json')
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=str(e)) from e
+
+
+@stores_router.get(
+    '/nearby',
+    description='Retrieves the stores within a distance of a point',
+    status_code=status.HTTP_200_OK
+)
+async def retrieve_stores_within_endpoint(
+    latitude: float = LATITUDE,
+    longitude: float = LONGITUDE,
+    radius_km: float = Query(..., gt=0, le=1000),
+    limit: int = Query(100, ge=1, le=1000),
+    _db: Session = Depends(get_read_db)
+) -> List[NearbyStore]:
+    """The endpoint for the stores around a point
+
+    Args:
+        latitude (float): The latitude of the point
+        longitude (float): The longitude of the point
+        radius_km (float): The distance, in kilometres
+        limit (int): The most stores returned. Defaults to 100.
+        _db (Session, optional): The database session. Defaults to Depends(get_read_db).
+
+    Returns:
+        List[NearbyStore]: The stores with their distance, the nearest first
+    """
+    try:
+        return await retrieve_stores_within_service(
+            latitude, longitude, radius_km, limit, _db)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)) from e
+
+
+@stores_router.get(
+    '/nearest',
+    description='Retrieves the k stores nearest to a point',
+    status_code=status.HTTP_200_OK
+)
+async def retrieve_nearest_stores_endpoint(
+    latitude: float = LATITUDE,
+    longitude: float = LONGITUDE,
+    k: int = Query(5, ge=1, le=100),
+    _db: Session = Depends(get_read_db)
+) -> List[NearbyStore]:
+    """The endpoint for the stores nearest to a point
+
+    Args:
+        latitude (float): The latitude of the point
+        longitude (float): The longitude of the point
+        k (int): The number of stores. Defaults to 5.
+        _db (Session, optional): The database session. Defaults to Depends(get_read_db).
+
+    Returns:
+        List[NearbyStore]: The stores with their distance, the nearest first
+    """
+    try:
+        return await retrieve_nearest_stores_service(
+            latitude, longitude, k, _db)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)) from e
+
+
+@stores_router.get(
+    '/density/{_z}/{_x}/{_y}',
+    description='Counts the incidents of the stores per cell of a map tile',
+    status_code=status.HTTP_200_OK
+)
+async def retrieve_density_tile_endpoint(
+    _z: int,
+    _x: int,
+    _y: int,
+    grid: int = Query(16, ge=1, le=64,
+                      description='The cells along each side of the tile'),
+    start: Optional[datetime] = Query(None),
+    end: Optional[datetime] = Query(None),
+    _db: Session = Depends(get_read_db)
+) -> DensityTile:
+    """The endpoint for the incident density grid of a map tile
+
+    Args:
+        _z (int): The zoom level
+        _x (int): The column of the tile
+        _y (int): The row of the tile
+        grid (int): The cells along each side of the tile. Defaults to 16.
+        start (Optional[datetime]): Only count incidents created from then
+        end (Optional[datetime]): Only count incidents created before then
+        _db (Session, optional): The database session. Defaults to Depends(get_read_db).
+
+    Raises:
+        HTTPException: A 422 error code is raised if the tile does not exist
+
+    Returns:
+        DensityTile: The cells holding at least one store
+    """
+    try:
+        return await retrieve_density_tile_service(
+            _z, _x, _y, grid, _db, start, end)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=str(e)) from e
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)) from e
+
+
+@stores_router.get(
+    '/changes',
+    response_model=ChangeFeedResult[sparse_schema(ReadStore, STORE_FIELDS)],
+    description='Retrieves the stores changed since a cursor',
+    status_code=status.HTTP_200_OK
+)
+async def retrieve_stores_changes_endpoint(
+    since: Optional[int] = Query(None, ge=0, description=SINCE_DESCRIPTION),
+    limit: int = Query(500, ge=1, le=CHANGE_FEED_MAX_LIMIT),
+    region_id: Optional[UUID] = Query(None, description='Only the stores of a region'),
+    _db: Session = Depends(get_db)
+) -> ChangeFeedResult[ReadStore]:
+    """The endpoint returning the stores changed since the last sync
+
+    Args:
+        since (Optional[int]): The cursor of the last sync. Defaults to the beginning.
+        limit (int): The most changes returned. Defaults to 500.
+        region_id (Optional[UUID]): Only the stores of this region
+        _db (Session, optional): The database session. Defaults to Depends(get_db).
+
+    Raises:
+        HTTPException: A 503 error code is raised while the feed starts, a 400
+            error code if something goes wrong
+
+    Returns:
+        ChangeFeedResult[ReadStore]: The stores created or updated, the ids
+            deleted and the cursor of the next sync
+    """
+    try:
+        items, deleted, cursor, has_more = await retrieve_changes_service(
+            ChangedEntity.STORE, since, limit, _db,
+            ('region_id', region_id) if region_id is not None else None)
+        return Response(
+            serialise_changes(ReadStore, items, deleted, cursor, has_more,
+                              STORE_FIELDS),
+            media_type='application/json')
+    except ChangeFeedNotReady as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail=str(e),
+                            headers={'Retry-After': '1'}) from e
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=str(e)) from e
+
 
 @stores_router.get('/region/{_region_id}', description='Retrieves all stores', status_code=status.HTTP_200_OK)
 async def retrieve_all_stores_in_a_region_endpoint(
-    _region_id: UUID, _db: Session = Depends(get_db)
+    _region_id: UUID,
+    _db: Session = Depends(get_read_db),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
 ) -> List[ReadStore]:
     """The endpoint to show all stores in a region
 
     Args:
         _region_id (UUID): The id of a region
-        _db (Session, optional): The database session. Defaults to Depends(get_db).
+        _db (Session, optional): The database session. Defaults to Depends(get_read_db).
+        fields (Optional[str]): The fields to return. Defaults to all.
 
     Returns:
         List[ReadStore]: A list of the stores
     """
     try:
-        return await retrieve_all_stores_in_a_region_service(
-            _region_id, _db)
+        _fields = parse_fields(fields, STORE_FIELDS)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=str(e)) from e
+
+    try:
+        result = await retrieve_all_stores_in_a_region_service(
+            _region_id, _db, _fields)
+        if _fields:
+            return Response(serialise_many(ReadStore, result, _fields),
+                            media_type='application/json')
+        return result
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)) from e
@@ -42,18 +263,35 @@ async def retrieve_all_stores_in_a_region_endpoint(
     description="Retrieves one store",
     status_code=status.HTTP_200_OK
 )
-async def retrieve_one_store_endpoint(_store_id: UUID, _db: Session = Depends(get_db)) -> ReadStore:
+async def retrieve_one_store_endpoint(
+    _store_id: UUID,
+    _db: Session = Depends(get_read_db),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
+) -> ReadStore:
     """The endpoint to show a specific store
 
     Args:
         store_id (UUID): The id of a store
         db (Session): The database session
+        fields (Optional[str]): The fields to return. Defaults to all.
 
     Returns:
         ReadStore: The store
     """
     try:
-        return await retrieve_one_store_service(_store_id, _db)
+        _fields = parse_fields(fields, STORE_FIELDS)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=str(e)) from e
+
+    try:
+        result = await retrieve_one_store_service(_store_id, _db, _fields)
+        if _fields:
+            if result is None:
+                raise LookupError('Store not found')
+            return Response(serialise_one(ReadStore, result, _fields),
+                            media_type='application/json')
+        return result
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail=str(e)) from e
@@ -110,20 +348,64 @@ async def update_store_endpoint(
         ) from e
 
 
+@stores_router.put(
+    "/{_store_id}/location",
+    description="Places a store on the map",
+    status_code=status.HTTP_202_ACCEPTED
+)
+async def update_store_location_endpoint(
+    _store_id: UUID,
+    _location: StoreLocation,
+    _db: Session = Depends(get_db)
+) -> ReadStore:
+    """The endpoint to set the coordinates of a store
+
+    Args:
+        _store_id (UUID): The id of the store
+        _location (StoreLocation): The coordinates of the store
+        _db (Session, optional): The database session. Defaults to Depends(get_db).
+
+    Raises:
+        HTTPException: A 404 error code is raised if the store does not exist
+
+    Returns:
+        ReadStore: The updated store
+    """
+    try:
+        store = await update_store_location_service(_store_id, _location, _db)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)) from e
+    if store is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail='Store not found')
+    return store
+
+
 @stores_router.delete(
     "/{_store_id}",
-    description="Deletes a store",
+    description="Deletes a store, a large one in the background",
+    response_model=None,
+    responses=PURGE_ACCEPTED,
     status_code=status.HTTP_204_NO_CONTENT
 )
-async def delete_store_endpoint(_store_id: UUID, _db: Session = Depends(get_db)) -> None:
+async def delete_store_endpoint(
+    _store_id: UUID, _db: Session = Depends(get_db)
+) -> Optional[JSONResponse]:
     """The endpoint to delete a store
 
     Args:
         store_id (UUID): The id of the store
         db (Session): The database session
+
+    Returns:
+        Optional[JSONResponse]: The purge job of a large store
     """
     try:
-        await delete_store_service(_store_id, _db)
+        job = await delete_store_service(_store_id, _db)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)) from e
+    if job is not None:
+        return purge_accepted(job)
+    return None
@@ -0,0 +1,49 @@
+"""The schema file for the incident rate anomalies"""
+from datetime import date, datetime
+from enum import Enum
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+
+class AnomalyLevel(str, Enum):
+    """The levels anomalies are detected at"""
+    STORE = 'store'
+    STORE_SECTION = 'store_section'
+
+
+class AnomalyMetric(str, Enum):
+    """The daily metrics anomalies are detected on"""
+    COUNT = 'count'
+    LOSS_VALUE = 'loss_value'
+
+
+class Anomaly(BaseModel):
+    """The schema for one anomalous day
+
+    Args:
+        BaseModel (Pydantic): The base class for all schemas
+    """
+    level: AnomalyLevel
+    metric: AnomalyMetric
+    store_id: str
+    store_section_id: Optional[str] = None
+    day: date
+    value: float
+    baseline_mean: float
+    baseline_std: float
+    z_score: float
+
+
+class AnomalyReport(BaseModel):
+    """The schema for the output of an anomaly job run
+
+    Args:
+        BaseModel (Pydantic): The base class for all schemas
+    """
+    computed_at: datetime
+    runtime_seconds: float
+    baseline_days: int
+    z_threshold: float
+    series: int
+    anomalies: List[Anomaly]
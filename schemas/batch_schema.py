@@ -0,0 +1,32 @@
+"""The schemas for the batch fetch endpoints"""
+import os
+from typing import Generic, List, TypeVar
+from uuid import UUID
+
+from dotenv import find_dotenv, load_dotenv
+from pydantic import BaseModel, Field
+
+load_dotenv(find_dotenv())
+
+BATCH_GET_MAX_IDS = int(os.environ.get('BATCH_GET_MAX_IDS', '1000'))
+
+ItemT = TypeVar('ItemT')
+
+
+class BatchGet(BaseModel):
+    """The schema of a batch fetch request
+
+    Args:
+        BaseModel (Pydantic): The base class for all schemas
+    """
+    ids: List[UUID] = Field(..., min_length=1, max_length=BATCH_GET_MAX_IDS)
+
+
+class BatchGetResult(BaseModel, Generic[ItemT]):
+    """The items found, in request order, and the ids that were not
+
+    Args:
+        BaseModel (Pydantic): The base class for all schemas
+    """
+    items: List[ItemT]
+    missing: List[UUID]
@@ -0,0 +1,37 @@
+"""The schemas for the incremental change feeds"""
+import os
+from enum import Enum
+from typing import Generic, List, TypeVar
+from uuid import UUID
+
+from dotenv import find_dotenv, load_dotenv
+from pydantic import BaseModel
+
+load_dotenv(find_dotenv())
+
+CHANGE_FEED_MAX_LIMIT = int(os.environ.get('CHANGE_FEED_MAX_LIMIT', '5000'))
+
+SINCE_DESCRIPTION = ('The cursor returned by the previous sync. Omitted, the '
+                     'feed starts from the beginning.')
+
+ItemT = TypeVar('ItemT')
+
+
+class ChangedEntity(str, Enum):
+    """The rows with a change feed"""
+    REGION = 'region'
+    STORE = 'store'
+    STORE_SECTION = 'store_section'
+    INCIDENT = 'incident'
+
+
+class ChangeFeedResult(BaseModel, Generic[ItemT]):
+    """The rows created or updated after a cursor and the ids deleted since
+
+    Args:
+        BaseModel (Pydantic): The base class for all schemas
+    """
+    items: List[ItemT]
+    deleted: List[UUID]
+    cursor: int
+    has_more: bool
@@ -0,0 +1,38 @@
+"""The schema file for the employees"""
+from datetime import datetime
+from uuid import UUID
+
+from pydantic import BaseModel, EmailStr, Field
+
+
+class EmployeeBase(BaseModel):
+    """The base schema for the employees data
+
+    Args:
+        BaseModel (Pydantic): The base class for the models
+    """
+    employee_name: str
+    employee_email: EmailStr
+
+
+class CreateEmployee(EmployeeBase):
+    """The schema used for registering employees
+
+    Args:
+        EmployeeBase (BaseModel): The base schema for the employees data
+    """
+    employee_password: str = Field(min_length=8)
+
+
+class ReadEmployee(EmployeeBase):
+    """The schema used for reading employees, never with their password
+
+    Args:
+        EmployeeBase (BaseModel): The base schema for the employees data
+    """
+    employee_id: UUID
+    created_at: datetime
+
+    class Config:
+        """Config subclass for reading employee data"""
+        from_attributes = True
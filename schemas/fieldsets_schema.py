@@ -0,0 +1,274 @@
+"""The helpers for sparse fieldsets on the read endpoints
+
+A ``?fields=`` parameter names the columns a client wants. The services then
+select only those columns, and the rows are serialised with a schema narrowed
+to the same fields, straight to JSON bytes by pydantic-core.
+"""
+from functools import lru_cache
+from typing import Any, Iterable, List, Optional, Sequence, Tuple, Type
+from uuid import UUID
+
+from pydantic import BaseModel, ConfigDict, TypeAdapter, create_model
+from sqlalchemy import Select, any_, bindparam, select
+from sqlalchemy.dialects.postgresql import ARRAY
+
+FIELDS_DESCRIPTION = 'A comma separated list of the fields to return'
+
+
+@lru_cache(maxsize=None)
+def selectable_fields(_schema: Type[BaseModel], _model: Any) -> Tuple[str, ...]:
+    """The schema fields that map onto a column of the model
+
+    Args:
+        _schema (Type[BaseModel]): The read schema
+        _model (Any): The SQLAlchemy model
+
+    Returns:
+        Tuple[str, ...]: The fields a client may ask for
+    """
+    columns = set(_model.__table__.columns.keys())
+    return tuple(field for field in _schema.model_fields if field in columns)
+
+
+def parse_fields(
+    _fields: Optional[str], _allowed: Tuple[str, ...]
+) -> Optional[Tuple[str, ...]]:
+    """Validates a ``?fields=`` value
+
+    Args:
+        _fields (Optional[str]): The comma separated field names
+        _allowed (Tuple[str, ...]): The fields that may be selected
+
+    Raises:
+        ValueError: A field is unknown or cannot be selected
+
+    Returns:
+        Optional[Tuple[str, ...]]: The requested fields in schema order, or
+            None when every field was requested
+    """
+    if not _fields:
+        return None
+
+    requested = {field.strip() for field in _fields.split(',') if field.strip()}
+    unknown = requested - set(_allowed)
+    if unknown:
+        raise ValueError(
+            f'Unknown fields: {", ".join(sorted(unknown))}. '
+            f'Allowed fields: {", ".join(_allowed)}')
+
+    return tuple(field for field in _allowed if field in requested)
+
+
+@lru_cache(maxsize=256)
+def sparse_schema(
+    _schema: Type[BaseModel], _fields: Optional[Tuple[str, ...]]
+) -> Type[BaseModel]:
+    """The read schema narrowed to the requested fields
+
+    Args:
+        _schema (Type[BaseModel]): The read schema
+        _fields (Optional[Tuple[str, ...]]): The requested fields
+
+    Returns:
+        Type[BaseModel]: A schema with only those fields
+    """
+    if _fields is None:
+        return _schema
+
+    return create_model(
+        f'{_schema.__name__}Sparse',
+        __config__=ConfigDict(from_attributes=True),
+        **{field: (_schema.model_fields[field].annotation,
+                   _schema.model_fields[field])
+           for field in _fields})
+
+
+_UUID_LIST = TypeAdapter(List[UUID])
+
+
+@lru_cache(maxsize=256)
+def _list_adapter(_schema: Type[BaseModel]) -> TypeAdapter:
+    return TypeAdapter(List[_schema])
+
+
+def build_serialisers(*_schemas: Type[BaseModel]) -> None:
+    """Builds the list serialisers of read schemas ahead of their first use
+
+    Args:
+        _schemas (Type[BaseModel]): The read schemas
+    """
+    for schema in _schemas:
+        _list_adapter(schema)
+
+
+def serialise_many(
+    _schema: Type[BaseModel],
+    _rows: Iterable[Any],
+    _fields: Optional[Tuple[str, ...]] = None
+) -> bytes:
+    """Serialises rows or ORM objects to a JSON array
+
+    Args:
+        _schema (Type[BaseModel]): The read schema
+        _rows (Iterable[Any]): The rows, mappings or ORM objects
+        _fields (Optional[Tuple[str, ...]]): The requested fields
+
+    Returns:
+        bytes: The JSON document
+    """
+    adapter = _list_adapter(sparse_schema(_schema, _fields))
+    return adapter.dump_json(
+        adapter.validate_python(list(_rows), from_attributes=True))
+
+
+def serialise_one(
+    _schema: Type[BaseModel],
+    _row: Any,
+    _fields: Optional[Tuple[str, ...]] = None
+) -> bytes:
+    """Serialises a row or ORM object to a JSON object
+
+    Args:
+        _schema (Type[BaseModel]): The read schema
+        _row (Any): The row, mapping or ORM object
+        _fields (Optional[Tuple[str, ...]]): The requested fields
+
+    Returns:
+        bytes: The JSON document
+    """
+    schema = sparse_schema(_schema, _fields)
+    return schema.model_validate(_row, from_attributes=True).model_dump_json() \
+        .encode()
+
+
+def serialise_batch(
+    _schema: Type[BaseModel],
+    _rows: Iterable[Any],
+    _missing: Sequence[UUID],
+    _fields: Optional[Tuple[str, ...]] = None
+) -> bytes:
+    """Serialises a batch fetch result to a JSON object
+
+    Args:
+        _schema (Type[BaseModel]): The read schema
+        _rows (Iterable[Any]): The rows or ORM objects found
+        _missing (Sequence[UUID]): The ids that were not found
+        _fields (Optional[Tuple[str, ...]]): The requested fields
+
+    Returns:
+        bytes: The JSON document
+    """
+    return b''.join((b'{"items":', serialise_many(_schema, _rows, _fields),
+                     b',"missing":', _UUID_LIST.dump_json(list(_missing)),
+                     b'}'))
+
+
+def serialise_changes(
+    _schema: Type[BaseModel],
+    _rows: Iterable[Any],
+    _deleted: Sequence[UUID],
+    _cursor: int,
+    _has_more: bool,
+    _fields: Optional[Tuple[str, ...]] = None
+) -> bytes:
+    """Serialises a page of a change feed to a JSON object
+
+    Args:
+        _schema (Type[BaseModel]): The read schema
+        _rows (Iterable[Any]): The rows created or updated
+        _deleted (Sequence[UUID]): The ids deleted
+        _cursor (int): The cursor of the next page
+        _has_more (bool): Whether more changes follow the cursor
+        _fields (Optional[Tuple[str, ...]]): The fields of the rows
+
+    Returns:
+        bytes: The JSON document
+    """
+    return b''.join((b'{"items":', serialise_many(_schema, _rows, _fields),
+                     b',"deleted":', _UUID_LIST.dump_json(list(_deleted)),
+                     b',"cursor":', str(_cursor).encode(),
+                     b',"has_more":', b'true' if _has_more else b'false',
+                     b'}'))
+
+
+def model_columns(_model: Any, _fields: Tuple[str, ...]) -> List[Any]:
+    """The model columns backing the requested fields
+
+    Args:
+        _model (Any): The SQLAlchemy model
+        _fields (Tuple[str, ...]): The requested fields
+
+    Returns:
+        List[Any]: The column attributes to select
+    """
+    return [getattr(_model, field) for field in _fields]
+
+
+@lru_cache(maxsize=256)
+def sparse_select(
+    _model: Any, _fields: Tuple[str, ...], _key: Optional[str] = None
+) -> Select:
+    """A cached statement selecting the requested fields by one column
+
+    The value is bound per call under the name of the key column, so every
+    request for the same fields reuses one statement and its compiled form.
+
+    Args:
+        _model (Any): The SQLAlchemy model
+        _fields (Tuple[str, ...]): The requested fields
+        _key (Optional[str]): The column filtered on, if any
+
+    Returns:
+        Select: The parameterised statement
+    """
+    statement = select(*model_columns(_model, _fields))
+    if _key is None:
+        return statement
+    return statement.where(getattr(_model, _key) == bindparam(_key))
+
+
+@lru_cache(maxsize=256)
+def batch_select(
+    _model: Any, _fields: Optional[Tuple[str, ...]], _key: str
+) -> Select:
+    """A cached statement fetching many rows by id in one round trip
+
+    The ids are bound as one array under ``ids``. The key column is always
+    selected so the caller can tell which ids were not found.
+
+    Args:
+        _model (Any): The SQLAlchemy model
+        _fields (Optional[Tuple[str, ...]]): The requested fields, or None
+            for whole objects
+        _key (str): The id column
+
+    Returns:
+        Select: The parameterised statement
+    """
+    key = getattr(_model, _key)
+    if _fields is None:
+        statement = select(_model)
+    else:
+        statement = select(*model_columns(
+            _model, _fields if _key in _fields else (_key, *_fields)))
+    return statement.where(
+        key == any_(bindparam('ids', type_=ARRAY(key.type))))
+
+
+def order_batch(
+    _ids: Sequence[UUID], _rows: Iterable[Any], _key: str
+) -> Tuple[List[Any], List[UUID]]:
+    """Puts the rows in request order and lists the ids not found
+
+    Args:
+        _ids (Sequence[UUID]): The requested ids, possibly repeated
+        _rows (Iterable[Any]): The rows or ORM objects found
+        _key (str): The id attribute
+
+    Returns:
+        Tuple[List[Any], List[UUID]]: The rows found and the missing ids
+    """
+    found = {getattr(row, _key): row for row in _rows}
+    requested = list(dict.fromkeys(_ids))
+    return ([found[_id] for _id in requested if _id in found],
+            [_id for _id in requested if _id not in found])
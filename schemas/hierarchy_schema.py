@@ -0,0 +1,37 @@
+"""The schemas describing the region, store and store section tree"""
+from typing import List
+from uuid import UUID
+
+from pydantic import BaseModel
+
+
+class HierarchyStoreSection(BaseModel):
+    """A store section in the tree
+
+    Args:
+        BaseModel (Pydantic): The base class for all schemas
+    """
+    store_section_id: UUID
+    store_section_name: str
+
+
+class HierarchyStore(BaseModel):
+    """A store and its sections in the tree
+
+    Args:
+        BaseModel (Pydantic): The base class for all schemas
+    """
+    store_id: UUID
+    store_name: str
+    store_sections: List[HierarchyStoreSection]
+
+
+class HierarchyRegion(BaseModel):
+    """A region and its stores in the tree
+
+    Args:
+        BaseModel (Pydantic): The base class for all schemas
+    """
+    region_id: UUID
+    region_name: str
+    stores: List[HierarchyStore]
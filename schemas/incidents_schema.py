@@ -1,5 +1,6 @@
 """The schema file for incidents in the store"""
 from datetime import datetime
+from enum import Enum
 from typing import Optional
 from uuid import UUID
 
@@ -68,3 +69,20 @@ class UpdateIncident(BaseModel):
     class Config:
         """The subclass for reading data from the database"""
         from_attributes = True
+
+
+class QueuedIncident(BaseModel):
+    """The schema returned when an incident is queued for a buffered write
+
+    Args:
+        BaseModel (Pydantic): The base class for all schemas
+    """
+    incident_id: UUID
+    status: str = 'queued'
+
+
+class IncidentFeedScope(str, Enum):
+    """The objects a live incident feed can be subscribed to"""
+    REGION = 'region'
+    STORE = 'store'
+    STORE_SECTION = 'store_section'
@@ -34,4 +34,4 @@ class EmployeeTokenData(BaseModel):
 
     class Config:
         """The subclass for reading data from the database"""
-        orm_mode = True
+        from_attributes = True
@@ -0,0 +1,25 @@
+"""The schemas for the request profiles"""
+from datetime import datetime
+from typing import Optional
+from uuid import UUID
+
+from pydantic import BaseModel
+
+
+class ReadProfile(BaseModel):
+    """The schema describing a stored request profile
+
+    Args:
+        BaseModel (Pydantic): The base class for all schemas
+    """
+    profile_id: UUID
+    method: str
+    path: str
+    route: Optional[str] = None
+    status_code: Optional[int] = None
+    trigger: str
+    created_at: datetime
+    duration: float
+    samples: int
+    queries: int
+    query_seconds: float
@@ -0,0 +1,54 @@
+"""The schemas for the background purges of large subtrees"""
+from datetime import datetime
+from enum import Enum
+from typing import Optional
+from uuid import UUID
+
+from pydantic import BaseModel, computed_field
+
+
+class PurgeTarget(str, Enum):
+    """The rows whose subtree can be purged"""
+    REGION = 'region'
+    STORE = 'store'
+    STORE_SECTION = 'store_section'
+
+
+class PurgeStatus(str, Enum):
+    """The lifecycle of a purge job"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+class ReadPurgeJob(BaseModel):
+    """The schema describing a purge job
+
+    Args:
+        BaseModel (Pydantic): The base class for all schemas
+    """
+    job_id: UUID
+    target_type: PurgeTarget
+    target_id: UUID
+    status: PurgeStatus
+    total_incidents: Optional[int] = None
+    deleted_incidents: int
+    error: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    @computed_field
+    @property
+    def progress(self) -> Optional[float]:
+        """The share of the incidents deleted so far"""
+        if self.status == PurgeStatus.DONE:
+            return 1.0
+        if not self.total_incidents:
+            return None
+        return min(self.deleted_incidents / self.total_incidents, 1.0)
+
+    class Config:
+        """The subclass for reading data from the database"""
+        from_attributes = True
@@ -1,5 +1,5 @@
 """The schema file for regions"""
-from datetime import datetime
+from datetime import date, datetime
 from typing import List, Optional
 from uuid import UUID
 
@@ -55,3 +55,42 @@ class UpdateRegion(BaseModel):
     class Config:
         """The config subclass for reading data"""
         from_attributes = True
+
+
+class RegionStoreTotal(BaseModel):
+    """The schema for a store's incident totals in a region summary
+
+    Args:
+        BaseModel (Pydantic): The base class for all schemas
+    """
+    store_id: UUID
+    store_name: str
+    incident_count: int
+    loss_value: float
+
+
+class RegionTrendDay(BaseModel):
+    """The schema for one day of a region's incident trend
+
+    Args:
+        BaseModel (Pydantic): The base class for all schemas
+    """
+    day: date
+    incident_count: int
+    loss_value: float
+
+
+class RegionSummary(BaseModel):
+    """The schema for the dashboard summary of a region
+
+    Args:
+        BaseModel (Pydantic): The base class for all schemas
+    """
+    region_id: UUID
+    region_name: str
+    store_count: int
+    store_section_count: int
+    incident_count: int
+    loss_value: float
+    top_stores: List[RegionStoreTotal]
+    trend: List[RegionTrendDay]
@@ -0,0 +1,52 @@
+"""The schemas for the asynchronous report jobs"""
+from datetime import date, datetime
+from enum import Enum
+from typing import Optional
+from uuid import UUID
+
+from pydantic import BaseModel
+
+
+class ReportKind(str, Enum):
+    """The reports that can be requested"""
+    YEAR_OVER_YEAR_LOSS = 'year_over_year_loss'
+    STORE_LOSS = 'store_loss'
+    PRODUCT_LOSS = 'product_loss'
+
+
+class ReportStatus(str, Enum):
+    """The lifecycle of a report job"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+class CreateReport(BaseModel):
+    """The schema used to request a report
+
+    Args:
+        BaseModel (Pydantic): The base class for all schemas
+    """
+    kind: ReportKind
+    start: Optional[date] = None
+    end: Optional[date] = None
+    region_id: Optional[UUID] = None
+
+
+class ReadReport(BaseModel):
+    """The schema describing a report job
+
+    Args:
+        BaseModel (Pydantic): The base class for all schemas
+    """
+    report_id: UUID
+    parameters: CreateReport
+    status: ReportStatus
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    row_count: Optional[int] = None
+    size_bytes: Optional[int] = None
+    error: Optional[str] = None
+    result_url: Optional[str] = None
@@ -0,0 +1,58 @@
+"""The schema file for the product sketches"""
+from typing import List
+
+from pydantic import BaseModel
+
+
+class TopProduct(BaseModel):
+    """The schema for one product in a heavy hitter list
+
+    Args:
+        BaseModel (Pydantic): The base class for all schemas
+    """
+    product: str
+    loss_value: float
+    max_overestimate: float
+
+
+class StoreTopProducts(BaseModel):
+    """The schema for the products with the highest loss value in a store
+
+    Every product whose true loss exceeds ``guaranteed_threshold`` is listed,
+    and each listed loss overestimates the true loss by at most its
+    ``max_overestimate``.
+
+    Args:
+        BaseModel (Pydantic): The base class for all schemas
+    """
+    store_id: str
+    total_loss_value: float
+    products: List[TopProduct]
+    guaranteed_threshold: float
+    count_min_max_error: float
+    count_min_confidence: float
+
+
+class ProductLoss(BaseModel):
+    """The schema for the estimated loss value of a single product
+
+    Args:
+        BaseModel (Pydantic): The base class for all schemas
+    """
+    store_id: str
+    product: str
+    loss_value: float
+    max_overestimate: float
+    confidence: float
+
+
+class DistinctProducts(BaseModel):
+    """The schema for the estimated number of distinct products
+
+    Args:
+        BaseModel (Pydantic): The base class for all schemas
+    """
+    scope: str
+    scope_id: str
+    distinct_products: int
+    relative_standard_error: float
@@ -0,0 +1,39 @@
+"""The schemas for the slow-query log"""
+from datetime import datetime
+from typing import Any, Optional
+
+from pydantic import BaseModel, computed_field
+
+
+class SlowQuery(BaseModel):
+    """The schema describing a slow statement and its totals
+
+    Args:
+        BaseModel (Pydantic): The base class for all schemas
+    """
+    statement_id: str
+    service: Optional[str] = None
+    statement: str
+    parameters: Any = None
+    calls: int
+    total_seconds: float
+    max_seconds: float
+    last_seen: datetime
+    has_plan: bool
+    plan_seconds: Optional[float] = None
+    plan_captured_at: Optional[datetime] = None
+
+    @computed_field
+    @property
+    def mean_seconds(self) -> float:
+        """The average duration of the slow calls"""
+        return self.total_seconds / self.calls
+
+
+class SlowQueryPlan(SlowQuery):
+    """The schema of a slow statement with its last captured plan
+
+    Args:
+        SlowQuery (Pydantic): The statement and its totals
+    """
+    plan: Any = None
@@ -3,7 +3,7 @@ from datetime import datetime
 from typing import List, Optional
 from uuid import UUID
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 from schemas.incidents_schema import ReadIncident
 from schemas.store_sections_schema import ReadStoreSection
@@ -16,6 +16,8 @@ class StoreBase(BaseModel):
         BaseModel (Pydantic): The base class for all schemas
     """
     store_name: str
+    store_latitude: Optional[float] = Field(None, ge=-90, le=90)
+    store_longitude: Optional[float] = Field(None, ge=-180, le=180)
 
 
 class ReadStore(StoreBase):
@@ -56,3 +58,58 @@ class UpdateStore(BaseModel):
     class Config:
         """The config subclass for reading data"""
         from_attributes = True
+
+
+class StoreLocation(BaseModel):
+    """The schema used to place a store on the map
+
+    Args:
+        BaseModel (Pydantic): The base for all schemas
+    """
+    store_latitude: float = Field(ge=-90, le=90)
+    store_longitude: float = Field(ge=-180, le=180)
+
+
+class NearbyStore(StoreLocation):
+    """The schema of a store found around a point
+
+    Args:
+        StoreLocation (Pydantic): The location of the store
+    """
+    store_id: UUID
+    store_name: str
+    region_id: UUID
+    distance_meters: float
+
+    class Config:
+        """The config subclass for reading data"""
+        from_attributes = True
+
+
+class DensityCell(BaseModel):
+    """The incidents of the stores in one cell of a map tile
+
+    Args:
+        BaseModel (Pydantic): The base for all schemas
+    """
+    column: int
+    row: int
+    store_count: int
+    incident_count: int
+
+
+class DensityTile(BaseModel):
+    """The incident density grid of a map tile
+
+    Args:
+        BaseModel (Pydantic): The base for all schemas
+    """
+    z: int
+    x: int
+    y: int
+    grid: int
+    west: float
+    south: float
+    east: float
+    north: float
+    cells: List[DensityCell]
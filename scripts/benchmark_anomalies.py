@@ -0,0 +1,80 @@
+"""Times the anomaly scoring on synthetic daily incident counts
+
+Scores a stores x days and a sections x days matrix of Poisson counts with
+detect_anomalies, and times laying grouped section rows out as matrices,
+the step between the SQL totals and the scoring. Nothing is read from the
+database, but the services are imported, so DATABASE_URL must be set:
+
+    python -m scripts.benchmark_anomalies
+"""
+import argparse
+import statistics
+import time
+from datetime import date, timedelta
+from typing import Callable, Tuple
+
+import numpy as np
+
+from services.anomaly_services import _day_matrices, detect_anomalies
+
+STORES = 10000
+SECTIONS_PER_STORE = 8
+DAYS = 730
+GROUPED_DAYS = 120
+
+
+def timed(_call: Callable[[], object], _runs: int) -> Tuple[float, object]:
+    """The median seconds of a call and its last result"""
+    timings = []
+    for _ in range(_runs):
+        started = time.perf_counter()
+        result = _call()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), result
+
+
+def grouped_rows(_stores: int, _sections: int, _days: int, _start: date):
+    """One store, section, day, count and loss row per section and day"""
+    return [(f'store-{store}', f'section-{store}-{section}',
+             _start + timedelta(days=day), 3, 42.0)
+            for store in range(_stores) for section in range(_sections)
+            for day in range(_days)]
+
+
+def main() -> None:
+    """Builds the inputs and times the scoring"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stores', type=int, default=STORES)
+    parser.add_argument('--sections-per-store', type=int,
+                        default=SECTIONS_PER_STORE)
+    parser.add_argument('--days', type=int, default=DAYS)
+    parser.add_argument('--grouped-days', type=int, default=GROUPED_DAYS)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    generator = np.random.default_rng(0)
+    stores = generator.poisson(
+        5.0, (args.stores, args.days)).astype(np.float64)
+    sections = generator.poisson(
+        1.0, (args.stores * args.sections_per_store, args.days)) \
+        .astype(np.float64)
+    start = date.today() - timedelta(days=args.grouped_days - 1)
+    rows = grouped_rows(args.stores, 1, args.grouped_days, start)
+
+    results = {
+        f'detect_anomalies, {args.stores} stores x {args.days} days':
+            timed(lambda: detect_anomalies(stores, _min_value=3), args.runs),
+        f'detect_anomalies, {len(sections)} sections x {args.days} days':
+            timed(lambda: detect_anomalies(sections, _min_value=3), args.runs),
+        f'matrix build, {len(rows)} grouped rows':
+            timed(lambda: _day_matrices(rows, start, args.grouped_days),
+                  args.runs),
+    }
+
+    print(f'median of {args.runs} runs')
+    for name, (seconds, _) in results.items():
+        print(f'  {name:<52} {seconds:7.2f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Times the incidents of a store with all fields against a sparse fieldset
+
+Seeds a region, a store, a section and 5000 incidents with 1 KB
+descriptions into the database of DATABASE_URL, times GET
+/incidents/store/{id} with every field and with the fields a mobile client
+needs through the test client, then deletes what it seeded. Run it from the
+repository root on a throwaway database, with AUTH_REQUIRED off:
+
+    python -m scripts.benchmark_fieldsets
+"""
+import argparse
+import statistics
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Tuple
+
+from fastapi.testclient import TestClient
+from sqlalchemy import delete, insert
+
+from app.main import app
+from database.db import SessionLocal
+from models.models import Incidents, Regions, Stores, StoreSections
+
+INCIDENTS = 5000
+DESCRIPTION_BYTES = 1024
+MOBILE_FIELDS = 'incident_id,product_name,product_price,created_at'
+
+
+def seed(_incidents: int, _description_bytes: int) -> Tuple[uuid.UUID,
+                                                             uuid.UUID]:
+    """Inserts a region, a store, a section and the store's incidents
+
+    Returns:
+        Tuple[uuid.UUID, uuid.UUID]: The ids of the region and the store
+    """
+    now = datetime.now()
+    region_id, store_id, section_id = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    incidents = [{
+        'incident_id': uuid.uuid4(),
+        'incident_description': 'x' * _description_bytes,
+        'product_name': f'Product {i % 50}', 'product_code': f'P{i % 50:04d}',
+        'product_quantity': 1 + i % 5, 'product_price': 9.99,
+        'employee_id': 'benchmark', 'employee_name': 'Benchmark',
+        'employee_email': 'benchmark@example.com',
+        'created_at': now - timedelta(minutes=i),
+        'region_id': region_id, 'store_id': store_id,
+        'store_section_id': section_id} for i in range(_incidents)]
+    with SessionLocal() as _db:
+        _db.execute(insert(Regions), [{
+            'region_id': region_id, 'region_name': 'Benchmark',
+            'created_at': now}])
+        _db.execute(insert(Stores), [{
+            'store_id': store_id, 'store_name': 'Benchmark',
+            'region_id': region_id, 'created_at': now}])
+        _db.execute(insert(StoreSections), [{
+            'store_section_id': section_id, 'store_section_name': 'Benchmark',
+            'store_id': store_id, 'created_at': now}])
+        _db.execute(insert(Incidents), incidents)
+        _db.commit()
+    return region_id, store_id
+
+
+def unseed(_region_id: uuid.UUID) -> None:
+    """Deletes the seeded region, with everything in it cascading"""
+    with SessionLocal() as _db:
+        _db.execute(delete(Regions).where(Regions.region_id == _region_id))
+        _db.commit()
+
+
+def timed(_request: Callable, _runs: int) -> Tuple[float, int]:
+    """The median milliseconds of a request and the size of its body
+
+    Returns:
+        Tuple[float, int]: The median time and the body size in bytes
+    """
+    timings = []
+    for _ in range(_runs):
+        started = time.perf_counter()
+        response = _request()
+        timings.append((time.perf_counter() - started) * 1000)
+        response.raise_for_status()
+    return statistics.median(timings), len(response.content)
+
+
+def main() -> None:
+    """Seeds, benchmarks and cleans up"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--incidents', type=int, default=INCIDENTS)
+    parser.add_argument('--description-bytes', type=int,
+                        default=DESCRIPTION_BYTES)
+    parser.add_argument('--fields', default=MOBILE_FIELDS)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    region_id, store_id = seed(args.incidents, args.description_bytes)
+    path = f'/incidents/store/{store_id}'
+    try:
+        with TestClient(app) as client:
+            results = {
+                'all fields': timed(lambda: client.get(path), args.runs),
+                f'?fields={args.fields}': timed(
+                    lambda: client.get(path, params={'fields': args.fields}),
+                    args.runs),
+            }
+    finally:
+        unseed(region_id)
+
+    print(f'GET /incidents/store/{{id}}, {args.incidents} incidents with '
+          f'{args.description_bytes} byte descriptions, '
+          f'median of {args.runs} runs')
+    for name, (milliseconds, size) in results.items():
+        print(f'  {name:<60} {milliseconds:9.1f} ms  {size / 1e6:5.2f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Times the region, store and section tree against the nested regions list
+
+Seeds 20 regions, 5000 stores and 15000 store sections into the database of
+DATABASE_URL, times GET /regions/ (the nested ReadRegion response) and GET
+/hierarchy/ uncached and cached through the test client, then deletes what
+it seeded. Run it from the repository root on a throwaway database with no
+regions, and with AUTH_REQUIRED off:
+
+    python -m scripts.benchmark_hierarchy
+"""
+import argparse
+import statistics
+import time
+import uuid
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from fastapi.testclient import TestClient
+from sqlalchemy import delete, func, insert, select
+
+from app.main import app
+from database.db import SessionLocal
+from models.models import Regions, Stores, StoreSections
+from services.cache_services import hierarchy_cache
+
+REGIONS = 20
+STORES = 5000
+SECTIONS_PER_STORE = 3
+
+
+def seed(_regions: int, _stores: int, _sections: int) -> List[uuid.UUID]:
+    """Inserts the regions, their stores and the stores' sections
+
+    Returns:
+        List[uuid.UUID]: The ids of the regions seeded
+    """
+    now = datetime.now()
+    regions = [{'region_id': uuid.uuid4(), 'region_name': f'Region {i:02d}',
+                'created_at': now} for i in range(_regions)]
+    stores = [{'store_id': uuid.uuid4(), 'store_name': f'Store {i:05d}',
+               'region_id': regions[i % _regions]['region_id'],
+               'created_at': now} for i in range(_stores)]
+    sections = [{'store_section_id': uuid.uuid4(),
+                 'store_section_name': f'Section {j}',
+                 'store_id': store['store_id'], 'created_at': now}
+                for store in stores for j in range(_sections)]
+    with SessionLocal() as _db:
+        if _db.scalar(select(func.count()).select_from(Regions)):
+            raise SystemExit('The database already holds regions, use an '
+                             'empty one')
+        _db.execute(insert(Regions), regions)
+        _db.execute(insert(Stores), stores)
+        _db.execute(insert(StoreSections), sections)
+        _db.commit()
+    return [region['region_id'] for region in regions]
+
+
+def unseed(_region_ids: List[uuid.UUID]) -> None:
+    """Deletes the seeded regions, their stores and sections cascading"""
+    with SessionLocal() as _db:
+        _db.execute(delete(Regions).where(Regions.region_id.in_(_region_ids)))
+        _db.commit()
+
+
+def timed(_request: Callable, _runs: int) -> Tuple[float, int]:
+    """The median milliseconds of a request and the size of its body
+
+    Returns:
+        Tuple[float, int]: The median time and the body size in bytes
+    """
+    timings = []
+    for _ in range(_runs):
+        started = time.perf_counter()
+        response = _request()
+        timings.append((time.perf_counter() - started) * 1000)
+        response.raise_for_status()
+    return statistics.median(timings), len(response.content)
+
+
+def main() -> None:
+    """Seeds, benchmarks and cleans up"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--regions', type=int, default=REGIONS)
+    parser.add_argument('--stores', type=int, default=STORES)
+    parser.add_argument('--sections-per-store', type=int,
+                        default=SECTIONS_PER_STORE)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    region_ids = seed(args.regions, args.stores, args.sections_per_store)
+    try:
+        with TestClient(app) as client:
+            def uncached():
+                hierarchy_cache.clear()
+                return client.get('/hierarchy/')
+
+            results = {
+                'GET /regions/ (nested ReadRegion)': timed(
+                    lambda: client.get('/regions/'), args.runs),
+                'GET /hierarchy/ uncached': timed(uncached, args.runs),
+                'GET /hierarchy/ cached': timed(
+                    lambda: client.get('/hierarchy/'), args.runs),
+            }
+    finally:
+        unseed(region_ids)
+
+    print(f'{args.regions} regions, {args.stores} stores, '
+          f'{args.stores * args.sections_per_store} sections, '
+          f'median of {args.runs} runs')
+    for name, (milliseconds, size) in results.items():
+        print(f'  {name:<36} {milliseconds:9.1f} ms  {size / 1e6:5.2f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""Times a burst of concurrent logins and the liveness probe during it
+
+Seeds one employee into the database of DATABASE_URL, starts the app under
+uvicorn, fires concurrent logins at it while /health/live is probed every
+few milliseconds, then stops the server and deletes the employee. The
+logins per second show the hashing pool's throughput, the probe latency
+whether the event loop kept serving during the burst. Run it from the
+repository root; a throwaway SECRET_KEY is used when none is set:
+
+    python -m scripts.benchmark_login
+"""
+import argparse
+import asyncio
+import os
+import secrets
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from typing import List, Tuple
+
+import httpx
+from sqlalchemy import delete
+
+from database.db import SessionLocal
+from models.models import Employees
+from services.password_services import password_context
+
+CONCURRENCY = 32
+PROBE_INTERVAL = 0.02
+PASSWORD = 'benchmark-password'
+
+
+def seed() -> str:
+    """Inserts an employee to log in as
+
+    Returns:
+        str: The employee's email
+    """
+    email = f'benchmark-{uuid.uuid4().hex[:12]}@example.com'
+    with SessionLocal() as _db:
+        _db.add(Employees(employee_name='Benchmark', employee_email=email,
+                          hashed_password=password_context.hash(PASSWORD)))
+        _db.commit()
+    return email
+
+
+def unseed(_email: str) -> None:
+    """Deletes the seeded employee"""
+    with SessionLocal() as _db:
+        _db.execute(delete(Employees)
+                    .where(Employees.employee_email == _email))
+        _db.commit()
+
+
+def free_port() -> int:
+    """A port nothing listens on"""
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+async def wait_until_live(_client: httpx.AsyncClient, _timeout: float) -> None:
+    """Polls the liveness probe until the server answers"""
+    deadline = time.monotonic() + _timeout
+    while True:
+        try:
+            if (await _client.get('/health/live')).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        if time.monotonic() > deadline:
+            raise SystemExit('The server did not start')
+        await asyncio.sleep(0.1)
+
+
+async def burst(
+    _client: httpx.AsyncClient, _email: str, _logins: int, _interval: float
+) -> Tuple[float, List[int], List[float]]:
+    """Runs the concurrent logins while probing the liveness endpoint
+
+    Returns:
+        Tuple[float, List[int], List[float]]: The seconds the burst took, the
+            status code of every login and the probe latencies in ms
+    """
+    latencies: List[float] = []
+    done = asyncio.Event()
+
+    async def probe():
+        while not done.is_set():
+            started = time.perf_counter()
+            await _client.get('/health/live')
+            latencies.append((time.perf_counter() - started) * 1000)
+            await asyncio.sleep(_interval)
+
+    async def login():
+        response = await _client.post('/auth/login', json={
+            'employee_email': _email, 'employee_password': PASSWORD})
+        return response.status_code
+
+    prober = asyncio.create_task(probe())
+    started = time.perf_counter()
+    statuses = await asyncio.gather(*(login() for _ in range(_logins)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await prober
+    return elapsed, statuses, latencies
+
+
+async def run(_port: int, _email: str, _logins: int, _interval: float):
+    """Waits for the server and runs the burst against it"""
+    limits = httpx.Limits(max_connections=_logins + 1)
+    async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{_port}',
+                                 limits=limits, timeout=120) as client:
+        await wait_until_live(client, 30)
+        return await burst(client, _email, _logins, _interval)
+
+
+def main() -> None:
+    """Seeds, starts the server, benchmarks and cleans up"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY)
+    parser.add_argument('--probe-interval', type=float, default=PROBE_INTERVAL)
+    args = parser.parse_args()
+
+    port = free_port()
+    environment = {**os.environ,
+                   'SECRET_KEY': os.environ.get('SECRET_KEY')
+                   or secrets.token_hex(32)}
+    email = seed()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'app.main:app',
+         '--port', str(port), '--log-level', 'warning'], env=environment)
+    try:
+        elapsed, statuses, latencies = asyncio.run(
+            run(port, email, args.concurrency, args.probe_interval))
+    finally:
+        server.terminate()
+        server.wait()
+        unseed(email)
+
+    succeeded = statuses.count(200)
+    print(f'{args.concurrency} concurrent logins, /health/live probed every '
+          f'{args.probe_interval * 1000:.0f} ms')
+    print(f'  logins/s      {succeeded / elapsed:8.1f}  '
+          f'({succeeded} ok, {len(statuses) - succeeded} refused)')
+    print(f'  health p50    {statistics.median(latencies):8.1f} ms')
+    print(f'  health max    {max(latencies):8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
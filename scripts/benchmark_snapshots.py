@@ -0,0 +1,178 @@
+"""Times the per-section daily totals from SQL against the day snapshots
+
+Seeds 10M incidents over the closed days of the anomaly window, 119 by
+default, and 200 store sections into the database of DATABASE_URL. It times
+the per-section daily totals and the full anomaly job from Postgres alone,
+then exports the days into a temporary snapshot directory and times both
+again, cold and warm, from the snapshots plus SQL for the open day. It
+checks the totals and the anomalies are the same either way, then deletes
+what it seeded. Run it from the repository root on a throwaway database:
+
+    python -m scripts.benchmark_snapshots --incidents 1000000
+"""
+import argparse
+import shutil
+import statistics
+import tempfile
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from typing import Callable, List, Tuple
+
+from sqlalchemy import delete, insert, text
+
+from database.db import SessionLocal
+from models.models import Regions, Stores, StoreSections
+from services.anomaly_services import (ANOMALY_HISTORY_DAYS,
+                                       compute_anomaly_report)
+from services.incident_snapshot_services import (SNAPSHOT_HISTORY_DAYS,
+                                                 daily_section_totals,
+                                                 incident_snapshots)
+
+INCIDENTS = 10_000_000
+STORES = 20
+SECTIONS_PER_STORE = 10
+
+# Spreads the incidents evenly over the sections and the closed days
+INSERT_INCIDENTS = text("""
+INSERT INTO incidents (incident_id, incident_description, product_name,
+                       product_code, product_quantity, product_price,
+                       employee_id, employee_name, employee_email,
+                       created_at, region_id, store_id, store_section_id)
+SELECT gen_random_uuid(), 'Benchmark', 'Product', 'P0001', 1 + n % 5,
+       9.99 + n % 7, 'benchmark', 'Benchmark', 'benchmark@example.com',
+       CAST(:first AS timestamp) + (n % :days) * interval '1 day'
+           + (n % 86399) * interval '1 second',
+       :region_id, s.store_id, s.store_section_id
+FROM generate_series(0, :incidents - 1) AS n
+JOIN (SELECT store_id, store_section_id,
+             ROW_NUMBER() OVER (ORDER BY store_section_id) - 1 AS position
+      FROM store_sections
+      WHERE store_id = ANY(CAST(:store_ids AS uuid[]))) AS s
+  ON s.position = n % :sections
+""")
+# The seeded incidents were never served, so their deletes leave no tombstone
+SKIP_TOMBSTONES = text("SET LOCAL app.archiving = 'on'")
+
+
+def seed(_incidents: int, _stores: int, _sections: int,
+         _first: date, _days: int) -> uuid.UUID:
+    """Inserts a region, its stores and sections and the incidents
+
+    Returns:
+        uuid.UUID: The id of the region seeded
+    """
+    now = datetime.now()
+    region_id = uuid.uuid4()
+    stores = [{'store_id': uuid.uuid4(), 'store_name': f'Store {i:03d}',
+               'region_id': region_id, 'created_at': now}
+              for i in range(_stores)]
+    sections = [{'store_section_id': uuid.uuid4(),
+                 'store_section_name': f'Section {j}',
+                 'store_id': store['store_id'], 'created_at': now}
+                for store in stores for j in range(_sections)]
+    with SessionLocal() as _db:
+        _db.execute(insert(Regions), [{
+            'region_id': region_id, 'region_name': 'Benchmark',
+            'created_at': now}])
+        _db.execute(insert(Stores), stores)
+        _db.execute(insert(StoreSections), sections)
+        _db.execute(INSERT_INCIDENTS, {
+            'first': _first, 'days': _days, 'region_id': region_id,
+            'incidents': _incidents, 'sections': len(sections),
+            'store_ids': [str(store['store_id']) for store in stores]})
+        _db.commit()
+        _db.execute(text('ANALYZE incidents'))
+        _db.commit()
+    return region_id
+
+
+def unseed(_region_id: uuid.UUID) -> None:
+    """Deletes the seeded region, with everything in it cascading"""
+    with SessionLocal() as _db:
+        _db.execute(SKIP_TOMBSTONES)
+        _db.execute(delete(Regions).where(Regions.region_id == _region_id))
+        _db.commit()
+
+
+def timed(_call: Callable, _runs: int) -> Tuple[List[float], object]:
+    """The seconds of every run of a call and its last result"""
+    timings = []
+    for _ in range(_runs):
+        started = time.perf_counter()
+        result = _call()
+        timings.append(time.perf_counter() - started)
+    return timings, result
+
+
+def normalised(_rows: List[Tuple]) -> List[Tuple]:
+    """The totals in one form, whichever source they came from"""
+    return sorted((str(store_id), str(section_id), str(day)[:10], int(count),
+                   round(float(loss), 6))
+                  for store_id, section_id, day, count, loss in _rows)
+
+
+def anomalies(_report: dict) -> List[Tuple]:
+    """The anomalies of a report, without the times it was computed at"""
+    return sorted((anomaly['level'], anomaly['metric'],
+                   str(anomaly['store_id']), str(anomaly['store_section_id']),
+                   anomaly['day']) for anomaly in _report['anomalies'])
+
+
+def main() -> None:
+    """Seeds, benchmarks and cleans up"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--incidents', type=int, default=INCIDENTS)
+    parser.add_argument('--stores', type=int, default=STORES)
+    parser.add_argument('--sections-per-store', type=int,
+                        default=SECTIONS_PER_STORE)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    today = date.today()
+    days = min(SNAPSHOT_HISTORY_DAYS, ANOMALY_HISTORY_DAYS - 1)
+    first = today - timedelta(days=days)
+    incident_snapshots.path = tempfile.mkdtemp(prefix='snapshots-')
+
+    started = time.perf_counter()
+    region_id = seed(args.incidents, args.stores, args.sections_per_store,
+                     first, days)
+    seeded = time.perf_counter() - started
+    try:
+        with SessionLocal() as _db:
+            sql_totals, sql_rows = timed(
+                lambda: daily_section_totals(_db, first, today), args.runs)
+            sql_job, sql_report = timed(
+                lambda: compute_anomaly_report(_db, today), args.runs)
+
+            export, _ = timed(
+                lambda: incident_snapshots.build_missing(today), 1)
+
+            snapshot_totals, snapshot_rows = timed(
+                lambda: daily_section_totals(_db, first, today),
+                args.runs + 1)
+            snapshot_job, snapshot_report = timed(
+                lambda: compute_anomaly_report(_db, today), args.runs)
+    finally:
+        unseed(region_id)
+        shutil.rmtree(incident_snapshots.path, ignore_errors=True)
+
+    identical = (normalised(sql_rows) == normalised(snapshot_rows)
+                 and anomalies(sql_report) == anomalies(snapshot_report))
+    print(f'{args.incidents} incidents over {days} days, '
+          f'{args.stores * args.sections_per_store} sections, seeded in '
+          f'{seeded:.0f} s, median of {args.runs} runs')
+    for name, seconds in (
+            ('SQL per-section daily totals', statistics.median(sql_totals)),
+            ('snapshots + SQL for the open day, cold', snapshot_totals[0]),
+            ('snapshots + SQL for the open day, warm',
+             statistics.median(snapshot_totals[1:])),
+            ('anomaly job from SQL', statistics.median(sql_job)),
+            ('anomaly job from snapshots', statistics.median(snapshot_job)),
+            (f'initial export of {days} days', export[0])):
+        print(f'  {name:<44} {seconds:8.2f} s')
+    print(f'  totals and anomalies identical: {"yes" if identical else "NO"}')
+
+
+if __name__ == '__main__':
+    main()
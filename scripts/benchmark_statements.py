@@ -0,0 +1,160 @@
+"""Times the hot read services per call, and the part spent outside the DBAPI
+
+Seeds a region, a store, a section and a few incidents into the database of
+DATABASE_URL, calls every hot read service thousands of times on a single
+session, then deletes what it seeded. The time the cursor spends executing
+is summed through the engine's events, so the rest of a call is the Python
+overhead the cached statements cut. Pass --no-statement-cache to compile
+every statement again, and run it once with DATABASE_PREPARE_THRESHOLD=0 on
+a postgresql+psycopg:// url to see what the server side prepare saves:
+
+    python -m scripts.benchmark_statements
+"""
+import argparse
+import asyncio
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Tuple
+
+from sqlalchemy import delete, event, insert
+
+from database.db import SessionLocal, engine
+from models.models import Incidents, Regions, Stores, StoreSections
+from services.incidents_services import (
+    retrieve_a_single_incident_service,
+    retrieve_all_incidents_in_a_store_service)
+from services.regions_service import retrieve_one_region_service
+from services.store_sections_services import \
+    retrieve_all_store_sections_from_a_store_service
+from services.stores_services import retrieve_one_store_service
+
+CALLS = 3000
+INCIDENTS = 10
+
+
+class CursorTimer:
+    """Sums the seconds the cursor spends executing statements"""
+
+    def __init__(self) -> None:
+        self.seconds = 0.0
+        self._started = 0.0
+
+    def before(self, *_args) -> None:
+        self._started = time.perf_counter()
+
+    def after(self, *_args) -> None:
+        self.seconds += time.perf_counter() - self._started
+
+
+def seed(_incidents: int) -> Dict[str, uuid.UUID]:
+    """Inserts a region, a store, a section and the store's incidents
+
+    Returns:
+        Dict[str, uuid.UUID]: The id of each seeded row kind
+    """
+    now = datetime.now()
+    ids = {'region': uuid.uuid4(), 'store': uuid.uuid4(),
+           'section': uuid.uuid4(), 'incident': uuid.uuid4()}
+    incidents = [{
+        'incident_id': ids['incident'] if i == 0 else uuid.uuid4(),
+        'incident_description': 'Benchmark', 'product_name': 'Product',
+        'product_code': 'P0001', 'product_quantity': 1, 'product_price': 9.99,
+        'employee_id': 'benchmark', 'employee_name': 'Benchmark',
+        'employee_email': 'benchmark@example.com',
+        'created_at': now - timedelta(minutes=i),
+        'region_id': ids['region'], 'store_id': ids['store'],
+        'store_section_id': ids['section']} for i in range(_incidents)]
+    with SessionLocal() as _db:
+        _db.execute(insert(Regions), [{
+            'region_id': ids['region'], 'region_name': 'Benchmark',
+            'created_at': now}])
+        _db.execute(insert(Stores), [{
+            'store_id': ids['store'], 'store_name': 'Benchmark',
+            'region_id': ids['region'], 'created_at': now}])
+        _db.execute(insert(StoreSections), [{
+            'store_section_id': ids['section'],
+            'store_section_name': 'Benchmark', 'store_id': ids['store'],
+            'created_at': now}])
+        _db.execute(insert(Incidents), incidents)
+        _db.commit()
+    return ids
+
+
+def unseed(_region_id: uuid.UUID) -> None:
+    """Deletes the seeded region, with everything in it cascading"""
+    with SessionLocal() as _db:
+        _db.execute(delete(Regions).where(Regions.region_id == _region_id))
+        _db.commit()
+
+
+async def benchmark(
+    _ids: Dict[str, uuid.UUID], _calls: int, _statement_cache: bool
+) -> Dict[str, Tuple[float, float]]:
+    """The microseconds per call of every service, in all and in Python
+
+    Returns:
+        Dict[str, Tuple[float, float]]: The total and the non-DBAPI time
+    """
+    services = {
+        'incident by id': lambda _db: retrieve_a_single_incident_service(
+            _ids['incident'], _db),
+        'incidents in store': lambda _db:
+            retrieve_all_incidents_in_a_store_service(_ids['store'], _db),
+        'store by id': lambda _db: retrieve_one_store_service(
+            _ids['store'], _db),
+        'region by id': lambda _db: retrieve_one_region_service(
+            _ids['region'], _db),
+        'sections in store': lambda _db:
+            retrieve_all_store_sections_from_a_store_service(
+                _ids['store'], _db),
+    }
+    timer = CursorTimer()
+    event.listen(engine, 'before_cursor_execute', timer.before)
+    event.listen(engine, 'after_cursor_execute', timer.after)
+    results = {}
+    try:
+        with SessionLocal() as _db:
+            if not _statement_cache:
+                _db.connection(execution_options={'compiled_cache': None})
+            for name, service in services.items():
+                # Warms the caches, the pool and the server's plans up
+                for _ in range(50):
+                    await service(_db)
+                timer.seconds = 0.0
+                started = time.perf_counter()
+                for _ in range(_calls):
+                    await service(_db)
+                elapsed = time.perf_counter() - started
+                results[name] = (elapsed * 1e6 / _calls,
+                                 (elapsed - timer.seconds) * 1e6 / _calls)
+    finally:
+        event.remove(engine, 'before_cursor_execute', timer.before)
+        event.remove(engine, 'after_cursor_execute', timer.after)
+    return results
+
+
+def main() -> None:
+    """Seeds, benchmarks and cleans up"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=CALLS)
+    parser.add_argument('--incidents', type=int, default=INCIDENTS)
+    parser.add_argument('--no-statement-cache', action='store_true')
+    args = parser.parse_args()
+
+    ids = seed(args.incidents)
+    try:
+        results = asyncio.run(
+            benchmark(ids, args.calls, not args.no_statement_cache))
+    finally:
+        unseed(ids['region'])
+
+    print(f'{args.calls} calls per service on one session, statement cache '
+          f'{"off" if args.no_statement_cache else "on"}')
+    print(f'  {"":<20} {"per call":>10} {"python":>10}')
+    for name, (total, python) in results.items():
+        print(f'  {name:<20} {total:7.0f} us {python:7.0f} us')
+
+
+if __name__ == '__main__':
+    main()
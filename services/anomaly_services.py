@@ -0,0 +1,271 @@
+"""The file containing the incident rate anomaly detection
+
+Daily incident counts and loss values of every store section are read from
+the memory-mapped day snapshots, with only the days not exported yet grouped
+in Postgres, and laid out as a dense ``series x days`` matrix. The rolling
+baseline of every series is then computed at once with cumulative sums, so
+the job costs a handful of NumPy passes however many stores there are.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import find_dotenv, load_dotenv
+from sqlalchemy.orm import Session
+
+from database.db import read_session
+from schemas.anomalies_schema import AnomalyReport
+from services.incident_snapshot_services import daily_section_totals
+
+load_dotenv(find_dotenv())
+
+logger = logging.getLogger(__name__)
+
+ANOMALY_HISTORY_DAYS = int(os.environ.get('ANOMALY_HISTORY_DAYS', '120'))
+ANOMALY_BASELINE_DAYS = int(os.environ.get('ANOMALY_BASELINE_DAYS', '28'))
+ANOMALY_REPORT_DAYS = int(os.environ.get('ANOMALY_REPORT_DAYS', '7'))
+ANOMALY_Z_THRESHOLD = float(os.environ.get('ANOMALY_Z_THRESHOLD', '3'))
+ANOMALY_MIN_COUNT = int(os.environ.get('ANOMALY_MIN_COUNT', '3'))
+ANOMALY_INTERVAL = float(os.environ.get('ANOMALY_INTERVAL', '3600'))
+
+METRICS = ('count', 'loss_value')
+
+
+def rolling_baseline(
+    _values: np.ndarray, _window: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """The mean and standard deviation of the previous ``_window`` days
+
+    The current day is excluded from its own baseline. Days with less than a
+    full window of history get NaN.
+
+    Args:
+        _values (np.ndarray): A ``series x days`` matrix
+        _window (int): The number of days in the baseline
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The baseline mean and standard deviation
+    """
+    series, days = _values.shape
+    padded = np.zeros((series, days + 1))
+    squares = np.zeros((series, days + 1))
+    np.cumsum(_values, axis=1, out=padded[:, 1:])
+    np.cumsum(_values * _values, axis=1, out=squares[:, 1:])
+
+    mean = np.full(_values.shape, np.nan)
+    std = np.full(_values.shape, np.nan)
+    if days <= _window:
+        return mean, std
+
+    window_sum = padded[:, _window:-1] - padded[:, :-_window - 1]
+    window_squares = squares[:, _window:-1] - squares[:, :-_window - 1]
+    mean[:, _window:] = window_sum / _window
+    variance = window_squares / _window - mean[:, _window:] ** 2
+    std[:, _window:] = np.sqrt(np.maximum(variance, 0.0))
+    return mean, std
+
+
+def detect_anomalies(
+    _values: np.ndarray,
+    _window: int = ANOMALY_BASELINE_DAYS,
+    _threshold: float = ANOMALY_Z_THRESHOLD,
+    _min_value: float = 0.0
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Flags the days that spike above their own series' baseline
+
+    The standard deviation is floored at one, and at a tenth of the mean, so
+    quiet series do not alert on a single extra incident.
+
+    Args:
+        _values (np.ndarray): A ``series x days`` matrix
+        _window (int): The number of days in the baseline
+        _threshold (float): The z-score above which a day is anomalous
+        _min_value (float): The smallest value that can be anomalous
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: The anomaly
+            mask, z-scores, baseline means and baseline standard deviations
+    """
+    mean, std = rolling_baseline(_values, _window)
+    floor = np.maximum(std, np.maximum(1.0, 0.1 * np.abs(mean)))
+    with np.errstate(invalid='ignore'):
+        z_scores = (_values - mean) / floor
+        mask = (z_scores > _threshold) & (_values >= _min_value)
+    return mask, z_scores, mean, std
+
+
+def _day_matrices(
+    _rows: List[Tuple], _start: date, _days: int
+) -> Tuple[np.ndarray, np.ndarray, Dict[str, np.ndarray]]:
+    """Lays the grouped rows out as dense per section matrices
+
+    Args:
+        _rows (List[Tuple]): The store, section, day, count and loss rows
+        _start (date): The first day of the matrices
+        _days (int): The number of days in the matrices
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, Dict[str, np.ndarray]]: The store id and
+            section id of every series and a matrix per metric
+    """
+    if not _rows:
+        empty = np.zeros((0, _days))
+        return (np.array([], dtype=object), np.array([], dtype=object),
+                {metric: empty for metric in METRICS})
+
+    stores, sections, days, counts, losses = zip(*_rows)
+    keys = np.array([f'{store}|{section}' for store, section in zip(stores, sections)])
+    unique_keys, series_index = np.unique(keys, return_inverse=True)
+    day_index = (np.array([str(day)[:10] for day in days], dtype='datetime64[D]')
+                 - np.datetime64(_start, 'D')).astype(np.int64)
+
+    matrices = {}
+    for metric, values in zip(METRICS, (counts, losses)):
+        matrix = np.zeros((len(unique_keys), _days))
+        np.add.at(matrix, (series_index, day_index),
+                  np.asarray(values, dtype=np.float64))
+        matrices[metric] = matrix
+
+    split = np.char.partition(unique_keys.astype(str), '|')
+    return split[:, 0].astype(object), split[:, 2].astype(object), matrices
+
+
+def _roll_up_to_stores(
+    _store_ids: np.ndarray, _matrices: Dict[str, np.ndarray]
+) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """Sums the section series of every store into one store series"""
+    unique_stores, store_index = np.unique(_store_ids.astype(str),
+                                           return_inverse=True)
+    rolled = {}
+    for metric, matrix in _matrices.items():
+        store_matrix = np.zeros((len(unique_stores), matrix.shape[1]))
+        np.add.at(store_matrix, store_index, matrix)
+        rolled[metric] = store_matrix
+    return unique_stores.astype(object), rolled
+
+
+def compute_anomaly_report(_db: Session, _today: Optional[date] = None) -> Dict:
+    """Computes the store and store section anomalies in one pass
+
+    Args:
+        _db (Session): The database session
+        _today (Optional[date]): The last day considered. Defaults to today.
+
+    Returns:
+        Dict: The anomaly report
+    """
+    started = time.perf_counter()
+    today = _today or date.today()
+    start = today - timedelta(days=ANOMALY_HISTORY_DAYS - 1)
+    rows = daily_section_totals(_db, start, today)
+
+    store_ids, section_ids, section_matrices = _day_matrices(
+        rows, start, ANOMALY_HISTORY_DAYS)
+    stores, store_matrices = _roll_up_to_stores(store_ids, section_matrices)
+
+    anomalies = []
+    first_reported = ANOMALY_HISTORY_DAYS - ANOMALY_REPORT_DAYS
+    levels = (
+        ('store', stores, None, store_matrices),
+        ('store_section', store_ids, section_ids, section_matrices),
+    )
+    for level, level_store_ids, level_section_ids, matrices in levels:
+        for metric, matrix in matrices.items():
+            mask, z_scores, mean, std = detect_anomalies(
+                matrix, _min_value=ANOMALY_MIN_COUNT if metric == 'count' else 0.0)
+            mask[:, :first_reported] = False
+            for series, day_offset in zip(*np.nonzero(mask)):
+                anomalies.append({
+                    'level': level,
+                    'metric': metric,
+                    'store_id': level_store_ids[series],
+                    'store_section_id': (level_section_ids[series]
+                                         if level_section_ids is not None
+                                         else None),
+                    'day': start + timedelta(days=int(day_offset)),
+                    'value': float(matrix[series, day_offset]),
+                    'baseline_mean': float(mean[series, day_offset]),
+                    'baseline_std': float(std[series, day_offset]),
+                    'z_score': float(z_scores[series, day_offset])
+                })
+
+    anomalies.sort(key=lambda anomaly: anomaly['z_score'], reverse=True)
+    return {
+        'computed_at': datetime.now(),
+        'runtime_seconds': time.perf_counter() - started,
+        'baseline_days': ANOMALY_BASELINE_DAYS,
+        'z_threshold': ANOMALY_Z_THRESHOLD,
+        'series': len(store_ids),
+        'anomalies': anomalies
+    }
+
+
+_latest_report: Optional[Dict] = None
+_job: Optional[asyncio.Task] = None
+
+
+def _compute_with_new_session() -> Dict:
+    global _latest_report  # pylint: disable=global-statement
+
+    with read_session() as _db:
+        _latest_report = compute_anomaly_report(_db)
+    return _latest_report
+
+
+async def retrieve_anomalies_service(
+    _level: Optional[str] = None, _metric: Optional[str] = None
+) -> AnomalyReport:
+    """The service returning the anomalies of the latest run
+
+    Args:
+        _level (Optional[str]): Only keep store or store_section anomalies
+        _metric (Optional[str]): Only keep count or loss_value anomalies
+
+    Returns:
+        AnomalyReport: The latest report, computed now if there is none yet
+    """
+    report = _latest_report or await asyncio.to_thread(_compute_with_new_session)
+    anomalies = [
+        anomaly for anomaly in report['anomalies']
+        if (_level is None or anomaly['level'] == _level)
+        and (_metric is None or anomaly['metric'] == _metric)
+    ]
+    return {**report, 'anomalies': anomalies}
+
+
+async def recompute_anomalies_service() -> AnomalyReport:
+    """The service that reruns the anomaly job now
+
+    Returns:
+        AnomalyReport: The new report
+    """
+    return await asyncio.to_thread(_compute_with_new_session)
+
+
+async def _recompute_periodically() -> None:
+    while True:
+        try:
+            await asyncio.to_thread(_compute_with_new_session)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('The anomaly job failed')
+        await asyncio.sleep(ANOMALY_INTERVAL)
+
+
+async def start_anomaly_job() -> None:
+    """Starts the periodic anomaly job"""
+    global _job  # pylint: disable=global-statement
+
+    _job = asyncio.create_task(_recompute_periodically())
+
+
+async def stop_anomaly_job() -> None:
+    """Stops the periodic anomaly job"""
+    global _job  # pylint: disable=global-statement
+
+    if _job is not None:
+        _job.cancel()
+        _job = None
@@ -0,0 +1,461 @@
+"""The file containing the cold storage of old incidents
+
+Incidents older than ``ARCHIVE_AFTER_DAYS`` are moved, in small batches, into
+zstd compressed Parquet files partitioned by month and deleted from the hot
+table, so its indexes only cover the incidents the API serves day to day.
+
+Before the first batch is deleted the archive's watermark is raised to the
+cutoff. Reads reaching before the watermark combine the hot table with the
+archive and keep one copy of every incident, so a run that stops between
+writing a file and deleting its rows never loses or doubles anything.
+
+Run it with ``python -m services.archive_services``.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from dotenv import find_dotenv, load_dotenv
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from database.db import SessionLocal
+
+load_dotenv(find_dotenv())
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_PATH = os.environ.get('ARCHIVE_PATH', os.path.join('data', 'archive'))
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '730'))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', '5000'))
+# Leaves room between batches for autovacuum and the API's own writes
+ARCHIVE_BATCH_PAUSE = float(os.environ.get('ARCHIVE_BATCH_PAUSE', '0.1'))
+ARCHIVE_COMPRESSION = 'zstd'
+WATERMARK_FILE = '_watermark.json'
+
+ARCHIVE_SCHEMA = pa.schema([
+    ('incident_id', pa.string()),
+    ('incident_description', pa.string()),
+    ('product_name', pa.string()),
+    ('product_code', pa.string()),
+    ('product_quantity', pa.int32()),
+    ('product_price', pa.float64()),
+    ('employee_id', pa.string()),
+    ('employee_name', pa.string()),
+    ('employee_email', pa.string()),
+    ('created_at', pa.timestamp('us')),
+    ('updated_at', pa.timestamp('us')),
+    ('region_id', pa.string()),
+    ('store_id', pa.string()),
+    ('store_section_id', pa.string()),
+])
+UUID_COLUMNS = ('incident_id', 'region_id', 'store_id', 'store_section_id')
+
+# Skips the rows a request is updating, the next batch picks them up
+SELECT_ARCHIVABLE_INCIDENTS = text(f"""
+SELECT {', '.join(ARCHIVE_SCHEMA.names)}
+FROM incidents
+WHERE created_at < :cutoff
+ORDER BY created_at
+LIMIT :limit
+FOR UPDATE SKIP LOCKED
+""")
+# The listings filter the archive on one of these columns, or on none
+FILTER_COLUMNS = (None, 'region_id', 'store_id', 'store_section_id')
+SELECT_OLDEST_HOT_INCIDENT = {
+    column: text(f"""
+SELECT MIN(created_at)
+FROM incidents
+WHERE (CAST(:start AS timestamp) IS NULL OR created_at >= :start)
+  AND created_at < :end
+""" + (f'  AND {column} = CAST(:value AS uuid)\n' if column else ''))
+    for column in FILTER_COLUMNS}
+SELECT_HOT_INCIDENT_IDS = text("""
+SELECT incident_id FROM incidents WHERE incident_id = ANY(CAST(:ids AS uuid[]))
+""")
+# Archived incidents stay readable, so the change feeds get no tombstones
+SKIP_TOMBSTONES = text("SET LOCAL app.archiving = 'on'")
+DELETE_ARCHIVED_INCIDENTS = text("""
+DELETE FROM incidents WHERE incident_id = ANY(CAST(:ids AS uuid[]))
+""")
+
+
+def _watermark_path(_path: str = ARCHIVE_PATH) -> str:
+    return os.path.join(_path, WATERMARK_FILE)
+
+
+_watermark_cache: Tuple[Optional[float], Optional[datetime]] = (None, None)
+
+
+def archive_watermark(_path: str = ARCHIVE_PATH) -> Optional[datetime]:
+    """The time before which incidents may have been archived
+
+    Args:
+        _path (str): The archive directory
+
+    Returns:
+        Optional[datetime]: The watermark, or None when nothing was archived
+    """
+    global _watermark_cache  # pylint: disable=global-statement
+
+    try:
+        modified = os.stat(_watermark_path(_path)).st_mtime
+    except FileNotFoundError:
+        return None
+    if _watermark_cache[0] != modified:
+        with open(_watermark_path(_path), encoding='utf-8') as watermark:
+            _watermark_cache = (modified, datetime.fromisoformat(
+                json.load(watermark)['cutoff']))
+    return _watermark_cache[1]
+
+
+def _raise_watermark(_cutoff: datetime, _path: str = ARCHIVE_PATH) -> None:
+    current = archive_watermark(_path)
+    if current is not None and current >= _cutoff:
+        return
+    os.makedirs(_path, exist_ok=True)
+    temporary = f'{_watermark_path(_path)}.tmp'
+    with open(temporary, 'w', encoding='utf-8') as watermark:
+        json.dump({'cutoff': _cutoff.isoformat()}, watermark)
+        watermark.flush()
+        os.fsync(watermark.fileno())
+    os.replace(temporary, _watermark_path(_path))
+
+
+def reaches_archive(_start: Optional[datetime]) -> bool:
+    """Whether a range starting at ``_start`` needs the archive
+
+    Args:
+        _start (Optional[datetime]): The start of the range. None only
+            covers the hot table, which is all the API serves by default.
+
+    Returns:
+        bool: Whether archived incidents can fall in the range
+    """
+    watermark = archive_watermark()
+    return _start is not None and watermark is not None and _start < watermark
+
+
+def _drop_hot_incidents(
+    _db: Session,
+    _table: pa.Table,
+    _start: Optional[datetime],
+    _end: Optional[datetime],
+    _filters: Optional[Dict[str, Any]]
+) -> pa.Table:
+    """Drops the archived incidents still in the hot table
+
+    They are the ones a run has written but not deleted yet, or an
+    interrupted run left behind, and must not be counted twice. Being hot,
+    none is older than the oldest hot incident of the range, and as a run
+    archives the oldest first only its current batch is usually newer, so
+    only those are looked up. When no hot incident is left before the
+    watermark the table is returned as is.
+
+    Args:
+        _db (Session): The database session
+        _table (pa.Table): The archived incidents, with their ids
+        _start (Optional[datetime]): The first time included
+        _end (Optional[datetime]): The first time excluded
+        _filters (Optional[Dict[str, Any]]): The column the listing filters
+            on and its value, if any
+
+    Returns:
+        pa.Table: The incidents only the archive holds
+    """
+    watermark = archive_watermark()
+    if watermark is None or _table.num_rows == 0:
+        return _table
+    column, value = next(iter((_filters or {None: None}).items()))
+    oldest = _db.execute(SELECT_OLDEST_HOT_INCIDENT[column], {
+        'start': _start, 'value': None if value is None else str(value),
+        'end': watermark if _end is None else min(_end, watermark)}).scalar()
+    if oldest is None:
+        return _table
+
+    candidates = _table.filter(pc.greater_equal(
+        _table['created_at'], pa.scalar(oldest, pa.timestamp('us'))))
+    hot = [str(incident_id) for incident_id in _db.execute(
+        SELECT_HOT_INCIDENT_IDS,
+        {'ids': candidates['incident_id'].to_pylist()}).scalars()]
+    if not hot:
+        return _table
+    return _table.filter(pc.invert(pc.is_in(
+        _table['incident_id'], value_set=pa.array(hot, pa.string()))))
+
+
+def _write_month(_rows: List[Dict], _month: str,
+                 _path: str = ARCHIVE_PATH) -> None:
+    """Writes one batch's incidents of a month to a new Parquet file"""
+    directory = os.path.join(_path, f'month={_month}')
+    os.makedirs(directory, exist_ok=True)
+    name = f'part-{uuid.uuid4().hex}.parquet'
+    # Dot files are skipped by the readers until they are complete
+    temporary = os.path.join(directory, f'.{name}')
+    pq.write_table(pa.Table.from_pylist(_rows, schema=ARCHIVE_SCHEMA),
+                   temporary, compression=ARCHIVE_COMPRESSION)
+    with open(temporary, 'rb') as written:
+        os.fsync(written.fileno())
+    os.replace(temporary, os.path.join(directory, name))
+
+
+def archive_incidents(
+    _older_than_days: int = ARCHIVE_AFTER_DAYS,
+    _batch_size: int = ARCHIVE_BATCH_SIZE,
+    _pause: float = ARCHIVE_BATCH_PAUSE,
+    _path: str = ARCHIVE_PATH
+) -> int:
+    """Moves the incidents older than a number of days into the archive
+
+    Every batch is written to Parquet before its rows are deleted in their
+    own short transaction, so no lock is held for longer than one batch.
+
+    Args:
+        _older_than_days (int): The age from which incidents are archived
+        _batch_size (int): The incidents moved per transaction
+        _pause (float): The seconds slept between batches
+        _path (str): The archive directory
+
+    Returns:
+        int: The number of incidents archived
+    """
+    cutoff = datetime.combine(
+        date.today() - timedelta(days=_older_than_days), datetime.min.time())
+    _raise_watermark(cutoff, _path)
+
+    archived = 0
+    while True:
+        with SessionLocal() as _db:
+            rows = _db.execute(SELECT_ARCHIVABLE_INCIDENTS, {
+                'cutoff': cutoff, 'limit': _batch_size}).mappings().all()
+            if not rows:
+                break
+
+            months: Dict[str, List[Dict]] = {}
+            for row in rows:
+                row = {column: str(value) if column in UUID_COLUMNS
+                       and value is not None else value
+                       for column, value in row.items()}
+                months.setdefault(row['created_at'].strftime('%Y-%m'),
+                                  []).append(row)
+            for month, month_rows in months.items():
+                _write_month(month_rows, month, _path)
+
+            _db.execute(SKIP_TOMBSTONES)
+            _db.execute(DELETE_ARCHIVED_INCIDENTS, {'ids': [
+                row['incident_id'] for month_rows in months.values()
+                for row in month_rows]})
+            _db.commit()
+
+        archived += len(rows)
+        logger.info('Archived %s incidents older than %s', archived, cutoff)
+        time.sleep(_pause)
+    return archived
+
+
+def _months(_start: Optional[datetime], _end: Optional[datetime]):
+    """The partition filter of a range, so other months are not opened"""
+    expression = None
+    if _start is not None:
+        expression = ds.field('month') >= _start.strftime('%Y-%m')
+    if _end is not None:
+        upper = ds.field('month') <= _end.strftime('%Y-%m')
+        expression = upper if expression is None else expression & upper
+    return expression
+
+
+def read_archive(
+    _start: Optional[datetime] = None,
+    _end: Optional[datetime] = None,
+    _filters: Optional[Dict[str, Any]] = None,
+    _columns: Optional[Iterable[str]] = None,
+    _db: Optional[Session] = None,
+    _path: str = ARCHIVE_PATH
+) -> pa.Table:
+    """The archived incidents of a time range
+
+    Args:
+        _start (Optional[datetime]): The first time included
+        _end (Optional[datetime]): The first time excluded
+        _filters (Optional[Dict[str, Any]]): The column that must equal a
+            value, if any
+        _columns (Optional[Iterable[str]]): The columns read. Defaults to all.
+        _db (Optional[Session]): The database session, to leave out the
+            incidents still in the hot table
+        _path (str): The archive directory
+
+    Returns:
+        pa.Table: The incidents, one row per incident
+    """
+    columns = list(_columns or ARCHIVE_SCHEMA.names)
+    if not os.path.isdir(_path):
+        return ARCHIVE_SCHEMA.empty_table().select(columns)
+
+    dataset = ds.dataset(
+        _path, format='parquet', partitioning='hive',
+        schema=ARCHIVE_SCHEMA.append(pa.field('month', pa.string())),
+        ignore_prefixes=['.', '_'])
+    expression = _months(_start, _end)
+    conditions = []
+    if _start is not None:
+        conditions.append(ds.field('created_at') >= pa.scalar(
+            _start, pa.timestamp('us')))
+    if _end is not None:
+        conditions.append(ds.field('created_at') < pa.scalar(
+            _end, pa.timestamp('us')))
+    for column, value in (_filters or {}).items():
+        conditions.append(ds.field(column) == str(value))
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+
+    table = dataset.to_table(
+        columns=list(dict.fromkeys(columns + ['incident_id', 'created_at'])),
+        filter=expression)
+    if table.num_rows == 0:
+        return table.select(columns)
+
+    # A batch interrupted before its delete committed is archived twice
+    if pc.count_distinct(table['incident_id']).as_py() != table.num_rows:
+        first_rows = table.append_column(
+            'row', pa.array(range(table.num_rows), pa.int64())) \
+            .group_by('incident_id', use_threads=False) \
+            .aggregate([('row', 'min')])['row_min']
+        table = table.take(first_rows)
+    if _db is not None:
+        table = _drop_hot_incidents(_db, table, _start, _end, _filters)
+    return table.select(columns)
+
+
+def archived_incidents(
+    _db: Session,
+    _column: str,
+    _value: Any,
+    _start: Optional[datetime],
+    _end: Optional[datetime]
+) -> List[Dict]:
+    """The archived incidents matching a listing
+
+    Args:
+        _db (Session): The database session
+        _column (str): The column the listing filters on
+        _value (Any): The value of that column
+        _start (Optional[datetime]): The first time included
+        _end (Optional[datetime]): The first time excluded
+
+    Returns:
+        List[Dict]: The incidents no longer in the hot table, oldest first
+    """
+    table = read_archive(_start, _end, {_column: _value}, _db=_db)
+    return table.take(pc.sort_indices(
+        table, [('created_at', 'ascending')])).to_pylist()
+
+
+def archived_daily_section_totals(
+    _db: Session, _start: datetime, _end: datetime
+) -> List[Tuple]:
+    """The archived incident count and loss of every store section per day
+
+    Args:
+        _db (Session): The database session
+        _start (datetime): The first time included
+        _end (datetime): The first time excluded
+
+    Returns:
+        List[Tuple]: The store, section, day, count and loss of every
+            section that had archived incidents on a day
+    """
+    table = read_archive(_start, _end, _columns=(
+        'store_id', 'store_section_id', 'created_at', 'product_quantity',
+        'product_price'), _db=_db)
+    if table.num_rows == 0:
+        return []
+
+    table = table.append_column('day', pc.cast(
+        table['created_at'], pa.date32())).append_column(
+        'loss_value', pc.fill_null(pc.multiply(
+            table['product_price'],
+            pc.cast(table['product_quantity'], pa.float64())), 0.0))
+    totals = table.group_by(
+        ['store_id', 'store_section_id', 'day'], use_threads=False).aggregate(
+        [('created_at', 'count'), ('loss_value', 'sum')])
+    return list(zip(*(totals[column].to_pylist() for column in (
+        'store_id', 'store_section_id', 'day', 'created_at_count',
+        'loss_value_sum'))))
+
+
+def archived_report_facts(
+    _db: Session,
+    _start: Optional[datetime],
+    _end: Optional[datetime],
+    _region_id: Optional[Any]
+) -> Dict[str, List]:
+    """The archived incidents pre-aggregated for the reports
+
+    Args:
+        _db (Session): The database session
+        _start (Optional[datetime]): The first time included
+        _end (Optional[datetime]): The first time excluded
+        _region_id (Optional[Any]): Only this region, if set
+
+    Returns:
+        Dict[str, List]: A column of values per report fact, empty when the
+            range does not reach the archive
+    """
+    columns = ('region_id', 'store_id', 'product_code', 'product_name',
+               'year', 'incident_count', 'quantity', 'loss_value')
+    watermark = archive_watermark()
+    if watermark is None or (_start is not None and _start >= watermark):
+        return {column: [] for column in columns}
+
+    table = read_archive(_start, _end,
+                         {'region_id': _region_id} if _region_id else None,
+                         ('region_id', 'store_id', 'product_code',
+                          'product_name', 'created_at', 'product_quantity',
+                          'product_price'),
+                         _db)
+    if table.num_rows == 0:
+        return {column: [] for column in columns}
+
+    quantity = pc.cast(table['product_quantity'], pa.float64())
+    table = table.append_column('year', pc.year(table['created_at'])) \
+        .append_column('quantity', pc.fill_null(table['product_quantity'], 0)) \
+        .append_column('loss_value', pc.fill_null(
+            pc.multiply(table['product_price'], quantity), 0.0))
+    facts = table.group_by(
+        ['region_id', 'store_id', 'product_code', 'year'],
+        use_threads=False).aggregate([
+            ('product_name', 'min'), ('created_at', 'count'),
+            ('quantity', 'sum'), ('loss_value', 'sum')])
+    return {
+        'region_id': facts['region_id'].to_pylist(),
+        'store_id': facts['store_id'].to_pylist(),
+        'product_code': facts['product_code'].to_pylist(),
+        'product_name': facts['product_name_min'].to_pylist(),
+        'year': facts['year'].to_pylist(),
+        'incident_count': facts['created_at_count'].to_pylist(),
+        'quantity': facts['quantity_sum'].to_pylist(),
+        'loss_value': facts['loss_value_sum'].to_pylist(),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Moves old incidents into the Parquet archive')
+    parser.add_argument('--older-than-days', type=int,
+                        default=ARCHIVE_AFTER_DAYS)
+    parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE)
+    parser.add_argument('--pause', type=float, default=ARCHIVE_BATCH_PAUSE)
+    arguments = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    total = archive_incidents(arguments.older_than_days, arguments.batch_size,
+                              arguments.pause)
+    print(f'Archived {total} incidents')
@@ -0,0 +1,214 @@
+"""The file containing the employee authentication services
+
+Employees log in with their email and password and receive a signed JWT.
+Verifying a token checks its HS256 signature and expiry once: the decoded
+claims are then kept in a bounded cache keyed by the SHA-256 of the token,
+until the token expires or ``AUTH_TOKEN_CACHE_TTL`` elapses, so a request
+carrying a known token costs a hash and a dictionary lookup. No employee is
+loaded from the database to authenticate a request.
+"""
+import hashlib
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from uuid import UUID
+
+import jwt
+from dotenv import find_dotenv, load_dotenv
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from models.models import Employees
+from schemas.employees_schema import CreateEmployee, ReadEmployee
+from schemas.jwt_schemas import EmployeeLogin, EmployeeToken, EmployeeTokenData
+from services.cache_services import TTLCache
+from services.password_services import password_hasher
+
+load_dotenv(find_dotenv())
+
+SECRET_KEY = os.environ.get('SECRET_KEY')
+JWT_ALGORITHM = 'HS256'
+ACCESS_TOKEN_EXPIRE_MINUTES = float(
+    os.environ.get('ACCESS_TOKEN_EXPIRE_MINUTES', '30'))
+AUTH_TOKEN_CACHE_SIZE = int(os.environ.get('AUTH_TOKEN_CACHE_SIZE', '10000'))
+AUTH_TOKEN_CACHE_TTL = float(os.environ.get('AUTH_TOKEN_CACHE_TTL', '300'))
+AUTH_REQUIRED = os.environ.get('AUTH_REQUIRED', 'off') == 'on'
+
+# Without a secret no token can be signed, so every login would fail
+if AUTH_REQUIRED and not SECRET_KEY:
+    raise RuntimeError('SECRET_KEY must be set when AUTH_REQUIRED is on')
+
+token_cache = TTLCache(AUTH_TOKEN_CACHE_SIZE, AUTH_TOKEN_CACHE_TTL)
+
+SELECT_AN_EMPLOYEE = select(Employees) \
+    .where(Employees.employee_id == bindparam('employee_id'))
+SELECT_AN_EMPLOYEE_BY_EMAIL = select(Employees) \
+    .where(Employees.employee_email == bindparam('employee_email'))
+UPDATE_A_PASSWORD_HASH = update(Employees.__table__) \
+    .where(Employees.__table__.c.employee_id == bindparam('_employee_id')) \
+    .values(hashed_password=bindparam('_hashed_password'))
+
+
+class InvalidCredentials(Exception):
+    """Raised when an email and password do not match an employee"""
+
+
+class InvalidToken(Exception):
+    """Raised when a token is malformed, badly signed or expired"""
+
+
+class EmployeeExists(Exception):
+    """Raised when registering an email that is already taken"""
+
+
+class AuthNotConfigured(Exception):
+    """Raised when a token is signed or verified without a SECRET_KEY"""
+
+
+def _secret_key() -> str:
+    if not SECRET_KEY:
+        raise AuthNotConfigured('Logins are disabled, SECRET_KEY is not set')
+    return SECRET_KEY
+
+
+def create_access_token(_employee_id: UUID) -> str:
+    """Signs a token for an employee
+
+    Args:
+        _employee_id (UUID): The id of the employee
+
+    Raises:
+        AuthNotConfigured: No SECRET_KEY is set
+
+    Returns:
+        str: The encoded JWT
+    """
+    now = datetime.now(timezone.utc)
+    return jwt.encode({
+        'sub': str(_employee_id),
+        'iat': now,
+        'exp': now + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    }, _secret_key(), algorithm=JWT_ALGORITHM)
+
+
+def verify_access_token(_token: str) -> EmployeeTokenData:
+    """Verifies a token, from the cache when it was verified before
+
+    Args:
+        _token (str): The encoded JWT
+
+    Raises:
+        InvalidToken: The token is malformed, badly signed or expired
+        AuthNotConfigured: No SECRET_KEY is set
+
+    Returns:
+        EmployeeTokenData: The employee the token was issued to
+    """
+    key = hashlib.sha256(_token.encode()).digest()
+    claims = token_cache.get(key)
+    if claims is not None:
+        return claims
+
+    try:
+        payload = jwt.decode(_token, _secret_key(), algorithms=[JWT_ALGORITHM],
+                             options={'require': ['sub', 'exp']})
+    except jwt.PyJWTError as e:
+        raise InvalidToken(str(e)) from e
+
+    claims = EmployeeTokenData(id=payload['sub'])
+    # Never cached past the token's own expiry
+    token_cache.set(key, claims, payload['exp'] - time.time())
+    return claims
+
+
+async def register_employee_service(
+    _employee_data: CreateEmployee, _db: Session
+) -> ReadEmployee:
+    """The service function for registering employees
+
+    Args:
+        _employee_data (CreateEmployee): The employee and their password
+        _db (Session): The database session
+
+    Raises:
+        EmployeeExists: The email is already registered
+        PasswordHasherBusy: Too many passwords are being hashed at once
+
+    Returns:
+        ReadEmployee: The new employee
+    """
+    hashed_password = await password_hasher.hash(
+        _employee_data.employee_password)
+    employee = Employees(
+        **_employee_data.model_dump(exclude={'employee_password'}),
+        hashed_password=hashed_password)
+    _db.add(employee)
+    try:
+        _db.commit()
+    except IntegrityError as e:
+        _db.rollback()
+        raise EmployeeExists(
+            f'{_employee_data.employee_email} is already registered') from e
+    _db.refresh(employee)
+    return employee
+
+
+async def login_service(
+    _credentials: EmployeeLogin, _db: Session
+) -> EmployeeToken:
+    """The service function exchanging an email and password for a token
+
+    Args:
+        _credentials (EmployeeLogin): The email and password
+        _db (Session): The database session
+
+    Raises:
+        InvalidCredentials: No employee has this email and password
+        PasswordHasherBusy: Too many logins are being checked at once
+        AuthNotConfigured: No SECRET_KEY is set
+
+    Returns:
+        EmployeeToken: The bearer token
+    """
+    # Before the password is hashed, as no token could be signed anyway
+    _secret_key()
+    employee = _db.scalars(SELECT_AN_EMPLOYEE_BY_EMAIL, {
+        'employee_email': _credentials.employee_email}).first()
+    employee_id, hashed_password = (employee.employee_id,
+                                    employee.hashed_password) \
+        if employee is not None else (None, None)
+    # Hands the connection back to the pool for the slow check, so a burst of
+    # logins waiting for the hasher does not hold the whole pool
+    _db.rollback()
+
+    valid, new_hash = await password_hasher.verify_and_update(
+        _credentials.employee_password, hashed_password)
+    if not valid:
+        raise InvalidCredentials('Incorrect email or password')
+
+    if new_hash is not None:
+        # Hashed with an older cost factor, upgraded now the password is known
+        _db.execute(UPDATE_A_PASSWORD_HASH,
+                    {'_employee_id': employee_id, '_hashed_password': new_hash})
+        _db.commit()
+
+    return EmployeeToken(access_token=create_access_token(employee_id),
+                         token_type='bearer')
+
+
+async def retrieve_employee_service(
+    _employee_id: UUID, _db: Session
+) -> Optional[ReadEmployee]:
+    """The service function returning an employee
+
+    Args:
+        _employee_id (UUID): The id of the employee
+        _db (Session): The database session
+
+    Returns:
+        Optional[ReadEmployee]: The employee, if any
+    """
+    return _db.scalars(SELECT_AN_EMPLOYEE,
+                       {'employee_id': _employee_id}).first()
@@ -0,0 +1,117 @@
+"""The file containing the in-process response caches
+
+The caches are per worker. Writes invalidate the keys they affect in the
+worker that served them, and the TTL bounds how stale another worker's copy
+can get.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Iterable, Optional
+
+from dotenv import find_dotenv, load_dotenv
+
+load_dotenv(find_dotenv())
+
+REGION_SUMMARY_CACHE_TTL = float(
+    os.environ.get('REGION_SUMMARY_CACHE_TTL', '60'))
+REGION_SUMMARY_CACHE_SIZE = int(
+    os.environ.get('REGION_SUMMARY_CACHE_SIZE', '1024'))
+HIERARCHY_CACHE_TTL = float(os.environ.get('HIERARCHY_CACHE_TTL', '60'))
+
+
+class TTLCache:
+    """A thread-safe LRU cache whose entries expire after a fixed time
+
+    Args:
+        maxsize (int): The maximum number of entries kept
+        ttl (float): The lifetime of an entry, in seconds
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, _key: Hashable) -> Optional[Any]:
+        """Returns a live entry, or None
+
+        Args:
+            _key (Hashable): The cache key
+
+        Returns:
+            Optional[Any]: The cached value
+        """
+        with self._lock:
+            entry = self._entries.get(_key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(_key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(_key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, _key: Hashable, _value: Any, _ttl: Optional[float] = None) -> None:
+        """Stores an entry, evicting the least recently used one when full
+
+        Args:
+            _key (Hashable): The cache key
+            _value (Any): The value cached
+            _ttl (Optional[float]): A shorter lifetime for this entry
+        """
+        ttl = self.ttl if _ttl is None else min(_ttl, self.ttl)
+        with self._lock:
+            self._entries[_key] = (time.monotonic() + ttl, _value)
+            self._entries.move_to_end(_key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, _keys: Iterable[Hashable]) -> None:
+        """Drops entries
+
+        Args:
+            _keys (Iterable[Hashable]): The keys dropped
+        """
+        with self._lock:
+            for key in _keys:
+                self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """Drops every entry"""
+        with self._lock:
+            self._entries.clear()
+
+    def metrics(self) -> dict:
+        """The size and hit counters
+
+        Returns:
+            dict: The current metrics
+        """
+        return {'size': len(self._entries), 'hits': self.hits,
+                'misses': self.misses}
+
+
+region_summary_cache = TTLCache(REGION_SUMMARY_CACHE_SIZE,
+                                REGION_SUMMARY_CACHE_TTL)
+
+hierarchy_cache = TTLCache(1, HIERARCHY_CACHE_TTL)
+
+
+def invalidate_region_summaries(*_region_ids: Any) -> None:
+    """Drops the cached summaries of the regions a write touched
+
+    Args:
+        _region_ids (Any): The ids of the regions
+    """
+    region_summary_cache.invalidate(
+        str(region_id) for region_id in _region_ids if region_id is not None)
+
+
+def invalidate_hierarchy() -> None:
+    """Drops the cached region, store and store section tree"""
+    hierarchy_cache.clear()
@@ -0,0 +1,246 @@
+"""The file containing the incremental change feeds
+
+Every insert and update of a region, store, section or incident stamps the
+row with the next value of the ``change_seq`` sequence, and every delete
+leaves a tombstone stamped the same way. A client keeps the cursor of its
+last sync and asks for what changed after it, which the indexes on
+``change_seq`` answer in O(changes) instead of O(rows).
+
+A value is drawn when a row is written, not when its transaction commits, so
+a smaller value can become visible after a larger one. A cursor past the
+larger one would skip the smaller for good. The feeds therefore stop at a
+watermark below which every value is settled: the monitor reads the
+sequence, then takes a snapshot, and raises the watermark to that reading
+once every transaction running at the snapshot has ended. The stamping
+trigger takes the transaction id before the value, so a transaction holding
+a value is always among them. A write shows up in the feeds a polling
+interval or two after it commits.
+
+The watermark is the primary's, so the feeds read from the primary.
+"""
+import asyncio
+import logging
+import os
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from dotenv import find_dotenv, load_dotenv
+from sqlalchemy import Select, bindparam, select, text
+from sqlalchemy.orm import Session
+
+from database.db import engine
+from models.models import (Incidents, Regions, Stores, StoreSections,
+                           Tombstones)
+from schemas.changes_schema import ChangedEntity
+from schemas.fieldsets_schema import model_columns, selectable_fields
+from schemas.incidents_schema import ReadIncident
+from schemas.regions_schema import ReadRegion
+from schemas.store_sections_schema import ReadStoreSection
+from schemas.stores_schema import ReadStore
+
+load_dotenv(find_dotenv())
+
+logger = logging.getLogger(__name__)
+
+CHANGE_FEED_INTERVAL = float(os.environ.get('CHANGE_FEED_INTERVAL', '0.5'))
+
+# The model and read schema of every feed, and the parents it filters on
+CHANGE_FEEDS = {
+    ChangedEntity.REGION: (Regions, ReadRegion, ()),
+    ChangedEntity.STORE: (Stores, ReadStore, ('region_id',)),
+    ChangedEntity.STORE_SECTION: (StoreSections, ReadStoreSection,
+                                  ('store_id',)),
+    ChangedEntity.INCIDENT: (Incidents, ReadIncident,
+                             ('region_id', 'store_id', 'store_section_id')),
+}
+
+READ_CHANGE_SEQ = text("""
+SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM change_seq
+""")
+# In READ COMMITTED every statement takes its own snapshot, this one after
+# the sequence was read
+READ_SNAPSHOT = text("""
+SELECT CAST(CAST(pg_snapshot_xmin(snapshot) AS text) AS bigint),
+       CAST(CAST(pg_snapshot_xmax(snapshot) AS text) AS bigint)
+FROM pg_current_snapshot() AS snapshot
+""")
+
+
+class ChangeFeedNotReady(Exception):
+    """Raised before the first watermark is known"""
+
+
+def feed_fields(_entity: ChangedEntity) -> Tuple[str, ...]:
+    """The fields of the rows of a feed
+
+    Args:
+        _entity (ChangedEntity): The feed
+
+    Returns:
+        Tuple[str, ...]: Every column field of the read schema
+    """
+    model, schema, _ = CHANGE_FEEDS[_entity]
+    return selectable_fields(schema, model)
+
+
+def _changed_rows(_entity: ChangedEntity, _parent: Optional[str]) -> Select:
+    model = CHANGE_FEEDS[_entity][0]
+    statement = select(*model_columns(model, feed_fields(_entity)),
+                       model.change_seq) \
+        .where(model.change_seq > bindparam('since'),
+               model.change_seq <= bindparam('until'))
+    if _parent is not None:
+        statement = statement.where(
+            getattr(model, _parent) == bindparam('parent_id'))
+    return statement.order_by(model.change_seq).limit(bindparam('limit'))
+
+
+def _tombstones(_parent: Optional[str]) -> Select:
+    statement = select(Tombstones.entity_id, Tombstones.change_seq) \
+        .where(Tombstones.entity_type == bindparam('entity_type'),
+               Tombstones.change_seq > bindparam('since'),
+               Tombstones.change_seq <= bindparam('until'))
+    if _parent is not None:
+        statement = statement.where(
+            getattr(Tombstones, _parent) == bindparam('parent_id'))
+    return statement.order_by(Tombstones.change_seq) \
+        .limit(bindparam('limit'))
+
+
+# Built once at import for every feed and parent, and bound per call
+SELECT_CHANGED_ROWS = {
+    (entity, parent): _changed_rows(entity, parent)
+    for entity, (_, _, parents) in CHANGE_FEEDS.items()
+    for parent in (None, *parents)}
+SELECT_TOMBSTONES = {
+    parent: _tombstones(parent)
+    for parent in (None, 'region_id', 'store_id', 'store_section_id')}
+
+
+class ChangeWatermark:
+    """Polls the primary for the change sequence values that are settled
+
+    Args:
+        interval (float): The seconds between two readings
+    """
+
+    def __init__(self, interval: float = CHANGE_FEED_INTERVAL) -> None:
+        self.interval = interval
+        self.settled_seq: Optional[int] = None
+        self.readings = 0
+        # The values read and the snapshot xmax they wait for, a long
+        # transaction only holds the oldest back
+        self._pending: Deque[Tuple[int, int]] = deque(maxlen=1000)
+        self._task: Optional[asyncio.Task] = None
+
+    def observe(self) -> None:
+        """Reads the sequence and settles the readings no transaction holds"""
+        with engine.connect() as conn:
+            last_seq = conn.execute(READ_CHANGE_SEQ).scalar()
+            xmin, xmax = conn.execute(READ_SNAPSHOT).one()
+        self.readings += 1
+        self._pending.append((last_seq, xmax))
+        while self._pending and self._pending[0][1] <= xmin:
+            self.settled_seq = self._pending.popleft()[0]
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(self.observe)
+            except Exception:  # pylint: disable=broad-except
+                logger.warning('Could not read the change sequence',
+                               exc_info=True)
+
+    async def start(self) -> None:
+        """Takes a first reading and starts polling"""
+        try:
+            await asyncio.to_thread(self.observe)
+        except Exception:  # pylint: disable=broad-except
+            logger.warning('Could not read the change sequence',
+                           exc_info=True)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stops polling"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def metrics(self) -> Dict:
+        """The watermark and how far behind it the sequence is
+
+        Returns:
+            Dict: The current metrics
+        """
+        return {'settled_seq': self.settled_seq, 'readings': self.readings,
+                'pending_readings': len(self._pending)}
+
+
+change_watermark = ChangeWatermark()
+
+
+async def retrieve_changes_service(
+    _entity: ChangedEntity,
+    _since: Optional[int],
+    _limit: int,
+    _db: Session,
+    _parent: Optional[Tuple[str, UUID]] = None
+) -> Tuple[List[Any], List[UUID], int, bool]:
+    """The service function returning a page of a change feed
+
+    Args:
+        _entity (ChangedEntity): The feed
+        _since (Optional[int]): The cursor of the last sync, None for all
+        _limit (int): The most changes returned
+        _db (Session): The database session, on the primary
+        _parent (Optional[Tuple[str, UUID]]): The parent column and id the
+            feed is narrowed to, if any
+
+    Raises:
+        ChangeFeedNotReady: The watermark is not known yet
+
+    Returns:
+        Tuple[List[Any], List[UUID], int, bool]: The rows created or
+            updated, the ids deleted, the cursor of the next page and whether
+            more changes follow it
+    """
+    until = change_watermark.settled_seq
+    if until is None:
+        raise ChangeFeedNotReady('The change feed is starting, retry later')
+    # The rows stamped before the feeds existed all hold 0
+    since = -1 if _since is None else _since
+    parent, parent_id = _parent if _parent is not None else (None, None)
+    params = {'since': since, 'until': until, 'limit': _limit,
+              'parent_id': parent_id, 'entity_type': _entity.value}
+
+    rows = (await asyncio.to_thread(
+        _db.execute, SELECT_CHANGED_ROWS[(_entity, parent)], params)).all()
+    tombstones = (await asyncio.to_thread(
+        _db.execute, SELECT_TOMBSTONES[parent], params)).all()
+
+    # Each list holds the lowest changes of its kind, so the lowest of both
+    # together are all the changes up to the last one kept
+    changes = sorted([*rows, *tombstones], key=lambda row: row.change_seq)
+    has_more = len(rows) == _limit or len(tombstones) == _limit
+    if has_more:
+        changes = changes[:_limit]
+        cursor = changes[-1].change_seq
+    else:
+        # Another worker may have handed out a cursor past this watermark
+        cursor = max(since, until, 0)
+
+    return ([row for row in changes if not hasattr(row, 'entity_id')],
+            [row.entity_id for row in changes if hasattr(row, 'entity_id')],
+            cursor, has_more)
+
+
+async def start_change_watermark() -> None:
+    """Starts settling the change sequence"""
+    await change_watermark.start()
+
+
+async def stop_change_watermark() -> None:
+    """Stops settling the change sequence"""
+    await change_watermark.stop()
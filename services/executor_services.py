@@ -0,0 +1,53 @@
+"""The file containing the default executor of the event loop
+
+``asyncio.to_thread`` hands a service's call to a worker thread whose stack
+no longer shows the service. ``RequestExecutor`` remembers, for as long as
+the call runs, which service submitted it and which profiled request it
+works for, so the slow-query log and the profiler can attribute what the
+thread does.
+"""
+import asyncio
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from database.slow_query_log import (SLOW_QUERY_LOG, calling_service,
+                                     service_of_thread)
+from services.profiler_services import PROFILING, current_profile
+
+
+class RequestExecutor(ThreadPoolExecutor):
+    """The default executor, marking its threads with who submitted the call
+
+    ``run_in_executor`` submits from the calling task, so the caller's stack
+    and the request's profile are both at hand in ``submit``.
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        profile = current_profile.get()
+        service = calling_service(
+            sys._getframe(1)) if SLOW_QUERY_LOG else None  # pylint: disable=protected-access
+        if profile is None and service is None:
+            return super().submit(fn, *args, **kwargs)
+
+        def run():
+            thread = threading.get_ident()
+            if profile is not None:
+                profile.threads.add(thread)
+            if service is not None:
+                service_of_thread[thread] = service
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                if profile is not None:
+                    profile.threads.discard(thread)
+                service_of_thread.pop(thread, None)
+
+        return super().submit(run)
+
+
+async def install_request_executor() -> None:
+    """Makes ``RequestExecutor`` the default executor when something uses it"""
+    if PROFILING or SLOW_QUERY_LOG:
+        asyncio.get_running_loop().set_default_executor(
+            RequestExecutor(thread_name_prefix='asyncio'))
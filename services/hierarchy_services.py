@@ -0,0 +1,74 @@
+"""The file containing the service for the region, store and section tree
+
+PostgreSQL builds the whole nested document with json_agg and hands it back
+as text, so no ORM object or schema instance is created for any node.
+"""
+import asyncio
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from services.cache_services import hierarchy_cache
+
+HIERARCHY_CACHE_KEY = 'hierarchy'
+
+# Each level is aggregated once and hash joined onto its parent, rather than
+# running a correlated subquery per store
+HIERARCHY_QUERY = text("""
+WITH sections AS (
+    SELECT ss.store_id,
+           json_agg(json_build_object(
+               'store_section_id', ss.store_section_id,
+               'store_section_name', ss.store_section_name
+           ) ORDER BY ss.store_section_name) AS store_sections
+    FROM store_sections ss
+    GROUP BY ss.store_id
+),
+region_stores AS (
+    SELECT s.region_id,
+           json_agg(json_build_object(
+               'store_id', s.store_id,
+               'store_name', s.store_name,
+               'store_sections', COALESCE(sec.store_sections, '[]'::json)
+           ) ORDER BY s.store_name) AS stores
+    FROM stores s
+    LEFT JOIN sections sec ON sec.store_id = s.store_id
+    GROUP BY s.region_id
+)
+SELECT COALESCE(json_agg(json_build_object(
+           'region_id', r.region_id,
+           'region_name', r.region_name,
+           'stores', COALESCE(rs.stores, '[]'::json)
+       ) ORDER BY r.region_name), '[]'::json)::text
+FROM regions r
+LEFT JOIN region_stores rs ON rs.region_id = r.region_id
+""")
+
+
+def prime_hierarchy(_db: Session) -> bytes:
+    """Builds the tree and caches it
+
+    Args:
+        _db (Session): The database session
+
+    Returns:
+        bytes: The tree as a JSON document
+    """
+    document = _db.execute(HIERARCHY_QUERY).scalar().encode()
+    hierarchy_cache.set(HIERARCHY_CACHE_KEY, document)
+    return document
+
+
+async def retrieve_hierarchy_service(_db: Session) -> bytes:
+    """The service returning the region, store and store section tree
+
+    Args:
+        _db (Session): The database session
+
+    Returns:
+        bytes: The tree as a JSON document
+    """
+    document = hierarchy_cache.get(HIERARCHY_CACHE_KEY)
+    if document is None:
+        document = await asyncio.to_thread(prime_hierarchy, _db)
+    return document
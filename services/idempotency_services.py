@@ -0,0 +1,206 @@
+"""The file containing the idempotency key store for incident creation
+
+Terminals on flaky store networks retry ``POST /incidents/``. When a retry
+carries the same ``Idempotency-Key`` header as the original request, the
+response stored under the key is returned instead of inserting again. Keys
+are claimed in the same transaction as the incidents they guard, so a key is
+only ever stored for an incident that was written. The buffered ingestion
+queue claims them when it accepts an incident instead, so every worker sees
+the id it answered with, and releases them if the write is given up.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set
+
+from dotenv import find_dotenv, load_dotenv
+from fastapi import Response
+from pydantic import BaseModel
+from sqlalchemy import bindparam, delete, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from database.db import SessionLocal
+from models.models import IdempotencyKeys
+
+load_dotenv(find_dotenv())
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_KEY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_KEY_TTL_HOURS = float(
+    os.environ.get('IDEMPOTENCY_KEY_TTL_HOURS', '24'))
+IDEMPOTENCY_PURGE_INTERVAL = float(
+    os.environ.get('IDEMPOTENCY_PURGE_INTERVAL', '3600'))
+
+# One primary key lookup. Expired keys that were not purged yet are ignored.
+SELECT_A_STORED_RESPONSE = select(IdempotencyKeys).where(
+    IdempotencyKeys.idempotency_key == bindparam('idempotency_key'),
+    IdempotencyKeys.created_at >= bindparam('not_before'))
+PURGE_EXPIRED_KEYS = delete(IdempotencyKeys.__table__).where(
+    IdempotencyKeys.__table__.c.created_at < bindparam('not_before'))
+RELEASE_KEYS = delete(IdempotencyKeys.__table__).where(
+    IdempotencyKeys.__table__.c.idempotency_key.in_(
+        bindparam('keys', expanding=True)))
+
+
+class IdempotencyKeyReused(Exception):
+    """Raised when a key comes back with a different request body"""
+
+
+class IdempotencyKeyTaken(Exception):
+    """Raised when a concurrent request claimed the key first"""
+
+
+def _not_before() -> datetime:
+    return datetime.now() - timedelta(hours=IDEMPOTENCY_KEY_TTL_HOURS)
+
+
+def request_hash(_payload: BaseModel) -> str:
+    """The fingerprint telling a retry from a new request under the same key
+
+    Args:
+        _payload (BaseModel): The validated request body
+
+    Returns:
+        str: The SHA-256 of the body's JSON
+    """
+    return hashlib.sha256(_payload.model_dump_json().encode()).hexdigest()
+
+
+def find_stored_response(
+    _db: Session, _key: str, _payload: BaseModel
+) -> Optional[IdempotencyKeys]:
+    """Looks up the response stored under a key
+
+    Args:
+        _db (Session): The database session
+        _key (str): The idempotency key
+        _payload (BaseModel): The request body of the retry
+
+    Raises:
+        IdempotencyKeyReused: The key was stored for a different body
+
+    Returns:
+        Optional[IdempotencyKeys]: The stored response, if any
+    """
+    stored = _db.scalars(SELECT_A_STORED_RESPONSE, {
+        'idempotency_key': _key, 'not_before': _not_before()}).first()
+    if stored is not None and stored.request_hash != request_hash(_payload):
+        raise IdempotencyKeyReused(
+            f'{IDEMPOTENCY_KEY_HEADER} {_key} was used for a different request')
+    return stored
+
+
+def replay_response(_stored: IdempotencyKeys) -> Response:
+    """Rebuilds the response of the original request
+
+    Args:
+        _stored (IdempotencyKeys): The stored response
+
+    Returns:
+        Response: The original status and body
+    """
+    return Response(_stored.response_body, status_code=_stored.status_code,
+                    media_type='application/json',
+                    headers={'Idempotent-Replayed': 'true'})
+
+
+def stored_response(
+    _key: str, _request_hash: str, _status_code: int, _body: str
+) -> Dict:
+    """The row stored under a key for a response
+
+    Args:
+        _key (str): The idempotency key
+        _request_hash (str): The fingerprint of the request body
+        _status_code (int): The status code of the response
+        _body (str): The JSON body of the response
+
+    Returns:
+        Dict: The values of the idempotency_keys row
+    """
+    return {'idempotency_key': _key, 'request_hash': _request_hash,
+            'status_code': _status_code, 'response_body': _body,
+            'created_at': datetime.now()}
+
+
+def claim_idempotency_keys(_db: Session, _responses: List[Dict]) -> Set[str]:
+    """Stores responses under keys that are not taken yet
+
+    Runs in the caller's transaction. A key still held by a concurrent,
+    uncommitted transaction waits for it, so at most one request claims it.
+    Expired keys are taken over.
+
+    Args:
+        _db (Session): The database session
+        _responses (List[Dict]): The rows from ``stored_response``, one per key
+
+    Returns:
+        Set[str]: The keys that were claimed
+    """
+    statement = insert(IdempotencyKeys).values(_responses)
+    statement = statement.on_conflict_do_update(
+        index_elements=[IdempotencyKeys.idempotency_key],
+        set_={column: statement.excluded[column] for column in (
+            'request_hash', 'status_code', 'response_body', 'created_at')},
+        where=IdempotencyKeys.created_at < _not_before()
+    ).returning(IdempotencyKeys.idempotency_key)
+    return set(_db.scalars(statement).all())
+
+
+def release_idempotency_keys(_db: Session, _keys: List[str]) -> None:
+    """Deletes keys whose incidents were never written, so retries write them
+
+    Runs in the caller's transaction.
+
+    Args:
+        _db (Session): The database session
+        _keys (List[str]): The idempotency keys
+    """
+    if _keys:
+        _db.execute(RELEASE_KEYS, {'keys': _keys})
+
+
+def purge_expired_idempotency_keys() -> int:
+    """Deletes the keys older than the TTL
+
+    Returns:
+        int: The number of keys deleted
+    """
+    with SessionLocal() as _db:
+        deleted = _db.execute(PURGE_EXPIRED_KEYS,
+                              {'not_before': _not_before()}).rowcount
+        _db.commit()
+    return deleted
+
+
+_purge_job: Optional[asyncio.Task] = None
+
+
+async def _purge_periodically() -> None:
+    while True:
+        try:
+            deleted = await asyncio.to_thread(purge_expired_idempotency_keys)
+            logger.info('Purged %d expired idempotency keys', deleted)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('The idempotency key purge failed')
+        await asyncio.sleep(IDEMPOTENCY_PURGE_INTERVAL)
+
+
+async def start_idempotency_purge() -> None:
+    """Starts the periodic purge of expired idempotency keys"""
+    global _purge_job  # pylint: disable=global-statement
+
+    _purge_job = asyncio.create_task(_purge_periodically())
+
+
+async def stop_idempotency_purge() -> None:
+    """Stops the periodic purge"""
+    global _purge_job  # pylint: disable=global-statement
+
+    if _purge_job is not None:
+        _purge_job.cancel()
+        _purge_job = None
@@ -0,0 +1,256 @@
+"""The file containing the live incident feed
+
+Incident writes publish one event per incident. With PostgreSQL the event is
+sent with ``pg_notify`` inside the writing transaction, so it is only
+delivered on commit, and every worker receives it through a single
+``LISTEN`` connection. Without it the event is dispatched in-process after
+the commit. Each worker then fans the already encoded bytes out to the
+subscribers of the incident's region, store and store section.
+"""
+import asyncio
+import logging
+import os
+import threading
+from collections import defaultdict
+from typing import Dict, Optional, Set, Tuple, Union
+
+import orjson
+from dotenv import find_dotenv, load_dotenv
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+
+from database.db import DATABASE_URL, SessionLocal, engine
+from models.models import Incidents
+from schemas.incidents_schema import IncidentFeedScope, ReadIncident
+
+load_dotenv(find_dotenv())
+
+logger = logging.getLogger(__name__)
+
+INCIDENT_FEED_CHANNEL = 'incident_feed'
+INCIDENT_FEED_NOTIFY = (
+    os.environ.get('INCIDENT_FEED_NOTIFY', 'true').lower() == 'true'
+    and engine.dialect.name == 'postgresql'
+)
+INCIDENT_FEED_SUBSCRIBER_BUFFER = int(
+    os.environ.get('INCIDENT_FEED_SUBSCRIBER_BUFFER', '100'))
+# NOTIFY payloads must stay below 8000 bytes
+_MAX_NOTIFY_PAYLOAD = 7900
+_PENDING_KEY = 'incident_feed_pending'
+
+_SCOPE_FIELDS = {
+    IncidentFeedScope.REGION: 'region_id',
+    IncidentFeedScope.STORE: 'store_id',
+    IncidentFeedScope.STORE_SECTION: 'store_section_id',
+}
+
+
+class IncidentFeedBroker:
+    """Fans encoded incident events out to per-scope subscriber queues"""
+
+    def __init__(self, buffer_size: int = INCIDENT_FEED_SUBSCRIBER_BUFFER) -> None:
+        self.buffer_size = buffer_size
+        self._subscribers: Dict[Tuple[str, str], Set[asyncio.Queue]] = \
+            defaultdict(set)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._published_total = 0
+        self._dropped_total = 0
+
+    def bind(self, _loop: asyncio.AbstractEventLoop) -> None:
+        """Binds the broker to the event loop its subscribers live on
+
+        Args:
+            _loop (asyncio.AbstractEventLoop): The worker's event loop
+        """
+        self._loop = _loop
+
+    def subscribe(self, _scope: IncidentFeedScope, _scope_id: str) -> asyncio.Queue:
+        """Registers a subscriber for a region, store or store section
+
+        Args:
+            _scope (IncidentFeedScope): The kind of object subscribed to
+            _scope_id (str): The id of the object
+
+        Returns:
+            asyncio.Queue: The queue the encoded events are delivered to
+        """
+        queue = asyncio.Queue(maxsize=self.buffer_size)
+        self._subscribers[(_scope.value, str(_scope_id))].add(queue)
+        return queue
+
+    def unsubscribe(
+        self, _scope: IncidentFeedScope, _scope_id: str, _queue: asyncio.Queue
+    ) -> None:
+        """Removes a subscriber
+
+        Args:
+            _scope (IncidentFeedScope): The kind of object subscribed to
+            _scope_id (str): The id of the object
+            _queue (asyncio.Queue): The subscriber's queue
+        """
+        key = (_scope.value, str(_scope_id))
+        queues = self._subscribers.get(key)
+        if queues is None:
+            return
+        queues.discard(_queue)
+        if not queues:
+            del self._subscribers[key]
+
+    def dispatch(self, _payload: bytes) -> None:
+        """Delivers an encoded event to every matching subscriber
+
+        Slow subscribers lose their oldest event rather than holding up the
+        publisher.
+
+        Args:
+            _payload (bytes): The encoded event
+        """
+        self._published_total += 1
+        scopes = orjson.loads(_payload)['scopes']
+
+        for scope, scope_id in scopes.items():
+            for queue in self._subscribers.get((scope, scope_id), ()):
+                if queue.full():
+                    queue.get_nowait()
+                    self._dropped_total += 1
+                queue.put_nowait(_payload)
+
+    def dispatch_threadsafe(self, _payload: bytes) -> None:
+        """Delivers an event from a thread other than the event loop's
+
+        Args:
+            _payload (bytes): The encoded event
+        """
+        if self._loop is None or self._loop.is_closed():
+            return
+        self._loop.call_soon_threadsafe(self.dispatch, _payload)
+
+    def metrics(self) -> Dict:
+        """The subscriber and delivery counters
+
+        Returns:
+            Dict: The current metrics
+        """
+        return {
+            'transport': 'notify' if INCIDENT_FEED_NOTIFY else 'local',
+            'subscribers': sum(len(queues) for queues in self._subscribers.values()),
+            'published_total': self._published_total,
+            'dropped_total': self._dropped_total
+        }
+
+
+incident_feed_broker = IncidentFeedBroker()
+
+
+def encode_incident_event(_incident: Union[Incidents, dict], _event: str) -> bytes:
+    """Encodes an incident event once for every subscriber
+
+    Args:
+        _incident (Union[Incidents, dict]): The incident row or mapping
+        _event (str): One of created, updated or deleted
+
+    Returns:
+        bytes: The encoded event
+    """
+    incident = ReadIncident.model_validate(_incident).model_dump()
+    scopes = {scope.value: str(incident[field])
+              for scope, field in _SCOPE_FIELDS.items()}
+    payload = orjson.dumps(
+        {'event': _event, 'scopes': scopes, 'incident': incident})
+
+    if INCIDENT_FEED_NOTIFY and len(payload) > _MAX_NOTIFY_PAYLOAD:
+        incident['incident_description'] = None
+        payload = orjson.dumps({'event': _event, 'scopes': scopes,
+                                'incident': incident, 'truncated': True})
+    return payload
+
+
+def publish_incident_event(
+    _db: Session, _incident: Union[Incidents, dict], _event: str
+) -> None:
+    """Publishes an incident event as part of the session's transaction
+
+    Call it before the commit; nothing is delivered if the transaction rolls
+    back.
+
+    Args:
+        _db (Session): The database session writing the incident
+        _incident (Union[Incidents, dict]): The incident row or mapping
+        _event (str): One of created, updated or deleted
+    """
+    payload = encode_incident_event(_incident, _event)
+
+    if INCIDENT_FEED_NOTIFY:
+        _db.execute(text('SELECT pg_notify(:channel, :payload)'),
+                    {'channel': INCIDENT_FEED_CHANNEL,
+                     'payload': payload.decode()})
+    else:
+        _db.info.setdefault(_PENDING_KEY, []).append(payload)
+
+
+@event.listens_for(SessionLocal, 'after_commit')
+def _dispatch_pending_events(_db: Session) -> None:
+    """Dispatches the in-process events once their transaction commits"""
+    for payload in _db.info.pop(_PENDING_KEY, ()):
+        incident_feed_broker.dispatch_threadsafe(payload)
+
+
+@event.listens_for(SessionLocal, 'after_soft_rollback')
+def _discard_pending_events(_db: Session, _previous_transaction) -> None:
+    """Discards the in-process events of a rolled back transaction"""
+    _db.info.pop(_PENDING_KEY, None)
+
+
+class _NotifyListener(threading.Thread):
+    """Receives the feed events of every worker through LISTEN"""
+
+    def __init__(self) -> None:
+        super().__init__(name='incident-feed-listener', daemon=True)
+        self._stopped = threading.Event()
+
+    def stop(self) -> None:
+        """Asks the listener to exit after its current wait"""
+        self._stopped.set()
+
+    def run(self) -> None:
+        import psycopg  # pylint: disable=import-outside-toplevel
+
+        dsn = make_url(DATABASE_URL).set(drivername='postgresql') \
+            .render_as_string(hide_password=False)
+
+        while not self._stopped.is_set():
+            try:
+                with psycopg.connect(dsn, autocommit=True) as conn:
+                    conn.execute(f'LISTEN {INCIDENT_FEED_CHANNEL}')
+                    while not self._stopped.is_set():
+                        for notify in conn.notifies(timeout=1.0):
+                            incident_feed_broker.dispatch_threadsafe(
+                                notify.payload.encode())
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Incident feed listener failed, reconnecting')
+                self._stopped.wait(1.0)
+
+
+_listener: Optional[_NotifyListener] = None
+
+
+async def start_incident_feed() -> None:
+    """Binds the broker to the running loop and starts the LISTEN thread"""
+    global _listener  # pylint: disable=global-statement
+
+    incident_feed_broker.bind(asyncio.get_running_loop())
+
+    if INCIDENT_FEED_NOTIFY:
+        _listener = _NotifyListener()
+        _listener.start()
+
+
+async def stop_incident_feed() -> None:
+    """Stops the LISTEN thread"""
+    global _listener  # pylint: disable=global-statement
+
+    if _listener is not None:
+        _listener.stop()
+        await asyncio.to_thread(_listener.join, 5.0)
+        _listener = None
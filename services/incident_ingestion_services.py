@@ -0,0 +1,384 @@
+"""The file containing the write-behind ingestion queue for incidents
+
+When ``INCIDENT_INGESTION_MODE`` is set to ``buffered`` the create endpoint
+only validates the payload and puts it on an in-process asyncio queue. A
+background flusher then writes the queued incidents in batches, so a burst
+of terminals shares a handful of pooled connections instead of holding one
+each for its own commit.
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from uuid import UUID
+
+from dotenv import find_dotenv, load_dotenv
+from sqlalchemy import insert
+from sqlalchemy.exc import (DataError, IntegrityError, InterfaceError,
+                            OperationalError)
+
+from database.db import SessionLocal
+from models.models import Incidents
+from schemas.incidents_schema import CreateIncident, QueuedIncident
+from services.cache_services import invalidate_region_summaries
+from services.idempotency_services import (IdempotencyKeyReused,
+                                           IdempotencyKeyTaken,
+                                           claim_idempotency_keys,
+                                           release_idempotency_keys,
+                                           request_hash, stored_response)
+from services.incident_feed_services import publish_incident_event
+from services.product_sketch_services import observe_incident
+
+load_dotenv(find_dotenv())
+
+logger = logging.getLogger(__name__)
+
+INCIDENT_INGESTION_MODE = os.environ.get('INCIDENT_INGESTION_MODE', 'direct')
+INCIDENT_QUEUE_MAX_SIZE = int(os.environ.get('INCIDENT_QUEUE_MAX_SIZE', '10000'))
+INCIDENT_FLUSH_BATCH_SIZE = int(
+    os.environ.get('INCIDENT_FLUSH_BATCH_SIZE', '500'))
+INCIDENT_FLUSH_INTERVAL = float(
+    os.environ.get('INCIDENT_FLUSH_INTERVAL', '0.25'))
+INCIDENT_ENQUEUE_TIMEOUT = float(
+    os.environ.get('INCIDENT_ENQUEUE_TIMEOUT', '0.5'))
+INCIDENT_DRAIN_TIMEOUT = float(os.environ.get('INCIDENT_DRAIN_TIMEOUT', '30'))
+INCIDENT_FLUSH_RETRIES = 3
+
+# The connection dropped or the server is restarting, the same batch may pass
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+# A row the database refuses, such as a stale region, store or section id,
+# fails the same way every time
+REJECTED_ROW_ERRORS = (IntegrityError, DataError)
+
+
+class IngestionQueueFull(Exception):
+    """Raised when the queue stays full for longer than the enqueue timeout"""
+
+
+class IngestionQueueClosed(Exception):
+    """Raised when an incident is enqueued while the queue is draining"""
+
+
+class IncidentIngestionQueue:
+    """A bounded write-behind queue with a single background flusher
+
+    Args:
+        max_size (int): The maximum number of queued incidents
+        batch_size (int): The maximum number of incidents written per batch
+        flush_interval (float): The longest a queued incident waits, in seconds
+        enqueue_timeout (float): How long a producer waits for free space
+    """
+
+    def __init__(
+        self,
+        max_size: int = INCIDENT_QUEUE_MAX_SIZE,
+        batch_size: int = INCIDENT_FLUSH_BATCH_SIZE,
+        flush_interval: float = INCIDENT_FLUSH_INTERVAL,
+        enqueue_timeout: float = INCIDENT_ENQUEUE_TIMEOUT
+    ) -> None:
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+
+        self._queue: Optional[asyncio.Queue] = None
+        # The idempotency keys of queued incidents, so a retry that arrives
+        # before the flush gets the id of the incident already queued
+        self._pending_keys: Dict[str, Tuple[UUID, str]] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self._closed = True
+
+        self._enqueued_total = 0
+        self._rejected_total = 0
+        self._key_conflicts_total = 0
+        self._flushed_total = 0
+        self._failed_total = 0
+        self._batches_total = 0
+        self._last_flush_seconds = 0.0
+        self._max_flush_seconds = 0.0
+        self._total_flush_seconds = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the create endpoint should enqueue instead of writing"""
+        return not self._closed
+
+    async def start(self) -> None:
+        """Creates the queue and starts the background flusher"""
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        self._closed = False
+        self._flusher = asyncio.create_task(self._run())
+
+    async def enqueue(
+        self,
+        _incident_data: CreateIncident,
+        _idempotency_key: Optional[str] = None
+    ) -> UUID:
+        """Validates and queues an incident, waiting briefly for space
+
+        Args:
+            _incident_data (CreateIncident): The incident data
+            _idempotency_key (Optional[str]): The key of the incident, if any
+
+        Raises:
+            IngestionQueueClosed: The queue is draining for shutdown
+            IngestionQueueFull: The queue stayed full for the enqueue timeout
+            IdempotencyKeyReused: The key is queued for a different incident
+            IdempotencyKeyTaken: Another worker claimed the key first, its
+                stored response answers the request
+
+        Returns:
+            UUID: The id the incident will be written with
+        """
+        if self._closed:
+            raise IngestionQueueClosed('The ingestion queue is not accepting incidents')
+
+        fingerprint = request_hash(_incident_data) if _idempotency_key else None
+        if _idempotency_key in self._pending_keys:
+            incident_id, pending_fingerprint = self._pending_keys[_idempotency_key]
+            if pending_fingerprint != fingerprint:
+                raise IdempotencyKeyReused(
+                    f'Idempotency-Key {_idempotency_key} was used for a '
+                    'different request')
+            return incident_id
+
+        row = _incident_data.model_dump()
+        row['incident_id'] = uuid.uuid4()
+        row['created_at'] = datetime.now()
+        if _idempotency_key:
+            row['_idempotency_key'] = _idempotency_key
+            self._pending_keys[_idempotency_key] = (row['incident_id'],
+                                                    fingerprint)
+            # Claimed now, so a retry reaching another worker before the
+            # flush gets this id back instead of queueing a second incident
+            try:
+                claimed = await asyncio.to_thread(
+                    self._claim_key, _idempotency_key, fingerprint,
+                    row['incident_id'])
+            except BaseException:
+                self._pending_keys.pop(_idempotency_key, None)
+                raise
+            if not claimed:
+                self._pending_keys.pop(_idempotency_key, None)
+                self._key_conflicts_total += 1
+                raise IdempotencyKeyTaken(_idempotency_key)
+
+        try:
+            await asyncio.wait_for(self._queue.put(row), self.enqueue_timeout)
+        except asyncio.TimeoutError as e:
+            self._pending_keys.pop(_idempotency_key, None)
+            self._rejected_total += 1
+            if _idempotency_key:
+                await asyncio.to_thread(self._release_keys, [_idempotency_key])
+            raise IngestionQueueFull('The ingestion queue is full') from e
+
+        self._enqueued_total += 1
+        return row['incident_id']
+
+    async def _collect_batch(self) -> List[Dict]:
+        """Waits for one incident then gathers more until the batch is full or
+        the flush interval has passed
+
+        Returns:
+            List[Dict]: The incidents to write
+        """
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    @staticmethod
+    def _claim_key(_key: str, _fingerprint: str, _incident_id: UUID) -> bool:
+        """Stores the 202 of a queued incident under its idempotency key
+
+        Returns:
+            bool: Whether the key was claimed
+        """
+        with SessionLocal() as _db:
+            claimed = claim_idempotency_keys(_db, [stored_response(
+                _key, _fingerprint, 202,
+                QueuedIncident(incident_id=_incident_id).model_dump_json())])
+            _db.commit()
+        return _key in claimed
+
+    @staticmethod
+    def _release_keys(_keys: List[str]) -> None:
+        """Frees the keys of incidents that will not be written"""
+        try:
+            with SessionLocal() as _db:
+                release_idempotency_keys(_db, _keys)
+                _db.commit()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Could not release the idempotency keys %s', _keys)
+
+    @staticmethod
+    def _write_batch(_rows: List[Dict]) -> None:
+        """Writes a batch of incidents in a single transaction
+
+        Their idempotency keys were claimed when they were queued.
+
+        Args:
+            _rows (List[Dict]): The incidents to write
+        """
+        _rows = [{column: value for column, value in row.items()
+                  if not column.startswith('_')} for row in _rows]
+        with SessionLocal() as _db:
+            if _rows:
+                _db.execute(insert(Incidents), _rows)
+            for row in _rows:
+                publish_incident_event(_db, row, 'created')
+            _db.commit()
+
+        for row in _rows:
+            observe_incident(row)
+        invalidate_region_summaries(*{row['region_id'] for row in _rows})
+
+    async def _drop(self, _rows: List[Dict], _reason: str) -> None:
+        """Gives up on incidents and frees their idempotency keys
+
+        Args:
+            _rows (List[Dict]): The incidents dropped
+            _reason (str): Why they could not be written
+        """
+        self._failed_total += len(_rows)
+        logger.error('Dropping %d queued incidents, %s: %s', len(_rows),
+                     _reason, [str(row['incident_id']) for row in _rows],
+                     exc_info=True)
+        # Their retries must write them, not replay a lost id
+        await asyncio.to_thread(self._release_keys, [
+            row['_idempotency_key'] for row in _rows
+            if '_idempotency_key' in row])
+
+    async def _write(self, _rows: List[Dict]) -> int:
+        """Writes incidents, retrying transient failures
+
+        A batch the database rejects is split in half until the rows it
+        refuses are alone, so only those are dropped and every other
+        incident already answered with a 202 is still written.
+
+        Args:
+            _rows (List[Dict]): The incidents to write
+
+        Returns:
+            int: How many were written
+        """
+        for attempt in range(1, INCIDENT_FLUSH_RETRIES + 1):
+            try:
+                await asyncio.to_thread(self._write_batch, _rows)
+                return len(_rows)
+            except REJECTED_ROW_ERRORS:
+                if len(_rows) == 1:
+                    await self._drop(_rows, 'rejected by the database')
+                    return 0
+                middle = len(_rows) // 2
+                return (await self._write(_rows[:middle])
+                        + await self._write(_rows[middle:]))
+            except TRANSIENT_ERRORS:
+                if attempt == INCIDENT_FLUSH_RETRIES:
+                    await self._drop(
+                        _rows, f'still failing after {attempt} attempts')
+                    return 0
+                await asyncio.sleep(0.1 * 2 ** attempt)
+            except Exception:  # pylint: disable=broad-except
+                await self._drop(_rows, 'the batch write failed')
+                return 0
+        return 0
+
+    async def _flush(self, _rows: List[Dict]) -> None:
+        """Writes a batch off the event loop
+
+        Args:
+            _rows (List[Dict]): The incidents to write
+        """
+        started = time.perf_counter()
+        written = await self._write(_rows)
+
+        elapsed = time.perf_counter() - started
+        self._flushed_total += written
+        self._batches_total += 1
+        self._last_flush_seconds = elapsed
+        self._total_flush_seconds += elapsed
+        self._max_flush_seconds = max(self._max_flush_seconds, elapsed)
+
+    async def _run(self) -> None:
+        """The flusher loop"""
+        while True:
+            batch = await self._collect_batch()
+            try:
+                await self._flush(batch)
+            finally:
+                for row in batch:
+                    self._pending_keys.pop(row.get('_idempotency_key'), None)
+                    self._queue.task_done()
+
+    async def stop(self, _timeout: float = INCIDENT_DRAIN_TIMEOUT) -> None:
+        """Stops accepting incidents and drains what is already queued
+
+        Args:
+            _timeout (float): How long to wait for the drain, in seconds
+        """
+        if self._flusher is None:
+            return
+
+        self._closed = True
+
+        try:
+            await asyncio.wait_for(self._queue.join(), _timeout)
+        except asyncio.TimeoutError:
+            logger.error('Ingestion queue drain timed out with %d incidents left',
+                         self._queue.qsize())
+
+        self._flusher.cancel()
+        try:
+            await self._flusher
+        except asyncio.CancelledError:
+            pass
+        self._flusher = None
+
+    def metrics(self) -> Dict:
+        """The queue depth and flush latency counters
+
+        Returns:
+            Dict: The current metrics
+        """
+        return {
+            'mode': 'buffered' if self.enabled else 'direct',
+            'queue_depth': self._queue.qsize() if self._queue else 0,
+            'queue_max_size': self.max_size,
+            'enqueued_total': self._enqueued_total,
+            'rejected_total': self._rejected_total,
+            'key_conflicts_total': self._key_conflicts_total,
+            'flushed_total': self._flushed_total,
+            'failed_total': self._failed_total,
+            'batches_total': self._batches_total,
+            'last_flush_seconds': self._last_flush_seconds,
+            'max_flush_seconds': self._max_flush_seconds,
+            'avg_flush_seconds': (self._total_flush_seconds / self._batches_total
+                                  if self._batches_total else 0.0)
+        }
+
+
+incident_ingestion_queue = IncidentIngestionQueue()
+
+
+async def start_incident_ingestion() -> None:
+    """Starts the ingestion queue when buffered mode is configured"""
+    if INCIDENT_INGESTION_MODE == 'buffered':
+        await incident_ingestion_queue.start()
+
+
+async def stop_incident_ingestion() -> None:
+    """Drains the ingestion queue on shutdown"""
+    await incident_ingestion_queue.stop()
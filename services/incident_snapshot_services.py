@@ -0,0 +1,454 @@
+"""The file containing the columnar snapshots of closed incident days
+
+Every closed day of incidents is exported once into a directory of NumPy
+``.npy`` columns on local disk. The analytics read them memory-mapped, so the
+pages are shared by every worker on the host through the page cache and a
+scan is a handful of vectorised passes instead of a query. Only the days
+without a snapshot, normally just today, are still aggregated in Postgres.
+
+A day's snapshot is dropped when one of its incidents is updated or deleted,
+and the builder exports it again on its next run. Every invalidation also
+rewrites a marker file next to the snapshots, so an export running at the
+time, in any worker, notices after its rename and drops what it wrote.
+"""
+import asyncio
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from dotenv import find_dotenv, load_dotenv
+from sqlalchemy import func, select, text
+from sqlalchemy.orm import Session
+
+from database.db import SessionLocal
+from models.models import Incidents
+from services.archive_services import (archive_watermark,
+                                       archived_daily_section_totals,
+                                       reaches_archive)
+
+load_dotenv(find_dotenv())
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PATH = os.environ.get(
+    'SNAPSHOT_PATH', os.path.join('data', 'snapshots'))
+SNAPSHOT_HISTORY_DAYS = int(os.environ.get('SNAPSHOT_HISTORY_DAYS', '120'))
+SNAPSHOT_INTERVAL = float(os.environ.get('SNAPSHOT_INTERVAL', '3600'))
+# Incidents committed just after midnight can still carry yesterday's time
+SNAPSHOT_GRACE_MINUTES = int(os.environ.get('SNAPSHOT_GRACE_MINUTES', '15'))
+SNAPSHOT_FETCH_SIZE = 50000
+
+# The markers rewritten by every invalidation of a day, or of every day
+MARKER_SUFFIX = '.invalidated'
+ALL_DAYS_MARKER = f'all{MARKER_SUFFIX}'
+
+# The section codes are dense ranks, so they index the ordered section list
+SNAPSHOT_SECTIONS_QUERY = text("""
+SELECT DISTINCT region_id, store_id, store_section_id
+FROM incidents
+WHERE created_at >= :start AND created_at < :end
+ORDER BY region_id, store_id, store_section_id
+""")
+SNAPSHOT_ROWS_QUERY = text("""
+SELECT DENSE_RANK() OVER (ORDER BY region_id, store_id, store_section_id) - 1,
+       CAST(EXTRACT(EPOCH FROM created_at) * 1000000 AS bigint),
+       COALESCE(product_quantity, 0),
+       COALESCE(product_price * product_quantity, 0)
+FROM incidents
+WHERE created_at >= :start AND created_at < :end
+""")
+
+# The sections of a day are dictionary encoded, the columns hold their codes
+SECTIONS_FILE = 'sections.json'
+COLUMNS = {
+    'section': np.int32,
+    'created_at': 'datetime64[us]',
+    'quantity': np.int32,
+    'loss_value': np.float64,
+}
+
+
+class DaySnapshot(NamedTuple):
+    """The memory-mapped columns of one day of incidents
+
+    Args:
+        day (date): The day
+        sections (List[Tuple[str, str, str]]): The region, store and section
+            ids behind every section code
+        columns (Dict[str, np.ndarray]): The read-only columns
+    """
+    day: date
+    sections: List[Tuple[str, str, str]]
+    columns: Dict[str, np.ndarray]
+
+
+def _day_path(_day: date, _path: str = SNAPSHOT_PATH) -> str:
+    return os.path.join(_path, _day.isoformat())
+
+
+def _marker_path(_name: str, _path: str = SNAPSHOT_PATH) -> str:
+    return os.path.join(_path, _name)
+
+
+def _read_markers(_day: date, _path: str = SNAPSHOT_PATH) -> Tuple:
+    """The invalidation markers that apply to a day"""
+    markers = []
+    for name in (f'{_day.isoformat()}{MARKER_SUFFIX}', ALL_DAYS_MARKER):
+        try:
+            with open(_marker_path(name, _path), encoding='utf-8') as marker:
+                markers.append(marker.read())
+        except FileNotFoundError:
+            markers.append(None)
+    return tuple(markers)
+
+
+def _write_marker(_name: str, _path: str = SNAPSHOT_PATH) -> None:
+    os.makedirs(_path, exist_ok=True)
+    path = _marker_path(_name, _path)
+    temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temporary, 'w', encoding='utf-8') as marker:
+        marker.write(f'{time.time_ns()}.{os.getpid()}.{threading.get_ident()}')
+    os.replace(temporary, path)
+
+
+def _text(_id) -> Optional[str]:
+    return str(_id) if _id is not None else None
+
+
+def _day_bounds(_day: date) -> Tuple[datetime, datetime]:
+    start = datetime.combine(_day, datetime.min.time())
+    return start, start + timedelta(days=1)
+
+
+def last_closed_day(_now: Optional[datetime] = None) -> date:
+    """The most recent day no incident can be added to any more
+
+    Args:
+        _now (Optional[datetime]): The current time. Defaults to now.
+
+    Returns:
+        date: The last closed day
+    """
+    now = _now or datetime.now()
+    return (now - timedelta(minutes=SNAPSHOT_GRACE_MINUTES)).date() \
+        - timedelta(days=1)
+
+
+def build_day_snapshot(_db: Session, _day: date,
+                       _path: str = SNAPSHOT_PATH) -> int:
+    """Exports one day of incidents into its column files
+
+    The columns are written to a private directory that is renamed into
+    place, so readers never see a partial snapshot. An invalidation of the
+    day during the export drops the snapshot again after the rename.
+
+    Args:
+        _db (Session): The database session
+        _day (date): The day to export
+        _path (str): The snapshot directory
+
+    Returns:
+        int: The number of incidents exported
+    """
+    # Read before the export, an invalidation from now on changes them
+    markers = _read_markers(_day, _path)
+    params = dict(zip(('start', 'end'), _day_bounds(_day)))
+    sections = [tuple(map(_text, ids))
+                for ids in _db.execute(SNAPSHOT_SECTIONS_QUERY, params)]
+    result = _db.execute(
+        SNAPSHOT_ROWS_QUERY, params,
+        execution_options={'stream_results': True,
+                           'yield_per': SNAPSHOT_FETCH_SIZE})
+
+    chunks: Dict[str, List[np.ndarray]] = {column: [] for column in COLUMNS}
+    for partition in result.partitions():
+        block = np.array([tuple(row) for row in partition], dtype=np.float64)
+        for index, (column, dtype) in enumerate(COLUMNS.items()):
+            chunks[column].append(block[:, index].astype(
+                np.int64 if column == 'created_at' else dtype))
+
+    columns = {
+        column: (np.concatenate(chunks[column]) if chunks[column]
+                 else np.zeros(0, dtype=dtype)).view(dtype)
+        for column, dtype in COLUMNS.items()}
+    if len(columns['section']) and columns['section'].max() >= len(sections):
+        raise RuntimeError(f'The incidents of {_day} changed during the export')
+
+    os.makedirs(_path, exist_ok=True)
+    final = _day_path(_day, _path)
+    temporary = f'{final}.{os.getpid()}.{threading.get_ident()}.tmp'
+    os.makedirs(temporary)
+    for column, values in columns.items():
+        np.save(os.path.join(temporary, f'{column}.npy'), values)
+    with open(os.path.join(temporary, SECTIONS_FILE), 'w',
+              encoding='utf-8') as output:
+        json.dump(sections, output)
+
+    try:
+        os.rename(temporary, final)
+    except OSError:
+        # Another worker exported the day first
+        shutil.rmtree(temporary, ignore_errors=True)
+        return len(columns['section'])
+
+    if _read_markers(_day, _path) != markers:
+        # Its rmtree ran before the rename and found nothing to drop
+        shutil.rmtree(final, ignore_errors=True)
+        raise RuntimeError(f'The incidents of {_day} changed during the export')
+    return len(columns['section'])
+
+
+class IncidentSnapshots:
+    """The open snapshots of this process and the usage counters
+
+    Args:
+        path (str): The snapshot directory
+    """
+
+    def __init__(self, path: str = SNAPSHOT_PATH) -> None:
+        self.path = path
+        self._open: Dict[date, Tuple[int, DaySnapshot]] = {}
+        self._lock = threading.Lock()
+        self.days_from_snapshots = 0
+        self.days_from_database = 0
+        self.days_built = 0
+        self.last_build_seconds: Optional[float] = None
+
+    def load(self, _day: date) -> Optional[DaySnapshot]:
+        """The snapshot of a day, if it was exported
+
+        Opened snapshots are kept until their directory is replaced.
+
+        Args:
+            _day (date): The day
+
+        Returns:
+            Optional[DaySnapshot]: The memory-mapped snapshot
+        """
+        path = _day_path(_day, self.path)
+        try:
+            inode = os.stat(path).st_ino
+        except FileNotFoundError:
+            self._open.pop(_day, None)
+            return None
+
+        cached = self._open.get(_day)
+        if cached is not None and cached[0] == inode:
+            return cached[1]
+
+        try:
+            with open(os.path.join(path, SECTIONS_FILE),
+                      encoding='utf-8') as sections:
+                snapshot = DaySnapshot(
+                    _day, [tuple(ids) for ids in json.load(sections)],
+                    {column: np.load(os.path.join(path, f'{column}.npy'),
+                                     mmap_mode='r')
+                     for column in COLUMNS})
+        except (OSError, ValueError):
+            # Invalidated while it was being opened
+            return None
+
+        with self._lock:
+            self._open[_day] = (inode, snapshot)
+        return snapshot
+
+    def invalidate(self, _days: Optional[Iterable[date]] = None) -> None:
+        """Drops the snapshots of some days, or all of them
+
+        Args:
+            _days (Optional[Iterable[date]]): The days. Defaults to every day.
+        """
+        if _days is None:
+            _write_marker(ALL_DAYS_MARKER, self.path)
+            _days = [date.fromisoformat(name) for name in self._stored_days()]
+        else:
+            _days = list(_days)
+            for day in _days:
+                _write_marker(f'{day.isoformat()}{MARKER_SUFFIX}', self.path)
+        for day in _days:
+            self._drop(day)
+
+    def _drop(self, _day: date) -> None:
+        shutil.rmtree(_day_path(_day, self.path), ignore_errors=True)
+        with self._lock:
+            self._open.pop(_day, None)
+
+    def _stored_days(self) -> List[str]:
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(name for name in os.listdir(self.path)
+                      if not name.endswith(('.tmp', MARKER_SUFFIX)))
+
+    def build_missing(self, _today: Optional[date] = None) -> int:
+        """Exports the closed days that have no snapshot and prunes old ones
+
+        Args:
+            _today (Optional[date]): The current day. Defaults to today.
+
+        Returns:
+            int: The number of days exported
+        """
+        started = time.perf_counter()
+        last = last_closed_day() if _today is None \
+            else _today - timedelta(days=1)
+        first = last - timedelta(days=SNAPSHOT_HISTORY_DAYS - 1)
+
+        for name in self._stored_days():
+            if date.fromisoformat(name) < first:
+                self._drop(date.fromisoformat(name))
+        for name in os.listdir(self.path) if os.path.isdir(self.path) else []:
+            if name.endswith(MARKER_SUFFIX) and name != ALL_DAYS_MARKER \
+                    and date.fromisoformat(name[:-len(MARKER_SUFFIX)]) < first:
+                os.remove(_marker_path(name, self.path))
+
+        # Archived days are read from the archive instead
+        watermark = archive_watermark()
+        if watermark is not None:
+            first = max(first, watermark.date())
+
+        built = 0
+        with SessionLocal() as _db:
+            for offset in range((last - first).days + 1):
+                day = first + timedelta(days=offset)
+                if not os.path.isdir(_day_path(day, self.path)):
+                    try:
+                        build_day_snapshot(_db, day, self.path)
+                    except RuntimeError as e:
+                        # Exported again on the next run
+                        logger.warning('%s', e)
+                        continue
+                    built += 1
+                    self.days_built += 1
+
+        self.last_build_seconds = time.perf_counter() - started
+        return built
+
+    def metrics(self) -> Dict:
+        """The stored days and where the analytics read their days from
+
+        Returns:
+            Dict: The current metrics
+        """
+        return {
+            'stored_days': len(self._stored_days()),
+            'open_days': len(self._open),
+            'days_from_snapshots_total': self.days_from_snapshots,
+            'days_from_database_total': self.days_from_database,
+            'days_built_total': self.days_built,
+            'last_build_seconds': self.last_build_seconds
+        }
+
+
+incident_snapshots = IncidentSnapshots()
+
+
+def invalidate_snapshot_days(_days: Optional[Iterable[date]] = None) -> None:
+    """Drops the snapshots of the days whose incidents changed
+
+    Args:
+        _days (Optional[Iterable[date]]): The days. Defaults to every day.
+    """
+    incident_snapshots.invalidate(_days)
+
+
+def _day_runs(_days: List[date]) -> List[Tuple[date, date]]:
+    """Groups sorted days into runs of consecutive days"""
+    runs: List[Tuple[date, date]] = []
+    for day in _days:
+        if runs and runs[-1][1] + timedelta(days=1) == day:
+            runs[-1] = (runs[-1][0], day)
+        else:
+            runs.append((day, day))
+    return runs
+
+
+def daily_section_totals(
+    _db: Session, _first: date, _last: date
+) -> List[Tuple]:
+    """The incident count and loss of every store section per day
+
+    Snapshotted days are aggregated from their memory-mapped columns, the
+    others with one grouped query per run of consecutive days, plus the
+    archive for the days it may hold.
+
+    Args:
+        _db (Session): The database session
+        _first (date): The first day
+        _last (date): The last day, included
+
+    Returns:
+        List[Tuple]: The store, section, day, count and loss of every
+            section that had incidents on a day
+    """
+    rows: List[Tuple] = []
+    uncovered: List[date] = []
+    for offset in range((_last - _first).days + 1):
+        day = _first + timedelta(days=offset)
+        snapshot = incident_snapshots.load(day)
+        if snapshot is None:
+            uncovered.append(day)
+            continue
+
+        codes = snapshot.columns['section']
+        counts = np.bincount(codes, minlength=len(snapshot.sections))
+        losses = np.bincount(codes, weights=snapshot.columns['loss_value'],
+                             minlength=len(snapshot.sections))
+        for code in np.nonzero(counts)[0]:
+            _, store_id, store_section_id = snapshot.sections[code]
+            rows.append((store_id, store_section_id, day, int(counts[code]),
+                         float(losses[code])))
+    incident_snapshots.days_from_snapshots += \
+        (_last - _first).days + 1 - len(uncovered)
+    incident_snapshots.days_from_database += len(uncovered)
+
+    day = func.date(Incidents.created_at)
+    for first, last in _day_runs(uncovered):
+        start, end = _day_bounds(first)[0], _day_bounds(last)[1]
+        if reaches_archive(start):
+            rows.extend(archived_daily_section_totals(_db, start, end))
+        rows.extend(_db.execute(
+            select(Incidents.store_id, Incidents.store_section_id, day,
+                   func.count(), func.coalesce(func.sum(
+                       Incidents.product_price * Incidents.product_quantity),
+                       0.0))
+            .where(Incidents.created_at >= start, Incidents.created_at < end)
+            .group_by(Incidents.store_id, Incidents.store_section_id, day)
+        ).all())
+    return rows
+
+
+_builder: Optional[asyncio.Task] = None
+
+
+async def _build_periodically() -> None:
+    while True:
+        try:
+            built = await asyncio.to_thread(incident_snapshots.build_missing)
+            if built:
+                logger.info('Exported %s incident days to %s', built,
+                            incident_snapshots.path)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('The incident snapshot builder failed')
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+
+
+async def start_incident_snapshots() -> None:
+    """Starts the periodic snapshot builder"""
+    global _builder  # pylint: disable=global-statement
+
+    _builder = asyncio.create_task(_build_periodically())
+
+
+async def stop_incident_snapshots() -> None:
+    """Stops the periodic snapshot builder"""
+    global _builder  # pylint: disable=global-statement
+
+    if _builder is not None:
+        _builder.cancel()
+        _builder = None
@@ -1,105 +1,224 @@
 """The file containing the service functions for the incidents data"""
-from typing import List
+import asyncio
+from datetime import datetime
+from typing import List, Optional, Tuple
 from uuid import UUID
 
+from sqlalchemy import bindparam, delete, select, update
 from sqlalchemy.orm import Session
 
 from models.models import Incidents
+from schemas.fieldsets_schema import (batch_select, order_batch,
+                                     selectable_fields, sparse_select)
 from schemas.incidents_schema import (CreateIncident, ReadIncident,
                                       UpdateIncident)
+from services.archive_services import archived_incidents, reaches_archive
+from services.cache_services import invalidate_region_summaries
+from services.idempotency_services import (IdempotencyKeyTaken,
+                                           claim_idempotency_keys,
+                                           request_hash, stored_response)
+from services.incident_feed_services import publish_incident_event
+from services.incident_snapshot_services import invalidate_snapshot_days
+from services.product_sketch_services import observe_incident
+
+INCIDENT_FIELDS = selectable_fields(ReadIncident, Incidents)
+
+# The hot statements are built once at import. Values are bound per call, so a
+# request only looks its statement up in SQLAlchemy's compiled cache.
+SELECT_INCIDENTS_IN_A_REGION = select(Incidents) \
+    .where(Incidents.region_id == bindparam('region_id'))
+SELECT_INCIDENTS_IN_A_STORE = select(Incidents) \
+    .where(Incidents.store_id == bindparam('store_id'))
+SELECT_INCIDENTS_IN_A_STORE_SECTION = select(Incidents) \
+    .where(Incidents.store_section_id == bindparam('store_section_id'))
+SELECT_INCIDENTS_BY_AN_EMPLOYEE = select(Incidents) \
+    .where(Incidents.employee_id == bindparam('employee_id'))
+SELECT_AN_INCIDENT = select(Incidents) \
+    .where(Incidents.incident_id == bindparam('incident_id'))
+# A Core statement, so the SET clause follows the keys of the bound values
+UPDATE_AN_INCIDENT = update(Incidents.__table__) \
+    .where(Incidents.__table__.c.incident_id == bindparam('_incident_id'))
+DELETE_AN_INCIDENT = delete(Incidents) \
+    .where(Incidents.incident_id == bindparam('incident_id')) \
+    .execution_options(synchronize_session=False)
 
 
 async def create_incident_service(
-        _incident_data: CreateIncident, _db: Session) -> ReadIncident:
+        _incident_data: CreateIncident,
+        _db: Session,
+        _idempotency_key: Optional[str] = None) -> ReadIncident:
     """The service function for creating incidents in the database
 
     Args:
         _incident_data (CreateIncident): The incident data
         _db (Session): The database session
+        _idempotency_key (Optional[str]): Store the response under this key
+
+    Raises:
+        IdempotencyKeyTaken: A concurrent request stored the key first
 
     Returns:
         ReadIncident: The newly created incident
     """
     incident = Incidents(**_incident_data.model_dump())
     _db.add(incident)
+    _db.flush()
+    if _idempotency_key and not claim_idempotency_keys(_db, [stored_response(
+            _idempotency_key, request_hash(_incident_data), 201,
+            ReadIncident.model_validate(incident).model_dump_json())]):
+        _db.rollback()
+        raise IdempotencyKeyTaken(_idempotency_key)
+    publish_incident_event(_db, incident, 'created')
     _db.commit()
     _db.refresh(incident)
+    observe_incident(incident)
+    invalidate_region_summaries(incident.region_id)
     return incident
 
 
+async def _retrieve_incidents(
+    _column: str,
+    _value,
+    _statement,
+    _db: Session,
+    _fields: Optional[Tuple[str, ...]],
+    _start: Optional[datetime],
+    _end: Optional[datetime]
+) -> List[ReadIncident]:
+    """Lists the incidents with a column value, from the archive as well when
+    the range reaches past its watermark"""
+    # created_at is stored as naive local time
+    _start, _end = (
+        moment.astimezone().replace(tzinfo=None)
+        if moment is not None and moment.tzinfo is not None else moment
+        for moment in (_start, _end))
+    statement = sparse_select(Incidents, _fields, _column) if _fields \
+        else _statement
+    if _start is not None:
+        statement = statement.where(Incidents.created_at >= _start)
+    if _end is not None:
+        statement = statement.where(Incidents.created_at < _end)
+
+    result = await asyncio.to_thread(_db.execute, statement, {_column: _value})
+    incidents = result.all() if _fields else result.scalars().all()
+    if not reaches_archive(_start):
+        return incidents
+
+    archived = await asyncio.to_thread(
+        archived_incidents, _db, _column, _value, _start, _end)
+    return archived + list(incidents)
+
+
 async def retrieve_all_incidents_in_a_region_service(
     _region_id: UUID,
-    _db: Session
+    _db: Session,
+    _fields: Optional[Tuple[str, ...]] = None,
+    _start: Optional[datetime] = None,
+    _end: Optional[datetime] = None
 ) -> List[ReadIncident]:
     """The service used to fetch all incidents from the database
 
     Args:
         _db (Session): The database session
+        _fields (Optional[Tuple[str, ...]]): Only select these columns
+        _start (Optional[datetime]): Only incidents created from then on
+        _end (Optional[datetime]): Only incidents created before then
 
     Returns:
         List[ReadIncident]: A list of the incidents fetched
     """
-    return _db.query(Incidents).filter(Incidents.region_id == _region_id).all()
+    return await _retrieve_incidents(
+        'region_id', _region_id, SELECT_INCIDENTS_IN_A_REGION, _db, _fields,
+        _start, _end)
 
 
 async def retrieve_all_incidents_in_a_store_service(
     _store_id: UUID,
-    _db: Session
+    _db: Session,
+    _fields: Optional[Tuple[str, ...]] = None,
+    _start: Optional[datetime] = None,
+    _end: Optional[datetime] = None
 ) -> List[ReadIncident]:
     """The service used to fetch all incidents from the database
 
     Args:
         _db (Session): The database session
+        _fields (Optional[Tuple[str, ...]]): Only select these columns
+        _start (Optional[datetime]): Only incidents created from then on
+        _end (Optional[datetime]): Only incidents created before then
 
     Returns:
         List[ReadIncident]: A list of the incidents fetched
     """
-    return _db.query(Incidents).filter(Incidents.store_id == _store_id).all()
+    return await _retrieve_incidents(
+        'store_id', _store_id, SELECT_INCIDENTS_IN_A_STORE, _db, _fields,
+        _start, _end)
 
 
 async def retrieve_all_incidents_in_a_store_section_service(
     _store_section_id: UUID,
-    _db: Session
+    _db: Session,
+    _fields: Optional[Tuple[str, ...]] = None,
+    _start: Optional[datetime] = None,
+    _end: Optional[datetime] = None
 ) -> List[ReadIncident]:
     """The service used to fetch all incidents from the database
 
     Args:
         _db (Session): The database session
+        _fields (Optional[Tuple[str, ...]]): Only select these columns
+        _start (Optional[datetime]): Only incidents created from then on
+        _end (Optional[datetime]): Only incidents created before then
 
     Returns:
         List[ReadIncident]: A list of the incidents fetched
     """
-    return _db.query(Incidents).filter(Incidents.store_section_id == _store_section_id).all()
+    return await _retrieve_incidents(
+        'store_section_id', _store_section_id,
+        SELECT_INCIDENTS_IN_A_STORE_SECTION, _db, _fields, _start, _end)
 
 
 async def retrieve_all_incidents_reported_by_an_employee_service(
     _employee_id: str,
-    _db: Session
+    _db: Session,
+    _fields: Optional[Tuple[str, ...]] = None,
+    _start: Optional[datetime] = None,
+    _end: Optional[datetime] = None
 ) -> List[ReadIncident]:
     """The service used to fetch all incidents from the database
 
     Args:
         _db (Session): The database session
+        _fields (Optional[Tuple[str, ...]]): Only select these columns
+        _start (Optional[datetime]): Only incidents created from then on
+        _end (Optional[datetime]): Only incidents created before then
 
     Returns:
         List[ReadIncident]: A list of the incidents fetched
     """
-    return _db.query(Incidents).filter(Incidents.employee_id == _employee_id).all()
+    return await _retrieve_incidents(
+        'employee_id', _employee_id, SELECT_INCIDENTS_BY_AN_EMPLOYEE, _db,
+        _fields, _start, _end)
 
 
 async def retrieve_a_single_incident_service(
         _incident_id: UUID,
-        _db: Session) -> ReadIncident:
+        _db: Session,
+        _fields: Optional[Tuple[str, ...]] = None) -> ReadIncident:
     """The service function to retrieve a single incident
 
     Args:
         _incident_id (UUID): The id of the incident
         _db (Session): The database session
+        _fields (Optional[Tuple[str, ...]]): Only select these columns
 
     Returns:
         ReadIncident: The retrieved incident
     """
-    return _db.query(Incidents).filter(Incidents.incident_id == _incident_id).first()
+    if _fields:
+        return _db.execute(sparse_select(Incidents, _fields, 'incident_id'),
+                           {'incident_id': _incident_id}).first()
+    return _db.scalars(SELECT_AN_INCIDENT, {'incident_id': _incident_id}).first()
 
 
 async def update_an_incident_service(
@@ -116,11 +235,18 @@ async def update_an_incident_service(
     Returns:
         ReadIncident: The updated incident
     """
-    _db.query(Incidents).filter(Incidents.incident_id == _incident_id).update(
-        _update_incident_data.model_dump())
+    _db.execute(UPDATE_AN_INCIDENT, {
+        '_incident_id': _incident_id, **_update_incident_data.model_dump()})
+
+    incident = await retrieve_a_single_incident_service(_incident_id, _db)
+    if incident:
+        publish_incident_event(_db, incident, 'updated')
 
     _db.commit()
-    return await retrieve_a_single_incident_service(_incident_id, _db)
+    if incident:
+        invalidate_region_summaries(incident.region_id)
+        invalidate_snapshot_days([incident.created_at.date()])
+    return incident
 
 
 async def delete_an_incident_service(
@@ -132,5 +258,37 @@ async def delete_an_incident_service(
         _incident_id (UUID): The id of the incident in the database
         _db (Session): The database session
     """
-    _db.query(Incidents).filter(Incidents.incident_id == _incident_id).delete()
+    incident = await retrieve_a_single_incident_service(_incident_id, _db)
+    if not incident:
+        return
+
+    region_id = incident.region_id
+    day = incident.created_at.date()
+    publish_incident_event(_db, incident, 'deleted')
+    _db.execute(DELETE_AN_INCIDENT, {'incident_id': _incident_id})
     _db.commit()
+    invalidate_region_summaries(region_id)
+    invalidate_snapshot_days([day])
+
+
+async def retrieve_incidents_by_ids_service(
+    _ids: List[UUID],
+    _db: Session,
+    _fields: Optional[Tuple[str, ...]] = None
+) -> Tuple[List[ReadIncident], List[UUID]]:
+    """The service function fetching many incidents in one query
+
+    Args:
+        _ids (List[UUID]): The ids of the incidents
+        _db (Session): The database session
+        _fields (Optional[Tuple[str, ...]]): Only select these columns
+
+    Returns:
+        Tuple[List[ReadIncident], List[UUID]]: The incidents found, in
+            request order, and the ids that were not found
+    """
+    result = await asyncio.to_thread(
+        _db.execute, batch_select(Incidents, _fields, 'incident_id'),
+        {'ids': list(dict.fromkeys(_ids))})
+    rows = result.all() if _fields else result.scalars().all()
+    return order_batch(_ids, rows, 'incident_id')
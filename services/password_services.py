@@ -0,0 +1,183 @@
+"""The file containing the bounded pool hashing the passwords
+
+A bcrypt hash or check costs about 100 ms of CPU at the default cost factor,
+long enough to stall every request of the worker if it ran on the event
+loop. They run on a pool of their own instead, ``PASSWORD_HASH_WORKERS``
+threads wide: bcrypt releases the GIL while it hashes, so the threads use as
+many cores and the event loop keeps serving. A burst of logins cannot take
+over the default executor the database calls run on either.
+
+At most ``PASSWORD_HASH_MAX_WAITING`` calls wait for a thread. Past that the
+worker answers busy rather than queueing logins that would time out anyway.
+
+Hashes made with fewer than ``BCRYPT_ROUNDS`` rounds are reported as needing
+an update when they are verified, so raising the cost factor upgrades every
+employee's hash at their next login.
+"""
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from dotenv import find_dotenv, load_dotenv
+from passlib.context import CryptContext
+
+load_dotenv(find_dotenv())
+
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+PASSWORD_HASH_WORKERS = int(os.environ.get(
+    'PASSWORD_HASH_WORKERS', str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_MAX_WAITING = int(
+    os.environ.get('PASSWORD_HASH_MAX_WAITING', '64'))
+
+password_context = CryptContext(schemes=['bcrypt'], deprecated='auto',
+                                bcrypt__default_rounds=BCRYPT_ROUNDS,
+                                bcrypt__min_rounds=BCRYPT_ROUNDS)
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many calls already wait for the hashing pool"""
+
+
+class PasswordHasher:
+    """The pool running the bcrypt hashes and checks
+
+    Args:
+        workers (int): The number of hashing threads
+        max_waiting (int): The number of calls allowed to wait for a thread
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS,
+                 max_waiting: int = PASSWORD_HASH_MAX_WAITING) -> None:
+        self.workers = workers
+        self.max_waiting = max_waiting
+        self.hashed = 0
+        self.verified = 0
+        self.rehashed = 0
+        self.rejected = 0
+        self.calls = 0
+        self.seconds = 0.0
+        self.in_flight = 0
+        self.waiting = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._dummy_hash: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """Starts the hashing threads"""
+        self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix='password')
+        self._semaphore = asyncio.Semaphore(self.workers)
+
+    def stop(self) -> None:
+        """Stops the hashing threads once their current calls are done"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _timed(self, _function, *args):
+        started = time.perf_counter()
+        try:
+            return _function(*args)
+        finally:
+            with self._lock:
+                self.calls += 1
+                self.seconds += time.perf_counter() - started
+
+    async def _run(self, _function, *args):
+        if self._executor is None:
+            raise RuntimeError('The password hasher is not started')
+        if self._semaphore.locked() and self.waiting >= self.max_waiting:
+            self.rejected += 1
+            raise PasswordHasherBusy('Too many logins at once, retry later')
+
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._timed, _function, *args)
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    async def hash(self, _password: str) -> str:
+        """Hashes a password at the current cost factor
+
+        Args:
+            _password (str): The password
+
+        Raises:
+            PasswordHasherBusy: Too many calls already wait for the pool
+
+        Returns:
+            str: The bcrypt hash
+        """
+        hashed_password = await self._run(password_context.hash, _password)
+        self.hashed += 1
+        return hashed_password
+
+    async def verify_and_update(
+        self, _password: str, _hashed_password: Optional[str]
+    ) -> Tuple[bool, Optional[str]]:
+        """Checks a password, and rehashes it when its cost factor is outdated
+
+        Without a hash, e.g. for an unknown email, the password is checked
+        against a dummy hash so the answer takes as long as for a known one.
+
+        Args:
+            _password (str): The password
+            _hashed_password (Optional[str]): The stored hash, if any
+
+        Raises:
+            PasswordHasherBusy: Too many calls already wait for the pool
+
+        Returns:
+            Tuple[bool, Optional[str]]: Whether the password matches, and the
+                new hash to store when it was rehashed
+        """
+        if _hashed_password is None:
+            if self._dummy_hash is None:
+                self._dummy_hash = await self._run(password_context.hash, '')
+            await self._run(password_context.verify, _password,
+                            self._dummy_hash)
+            return False, None
+
+        valid, new_hash = await self._run(password_context.verify_and_update,
+                                          _password, _hashed_password)
+        self.verified += 1
+        if new_hash is not None:
+            self.rehashed += 1
+        return valid, new_hash
+
+    def metrics(self) -> Dict:
+        """The counters of the pool
+
+        Returns:
+            Dict: The current metrics
+        """
+        return {'workers': self.workers, 'rounds': BCRYPT_ROUNDS,
+                'in_flight': self.in_flight, 'waiting': self.waiting,
+                'hashed_total': self.hashed, 'verified_total': self.verified,
+                'rehashed_total': self.rehashed,
+                'rejected_total': self.rejected,
+                'mean_seconds': self.seconds / self.calls if self.calls else None}
+
+
+password_hasher = PasswordHasher()
+
+
+async def start_password_hasher() -> None:
+    """Starts the threads hashing the passwords"""
+    password_hasher.start()
+
+
+async def stop_password_hasher() -> None:
+    """Stops the threads hashing the passwords"""
+    password_hasher.stop()
@@ -0,0 +1,550 @@
+"""The file containing the streaming product sketches
+
+Every store keeps a Space-Saving summary and a Count-Min sketch of loss value
+(price times quantity) per product, and every store and region keeps a
+HyperLogLog of the distinct products with incidents. The sketches are fed by
+the incident create path, rebuilt from the incidents table when missing and
+pickled to disk periodically, so dashboards never scan the table.
+
+Every worker also catches up with the table periodically, reading the
+incidents created after its watermark, so the sketches include the incidents
+written by the other workers or while the application was down. The
+watermark is the latest creation time folded in. Rows stamped before it can
+still commit late, so each pass rereads a margin behind it and skips the
+incidents it already holds.
+"""
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import pickle
+import threading
+from collections.abc import Mapping
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple, Union
+from uuid import UUID
+
+import numpy as np
+from dotenv import find_dotenv, load_dotenv
+from sqlalchemy import bindparam, select
+from sqlalchemy.orm import Session
+
+from database.db import SessionLocal, read_session
+from models.models import Incidents
+from schemas.sketches_schema import (DistinctProducts, ProductLoss,
+                                     StoreTopProducts)
+
+load_dotenv(find_dotenv())
+
+logger = logging.getLogger(__name__)
+
+SKETCH_STORE_PATH = os.environ.get(
+    'SKETCH_STORE_PATH', 'data/product_sketches.pickle')
+SKETCH_PERSIST_INTERVAL = float(
+    os.environ.get('SKETCH_PERSIST_INTERVAL', '300'))
+SKETCH_TOP_CAPACITY = int(os.environ.get('SKETCH_TOP_CAPACITY', '200'))
+SKETCH_CMS_EPSILON = float(os.environ.get('SKETCH_CMS_EPSILON', '0.01'))
+SKETCH_CMS_DELTA = float(os.environ.get('SKETCH_CMS_DELTA', '0.01'))
+SKETCH_HLL_PRECISION = int(os.environ.get('SKETCH_HLL_PRECISION', '12'))
+SKETCH_CATCH_UP_INTERVAL = float(
+    os.environ.get('SKETCH_CATCH_UP_INTERVAL', '30'))
+# Longer than an incident may wait between being stamped and committed,
+# queueing and retries in the ingestion included
+SKETCH_CATCH_UP_MARGIN = timedelta(
+    seconds=float(os.environ.get('SKETCH_CATCH_UP_MARGIN', '300')))
+
+SKETCHED_COLUMNS = (Incidents.incident_id, Incidents.created_at,
+                    Incidents.store_id, Incidents.region_id,
+                    Incidents.product_code, Incidents.product_name,
+                    Incidents.product_price, Incidents.product_quantity)
+SELECT_SKETCHED_INCIDENTS = select(*SKETCHED_COLUMNS) \
+    .execution_options(yield_per=10000)
+SELECT_INCIDENTS_CREATED_AFTER = select(*SKETCHED_COLUMNS) \
+    .where(Incidents.created_at > bindparam('after')) \
+    .order_by(Incidents.created_at) \
+    .execution_options(yield_per=10000)
+
+
+def _hash64(_key: str) -> int:
+    """A stable 64 bit hash, identical across workers and restarts"""
+    return int.from_bytes(
+        hashlib.blake2b(_key.encode(), digest_size=8).digest(), 'big')
+
+
+class CountMinSketch:
+    """A weighted Count-Min sketch
+
+    Estimates never undercount and overcount by at most ``epsilon`` times the
+    total weight with probability ``1 - delta``.
+
+    Args:
+        epsilon (float): The additive error as a fraction of the total weight
+        delta (float): The probability of exceeding that error
+    """
+
+    def __init__(self, epsilon: float = SKETCH_CMS_EPSILON,
+                 delta: float = SKETCH_CMS_DELTA) -> None:
+        self.epsilon = epsilon
+        self.delta = delta
+        self.width = math.ceil(math.e / epsilon)
+        self.depth = math.ceil(math.log(1 / delta))
+        self.table = np.zeros((self.depth, self.width), dtype=np.float64)
+        self.total = 0.0
+
+    def _columns(self, _key: str) -> np.ndarray:
+        hashed = _hash64(_key)
+        first, second = hashed & 0xFFFFFFFF, hashed >> 32 | 1
+        return (first + np.arange(self.depth) * second) % self.width
+
+    def add(self, _key: str, _weight: float) -> None:
+        """Adds weight to a key"""
+        self.table[np.arange(self.depth), self._columns(_key)] += _weight
+        self.total += _weight
+
+    def estimate(self, _key: str) -> float:
+        """The upper estimate of a key's weight"""
+        return float(self.table[np.arange(self.depth), self._columns(_key)].min())
+
+
+class SpaceSaving:
+    """A weighted Space-Saving heavy hitter summary
+
+    Every key heavier than ``total / capacity`` is kept, and a kept key's
+    count overestimates its true weight by at most its recorded error.
+
+    Args:
+        capacity (int): The number of counters kept
+    """
+
+    def __init__(self, capacity: int = SKETCH_TOP_CAPACITY) -> None:
+        self.capacity = capacity
+        self.counters: Dict[str, List[float]] = {}
+        self.total = 0.0
+
+    def add(self, _key: str, _weight: float) -> None:
+        """Adds weight to a key, evicting the lightest counter when full"""
+        self.total += _weight
+        counter = self.counters.get(_key)
+
+        if counter is not None:
+            counter[0] += _weight
+        elif len(self.counters) < self.capacity:
+            self.counters[_key] = [_weight, 0.0]
+        else:
+            lightest = min(self.counters, key=lambda key: self.counters[key][0])
+            floor = self.counters.pop(lightest)[0]
+            self.counters[_key] = [floor + _weight, floor]
+
+    def top(self, _limit: int) -> List[Tuple[str, float, float]]:
+        """The heaviest keys
+
+        Args:
+            _limit (int): The number of keys returned
+
+        Returns:
+            List[Tuple[str, float, float]]: The key, count and error triples
+        """
+        ranked = sorted(self.counters.items(), key=lambda item: item[1][0],
+                        reverse=True)
+        return [(key, count, error) for key, (count, error) in ranked[:_limit]]
+
+
+class HyperLogLog:
+    """A HyperLogLog distinct counter
+
+    Args:
+        precision (int): The number of index bits, ``2 ** precision`` registers
+    """
+
+    def __init__(self, precision: int = SKETCH_HLL_PRECISION) -> None:
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    @property
+    def relative_standard_error(self) -> float:
+        """The standard error of the estimate relative to the true count"""
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def add(self, _key: str) -> None:
+        """Adds a key"""
+        hashed = _hash64(_key)
+        index = hashed >> (64 - self.precision)
+        remainder = (hashed << self.precision) & 0xFFFFFFFFFFFFFFFF
+        rank = min(64 - remainder.bit_length() + 1, 64 - self.precision + 1)
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def estimate(self) -> float:
+        """The estimated number of distinct keys"""
+        registers = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / registers)
+        raw = alpha * registers ** 2 / \
+            np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+
+        if raw <= 2.5 * registers and zeros:
+            return registers * math.log(registers / zeros)
+        return float(raw)
+
+
+class ProductSketches:
+    """The per store and per region product sketches"""
+
+    def __init__(self) -> None:
+        self.store_top: Dict[str, SpaceSaving] = {}
+        self.store_cms: Dict[str, CountMinSketch] = {}
+        self.store_distinct: Dict[str, HyperLogLog] = {}
+        self.region_distinct: Dict[str, HyperLogLog] = {}
+        # The latest creation time folded in, and the incidents created
+        # within the margin behind it, which a catch up skips
+        self.watermark: Optional[datetime] = None
+        self.recent: Dict[str, datetime] = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> Dict:
+        with self._lock:
+            state = self.__dict__.copy()
+            state['recent'] = dict(self.recent)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, _state: Dict) -> None:
+        # Sketches pickled without a watermark cannot be caught up
+        self.watermark = None
+        self.recent = {}
+        self.__dict__.update(_state)
+        self._lock = threading.Lock()
+
+    def observe(self, _incident: Union[Incidents, dict]) -> None:
+        """Feeds one incident into the sketches of its store and region
+
+        Args:
+            _incident (Union[Incidents, dict]): The incident row or mapping
+        """
+        if isinstance(_incident, Mapping):
+            get = _incident.get
+        else:
+            def get(_field):
+                return getattr(_incident, _field)
+
+        incident_id, created_at = str(get('incident_id')), get('created_at')
+        product = get('product_code') or get('product_name')
+        store_id, region_id = str(get('store_id')), str(get('region_id'))
+        loss_value = (get('product_price') or 0.0) * \
+            (get('product_quantity') or 0)
+
+        with self._lock:
+            if incident_id in self.recent:
+                return
+            if created_at is not None:
+                self.recent[incident_id] = created_at
+                if self.watermark is None or created_at > self.watermark:
+                    self.watermark = created_at
+            if not product:
+                return
+            self.store_top.setdefault(store_id, SpaceSaving()).add(
+                product, loss_value)
+            self.store_cms.setdefault(store_id, CountMinSketch()).add(
+                product, loss_value)
+            self.store_distinct.setdefault(store_id, HyperLogLog()).add(product)
+            self.region_distinct.setdefault(region_id, HyperLogLog()).add(product)
+
+    def forget_before(self, _cutoff: datetime) -> None:
+        """Drops the incidents no catch up rereads from the skipped ones
+
+        Args:
+            _cutoff (datetime): The creation time a catch up rereads from
+        """
+        with self._lock:
+            self.recent = {incident_id: created_at for incident_id, created_at
+                           in self.recent.items() if created_at > _cutoff}
+
+    def top_products(self, _store_id: str, _limit: int) -> Dict:
+        """The products with the highest loss value in a store
+
+        Args:
+            _store_id (str): The id of the store
+            _limit (int): The number of products returned
+
+        Returns:
+            Dict: The ranked products and the error bounds that apply to them
+        """
+        with self._lock:
+            top = self.store_top.get(str(_store_id), SpaceSaving())
+            cms = self.store_cms.get(str(_store_id), CountMinSketch())
+            products = [
+                {
+                    'product': product,
+                    'loss_value': min(count, cms.estimate(product)),
+                    'max_overestimate': error
+                }
+                for product, count, error in top.top(_limit)
+            ]
+            return {
+                'store_id': _store_id,
+                'total_loss_value': top.total,
+                'products': products,
+                'guaranteed_threshold': top.total / top.capacity,
+                'count_min_max_error': cms.epsilon * cms.total,
+                'count_min_confidence': 1 - cms.delta
+            }
+
+    def product_loss(self, _store_id: str, _product: str) -> Dict:
+        """The estimated loss value of one product in a store
+
+        Args:
+            _store_id (str): The id of the store
+            _product (str): The product code or name
+
+        Returns:
+            Dict: The upper estimate and its error bound
+        """
+        with self._lock:
+            cms = self.store_cms.get(str(_store_id), CountMinSketch())
+            return {
+                'store_id': _store_id,
+                'product': _product,
+                'loss_value': cms.estimate(_product),
+                'max_overestimate': cms.epsilon * cms.total,
+                'confidence': 1 - cms.delta
+            }
+
+    def distinct_products(self, _kind: str, _object_id: str) -> Dict:
+        """The estimated number of distinct products with incidents
+
+        Args:
+            _kind (str): Either store or region
+            _object_id (str): The id of the store or region
+
+        Returns:
+            Dict: The estimate and its relative standard error
+        """
+        sketches = self.store_distinct if _kind == 'store' else self.region_distinct
+        with self._lock:
+            hll = sketches.get(str(_object_id), HyperLogLog())
+            return {
+                'scope': _kind,
+                'scope_id': _object_id,
+                'distinct_products': round(hll.estimate()),
+                'relative_standard_error': hll.relative_standard_error
+            }
+
+
+product_sketches = ProductSketches()
+
+
+def rebuild_product_sketches(_db: Session) -> ProductSketches:
+    """Rebuilds the sketches with one streamed pass over the incidents table
+
+    Args:
+        _db (Session): The database session
+
+    Returns:
+        ProductSketches: The rebuilt sketches, also swapped in as the live ones
+    """
+    global product_sketches  # pylint: disable=global-statement
+
+    sketches = ProductSketches()
+    for row in _db.execute(SELECT_SKETCHED_INCIDENTS).mappings():
+        sketches.observe(row)
+    if sketches.watermark is not None:
+        sketches.forget_before(sketches.watermark - SKETCH_CATCH_UP_MARGIN)
+
+    product_sketches = sketches
+    return sketches
+
+
+def catch_up_product_sketches(_db: Session) -> int:
+    """Folds the incidents created since the watermark into the live sketches
+
+    Args:
+        _db (Session): The database session
+
+    Returns:
+        int: The number of incidents read
+    """
+    sketches = product_sketches
+    after = sketches.watermark - SKETCH_CATCH_UP_MARGIN \
+        if sketches.watermark is not None else datetime.min
+    read = 0
+    for row in _db.execute(SELECT_INCIDENTS_CREATED_AFTER,
+                           {'after': after}).mappings():
+        sketches.observe(row)
+        read += 1
+    if sketches.watermark is not None:
+        sketches.forget_before(sketches.watermark - SKETCH_CATCH_UP_MARGIN)
+    return read
+
+
+def persist_product_sketches(_path: str = SKETCH_STORE_PATH) -> None:
+    """Atomically writes the live sketches to disk
+
+    Every worker holds the whole table once caught up, so whichever writes
+    last leaves complete sketches.
+
+    Args:
+        _path (str): The file the sketches are pickled to
+    """
+    os.makedirs(os.path.dirname(_path) or '.', exist_ok=True)
+    temporary = f'{_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temporary, 'wb') as file:
+        pickle.dump(product_sketches, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, _path)
+
+
+def load_product_sketches(_path: str = SKETCH_STORE_PATH) -> bool:
+    """Loads the persisted sketches, if any
+
+    Args:
+        _path (str): The file the sketches are pickled to
+
+    Returns:
+        bool: Whether sketches that can be caught up were loaded
+    """
+    global product_sketches  # pylint: disable=global-statement
+
+    if not os.path.exists(_path):
+        return False
+    with open(_path, 'rb') as file:
+        sketches = pickle.load(file)
+    if sketches.watermark is None:
+        return False
+    product_sketches = sketches
+    return True
+
+
+def observe_incident(_incident: Union[Incidents, dict]) -> None:
+    """Feeds a newly written incident into the live sketches
+
+    Args:
+        _incident (Union[Incidents, dict]): The incident row or mapping
+    """
+    product_sketches.observe(_incident)
+
+
+def _rebuild_with_new_session() -> ProductSketches:
+    with read_session() as _db:
+        return rebuild_product_sketches(_db)
+
+
+def _catch_up_with_new_session() -> None:
+    # On the primary, a replica behind by more than the margin would skip
+    # incidents for good
+    with SessionLocal() as _db:
+        catch_up_product_sketches(_db)
+
+
+_persister: Optional[asyncio.Task] = None
+_catcher: Optional[asyncio.Task] = None
+
+
+async def _persist_periodically() -> None:
+    while True:
+        await asyncio.sleep(SKETCH_PERSIST_INTERVAL)
+        try:
+            await asyncio.to_thread(persist_product_sketches)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Persisting the product sketches failed')
+
+
+async def _catch_up_periodically() -> None:
+    while True:
+        await asyncio.sleep(SKETCH_CATCH_UP_INTERVAL)
+        try:
+            await asyncio.to_thread(_catch_up_with_new_session)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Catching up the product sketches failed')
+
+
+async def start_product_sketches() -> None:
+    """Loads and catches up, or rebuilds, the sketches and starts the
+    periodic catch up and persister"""
+    global _persister, _catcher  # pylint: disable=global-statement
+
+    try:
+        if await asyncio.to_thread(load_product_sketches):
+            await asyncio.to_thread(_catch_up_with_new_session)
+        else:
+            await asyncio.to_thread(_rebuild_with_new_session)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception('Loading the product sketches failed')
+
+    _catcher = asyncio.create_task(_catch_up_periodically())
+    _persister = asyncio.create_task(_persist_periodically())
+
+
+async def stop_product_sketches() -> None:
+    """Stops the catch up and the persister and writes the sketches one last
+    time"""
+    global _persister, _catcher  # pylint: disable=global-statement
+
+    if _persister is None:
+        return
+
+    _catcher.cancel()
+    _catcher = None
+    _persister.cancel()
+    _persister = None
+    try:
+        await asyncio.to_thread(persist_product_sketches)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception('Persisting the product sketches failed')
+
+
+async def retrieve_top_products_in_a_store_service(
+    _store_id: UUID, _limit: int
+) -> StoreTopProducts:
+    """The service returning the products with the highest loss in a store
+
+    Args:
+        _store_id (UUID): The id of the store
+        _limit (int): The number of products returned
+
+    Returns:
+        StoreTopProducts: The ranked products with their error bounds
+    """
+    return product_sketches.top_products(str(_store_id), _limit)
+
+
+async def retrieve_product_loss_in_a_store_service(
+    _store_id: UUID, _product: str
+) -> ProductLoss:
+    """The service returning the estimated loss of a product in a store
+
+    Args:
+        _store_id (UUID): The id of the store
+        _product (str): The product code or name
+
+    Returns:
+        ProductLoss: The estimate with its error bound
+    """
+    return product_sketches.product_loss(str(_store_id), _product)
+
+
+async def retrieve_distinct_products_service(
+    _kind: str, _object_id: UUID
+) -> DistinctProducts:
+    """The service returning the distinct products with incidents
+
+    Args:
+        _kind (str): Either store or region
+        _object_id (UUID): The id of the store or region
+
+    Returns:
+        DistinctProducts: The estimate with its relative standard error
+    """
+    return product_sketches.distinct_products(_kind, str(_object_id))
+
+
+async def rebuild_product_sketches_service() -> dict:
+    """The service rebuilding the sketches from the incidents table
+
+    The scan runs off the event loop on its own session.
+
+    Returns:
+        dict: The number of stores and regions sketched
+    """
+    sketches = await asyncio.to_thread(_rebuild_with_new_session)
+    return {'stores': len(sketches.store_top),
+            'regions': len(sketches.region_distinct)}
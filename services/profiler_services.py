@@ -0,0 +1,367 @@
+"""The file containing the on-demand request profiler
+
+A request is profiled when it carries the ``X-Profile`` header with the admin
+token, or when it is drawn at random with ``PROFILE_SAMPLE_RATE``. While at
+least one request is profiled a sampler thread reads the stacks of every
+thread every ``PROFILE_INTERVAL`` seconds and keeps those running for a
+profiled request: the event loop thread while the request's task is the one
+running, and the executor threads while they run one of its ``to_thread``
+calls, as marked by ``services.executor_services.RequestExecutor``. A sample
+where none of them is running is recorded as waiting.
+
+Each profile is written as a collapsed-stack file, the input format of
+``flamegraph.pl`` and speedscope, next to a metadata file with the route, the
+duration and the number of queries. Only the last ``PROFILE_KEEP`` profiles
+are kept.
+
+Nothing of this is installed when neither a token nor a sample rate is set.
+"""
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures.thread import _WorkItem
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+from uuid import UUID
+
+from dotenv import find_dotenv, load_dotenv
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from schemas.profiles_schema import ReadProfile
+
+load_dotenv(find_dotenv())
+
+logger = logging.getLogger(__name__)
+
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', '0.005'))
+PROFILE_MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', '60'))
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', '50'))
+PROFILE_STORE_PATH = os.environ.get(
+    'PROFILE_STORE_PATH', os.path.join('data', 'profiles'))
+PROFILING = bool(ADMIN_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+WAITING = '(waiting)'
+
+# The frames below these belong to the event loop or the executor, not to
+# the request, and are cut off every stack
+_ROOT_CODES = {asyncio.events.Handle._run.__code__,  # pylint: disable=protected-access
+               _WorkItem.run.__code__}
+_PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class RequestProfile:
+    """The samples and counters of one profiled request
+
+    Args:
+        method (str): The HTTP method
+        path (str): The requested path
+        trigger (str): Why the request is profiled, header or sample
+    """
+
+    def __init__(self, method: str, path: str, trigger: str) -> None:
+        self.profile_id = uuid.uuid4()
+        self.method = method
+        self.path = path
+        self.trigger = trigger
+        self.route: Optional[str] = None
+        self.status_code: Optional[int] = None
+        self.created_at = datetime.now()
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.stacks: Counter = Counter()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread: Optional[int] = None
+        self.task: Optional[asyncio.Task] = None
+        # The executor threads running a call of the request
+        self.threads: Set[int] = set()
+        self._started = 0.0
+        self.duration = 0.0
+
+    def start(self) -> None:
+        """Starts recording, from the request's own task"""
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.task = asyncio.current_task()
+        self._started = time.perf_counter()
+
+    def finish(self) -> None:
+        """Stops recording"""
+        self.duration = time.perf_counter() - self._started
+
+    @property
+    def expired(self) -> bool:
+        """Whether the request outlived the longest profile"""
+        return time.perf_counter() - self._started > PROFILE_MAX_SECONDS
+
+    def sample(self, _frames: Dict[int, object]) -> None:
+        """Records the stacks of the threads running for the request
+
+        Args:
+            _frames (Dict[int, object]): The frames of every thread
+        """
+        sampled = False
+        if asyncio.current_task(self.loop) is self.task:
+            frame = _frames.get(self.loop_thread)
+            if frame is not None:
+                self.stacks[_collapse(frame)] += 1
+                sampled = True
+        for thread in list(self.threads):
+            frame = _frames.get(thread)
+            if frame is not None:
+                self.stacks[_collapse(frame)] += 1
+                sampled = True
+        if not sampled:
+            self.stacks[WAITING] += 1
+
+    def collapsed(self) -> str:
+        """The samples in the collapsed-stack format
+
+        Returns:
+            str: One ``root;caller;callee count`` line per distinct stack
+        """
+        root = f'{self.method} {self.route or self.path}'
+        return ''.join(f'{root};{stack} {count}\n'
+                       for stack, count in self.stacks.most_common())
+
+    def metadata(self) -> ReadProfile:
+        """The description of the profile
+
+        Returns:
+            ReadProfile: The route, timings and counters
+        """
+        return ReadProfile(
+            profile_id=self.profile_id, method=self.method, path=self.path,
+            route=self.route, status_code=self.status_code,
+            trigger=self.trigger, created_at=self.created_at,
+            duration=self.duration, samples=sum(self.stacks.values()),
+            queries=self.queries, query_seconds=self.query_seconds)
+
+
+def _frame_name(_code) -> str:
+    filename = _code.co_filename
+    if filename.startswith(_PACKAGE_ROOT):
+        filename = os.path.relpath(filename, _PACKAGE_ROOT)
+    else:
+        filename = os.path.basename(filename)
+    return f'{_code.co_qualname} ({filename}:{_code.co_firstlineno})'
+
+
+def _collapse(_frame) -> str:
+    names: List[str] = []
+    while _frame is not None and _frame.f_code not in _ROOT_CODES:
+        names.append(_frame_name(_frame.f_code))
+        _frame = _frame.f_back
+    return ';'.join(reversed(names))
+
+
+current_profile: ContextVar[Optional[RequestProfile]] = ContextVar(
+    'current_profile', default=None)
+
+
+class Sampler:
+    """The thread sampling the stacks of the profiled requests
+
+    The thread only runs while a request is profiled.
+
+    Args:
+        interval (float): The seconds between two samples
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL) -> None:
+        self.interval = interval
+        self._profiles: Set[RequestProfile] = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, _profile: RequestProfile) -> None:
+        """Starts sampling a request
+
+        Args:
+            _profile (RequestProfile): The profile to fill
+        """
+        with self._lock:
+            self._profiles.add(_profile)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='request-profiler', daemon=True)
+                self._thread.start()
+
+    def remove(self, _profile: RequestProfile) -> None:
+        """Stops sampling a request
+
+        Args:
+            _profile (RequestProfile): The profile
+        """
+        with self._lock:
+            self._profiles.discard(_profile)
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                profiles = [profile for profile in self._profiles
+                            if not profile.expired]
+                if not profiles:
+                    self._thread = None
+                    return
+            frames = sys._current_frames()  # pylint: disable=protected-access
+            for profile in profiles:
+                profile.sample(frames)
+            del frames
+            time.sleep(self.interval)
+
+
+sampler = Sampler()
+
+
+class ProfileStore:
+    """The bounded on-disk store of the last profiles
+
+    Args:
+        path (str): The directory of the store
+        keep (int): The number of profiles kept
+    """
+
+    def __init__(self, path: str = PROFILE_STORE_PATH,
+                 keep: int = PROFILE_KEEP) -> None:
+        self.path = path
+        self.keep = keep
+        self.saved = 0
+
+    def _file(self, _profile_id: UUID, _suffix: str) -> str:
+        return os.path.join(self.path, f'{_profile_id}{_suffix}')
+
+    def save(self, _profile: RequestProfile) -> None:
+        """Writes a profile and drops the oldest beyond the bound
+
+        Args:
+            _profile (RequestProfile): The finished profile
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._file(_profile.profile_id, '.collapsed'), 'w',
+                  encoding='utf-8') as file:
+            file.write(_profile.collapsed())
+        # The metadata last, a profile is listed once its stacks are written
+        with open(self._file(_profile.profile_id, '.json'), 'w',
+                  encoding='utf-8') as file:
+            file.write(_profile.metadata().model_dump_json())
+        self.saved += 1
+
+        for profile in self.list()[self.keep:]:
+            for suffix in ('.json', '.collapsed'):
+                try:
+                    os.remove(self._file(profile.profile_id, suffix))
+                except FileNotFoundError:
+                    pass
+
+    def list(self) -> List[ReadProfile]:
+        """The stored profiles, the newest first
+
+        Returns:
+            List[ReadProfile]: The metadata of the profiles
+        """
+        if not os.path.isdir(self.path):
+            return []
+        profiles = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.path, name),
+                          encoding='utf-8') as file:
+                    profiles.append(ReadProfile(**json.load(file)))
+            except (OSError, ValueError):
+                continue
+        return sorted(profiles, key=lambda profile: profile.created_at,
+                      reverse=True)
+
+    def get(self, _profile_id: UUID) -> Optional[ReadProfile]:
+        """The metadata of a stored profile
+
+        Args:
+            _profile_id (UUID): The id of the profile
+
+        Returns:
+            Optional[ReadProfile]: The profile, if still stored
+        """
+        try:
+            with open(self._file(_profile_id, '.json'),
+                      encoding='utf-8') as file:
+                return ReadProfile(**json.load(file))
+        except FileNotFoundError:
+            return None
+
+    def collapsed_path(self, _profile_id: UUID) -> Optional[str]:
+        """The collapsed-stack file of a stored profile
+
+        Args:
+            _profile_id (UUID): The id of the profile
+
+        Returns:
+            Optional[str]: The path of the file, if still stored
+        """
+        path = self._file(_profile_id, '.collapsed')
+        return path if os.path.exists(path) else None
+
+    def metrics(self) -> Dict:
+        """The counters of the profiler
+
+        Returns:
+            Dict: The current metrics
+        """
+        return {'enabled': PROFILING, 'sample_rate': PROFILE_SAMPLE_RATE,
+                'saved_total': self.saved}
+
+
+profile_store = ProfileStore()
+
+
+def _count_query_start(_conn, _cursor, _statement, _parameters, context,
+                       _executemany) -> None:
+    if current_profile.get() is not None:
+        context.profile_query_started = time.perf_counter()
+
+
+def _count_query_end(_conn, _cursor, _statement, _parameters, context,
+                     _executemany) -> None:
+    profile = current_profile.get()
+    if profile is not None:
+        profile.queries += 1
+        profile.query_seconds += time.perf_counter() - getattr(
+            context, 'profile_query_started', time.perf_counter())
+
+
+if PROFILING:
+    event.listen(Engine, 'before_cursor_execute', _count_query_start)
+    event.listen(Engine, 'after_cursor_execute', _count_query_end)
+
+
+async def list_profiles_service() -> List[ReadProfile]:
+    """The service listing the stored profiles
+
+    Returns:
+        List[ReadProfile]: The profiles, the newest first
+    """
+    return await asyncio.to_thread(profile_store.list)
+
+
+async def retrieve_profile_service(_profile_id: UUID) -> Optional[ReadProfile]:
+    """The service returning a stored profile
+
+    Args:
+        _profile_id (UUID): The id of the profile
+
+    Returns:
+        Optional[ReadProfile]: The profile, if still stored
+    """
+    return await asyncio.to_thread(profile_store.get, _profile_id)
+
@@ -0,0 +1,253 @@
+"""The file containing the background purges of large subtrees
+
+Deleting a region, store or store section relies on the ``ON DELETE CASCADE``
+of the foreign keys. A subtree with more than ``PURGE_SYNC_LIMIT`` incidents
+is not deleted in the request: a purge job is recorded instead, and a
+background worker deletes its incidents ``PURGE_BATCH_SIZE`` at a time, each
+batch in its own short transaction, before deleting the row itself. This
+bounds both the lock time and the WAL written at once.
+
+The jobs live in the database, so any worker can report their progress and a
+job abandoned by a stopped worker is taken over once its heartbeat is stale.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+from uuid import UUID
+
+from dotenv import find_dotenv, load_dotenv
+from sqlalchemy import bindparam, select, text, update
+from sqlalchemy.orm import Session
+
+from database.db import SessionLocal
+from models.models import PurgeJobs
+from schemas.purges_schema import PurgeStatus, PurgeTarget
+from services.cache_services import (invalidate_hierarchy,
+                                     region_summary_cache)
+from services.incident_snapshot_services import invalidate_snapshot_days
+
+load_dotenv(find_dotenv())
+
+logger = logging.getLogger(__name__)
+
+PURGE_SYNC_LIMIT = int(os.environ.get('PURGE_SYNC_LIMIT', '10000'))
+PURGE_BATCH_SIZE = int(os.environ.get('PURGE_BATCH_SIZE', '5000'))
+PURGE_BATCH_PAUSE = float(os.environ.get('PURGE_BATCH_PAUSE', '0.05'))
+PURGE_POLL_INTERVAL = float(os.environ.get('PURGE_POLL_INTERVAL', '10'))
+PURGE_STALE_AFTER = float(os.environ.get('PURGE_STALE_AFTER', '120'))
+
+# The table of every target and the incidents column pointing to it
+TARGETS = {
+    PurgeTarget.REGION: ('regions', 'region_id'),
+    PurgeTarget.STORE: ('stores', 'store_id'),
+    PurgeTarget.STORE_SECTION: ('store_sections', 'store_section_id'),
+}
+COUNT_INCIDENTS_UP_TO = {
+    target: text(f"""
+SELECT COUNT(*) FROM (
+    SELECT 1 FROM incidents WHERE {column} = :target_id LIMIT :limit
+) subtree
+""") for target, (_, column) in TARGETS.items()}
+COUNT_INCIDENTS = {
+    target: text(f'SELECT COUNT(*) FROM incidents WHERE {column} = :target_id')
+    for target, (_, column) in TARGETS.items()}
+DELETE_AN_INCIDENT_BATCH = {
+    target: text(f"""
+DELETE FROM incidents WHERE incident_id IN (
+    SELECT incident_id FROM incidents WHERE {column} = :target_id LIMIT :limit
+)
+""") for target, (_, column) in TARGETS.items()}
+# Cascades to what is left, the sections and the incidents of other columns
+DELETE_THE_TARGET = {
+    target: text(f'DELETE FROM {table} WHERE {column} = :target_id')
+    for target, (table, column) in TARGETS.items()}
+
+SELECT_AN_ACTIVE_PURGE_JOB = select(PurgeJobs).where(
+    PurgeJobs.target_id == bindparam('target_id'),
+    PurgeJobs.status.in_([PurgeStatus.QUEUED.value,
+                          PurgeStatus.RUNNING.value]))
+SELECT_A_PURGE_JOB = select(PurgeJobs) \
+    .where(PurgeJobs.job_id == bindparam('job_id'))
+CLAIM_A_PURGE_JOB = text("""
+UPDATE purge_jobs
+SET status = 'running', started_at = COALESCE(started_at, :now),
+    heartbeat_at = :now
+WHERE job_id = (
+    SELECT job_id FROM purge_jobs
+    WHERE status = 'queued'
+       OR (status = 'running' AND heartbeat_at < :stale_before)
+    ORDER BY created_at
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING job_id, target_type, target_id
+""")
+RECORD_A_PURGE_BATCH = update(PurgeJobs.__table__) \
+    .where(PurgeJobs.__table__.c.job_id == bindparam('_job_id')) \
+    .values(deleted_incidents=PurgeJobs.__table__.c.deleted_incidents
+            + bindparam('_deleted'))
+FINISH_A_PURGE_JOB = update(PurgeJobs.__table__) \
+    .where(PurgeJobs.__table__.c.job_id == bindparam('_job_id'))
+
+
+def purge_if_large(
+    _db: Session, _target_type: PurgeTarget, _target_id: UUID
+) -> Optional[PurgeJobs]:
+    """Queues a purge job when a subtree is too large to delete at once
+
+    Args:
+        _db (Session): The database session
+        _target_type (PurgeTarget): The kind of row deleted
+        _target_id (UUID): The id of the row
+
+    Returns:
+        Optional[PurgeJobs]: The purge job, new or already running, or None
+            when the caller can delete the row right away
+    """
+    incidents = _db.execute(COUNT_INCIDENTS_UP_TO[_target_type], {
+        'target_id': _target_id, 'limit': PURGE_SYNC_LIMIT + 1}).scalar()
+    if incidents <= PURGE_SYNC_LIMIT:
+        return None
+
+    job = _db.scalars(SELECT_AN_ACTIVE_PURGE_JOB,
+                      {'target_id': _target_id}).first()
+    if job is None:
+        job = PurgeJobs(target_type=_target_type.value, target_id=_target_id,
+                        status=PurgeStatus.QUEUED.value, deleted_incidents=0)
+        _db.add(job)
+        _db.commit()
+        _db.refresh(job)
+    _wake_up.set()
+    return job
+
+
+def _claim_purge_job() -> Optional[tuple]:
+    now = datetime.now()
+    with SessionLocal() as _db:
+        job = _db.execute(CLAIM_A_PURGE_JOB, {
+            'now': now,
+            'stale_before': now - timedelta(seconds=PURGE_STALE_AFTER)
+        }).first()
+        _db.commit()
+    return job
+
+
+def run_purge_job(_job_id: UUID, _target_type: PurgeTarget,
+                  _target_id: UUID) -> int:
+    """Deletes a subtree batch by batch, then the row at its root
+
+    Args:
+        _job_id (UUID): The id of the job
+        _target_type (PurgeTarget): The kind of row deleted
+        _target_id (UUID): The id of the row
+
+    Returns:
+        int: The number of incidents deleted in batches
+    """
+    params = {'target_id': _target_id, 'limit': PURGE_BATCH_SIZE}
+    with SessionLocal() as _db:
+        total = _db.execute(COUNT_INCIDENTS[_target_type], params).scalar()
+        _db.execute(FINISH_A_PURGE_JOB.values(total_incidents=total),
+                    {'_job_id': _job_id})
+        _db.commit()
+
+    deleted = 0
+    while True:
+        with SessionLocal() as _db:
+            batch = _db.execute(DELETE_AN_INCIDENT_BATCH[_target_type],
+                                params).rowcount
+            _db.execute(RECORD_A_PURGE_BATCH.values(heartbeat_at=datetime.now()),
+                        {'_job_id': _job_id, '_deleted': batch})
+            _db.commit()
+        deleted += batch
+        if batch < PURGE_BATCH_SIZE:
+            break
+        time.sleep(PURGE_BATCH_PAUSE)
+
+    with SessionLocal() as _db:
+        _db.execute(DELETE_THE_TARGET[_target_type], params)
+        _db.execute(FINISH_A_PURGE_JOB.values(
+            status=PurgeStatus.DONE.value, finished_at=datetime.now()),
+            {'_job_id': _job_id})
+        _db.commit()
+
+    invalidate_hierarchy()
+    region_summary_cache.clear()
+    invalidate_snapshot_days()
+    return deleted
+
+
+def run_purge_jobs() -> int:
+    """Runs the queued and abandoned purge jobs until there are none left
+
+    Returns:
+        int: The number of jobs run
+    """
+    jobs = 0
+    while (job := _claim_purge_job()) is not None:
+        job_id, target_type, target_id = job
+        started = time.perf_counter()
+        try:
+            deleted = run_purge_job(job_id, PurgeTarget(target_type), target_id)
+            logger.info('Purged %s %s and %s incidents in %.1fs', target_type,
+                        target_id, deleted, time.perf_counter() - started)
+        except Exception as e:  # pylint: disable=broad-except
+            logger.exception('Purging %s %s failed', target_type, target_id)
+            with SessionLocal() as _db:
+                _db.execute(FINISH_A_PURGE_JOB.values(
+                    status=PurgeStatus.FAILED.value, error=str(e),
+                    finished_at=datetime.now()), {'_job_id': job_id})
+                _db.commit()
+        jobs += 1
+    return jobs
+
+
+async def retrieve_purge_job_service(
+    _job_id: UUID, _db: Session
+) -> Optional[PurgeJobs]:
+    """The service returning a purge job
+
+    Args:
+        _job_id (UUID): The id of the job
+        _db (Session): The database session
+
+    Returns:
+        Optional[PurgeJobs]: The job, if any
+    """
+    return _db.scalars(SELECT_A_PURGE_JOB, {'job_id': _job_id}).first()
+
+
+_wake_up = asyncio.Event()
+_runner: Optional[asyncio.Task] = None
+
+
+async def _run_periodically() -> None:
+    while True:
+        try:
+            await asyncio.to_thread(run_purge_jobs)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('The purge worker failed')
+        try:
+            await asyncio.wait_for(_wake_up.wait(), PURGE_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _wake_up.clear()
+
+
+async def start_purge_worker() -> None:
+    """Starts the background purge worker"""
+    global _runner  # pylint: disable=global-statement
+
+    _runner = asyncio.create_task(_run_periodically())
+
+
+async def stop_purge_worker() -> None:
+    """Stops the background purge worker, a running job is taken over later"""
+    global _runner  # pylint: disable=global-statement
+
+    if _runner is not None:
+        _runner.cancel()
+        _runner = None
@@ -1,10 +1,74 @@
 """The file containing the services for the regions"""
-from typing import List
+import asyncio
+from datetime import date, datetime, timedelta
+from typing import List, Optional, Tuple
 
+from sqlalchemy import bindparam, delete, select, text
 from sqlalchemy.orm import Session
 
-from models.models import Regions
-from schemas.regions_schema import CreateRegion, ReadRegion, UpdateRegion
+from models.models import PurgeJobs, Regions
+from schemas.fieldsets_schema import selectable_fields, sparse_select
+from schemas.purges_schema import PurgeTarget
+from schemas.regions_schema import (CreateRegion, ReadRegion, RegionSummary,
+                                    UpdateRegion)
+from services.cache_services import (invalidate_hierarchy,
+                                     invalidate_region_summaries,
+                                     region_summary_cache)
+from services.incident_snapshot_services import invalidate_snapshot_days
+from services.purge_services import purge_if_large
+
+REGION_FIELDS = selectable_fields(ReadRegion, Regions)
+REGION_SUMMARY_TREND_DAYS = 30
+REGION_SUMMARY_TOP_STORES = 10
+
+# Built once at import and bound per call, see services/incidents_services.py
+SELECT_ALL_REGIONS = select(Regions)
+SELECT_A_REGION = select(Regions) \
+    .where(Regions.region_id == bindparam('region_id'))
+DELETE_A_REGION = delete(Regions) \
+    .where(Regions.region_id == bindparam('region_id')) \
+    .execution_options(synchronize_session=False)
+
+# Every figure of the summary comes back from this one statement
+REGION_SUMMARY_QUERY = text("""
+WITH region_incidents AS (
+    SELECT store_id, created_at,
+           COALESCE(product_price * product_quantity, 0) AS loss_value
+    FROM incidents
+    WHERE region_id = :region_id
+),
+store_totals AS (
+    SELECT s.store_id, s.store_name,
+           COUNT(ri.store_id) AS incident_count,
+           COALESCE(SUM(ri.loss_value), 0) AS loss_value
+    FROM stores s
+    LEFT JOIN region_incidents ri ON ri.store_id = s.store_id
+    WHERE s.region_id = :region_id
+    GROUP BY s.store_id, s.store_name
+),
+trend AS (
+    SELECT CAST(created_at AS DATE) AS day,
+           COUNT(*) AS incident_count,
+           SUM(loss_value) AS loss_value
+    FROM region_incidents
+    WHERE created_at >= :trend_start
+    GROUP BY CAST(created_at AS DATE)
+)
+SELECT
+    r.region_name,
+    (SELECT COUNT(*) FROM store_totals) AS store_count,
+    (SELECT COUNT(*) FROM store_sections ss
+     JOIN stores s ON s.store_id = ss.store_id
+     WHERE s.region_id = :region_id) AS store_section_count,
+    (SELECT COUNT(*) FROM region_incidents) AS incident_count,
+    (SELECT COALESCE(SUM(loss_value), 0) FROM region_incidents) AS loss_value,
+    (SELECT COALESCE(json_agg(t ORDER BY t.loss_value DESC), '[]')
+     FROM (SELECT * FROM store_totals
+           ORDER BY loss_value DESC LIMIT :top_stores) t) AS top_stores,
+    (SELECT COALESCE(json_agg(d ORDER BY d.day), '[]') FROM trend d) AS trend
+FROM regions r
+WHERE r.region_id = :region_id
+""")
 
 
 async def create_region_service(_region_data: CreateRegion, _db: Session) -> ReadRegion:
@@ -21,32 +85,49 @@ async def create_region_service(_region_data: CreateRegion, _db: Session) -> Rea
     _db.add(region)
     _db.commit()
     _db.refresh(region)
+    invalidate_hierarchy()
     return region
 
 
-async def retrieve_all_regions_service(_db: Session) -> List[ReadRegion]:
+async def retrieve_all_regions_service(
+    _db: Session, _fields: Optional[Tuple[str, ...]] = None
+) -> List[ReadRegion]:
     """The service used to fetch all regions from the database
 
     Args:
         _db (Session): The database session
+        _fields (Optional[Tuple[str, ...]]): Only select these columns
 
     Returns:
         List[ReadRegion]: A list of the regions fetched
     """
-    return _db.query(Regions).all()
+    if _fields:
+        result = await asyncio.to_thread(
+            _db.execute, sparse_select(Regions, _fields))
+        return result.all()
+    result = await asyncio.to_thread(_db.scalars, SELECT_ALL_REGIONS)
+    return result.all()
 
 
-async def retrieve_one_region_service(_region_id: str, _db: Session) -> ReadRegion:
+async def retrieve_one_region_service(
+    _region_id: str,
+    _db: Session,
+    _fields: Optional[Tuple[str, ...]] = None
+) -> ReadRegion:
     """The service function to retrieve a specific region from the database
 
     Args:
         _region_id (str): The id of the region
         _db (Session): The database session
+        _fields (Optional[Tuple[str, ...]]): Only select these columns
 
     Returns:
         ReadRegion: The retrieved region data
     """
-    return _db.query(Regions).filter(Regions.region_id == _region_id).first()
+    if _fields:
+        return _db.execute(sparse_select(Regions, _fields, 'region_id'),
+                           {'region_id': _region_id}).first()
+    return _db.scalars(SELECT_A_REGION, {'region_id': _region_id}).first()
 
 
 async def update_region_service(
@@ -72,21 +153,94 @@ async def update_region_service(
     region.region_name = _update_region_data.region_name
 
     _db.commit()
+    invalidate_region_summaries(_region_id)
+    invalidate_hierarchy()
     _db.refresh(region)
     return region
 
 
-async def delete_region_service(_region_id: str, _db: Session) -> None:
+async def delete_region_service(
+        _region_id: str, _db: Session) -> Optional[PurgeJobs]:
     """The service function for deleting regions in the database
 
+    The stores, sections and incidents go with the region through the
+    foreign keys' cascades, none of them is loaded.
+
     Args:
         _region_id (str): The id of the region in the database
         _db (Session): The database session
+
+    Returns:
+        Optional[PurgeJobs]: The background purge of a large region, None
+            when the region was deleted right away
     """
     region = await retrieve_one_region_service(_region_id, _db)
 
     if not region:
-        return
+        return None
+
+    job = purge_if_large(_db, PurgeTarget.REGION, _region_id)
+    if job is not None:
+        return job
 
-    _db.delete(region)
+    _db.execute(DELETE_A_REGION, {'region_id': _region_id})
     _db.commit()
+    invalidate_region_summaries(_region_id)
+    invalidate_hierarchy()
+    invalidate_snapshot_days()
+    return None
+
+
+async def retrieve_region_summary_service(
+    _region_id: str, _db: Session
+) -> RegionSummary:
+    """The service function returning the dashboard summary of a region
+
+    The summary is built in a single SQL round trip and cached until a write
+    under the region invalidates it.
+
+    Args:
+        _region_id (str): The id of the region
+        _db (Session): The database session
+
+    Raises:
+        LookupError: The region does not exist
+
+    Returns:
+        RegionSummary: The region's totals, top stores and 30 day trend
+    """
+    cached = region_summary_cache.get(str(_region_id))
+    if cached is not None:
+        return cached
+
+    today = date.today()
+    trend_start = today - timedelta(days=REGION_SUMMARY_TREND_DAYS - 1)
+    result = await asyncio.to_thread(_db.execute, REGION_SUMMARY_QUERY, {
+        'region_id': _region_id,
+        'trend_start': datetime.combine(trend_start, datetime.min.time()),
+        'top_stores': REGION_SUMMARY_TOP_STORES
+    })
+    row = result.mappings().first()
+
+    if row is None:
+        raise LookupError(f'Region {_region_id} does not exist')
+
+    days = {day['day']: day for day in row['trend']}
+    trend = []
+    for offset in range(REGION_SUMMARY_TREND_DAYS):
+        day = (trend_start + timedelta(days=offset)).isoformat()
+        trend.append(days.get(
+            day, {'day': day, 'incident_count': 0, 'loss_value': 0.0}))
+
+    summary = RegionSummary(
+        region_id=_region_id,
+        region_name=row['region_name'],
+        store_count=row['store_count'],
+        store_section_count=row['store_section_count'],
+        incident_count=row['incident_count'],
+        loss_value=row['loss_value'],
+        top_stores=row['top_stores'],
+        trend=trend
+    )
+    region_summary_cache.set(str(_region_id), summary)
+    return summary
@@ -0,0 +1,541 @@
+"""The file containing the asynchronous report jobs
+
+Reports that take longer than an HTTP request should are queued as jobs and
+run on a small thread pool. Every result is streamed from a server side
+cursor into a gzip compressed JSON file in the local result store, next to a
+metadata file, so finished reports survive a restart. Ranges reaching past
+the archive's cutoff include the archived incidents. Requests with the same
+parameters share one job while it is queued, running or fresh.
+
+The store is shared by every worker process and its metadata files are the
+source of truth: any worker answers for a job another one runs, and the
+file named after the parameters' hash deduplicates requests across them.
+Each job records the process that owns it, so a worker starting up only
+fails the jobs whose owner is gone. Finished jobs are swept from the store,
+with their result, once they are older than ``REPORT_RESULT_TTL``.
+"""
+import asyncio
+import fcntl
+import gzip
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+from uuid import UUID
+
+from dotenv import find_dotenv, load_dotenv
+from sqlalchemy import text
+
+from database.db import read_session
+from schemas.reports_schema import (CreateReport, ReadReport, ReportKind,
+                                    ReportStatus)
+from services.archive_services import archived_report_facts
+
+load_dotenv(find_dotenv())
+
+logger = logging.getLogger(__name__)
+
+REPORT_STORE_PATH = os.environ.get(
+    'REPORT_STORE_PATH', os.path.join('data', 'reports'))
+REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', '2'))
+REPORT_MAX_PENDING = int(os.environ.get('REPORT_MAX_PENDING', '20'))
+REPORT_RESULT_TTL = float(os.environ.get('REPORT_RESULT_TTL', '3600'))
+REPORT_SWEEP_INTERVAL = float(os.environ.get('REPORT_SWEEP_INTERVAL', '300'))
+REPORT_STATEMENT_TIMEOUT_MS = int(
+    os.environ.get('REPORT_STATEMENT_TIMEOUT_MS', '600000'))
+REPORT_FETCH_SIZE = 5000
+
+# Every report groups these facts: the hot incidents pre-aggregated per
+# region, store, product and year, and the same aggregates of the archived
+# incidents, bound as arrays. Every filter is optional, NULL disables it.
+_FACTS = """
+WITH facts AS (
+    SELECT i.region_id, i.store_id, i.product_code,
+           MIN(i.product_name) AS product_name,
+           CAST(EXTRACT(YEAR FROM i.created_at) AS integer) AS year,
+           COUNT(*) AS incident_count,
+           COALESCE(SUM(i.product_quantity), 0) AS quantity,
+           COALESCE(SUM(i.product_price * i.product_quantity), 0) AS loss_value
+    FROM incidents i
+    WHERE (CAST(:start AS timestamp) IS NULL OR i.created_at >= :start)
+      AND (CAST(:end AS timestamp) IS NULL OR i.created_at < :end)
+      AND (CAST(:region_id AS uuid) IS NULL OR i.region_id = :region_id)
+    GROUP BY i.region_id, i.store_id, i.product_code, year
+    UNION ALL
+    SELECT * FROM unnest(
+        CAST(:archived_region_id AS uuid[]),
+        CAST(:archived_store_id AS uuid[]),
+        CAST(:archived_product_code AS text[]),
+        CAST(:archived_product_name AS text[]),
+        CAST(:archived_year AS integer[]),
+        CAST(:archived_incident_count AS bigint[]),
+        CAST(:archived_quantity AS bigint[]),
+        CAST(:archived_loss_value AS double precision[]))
+)
+"""
+
+REPORT_QUERIES = {
+    ReportKind.YEAR_OVER_YEAR_LOSS: text(_FACTS + """
+, yearly AS (
+    SELECT region_id, year,
+           SUM(incident_count) AS incident_count,
+           SUM(loss_value) AS loss_value
+    FROM facts
+    GROUP BY region_id, year
+)
+SELECT y.region_id, r.region_name, y.year, y.incident_count, y.loss_value,
+       y.loss_value - LAG(y.loss_value) OVER w AS loss_change,
+       y.loss_value / NULLIF(LAG(y.loss_value) OVER w, 0) - 1
+           AS loss_change_ratio
+FROM yearly y
+JOIN regions r ON r.region_id = y.region_id
+WINDOW w AS (PARTITION BY y.region_id ORDER BY y.year)
+ORDER BY r.region_name, y.year
+"""),
+    ReportKind.STORE_LOSS: text(_FACTS + """
+SELECT f.region_id, f.store_id, s.store_name,
+       SUM(f.incident_count) AS incident_count,
+       SUM(f.loss_value) AS loss_value
+FROM facts f
+JOIN stores s ON s.store_id = f.store_id
+GROUP BY f.region_id, f.store_id, s.store_name
+ORDER BY loss_value DESC
+"""),
+    ReportKind.PRODUCT_LOSS: text(_FACTS + """
+SELECT product_code, MIN(product_name) AS product_name,
+       SUM(incident_count) AS incident_count,
+       SUM(quantity) AS quantity,
+       SUM(loss_value) AS loss_value
+FROM facts
+GROUP BY product_code
+ORDER BY loss_value DESC
+"""),
+}
+
+
+# The process owning the jobs submitted here. Its start time tells it from a
+# later process reusing the pid, which is common in containers.
+OWNER_HOST = socket.gethostname()
+OWNER_PID = os.getpid()
+
+
+def _process_start_time(_pid: int) -> Optional[str]:
+    """The start time of a process, or None where /proc is unavailable"""
+    try:
+        with open(f'/proc/{_pid}/stat', encoding='utf-8') as stat:
+            # The command name may hold spaces, the fields after it do not
+            return stat.read().rsplit(')', 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+
+OWNER_STARTED = _process_start_time(OWNER_PID)
+
+
+def _owner_alive(_owner: Dict) -> bool:
+    """Whether the process owning a job may still be running it
+
+    Args:
+        _owner (Dict): The host, pid and start time recorded with the job
+
+    Returns:
+        bool: False when the owner ran on this host and is gone, or was
+            not recorded
+    """
+    if not _owner:
+        return False
+    if _owner.get('host') != OWNER_HOST:
+        return True
+    pid = _owner.get('pid')
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    started = _owner.get('started')
+    return started is None or started == _process_start_time(pid)
+
+
+class ReportQueueFull(Exception):
+    """Raised when too many report jobs are queued or running"""
+
+
+def parameters_hash(_parameters: CreateReport) -> str:
+    """The key under which identical report requests are deduplicated
+
+    Args:
+        _parameters (CreateReport): The report parameters
+
+    Returns:
+        str: The SHA-256 of the parameters' JSON
+    """
+    return hashlib.sha256(
+        _parameters.model_dump_json().encode()).hexdigest()
+
+
+def _json_default(_value: Any) -> Any:
+    if isinstance(_value, Decimal):
+        return float(_value)
+    if isinstance(_value, (date, datetime)):
+        return _value.isoformat()
+    if isinstance(_value, UUID):
+        return str(_value)
+    raise TypeError(f'{type(_value).__name__} is not JSON serialisable')
+
+
+class ReportJobs:
+    """The report queue, worker pool and result store
+
+    Args:
+        store_path (str): The directory of the result store
+        workers (int): The number of reports run at once
+        max_pending (int): The most jobs queued or running at once
+    """
+
+    def __init__(
+        self,
+        store_path: str = REPORT_STORE_PATH,
+        workers: int = REPORT_WORKERS,
+        max_pending: int = REPORT_MAX_PENDING
+    ) -> None:
+        self.store_path = store_path
+        self.workers = workers
+        self.max_pending = max_pending
+        # Only the jobs this process submitted, the others are read from disk
+        self._jobs: Dict[UUID, ReadReport] = {}
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.deduplicated = 0
+        self.swept = 0
+
+    def result_path(self, _report_id: UUID) -> str:
+        """The path of a report's compressed result"""
+        return os.path.join(self.store_path, f'{_report_id}.json.gz')
+
+    def _metadata_path(self, _report_id: UUID) -> str:
+        return os.path.join(self.store_path, f'{_report_id}.json')
+
+    def _hash_path(self, _key: str) -> str:
+        return os.path.join(self.store_path, f'{_key}.key')
+
+    def _write(self, _path: str, _content: str) -> None:
+        # A name of this process' own, so two workers never share a file
+        temporary = f'{_path}.{OWNER_PID}.{threading.get_ident()}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as output:
+            output.write(_content)
+        os.replace(temporary, _path)
+
+    def _save(self, _job: ReadReport, _owner: Optional[Dict] = None) -> None:
+        owner = _owner or {'host': OWNER_HOST, 'pid': OWNER_PID,
+                           'started': OWNER_STARTED}
+        self._write(self._metadata_path(_job.report_id), json.dumps(
+            {**_job.model_dump(mode='json'), 'owner': owner}))
+
+    def _read(self, _report_id: UUID) -> Optional[ReadReport]:
+        """The job in the store, failing it if its owner is gone"""
+        try:
+            with open(self._metadata_path(_report_id),
+                      encoding='utf-8') as metadata:
+                content = json.load(metadata)
+            owner = content.pop('owner', {})
+            job = ReadReport.model_validate(content)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logger.warning('Skipping the unreadable report metadata %s',
+                           _report_id)
+            return None
+
+        if job.status in (ReportStatus.QUEUED, ReportStatus.RUNNING) \
+                and job.report_id not in self._jobs \
+                and not _owner_alive(owner):
+            job.status = ReportStatus.FAILED
+            job.error = 'Interrupted by a restart'
+            job.finished_at = datetime.now()
+            self._save(job, owner)
+        return job
+
+    def _load(self) -> None:
+        """Fails the jobs of the store whose owner a restart interrupted"""
+        for name in os.listdir(self.store_path):
+            if not name.endswith('.json'):
+                continue
+            try:
+                self._read(UUID(name[:-len('.json')]))
+            except ValueError:
+                continue
+
+    def start(self) -> None:
+        """Loads the result store and starts the worker pool"""
+        os.makedirs(self.store_path, exist_ok=True)
+        self._load()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix='report')
+
+    def stop(self) -> None:
+        """Stops the worker pool, dropping the jobs that have not started"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    @contextmanager
+    def _store_lock(self) -> Iterator[None]:
+        """Holds the store for this thread against every worker's others
+
+        The file lock serialises the workers, the thread lock this one's
+        threads, as flock is held per open file.
+        """
+        with self._lock, open(os.path.join(self.store_path, '.submit.lock'),
+                              'w', encoding='utf-8') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _reusable(self, _job: ReadReport) -> bool:
+        if _job.status in (ReportStatus.QUEUED, ReportStatus.RUNNING):
+            return True
+        return (_job.status == ReportStatus.DONE
+                and datetime.now() - _job.finished_at
+                < timedelta(seconds=REPORT_RESULT_TTL)
+                and os.path.exists(self.result_path(_job.report_id)))
+
+    def submit(self, _parameters: CreateReport) -> ReadReport:
+        """Queues a report, or returns the job of an identical request
+
+        Args:
+            _parameters (CreateReport): The report parameters
+
+        Raises:
+            ReportQueueFull: Too many jobs are queued or running
+
+        Returns:
+            ReadReport: The job
+        """
+        key = parameters_hash(_parameters)
+        with self._store_lock():
+            existing = self._find(key)
+            if existing is not None and self._reusable(existing):
+                self.deduplicated += 1
+                return existing
+
+            pending = sum(job.status in (ReportStatus.QUEUED, ReportStatus.RUNNING)
+                          for job in self._jobs.values())
+            if pending >= self.max_pending:
+                raise ReportQueueFull('Too many reports are queued, retry later')
+
+            job = ReadReport(report_id=uuid.uuid4(), parameters=_parameters,
+                             status=ReportStatus.QUEUED, created_at=datetime.now())
+            self._jobs[job.report_id] = job
+            self._save(job)
+            self._write(self._hash_path(key), str(job.report_id))
+
+        self._executor.submit(self._run, job)
+        return job
+
+    def _find(self, _key: str) -> Optional[ReadReport]:
+        """The last job submitted with a parameters' hash, if any"""
+        try:
+            with open(self._hash_path(_key), encoding='utf-8') as report_id:
+                return self._read(UUID(report_id.read()))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def get(self, _report_id: UUID) -> Optional[ReadReport]:
+        """The job with an id, whichever worker runs it"""
+        return self._read(_report_id)
+
+    def _remove(self, _path: str) -> None:
+        try:
+            os.remove(_path)
+        except FileNotFoundError:
+            pass
+
+    def sweep(self) -> int:
+        """Removes the finished jobs older than the result TTL from the store
+
+        Their results, metadata and the hash files still naming them go, and
+        so do the temporary files an interrupted write left behind.
+
+        Returns:
+            int: The number of jobs removed
+        """
+        expired_before = datetime.now() - timedelta(seconds=REPORT_RESULT_TTL)
+        removed = 0
+        with self._store_lock():
+            for name in os.listdir(self.store_path):
+                path = os.path.join(self.store_path, name)
+                if name.endswith('.tmp'):
+                    if os.path.getmtime(path) < time.time() - REPORT_RESULT_TTL:
+                        self._remove(path)
+                    continue
+                if not name.endswith('.json'):
+                    continue
+                try:
+                    job = self._read(UUID(name[:-len('.json')]))
+                except ValueError:
+                    continue
+                if job is None or job.finished_at is None \
+                        or job.finished_at >= expired_before:
+                    continue
+
+                key_path = self._hash_path(parameters_hash(job.parameters))
+                try:
+                    with open(key_path, encoding='utf-8') as report_id:
+                        if report_id.read() == str(job.report_id):
+                            self._remove(key_path)
+                except FileNotFoundError:
+                    pass
+                self._remove(self.result_path(job.report_id))
+                self._remove(path)
+                self._jobs.pop(job.report_id, None)
+                removed += 1
+
+        self.swept += removed
+        return removed
+
+    def _write_result(self, _job: ReadReport) -> int:
+        """Streams the report's rows into the result store
+
+        Returns:
+            int: The number of rows written
+        """
+        parameters = _job.parameters
+        path = self.result_path(_job.report_id)
+        rows = 0
+        start, end = (datetime.combine(day, datetime.min.time())
+                      if day is not None else None
+                      for day in (parameters.start, parameters.end))
+        with read_session() as _db:
+            _db.execute(text(
+                f'SET LOCAL statement_timeout = {REPORT_STATEMENT_TIMEOUT_MS}'))
+            archived = archived_report_facts(_db, start, end,
+                                             parameters.region_id)
+            result = _db.execute(
+                REPORT_QUERIES[parameters.kind],
+                {'start': start, 'end': end,
+                 'region_id': parameters.region_id,
+                 **{f'archived_{column}': values
+                    for column, values in archived.items()}},
+                execution_options={'stream_results': True,
+                                   'yield_per': REPORT_FETCH_SIZE})
+
+            with gzip.open(f'{path}.tmp', 'wt', encoding='utf-8') as output:
+                output.write(f'{{"columns":{json.dumps(list(result.keys()))},'
+                             '"rows":[')
+                for partition in result.partitions():
+                    for row in partition:
+                        output.write(',' if rows else '')
+                        output.write(json.dumps(list(row), default=_json_default))
+                        rows += 1
+                output.write(']}')
+
+        os.replace(f'{path}.tmp', path)
+        return rows
+
+    def _run(self, _job: ReadReport) -> None:
+        with self._lock:
+            _job.status = ReportStatus.RUNNING
+            _job.started_at = datetime.now()
+            self._save(_job)
+
+        try:
+            rows = self._write_result(_job)
+        except Exception as e:  # pylint: disable=broad-except
+            logger.exception('Report %s failed', _job.report_id)
+            with self._lock:
+                _job.status = ReportStatus.FAILED
+                _job.error = str(e)
+                _job.finished_at = datetime.now()
+                self._save(_job)
+            return
+
+        with self._lock:
+            _job.status = ReportStatus.DONE
+            _job.finished_at = datetime.now()
+            _job.row_count = rows
+            _job.size_bytes = os.path.getsize(self.result_path(_job.report_id))
+            _job.result_url = f'/reports/{_job.report_id}/result'
+            self._save(_job)
+
+    def metrics(self) -> Dict:
+        """The job counts per status, of the jobs submitted to this worker
+
+        Returns:
+            Dict: The current metrics
+        """
+        counts = {status.value: 0 for status in ReportStatus}
+        for job in list(self._jobs.values()):
+            counts[job.status.value] += 1
+        return {'workers': self.workers, 'jobs': counts,
+                'deduplicated_total': self.deduplicated,
+                'swept_total': self.swept}
+
+
+report_jobs = ReportJobs()
+_sweeper: Optional[asyncio.Task] = None
+
+
+async def create_report_service(_parameters: CreateReport) -> ReadReport:
+    """The service queueing a report job
+
+    Args:
+        _parameters (CreateReport): The report parameters
+
+    Raises:
+        ReportQueueFull: Too many jobs are queued or running
+
+    Returns:
+        ReadReport: The new job, or the job of an identical request
+    """
+    # The store lock may be held by another worker for a while
+    return await asyncio.to_thread(report_jobs.submit, _parameters)
+
+
+async def retrieve_report_service(_report_id: UUID) -> Optional[ReadReport]:
+    """The service returning a report job
+
+    Args:
+        _report_id (UUID): The id of the job
+
+    Returns:
+        Optional[ReadReport]: The job, if any
+    """
+    return report_jobs.get(_report_id)
+
+
+async def _sweep_periodically() -> None:
+    while True:
+        await asyncio.sleep(REPORT_SWEEP_INTERVAL)
+        try:
+            await asyncio.to_thread(report_jobs.sweep)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Sweeping the report store failed')
+
+
+async def start_report_jobs() -> None:
+    """Loads the result store, starts the report workers and the sweeper"""
+    global _sweeper  # pylint: disable=global-statement
+
+    await asyncio.to_thread(report_jobs.start)
+    _sweeper = asyncio.create_task(_sweep_periodically())
+
+
+async def stop_report_jobs() -> None:
+    """Stops the sweeper and the report workers"""
+    global _sweeper  # pylint: disable=global-statement
+
+    if _sweeper is not None:
+        _sweeper.cancel()
+        _sweeper = None
+    report_jobs.stop()
@@ -0,0 +1,198 @@
+"""The file containing the services placing the stores on the map
+
+The proximity queries run in PostGIS against the GiST index on
+``stores.store_location``. The stores within a radius are filtered with
+``ST_DWithin`` and the k nearest are ordered by the ``<->`` operator, so
+PostgreSQL walks the index in distance order and stops after k rows instead
+of measuring the distance to every store.
+
+The density grid of a map tile selects the tile's stores through the
+bounding-box operator, which uses the same index, and counts their incidents
+per cell of the grid in one query. Tiles follow the z/x/y scheme of the web
+maps, so the cells line up with the tile's pixels.
+"""
+import asyncio
+import math
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from geoalchemy2 import Geography
+from sqlalchemy import bindparam, cast, func, select, text
+from sqlalchemy.orm import Session
+
+from models.models import Stores
+from schemas.stores_schema import DensityCell, DensityTile, NearbyStore
+
+MAX_TILE_ZOOM = 22
+
+# The point searched around, bound as longitude and latitude in degrees
+POINT = cast(func.ST_SetSRID(func.ST_MakePoint(
+    bindparam('longitude'), bindparam('latitude')), 4326),
+    Geography(geometry_type='POINT', srid=4326))
+# Ordering by the operator, not by ST_Distance, is what lets the planner walk
+# the GiST index
+BY_DISTANCE = Stores.store_location.op('<->')(POINT)
+NEARBY_STORE_COLUMNS = (
+    Stores.store_id, Stores.store_name, Stores.region_id,
+    Stores.store_latitude, Stores.store_longitude,
+    func.ST_Distance(Stores.store_location, POINT).label('distance_meters'))
+
+SELECT_STORES_WITHIN = select(*NEARBY_STORE_COLUMNS) \
+    .where(func.ST_DWithin(Stores.store_location, POINT, bindparam('radius'))) \
+    .order_by(BY_DISTANCE) \
+    .limit(bindparam('limit'))
+SELECT_NEAREST_STORES = select(*NEARBY_STORE_COLUMNS) \
+    .where(Stores.store_location.isnot(None)) \
+    .order_by(BY_DISTANCE) \
+    .limit(bindparam('limit'))
+
+# The rows are cut on the Mercator ordinate, like the tile itself, as in
+# tile_cell. The exact bounds follow the index filter, whose geodesic box is
+# slightly larger.
+SELECT_DENSITY_GRID = text("""
+SELECT CAST(LEAST(FLOOR((s.store_longitude - :west) / (:east - :west) * :grid),
+                  :grid - 1) AS integer) AS cell_column,
+       CAST(GREATEST(LEAST(FLOOR((:north_y - LN(TAN(PI() / 4 + RADIANS(s.store_latitude) / 2)))
+                                 / (:north_y - :south_y) * :grid),
+                           :grid - 1), 0) AS integer) AS cell_row,
+       COUNT(DISTINCT s.store_id) AS store_count,
+       COUNT(i.incident_id) AS incident_count
+FROM stores s
+LEFT JOIN incidents i ON i.store_id = s.store_id
+    AND (CAST(:start AS timestamp) IS NULL OR i.created_at >= :start)
+    AND (CAST(:end AS timestamp) IS NULL OR i.created_at < :end)
+WHERE s.store_location && CAST(ST_MakeEnvelope(:west, :south, :east, :north, 4326)
+                               AS geography)
+  AND s.store_longitude >= :west AND s.store_longitude < :east
+  AND s.store_latitude > :south AND s.store_latitude <= :north
+GROUP BY cell_column, cell_row
+ORDER BY cell_row, cell_column
+""")
+
+
+def tile_bounds(_z: int, _x: int, _y: int) -> dict:
+    """The extent of a web map tile
+
+    Args:
+        _z (int): The zoom level
+        _x (int): The column of the tile, from the antimeridian eastwards
+        _y (int): The row of the tile, from the north southwards
+
+    Raises:
+        ValueError: The tile does not exist at this zoom level
+
+    Returns:
+        dict: The west, south, east and north bounds in degrees, and the
+            Mercator ordinates of the north and south edges
+    """
+    if not 0 <= _z <= MAX_TILE_ZOOM:
+        raise ValueError(f'The zoom level must be between 0 and {MAX_TILE_ZOOM}')
+    tiles = 2 ** _z
+    if not (0 <= _x < tiles and 0 <= _y < tiles):
+        raise ValueError(f'The tile does not exist at zoom level {_z}')
+
+    north_y = math.pi * (1 - 2 * _y / tiles)
+    south_y = math.pi * (1 - 2 * (_y + 1) / tiles)
+    return {'west': _x / tiles * 360 - 180,
+            'east': (_x + 1) / tiles * 360 - 180,
+            'north': math.degrees(math.atan(math.sinh(north_y))),
+            'south': math.degrees(math.atan(math.sinh(south_y))),
+            'north_y': north_y, 'south_y': south_y}
+
+
+def tile_cell(_latitude: float, _longitude: float, _bounds: dict,
+              _grid: int) -> Tuple[int, int]:
+    """The cell of a tile's grid holding a point, as SELECT_DENSITY_GRID
+
+    Args:
+        _latitude (float): The latitude of the point, within the tile
+        _longitude (float): The longitude of the point, within the tile
+        _bounds (dict): The tile's extent, from tile_bounds
+        _grid (int): The number of cells along each side of the tile
+
+    Returns:
+        Tuple[int, int]: The column, from the west, and the row, from the
+            north
+    """
+    column = math.floor((_longitude - _bounds['west'])
+                        / (_bounds['east'] - _bounds['west']) * _grid)
+    mercator_y = math.log(math.tan(math.pi / 4 + math.radians(_latitude) / 2))
+    row = math.floor((_bounds['north_y'] - mercator_y)
+                     / (_bounds['north_y'] - _bounds['south_y']) * _grid)
+    # The east and south edges belong to the last cells, and the north edge,
+    # a rounding away from the tile, to the first
+    return min(column, _grid - 1), max(min(row, _grid - 1), 0)
+
+
+async def retrieve_stores_within_service(
+    _latitude: float, _longitude: float, _radius_km: float, _limit: int,
+    _db: Session
+) -> List[NearbyStore]:
+    """The service function returning the stores within a distance of a point
+
+    Args:
+        _latitude (float): The latitude of the point
+        _longitude (float): The longitude of the point
+        _radius_km (float): The distance, in kilometres
+        _limit (int): The most stores returned
+        _db (Session): The database session
+
+    Returns:
+        List[NearbyStore]: The stores, the nearest first
+    """
+    result = await asyncio.to_thread(_db.execute, SELECT_STORES_WITHIN, {
+        'latitude': _latitude, 'longitude': _longitude,
+        'radius': _radius_km * 1000, 'limit': _limit})
+    return result.all()
+
+
+async def retrieve_nearest_stores_service(
+    _latitude: float, _longitude: float, _k: int, _db: Session
+) -> List[NearbyStore]:
+    """The service function returning the stores nearest to a point
+
+    Args:
+        _latitude (float): The latitude of the point
+        _longitude (float): The longitude of the point
+        _k (int): The number of stores
+        _db (Session): The database session
+
+    Returns:
+        List[NearbyStore]: The stores, the nearest first
+    """
+    result = await asyncio.to_thread(_db.execute, SELECT_NEAREST_STORES, {
+        'latitude': _latitude, 'longitude': _longitude, 'limit': _k})
+    return result.all()
+
+
+async def retrieve_density_tile_service(
+    _z: int, _x: int, _y: int, _grid: int, _db: Session,
+    _start: Optional[datetime] = None, _end: Optional[datetime] = None
+) -> DensityTile:
+    """The service function counting the incidents per cell of a map tile
+
+    Args:
+        _z (int): The zoom level
+        _x (int): The column of the tile
+        _y (int): The row of the tile
+        _grid (int): The number of cells along each side of the tile
+        _db (Session): The database session
+        _start (Optional[datetime]): Only count incidents created from then
+        _end (Optional[datetime]): Only count incidents created before then
+
+    Raises:
+        ValueError: The tile does not exist at this zoom level
+
+    Returns:
+        DensityTile: The cells holding at least one store
+    """
+    bounds = tile_bounds(_z, _x, _y)
+    result = await asyncio.to_thread(_db.execute, SELECT_DENSITY_GRID, {
+        **bounds, 'grid': _grid, 'start': _start, 'end': _end})
+    cells = [DensityCell(column=row.cell_column, row=row.cell_row,
+                         store_count=row.store_count,
+                         incident_count=row.incident_count)
+             for row in result]
+    return DensityTile(
+        z=_z, x=_x, y=_y, grid=_grid, cells=cells,
+        **{key: bounds[key] for key in ('west', 'south', 'east', 'north')})
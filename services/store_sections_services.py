@@ -1,13 +1,51 @@
 """The file containing the store sections services"""
-from typing import List
+import asyncio
+from typing import List, Optional, Tuple
 from uuid import UUID
 
-from sqlalchemy.orm import Session
+from sqlalchemy import bindparam, delete, select
+from sqlalchemy.orm import Session, selectinload
 
-from models.models import StoreSections
+from models.models import PurgeJobs, Stores, StoreSections
+from schemas.fieldsets_schema import (batch_select, order_batch,
+                                     selectable_fields, sparse_select)
+from schemas.purges_schema import PurgeTarget
 from schemas.store_sections_schema import (CreateStoreSection,
                                            ReadStoreSection,
                                            UpdateStoreSection)
+from services.cache_services import (invalidate_hierarchy,
+                                     invalidate_region_summaries)
+from services.incident_snapshot_services import invalidate_snapshot_days
+from services.purge_services import purge_if_large
+
+STORE_SECTION_FIELDS = selectable_fields(ReadStoreSection, StoreSections)
+
+# Built once at import and bound per call, see services/incidents_services.py
+SELECT_THE_REGION_OF_A_STORE = select(Stores.region_id) \
+    .where(Stores.store_id == bindparam('store_id'))
+SELECT_A_STORE_SECTION = select(StoreSections) \
+    .where(StoreSections.store_section_id == bindparam('store_section_id'))
+SELECT_STORE_SECTIONS_IN_A_STORE = select(StoreSections) \
+    .where(StoreSections.store_id == bindparam('store_id'))
+DELETE_A_STORE_SECTION = delete(StoreSections) \
+    .where(StoreSections.store_section_id == bindparam('store_section_id')) \
+    .execution_options(synchronize_session=False)
+SELECT_STORE_SECTIONS_BY_IDS = batch_select(
+    StoreSections, None, 'store_section_id').options(
+        selectinload(StoreSections.incidents))
+
+
+def _region_of_store(_store_id: UUID, _db: Session) -> UUID:
+    """Looks up the region a store belongs to
+
+    Args:
+        _store_id (UUID): The store id
+        _db (Session): The database session
+
+    Returns:
+        UUID: The region id
+    """
+    return _db.scalar(SELECT_THE_REGION_OF_A_STORE, {'store_id': _store_id})
 
 
 async def create_store_section_service(
@@ -24,39 +62,56 @@ async def create_store_section_service(
     _db.add(_store_section_obj)
     _db.commit()
     _db.refresh(_store_section_obj)
+    invalidate_region_summaries(
+        _region_of_store(_store_section_obj.store_id, _db))
+    invalidate_hierarchy()
     return _store_section_obj
 
 
 async def retrieve_single_store_section_service(
-        _store_section_id: UUID, _db: Session) -> ReadStoreSection:
+        _store_section_id: UUID, _db: Session,
+        _fields: Optional[Tuple[str, ...]] = None) -> ReadStoreSection:
     """The service function for reading store sections in the database
 
     Args:
         _store_section_id (UUID): The store section id
         _db (Session): The database session
+        _fields (Optional[Tuple[str, ...]]): Only select these columns
 
     Returns:
         ReadStoreSection: The store section data
     """
-    return _db.query(StoreSections).filter(
-        StoreSections.store_section_id == _store_section_id
-    ).first()
+    if _fields:
+        return _db.execute(
+            sparse_select(StoreSections, _fields, 'store_section_id'),
+            {'store_section_id': _store_section_id}).first()
+    return _db.scalars(SELECT_A_STORE_SECTION,
+                       {'store_section_id': _store_section_id}).first()
 
 
 async def retrieve_all_store_sections_from_a_store_service(
     _store_id: UUID,
-    _db: Session
+    _db: Session,
+    _fields: Optional[Tuple[str, ...]] = None
 ) -> List[ReadStoreSection]:
     """The service function for reading all store sections in the database
 
     Args:
         _store_id (UUID): The store id
         _db (Session): The database session
+        _fields (Optional[Tuple[str, ...]]): Only select these columns
 
     Returns:
         List[ReadStoreSection]: The list of store section data
     """
-    return _db.query(StoreSections).filter(StoreSections.store_id == _store_id)
+    if _fields:
+        result = await asyncio.to_thread(
+            _db.execute, sparse_select(StoreSections, _fields, 'store_id'),
+            {'store_id': _store_id})
+        return result.all()
+    result = await asyncio.to_thread(
+        _db.scalars, SELECT_STORE_SECTIONS_IN_A_STORE, {'store_id': _store_id})
+    return result.all()
 
 
 async def update_store_section_service(
@@ -80,17 +135,63 @@ async def update_store_section_service(
     store.store_section_name = _store_section.store_section_name
     _db.commit()
     _db.refresh(store)
+    invalidate_region_summaries(_region_of_store(store.store_id, _db))
+    invalidate_hierarchy()
     return store
 
 
 async def delete_store_section_service(
-        _store_section_id: UUID, _db: Session) -> None:
+        _store_section_id: UUID, _db: Session) -> Optional[PurgeJobs]:
     """The service function for deleting store sections in the database
 
     Args:
         _store_section_id (UUID): The store section id
         _db (Session): The database session
+
+    Returns:
+        Optional[PurgeJobs]: The background purge of a large section, None
+            when the section was deleted right away
     """
-    _db.query(StoreSections).filter(
-        StoreSections.store_section_id == _store_section_id).delete()
+    store_section = await retrieve_single_store_section_service(
+        _store_section_id, _db)
+    if not store_section:
+        return None
+
+    job = purge_if_large(_db, PurgeTarget.STORE_SECTION, _store_section_id)
+    if job is not None:
+        return job
+
+    region_id = _region_of_store(store_section.store_id, _db)
+    _db.execute(DELETE_A_STORE_SECTION,
+                {'store_section_id': _store_section_id})
     _db.commit()
+    invalidate_region_summaries(region_id)
+    invalidate_hierarchy()
+    invalidate_snapshot_days()
+    return None
+
+
+async def retrieve_store_sections_by_ids_service(
+    _ids: List[UUID], _db: Session, _fields: Optional[Tuple[str, ...]] = None
+) -> Tuple[List[ReadStoreSection], List[UUID]]:
+    """The service function fetching many store sections in one query
+
+    Args:
+        _ids (List[UUID]): The ids of the store sections
+        _db (Session): The database session
+        _fields (Optional[Tuple[str, ...]]): Only select these columns
+
+    Returns:
+        Tuple[List[ReadStoreSection], List[UUID]]: The store sections found,
+            in request order, and the ids that were not found
+    """
+    params = {'ids': list(dict.fromkeys(_ids))}
+    if _fields:
+        result = await asyncio.to_thread(
+            _db.execute,
+            batch_select(StoreSections, _fields, 'store_section_id'), params)
+    else:
+        result = await asyncio.to_thread(
+            _db.scalars, SELECT_STORE_SECTIONS_BY_IDS, params)
+    rows = result.all()
+    return order_batch(_ids, rows, 'store_section_id')
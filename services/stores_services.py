@@ -1,11 +1,37 @@
 """The file containing all the services for the stores"""
-from typing import List
+import asyncio
+from typing import List, Optional, Tuple
 from uuid import UUID
 
-from sqlalchemy.orm import Session
-
-from models.models import Stores
-from schemas.stores_schema import CreateStore, ReadStore, UpdateStore
+from sqlalchemy import bindparam, delete, select, update
+from sqlalchemy.orm import Session, selectinload
+
+from models.models import PurgeJobs, Stores, StoreSections
+from schemas.fieldsets_schema import (batch_select, order_batch,
+                                     selectable_fields, sparse_select)
+from schemas.purges_schema import PurgeTarget
+from schemas.stores_schema import (CreateStore, ReadStore, StoreLocation,
+                                   UpdateStore)
+from services.cache_services import (invalidate_hierarchy,
+                                     invalidate_region_summaries)
+from services.incident_snapshot_services import invalidate_snapshot_days
+from services.purge_services import purge_if_large
+
+STORE_FIELDS = selectable_fields(ReadStore, Stores)
+
+# Built once at import and bound per call, see services/incidents_services.py
+SELECT_STORES_IN_A_REGION = select(Stores) \
+    .where(Stores.region_id == bindparam('region_id'))
+SELECT_A_STORE = select(Stores).where(Stores.store_id == bindparam('store_id'))
+UPDATE_A_STORE = update(Stores.__table__) \
+    .where(Stores.__table__.c.store_id == bindparam('_store_id'))
+DELETE_A_STORE = delete(Stores) \
+    .where(Stores.store_id == bindparam('store_id')) \
+    .execution_options(synchronize_session=False)
+# The nested incidents and sections are loaded in one query per relationship
+SELECT_STORES_BY_IDS = batch_select(Stores, None, 'store_id').options(
+    selectinload(Stores.incidents),
+    selectinload(Stores.store_sections).selectinload(StoreSections.incidents))
 
 
 async def create_store_service(
@@ -27,36 +53,52 @@ async def create_store_service(
     _db.add(store)
     _db.commit()
     _db.refresh(store)
+    invalidate_region_summaries(store.region_id)
+    invalidate_hierarchy()
 
     return store
 
 
 async def retrieve_all_stores_in_a_region_service(
-    _region_id: UUID, _db: Session
+    _region_id: UUID, _db: Session, _fields: Optional[Tuple[str, ...]] = None
 ) -> List[ReadStore]:
     """The service used to fetch all stores from the database
 
     Args:
         _region_id (UUID): The id of the region
         _db (Session): The database session
+        _fields (Optional[Tuple[str, ...]]): Only select these columns
 
     Returns:
         List[ReadStore]: A list of the stores fetched
     """
-    return _db.query(Stores).filter(Stores.region_id == _region_id).all()
-
-
-async def retrieve_one_store_service(_store_id: UUID, _db: Session) -> ReadStore:
+    if _fields:
+        result = await asyncio.to_thread(
+            _db.execute, sparse_select(Stores, _fields, 'region_id'),
+            {'region_id': _region_id})
+        return result.all()
+    result = await asyncio.to_thread(
+        _db.scalars, SELECT_STORES_IN_A_REGION, {'region_id': _region_id})
+    return result.all()
+
+
+async def retrieve_one_store_service(
+    _store_id: UUID, _db: Session, _fields: Optional[Tuple[str, ...]] = None
+) -> ReadStore:
     """The service function to retrieve a specific store from the database
 
     Args:
         _store_id (UUID): The id of the store
         _db (Session): The database session
+        _fields (Optional[Tuple[str, ...]]): Only select these columns
 
     Returns:
         ReadStore: The retrieved store data
     """
-    return _db.query(Stores).filter(Stores.store_id == _store_id).first()
+    if _fields:
+        return _db.execute(sparse_select(Stores, _fields, 'store_id'),
+                           {'store_id': _store_id}).first()
+    return _db.scalars(SELECT_A_STORE, {'store_id': _store_id}).first()
 
 
 async def update_store_service(
@@ -74,19 +116,90 @@ async def update_store_service(
     Returns:
         ReadStore: The updated store
     """
-    _db.query(Stores).filter(Stores.store_id == _store_id).update(
-        _update_store_data.model_dump())
+    _db.execute(UPDATE_A_STORE, {
+        '_store_id': _store_id, **_update_store_data.model_dump()})
+
+    _db.commit()
+    store = await retrieve_one_store_service(_store_id, _db)
+    if store:
+        invalidate_region_summaries(store.region_id)
+        invalidate_hierarchy()
+    return store
+
+
+async def update_store_location_service(
+    _store_id: UUID,
+    _location: StoreLocation,
+    _db: Session
+) -> Optional[ReadStore]:
+    """The service function placing a store on the map
+
+    The database derives the indexed location from the coordinates.
+
+    Args:
+        _store_id (UUID): The id of the store in the database
+        _location (StoreLocation): The coordinates of the store
+        _db (Session): The database session
 
+    Returns:
+        Optional[ReadStore]: The updated store, if it exists
+    """
+    _db.execute(UPDATE_A_STORE, {'_store_id': _store_id,
+                                 **_location.model_dump()})
     _db.commit()
-    return retrieve_one_store_service(_store_id, _db)
+    return await retrieve_one_store_service(_store_id, _db)
 
 
-async def delete_store_service(_store_id: UUID, _db: Session):
+async def delete_store_service(
+        _store_id: UUID, _db: Session) -> Optional[PurgeJobs]:
     """The service function for deleting stores in the database
 
     Args:
         _store_id (UUID): The id of the store in the database
         _db (Session): The database session
+
+    Returns:
+        Optional[PurgeJobs]: The background purge of a large store, None
+            when the store was deleted right away
     """
-    _db.query(Stores).filter(Stores.store_id == _store_id).delete()
+    store = await retrieve_one_store_service(_store_id, _db)
+    if not store:
+        return None
+
+    job = purge_if_large(_db, PurgeTarget.STORE, _store_id)
+    if job is not None:
+        return job
+
+    region_id = store.region_id
+    _db.execute(DELETE_A_STORE, {'store_id': _store_id})
     _db.commit()
+    invalidate_region_summaries(region_id)
+    invalidate_hierarchy()
+    # Its incidents went with it, on whichever days they were
+    invalidate_snapshot_days()
+    return None
+
+
+async def retrieve_stores_by_ids_service(
+    _ids: List[UUID], _db: Session, _fields: Optional[Tuple[str, ...]] = None
+) -> Tuple[List[ReadStore], List[UUID]]:
+    """The service function fetching many stores in one query
+
+    Args:
+        _ids (List[UUID]): The ids of the stores
+        _db (Session): The database session
+        _fields (Optional[Tuple[str, ...]]): Only select these columns
+
+    Returns:
+        Tuple[List[ReadStore], List[UUID]]: The stores found, in request
+            order, and the ids that were not found
+    """
+    params = {'ids': list(dict.fromkeys(_ids))}
+    if _fields:
+        result = await asyncio.to_thread(
+            _db.execute, batch_select(Stores, _fields, 'store_id'), params)
+    else:
+        result = await asyncio.to_thread(
+            _db.scalars, SELECT_STORES_BY_IDS, params)
+    rows = result.all()
+    return order_batch(_ids, rows, 'store_id')
@@ -0,0 +1,411 @@
+"""The file containing the request tracing
+
+A sampled request gets a server span, covering the whole request, and a
+child span for its router endpoint, for every ``*_service`` function it calls
+and for every SQL statement they run. The spans are created automatically:
+``instrument_application`` wraps the endpoints of the routes and the service
+functions once the routers are included, nothing has to be decorated.
+
+The trace context is taken from an incoming W3C ``traceparent`` header. A
+request without one is sampled with ``TRACE_SAMPLE_RATE``, one with one
+follows the caller's decision. An unsampled request costs a context variable
+read per wrapped call.
+
+Finished spans are exported in batches by a background thread, as OTLP JSON
+``resourceSpans`` lines appended to a local file, the stand-in for a
+collector, and also posted to ``TRACE_OTLP_ENDPOINT`` when one is set.
+"""
+import asyncio
+import functools
+import inspect
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+from dotenv import find_dotenv, load_dotenv
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+load_dotenv(find_dotenv())
+
+logger = logging.getLogger(__name__)
+
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.01'))
+TRACE_EXPORT_PATH = os.environ.get(
+    'TRACE_EXPORT_PATH', os.path.join('data', 'traces', 'spans.jsonl'))
+TRACE_EXPORT_MAX_BYTES = int(
+    os.environ.get('TRACE_EXPORT_MAX_BYTES', str(50 * 1024 * 1024)))
+TRACE_OTLP_ENDPOINT = os.environ.get('TRACE_OTLP_ENDPOINT')
+TRACE_EXPORT_INTERVAL = float(os.environ.get('TRACE_EXPORT_INTERVAL', '1'))
+TRACE_QUEUE_SIZE = int(os.environ.get('TRACE_QUEUE_SIZE', '10000'))
+TRACE_SERVICE_NAME = os.environ.get('TRACE_SERVICE_NAME', 'data-analysis')
+TRACING = os.environ.get('TRACING', 'on') != 'off'
+
+# The OTLP span kinds
+KIND_INTERNAL, KIND_SERVER, KIND_CLIENT = 1, 2, 3
+STATUS_ERROR = 2
+STATEMENT_MAX_LENGTH = 1000
+
+_TRACEPARENT = re.compile(
+    r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+
+def _random_id(_bytes: int) -> str:
+    return f'{random.getrandbits(_bytes * 8):0{_bytes * 2}x}'
+
+
+class Span:
+    """A timed operation of a trace
+
+    Args:
+        name (str): The name of the operation
+        trace_id (str): The 32 hex digits of the trace
+        parent_id (Optional[str]): The span this one is a child of
+        kind (int): The OTLP span kind
+    """
+
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'kind',
+                 'attributes', 'start', 'end', 'error')
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str],
+                 kind: int = KIND_INTERNAL) -> None:
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _random_id(8)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes: Dict[str, Any] = {}
+        self.start = time.time_ns()
+        self.end = 0
+        self.error: Optional[str] = None
+
+    def child(self, _name: str, _kind: int = KIND_INTERNAL) -> 'Span':
+        """Starts a span under this one
+
+        Args:
+            _name (str): The name of the operation
+            _kind (int): The OTLP span kind
+
+        Returns:
+            Span: The child span
+        """
+        return Span(_name, self.trace_id, self.span_id, _kind)
+
+    def finish(self, _error: Optional[BaseException] = None) -> None:
+        """Ends the span and hands it to the exporter
+
+        Args:
+            _error (Optional[BaseException]): What made the operation fail
+        """
+        self.end = time.time_ns()
+        if _error is not None:
+            self.error = f'{type(_error).__name__}: {_error}'
+        span_exporter.export(self)
+
+    def otlp(self) -> Dict:
+        """The span in the OTLP JSON encoding
+
+        Returns:
+            Dict: The span
+        """
+        span = {
+            'traceId': self.trace_id, 'spanId': self.span_id,
+            'name': self.name, 'kind': self.kind,
+            'startTimeUnixNano': str(self.start),
+            'endTimeUnixNano': str(self.end),
+            'attributes': [_attribute(key, value)
+                           for key, value in self.attributes.items()],
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        if self.error:
+            span['status'] = {'code': STATUS_ERROR, 'message': self.error}
+        return span
+
+
+def _attribute(_key: str, _value: Any) -> Dict:
+    if isinstance(_value, bool):
+        return {'key': _key, 'value': {'boolValue': _value}}
+    if isinstance(_value, int):
+        return {'key': _key, 'value': {'intValue': str(_value)}}
+    if isinstance(_value, float):
+        return {'key': _key, 'value': {'doubleValue': _value}}
+    return {'key': _key, 'value': {'stringValue': str(_value)}}
+
+
+current_span: ContextVar[Optional[Span]] = ContextVar(
+    'current_span', default=None)
+
+
+def start_trace(_name: str, _traceparent: Optional[str]) -> Optional[Span]:
+    """Starts the server span of a request, if the request is sampled
+
+    Args:
+        _name (str): The name of the span
+        _traceparent (Optional[str]): The incoming ``traceparent`` header
+
+    Returns:
+        Optional[Span]: The server span, or None when not sampled
+    """
+    match = _TRACEPARENT.match(_traceparent.strip().lower()) \
+        if _traceparent else None
+    if match is not None and match.group(1) != '0' * 32:
+        trace_id, parent_id, flags = match.groups()
+        if not int(flags, 16) & 1:
+            return None
+    else:
+        if random.random() >= TRACE_SAMPLE_RATE:
+            return None
+        trace_id, parent_id = _random_id(16), None
+    return Span(_name, trace_id, parent_id, KIND_SERVER)
+
+
+def traced(_function: Callable, _layer: str) -> Callable:
+    """Wraps a function so a sampled call records a child span
+
+    Args:
+        _function (Callable): The router endpoint or service function
+        _layer (str): The layer the function belongs to
+
+    Returns:
+        Callable: The wrapped function
+    """
+    name = f'{_function.__module__}.{_function.__qualname__}'
+
+    if inspect.iscoroutinefunction(_function):
+        @functools.wraps(_function)
+        async def wrapper(*args, **kwargs):
+            parent = current_span.get()
+            if parent is None:
+                return await _function(*args, **kwargs)
+            span = parent.child(name)
+            span.attributes['code.layer'] = _layer
+            token = current_span.set(span)
+            try:
+                result = await _function(*args, **kwargs)
+            except BaseException as e:
+                span.finish(e)
+                raise
+            finally:
+                current_span.reset(token)
+            span.finish()
+            return result
+    else:
+        @functools.wraps(_function)
+        def wrapper(*args, **kwargs):
+            parent = current_span.get()
+            if parent is None:
+                return _function(*args, **kwargs)
+            span = parent.child(name)
+            span.attributes['code.layer'] = _layer
+            token = current_span.set(span)
+            try:
+                result = _function(*args, **kwargs)
+            except BaseException as e:
+                span.finish(e)
+                raise
+            finally:
+                current_span.reset(token)
+            span.finish()
+            return result
+
+    wrapper.__traced__ = True
+    return wrapper
+
+
+def instrument_application(_app) -> None:
+    """Wraps the route endpoints and the service functions of the app
+
+    The service functions are replaced in every module of the application
+    that refers to them, the routers included.
+
+    Args:
+        _app (FastAPI): The application, with its routers included
+    """
+    if not TRACING:
+        return
+
+    modules = [module for name, module in list(sys.modules.items())
+               if name.split('.')[0] in ('services', 'routers', 'app')
+               and module is not None]
+    wrapped: Dict[int, Callable] = {}
+    for module in modules:
+        if not module.__name__.startswith('services.'):
+            continue
+        for name, value in list(vars(module).items()):
+            if (inspect.isfunction(value) and name.endswith('_service')
+                    and value.__module__ == module.__name__
+                    and not getattr(value, '__traced__', False)):
+                wrapped[id(value)] = traced(value, 'service')
+    for module in modules:
+        for name, value in list(vars(module).items()):
+            if id(value) in wrapped and inspect.isfunction(value):
+                setattr(module, name, wrapped[id(value)])
+
+    for route in _app.routes:
+        dependant = getattr(route, 'dependant', None)
+        if dependant is not None and not getattr(
+                dependant.call, '__traced__', False):
+            dependant.call = traced(dependant.call, 'router')
+
+
+class SpanExporter:
+    """Batches the finished spans and writes them out
+
+    Args:
+        path (str): The JSON lines file the spans are appended to
+        endpoint (Optional[str]): The OTLP/HTTP traces endpoint, if any
+    """
+
+    def __init__(self, path: str = TRACE_EXPORT_PATH,
+                 endpoint: Optional[str] = TRACE_OTLP_ENDPOINT) -> None:
+        self.path = path
+        self.endpoint = endpoint
+        self.exported = 0
+        self.dropped = 0
+        self.failures = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+        self._thread: Optional[threading.Thread] = None
+
+    def export(self, _span: Span) -> None:
+        """Queues a finished span, dropping it when the queue is full
+
+        Args:
+            _span (Span): The span
+        """
+        try:
+            self._queue.put_nowait(_span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _batch(self) -> Optional[List[Span]]:
+        """The spans queued, waiting up to an export interval for the first"""
+        try:
+            span = self._queue.get(timeout=TRACE_EXPORT_INTERVAL)
+        except queue.Empty:
+            return []
+        if span is None:
+            return None
+        spans = [span]
+        while len(spans) < 1000:
+            try:
+                span = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if span is None:
+                self._queue.put(None)
+                break
+            spans.append(span)
+        return spans
+
+    def _write(self, _spans: List[Span]) -> None:
+        payload = {'resourceSpans': [{
+            'resource': {'attributes': [
+                _attribute('service.name', TRACE_SERVICE_NAME)]},
+            'scopeSpans': [{'scope': {'name': __name__},
+                            'spans': [span.otlp() for span in _spans]}]
+        }]}
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        if (os.path.exists(self.path)
+                and os.path.getsize(self.path) > TRACE_EXPORT_MAX_BYTES):
+            os.replace(self.path, self.path + '.1')
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(payload) + '\n')
+        if self.endpoint:
+            httpx.post(self.endpoint, json=payload, timeout=5).raise_for_status()
+
+    def _run(self) -> None:
+        while (spans := self._batch()) is not None:
+            if not spans:
+                continue
+            try:
+                self._write(spans)
+                self.exported += len(spans)
+            except Exception:  # pylint: disable=broad-except
+                self.failures += 1
+                logger.warning('Could not export %s spans', len(spans),
+                               exc_info=True)
+
+    def start(self) -> None:
+        """Starts the export thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='span-exporter', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Exports what is queued and stops the export thread"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def metrics(self) -> Dict:
+        """The counters of the exporter
+
+        Returns:
+            Dict: The current metrics
+        """
+        return {'enabled': TRACING, 'sample_rate': TRACE_SAMPLE_RATE,
+                'queued': self._queue.qsize(), 'exported_total': self.exported,
+                'dropped_total': self.dropped,
+                'export_failures_total': self.failures}
+
+
+span_exporter = SpanExporter()
+
+
+def _start_statement_span(conn, _cursor, statement, _parameters, context,
+                          executemany) -> None:
+    parent = current_span.get()
+    if parent is None:
+        return
+    span = parent.child(statement.split(None, 1)[0].upper(), KIND_CLIENT)
+    span.attributes.update({
+        'db.system': conn.dialect.name,
+        'db.statement': statement[:STATEMENT_MAX_LENGTH],
+        'db.executemany': executemany})
+    context.trace_span = span
+
+
+def _finish_statement_span(_conn, cursor, _statement, _parameters, context,
+                           _executemany) -> None:
+    span = getattr(context, 'trace_span', None)
+    if span is not None:
+        context.trace_span = None
+        if cursor.rowcount is not None and cursor.rowcount >= 0:
+            span.attributes['db.rowcount'] = cursor.rowcount
+        span.finish()
+
+
+def _fail_statement_span(exception_context) -> None:
+    span = getattr(exception_context.execution_context, 'trace_span', None)
+    if span is not None:
+        exception_context.execution_context.trace_span = None
+        span.finish(exception_context.original_exception)
+
+
+if TRACING:
+    event.listen(Engine, 'before_cursor_execute', _start_statement_span)
+    event.listen(Engine, 'after_cursor_execute', _finish_statement_span)
+    event.listen(Engine, 'handle_error', _fail_statement_span)
+
+
+async def start_span_exporter() -> None:
+    """Starts exporting the finished spans"""
+    if TRACING:
+        span_exporter.start()
+
+
+async def stop_span_exporter() -> None:
+    """Exports the last spans and stops"""
+    await asyncio.to_thread(span_exporter.stop)
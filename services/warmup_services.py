@@ -0,0 +1,151 @@
+"""The file containing the warm-up run when the application starts
+
+A fresh worker would otherwise pay for its first connections, the mapper
+configuration, the serialisers of the read schemas and the hierarchy query
+on its first requests. The warm-up does all of it in the background right
+after startup, and ``/health/ready`` only reports ready once it is done, so
+a load balancer keeps the traffic away until then. ``/health/live`` answers
+from the first moment.
+
+A warm-up that fails, e.g. while the database is still starting, is retried
+every ``WARMUP_RETRY_INTERVAL`` seconds.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+from dotenv import find_dotenv, load_dotenv
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import configure_mappers
+
+from database.db import (DATABASE_POOL_SIZE, engine, read_session,
+                         replica_engine)
+from schemas.fieldsets_schema import build_serialisers
+from schemas.incidents_schema import ReadIncident
+from schemas.regions_schema import ReadRegion
+from schemas.store_sections_schema import ReadStoreSection
+from schemas.stores_schema import ReadStore
+from services.hierarchy_services import prime_hierarchy
+
+load_dotenv(find_dotenv())
+
+logger = logging.getLogger(__name__)
+
+WARM_UP = os.environ.get('WARM_UP', 'on') != 'off'
+# The pool keeps at most DATABASE_POOL_SIZE connections open
+WARMUP_CONNECTIONS = min(
+    int(os.environ.get('WARMUP_CONNECTIONS', str(DATABASE_POOL_SIZE))),
+    DATABASE_POOL_SIZE)
+WARMUP_RETRY_INTERVAL = float(os.environ.get('WARMUP_RETRY_INTERVAL', '5'))
+
+# The schemas the listing endpoints serialise through serialise_many
+WARMUP_SCHEMAS = (ReadRegion, ReadStore, ReadStoreSection, ReadIncident)
+
+
+def open_connections(_engine: Engine, _count: int) -> None:
+    """Opens connections at once so they are all left in the pool
+
+    Args:
+        _engine (Engine): The engine whose pool is filled
+        _count (int): The number of connections
+    """
+    connections = []
+    try:
+        for _ in range(_count):
+            connection = _engine.connect()
+            connections.append(connection)
+            connection.exec_driver_sql('SELECT 1')
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+class WarmUp:
+    """The state of the warm-up, read by the health endpoints"""
+
+    def __init__(self) -> None:
+        self.ready = not WARM_UP
+        self.attempts = 0
+        self.steps: Dict[str, float] = {}
+        self.time_to_ready: Optional[float] = None
+        self.error: Optional[str] = None
+        self._started = time.perf_counter()
+        self._task: Optional[asyncio.Task] = None
+
+    def _step(self, _name: str, _function, *args) -> None:
+        started = time.perf_counter()
+        _function(*args)
+        self.steps[_name] = time.perf_counter() - started
+
+    def run(self) -> None:
+        """Runs every step of the warm-up once"""
+        self._step('pool', open_connections, engine, WARMUP_CONNECTIONS)
+        if replica_engine is not None:
+            self._step('replica_pool', open_connections, replica_engine,
+                       WARMUP_CONNECTIONS)
+        self._step('mappers', configure_mappers)
+        self._step('serialisers', build_serialisers, *WARMUP_SCHEMAS)
+
+        def hierarchy():
+            with read_session() as _db:
+                prime_hierarchy(_db)
+
+        self._step('hierarchy', hierarchy)
+
+    async def _run_until_ready(self) -> None:
+        while True:
+            self.attempts += 1
+            try:
+                await asyncio.to_thread(self.run)
+                break
+            except Exception as e:  # pylint: disable=broad-except
+                self.error = str(e)
+                logger.warning('The warm-up failed, retrying in %ss',
+                               WARMUP_RETRY_INTERVAL, exc_info=True)
+                await asyncio.sleep(WARMUP_RETRY_INTERVAL)
+
+        self.error = None
+        self.time_to_ready = time.perf_counter() - self._started
+        self.ready = True
+        logger.info('Ready after %.2fs: %s', self.time_to_ready, ', '.join(
+            f'{name} {seconds * 1000:.0f} ms'
+            for name, seconds in self.steps.items()))
+
+    def start(self) -> None:
+        """Starts the warm-up in the background"""
+        self._started = time.perf_counter()
+        if WARM_UP:
+            self._task = asyncio.create_task(self._run_until_ready())
+
+    def stop(self) -> None:
+        """Reports not ready any more, so the traffic drains before shutdown"""
+        self.ready = False
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def metrics(self) -> Dict:
+        """The outcome of the warm-up
+
+        Returns:
+            Dict: The current metrics
+        """
+        return {'enabled': WARM_UP, 'ready': self.ready,
+                'attempts': self.attempts,
+                'time_to_ready_seconds': self.time_to_ready,
+                'step_seconds': dict(self.steps), 'error': self.error}
+
+
+warm_up = WarmUp()
+
+
+async def start_warm_up() -> None:
+    """Starts warming the worker up"""
+    warm_up.start()
+
+
+async def stop_warm_up() -> None:
+    """Marks the worker as not ready"""
+    warm_up.stop()
@@ -0,0 +1,16 @@
+"""The shared configuration of the tests
+
+The engines connect lazily, so placeholder urls let the modules import
+without a database.
+"""
+import os
+
+import pytest
+
+os.environ.setdefault('DATABASE_URL', 'postgresql://test@localhost/test')
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    """Runs the async tests on asyncio only, like the application"""
+    return 'asyncio'
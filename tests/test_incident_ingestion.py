@@ -0,0 +1,98 @@
+"""The tests of the batched writes of the buffered ingestion queue"""
+import uuid
+
+import pytest
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from services import incident_ingestion_services
+from services.incident_ingestion_services import IncidentIngestionQueue
+
+pytestmark = pytest.mark.anyio
+
+STALE_STORE_ID = uuid.uuid4()
+
+
+class StubDatabase:
+    """Stands in for the batch insert, refusing rows with a stale store id
+
+    Args:
+        outages (int): How many writes fail with a dropped connection first
+    """
+
+    def __init__(self, outages: int = 0) -> None:
+        self.outages = outages
+        self.writes = 0
+        self.written = []
+        self.released = []
+
+    def write_batch(self, _rows) -> None:
+        self.writes += 1
+        if self.outages:
+            self.outages -= 1
+            raise OperationalError('INSERT', {}, ConnectionError('dropped'))
+        if any(row['store_id'] == STALE_STORE_ID for row in _rows):
+            raise IntegrityError('INSERT', {}, ValueError('foreign key'))
+        self.written.extend(_rows)
+
+    def release_keys(self, _keys) -> None:
+        self.released.extend(_keys)
+
+
+@pytest.fixture
+def database(monkeypatch) -> StubDatabase:
+    """Routes the queue's writes and key releases to a stub"""
+    stub = StubDatabase()
+    monkeypatch.setattr(IncidentIngestionQueue, '_write_batch',
+                        staticmethod(stub.write_batch))
+    monkeypatch.setattr(IncidentIngestionQueue, '_release_keys',
+                        staticmethod(stub.release_keys))
+    monkeypatch.setattr(incident_ingestion_services.asyncio, 'sleep',
+                        _no_sleep)
+    return stub
+
+
+async def _no_sleep(_seconds: float) -> None:
+    pass
+
+
+def queued_incident(_store_id: uuid.UUID, _key: str) -> dict:
+    return {'incident_id': uuid.uuid4(), 'store_id': _store_id,
+            '_idempotency_key': _key}
+
+
+async def test_a_row_with_a_stale_foreign_key_only_drops_itself(database):
+    queue = IncidentIngestionQueue()
+    batch = [queued_incident(uuid.uuid4(), f'key-{i}') for i in range(7)]
+    batch.insert(4, queued_incident(STALE_STORE_ID, 'stale'))
+
+    await queue._flush(batch)
+
+    assert [row['incident_id'] for row in database.written] == [
+        row['incident_id'] for row in batch if row['store_id'] != STALE_STORE_ID]
+    assert database.released == ['stale']
+    assert queue.metrics()['flushed_total'] == 7
+    assert queue.metrics()['failed_total'] == 1
+
+
+async def test_a_dropped_connection_retries_the_whole_batch(database):
+    database.outages = 2
+    queue = IncidentIngestionQueue()
+    batch = [queued_incident(uuid.uuid4(), f'key-{i}') for i in range(3)]
+
+    await queue._flush(batch)
+
+    assert database.writes == 3
+    assert database.written == batch
+    assert database.released == []
+
+
+async def test_a_lasting_outage_drops_the_batch_and_frees_its_keys(database):
+    database.outages = 10
+    queue = IncidentIngestionQueue()
+    batch = [queued_incident(uuid.uuid4(), f'key-{i}') for i in range(3)]
+
+    await queue._flush(batch)
+
+    assert database.written == []
+    assert database.released == ['key-0', 'key-1', 'key-2']
+    assert queue.metrics()['failed_total'] == 3
@@ -0,0 +1,106 @@
+"""The tests of the read routing between the replica and the primary"""
+import time
+
+import pytest
+from starlette.requests import Request
+
+from database import db
+from database.db import LAST_WRITE_COOKIE, ReplicaLagMonitor
+
+pytestmark = pytest.mark.anyio
+
+
+class StubProbe:
+    """A replica lag probe returning a set lag, or failing"""
+
+    def __init__(self, lag: float) -> None:
+        self.lag = lag
+        self.fail = False
+
+    def __call__(self) -> float:
+        if self.fail:
+            raise ConnectionError('The replica is unreachable')
+        return self.lag
+
+
+class StubSession:
+    """A session recording which database it would read from"""
+
+    def __init__(self, target: str) -> None:
+        self.target = target
+
+    def close(self) -> None:
+        pass
+
+
+def request_with_cookies(_cookies: dict) -> Request:
+    header = '; '.join(f'{name}={value}' for name, value in _cookies.items())
+    return Request({'type': 'http', 'method': 'GET', 'path': '/',
+                    'headers': [(b'cookie', header.encode())] if header else []})
+
+
+@pytest.fixture
+def probe(monkeypatch) -> StubProbe:
+    """Routes the reads through a monitor driven by a stub probe"""
+    stub = StubProbe(0.0)
+    monitor = ReplicaLagMonitor(probe=stub, max_lag=5, interval=60)
+    monkeypatch.setattr(db, 'replica_lag_monitor', monitor)
+    monkeypatch.setattr(db, 'SessionLocal', lambda: StubSession('primary'))
+    monkeypatch.setattr(db, 'ReplicaSessionLocal',
+                        lambda: StubSession('replica'))
+    return stub
+
+
+async def read_target(_request: Request) -> str:
+    dependency = db.get_read_db(_request)
+    session = await dependency.__anext__()
+    await dependency.aclose()
+    return session.target
+
+
+async def test_reads_use_the_replica_under_the_lag_threshold(probe):
+    probe.lag = 4.9
+    db.replica_lag_monitor.check()
+
+    assert db.replica_lag_monitor.replica_usable
+    assert await read_target(request_with_cookies({})) == 'replica'
+    assert db.replica_lag_monitor.replica_reads == 1
+
+
+async def test_reads_use_the_primary_above_the_lag_threshold(probe):
+    probe.lag = 5.1
+    db.replica_lag_monitor.check()
+
+    assert not db.replica_lag_monitor.replica_usable
+    assert await read_target(request_with_cookies({})) == 'primary'
+    assert db.replica_lag_monitor.primary_reads == 1
+
+
+async def test_reads_use_the_primary_when_the_probe_fails(probe):
+    db.replica_lag_monitor.check()
+    probe.fail = True
+    db.replica_lag_monitor.check()
+
+    assert db.replica_lag_monitor.lag_seconds is None
+    assert await read_target(request_with_cookies({})) == 'primary'
+
+
+async def test_reads_use_the_primary_before_the_first_probe(probe):
+    assert await read_target(request_with_cookies({})) == 'primary'
+
+
+async def test_reads_use_the_primary_after_a_recent_write(probe):
+    db.replica_lag_monitor.check()
+
+    recent = request_with_cookies({LAST_WRITE_COOKIE: time.time() - 1})
+    assert await read_target(recent) == 'primary'
+
+
+async def test_reads_use_the_replica_once_the_write_is_old(probe):
+    db.replica_lag_monitor.check()
+
+    old = request_with_cookies(
+        {LAST_WRITE_COOKIE: time.time() - db.READ_YOUR_WRITES_SECONDS - 1})
+    assert await read_target(old) == 'replica'
+    assert await read_target(
+        request_with_cookies({LAST_WRITE_COOKIE: 'garbage'})) == 'replica'
@@ -0,0 +1,204 @@
+"""The tests of the store proximity queries and the density tiles
+
+The spatial queries run against the PostGIS database of TEST_DATABASE_URL,
+and are skipped when it is unset or lacks PostGIS. The tile maths needs none.
+"""
+import math
+import os
+import uuid
+from collections import Counter
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+
+from models.models import Incidents, Regions, Stores, StoreSections
+from services.store_locations_services import (
+    MAX_TILE_ZOOM, retrieve_density_tile_service,
+    retrieve_nearest_stores_service, retrieve_stores_within_service,
+    tile_bounds, tile_cell)
+
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+MERCATOR_LIMIT = math.degrees(math.atan(math.sinh(math.pi)))
+
+LONDON = (51.5074, -0.1278)
+GREENWICH = (51.4769, -0.0005)
+PARIS = (48.8566, 2.3522)
+SYDNEY = (-33.8688, 151.2093)
+
+
+def test_the_world_tile_covers_the_mercator_square():
+    bounds = tile_bounds(0, 0, 0)
+
+    assert (bounds['west'], bounds['east']) == (-180, 180)
+    assert bounds['north'] == pytest.approx(MERCATOR_LIMIT)
+    assert bounds['south'] == pytest.approx(-MERCATOR_LIMIT)
+    assert bounds['north_y'] == pytest.approx(math.pi)
+    assert bounds['south_y'] == pytest.approx(-math.pi)
+
+
+def test_tiles_split_at_the_equator_and_the_meridian():
+    north_west = tile_bounds(1, 0, 0)
+    south_east = tile_bounds(1, 1, 1)
+
+    assert (north_west['west'], north_west['east']) == (-180, 0)
+    assert north_west['south'] == pytest.approx(0)
+    assert (south_east['west'], south_east['east']) == (0, 180)
+    assert south_east['north'] == pytest.approx(0)
+
+
+def test_adjacent_tiles_share_their_edges():
+    tile = tile_bounds(12, 2046, 1361)
+
+    assert tile_bounds(12, 2047, 1361)['west'] == tile['east']
+    assert tile_bounds(12, 2046, 1362)['north'] == pytest.approx(tile['south'])
+
+
+@pytest.mark.parametrize('z, x, y', [
+    (-1, 0, 0), (MAX_TILE_ZOOM + 1, 0, 0), (1, 2, 0), (1, 0, 2), (3, -1, 0)])
+def test_tiles_outside_the_zoom_level_are_refused(z, x, y):
+    with pytest.raises(ValueError):
+        tile_bounds(z, x, y)
+
+
+def test_cells_follow_the_mercator_ordinate():
+    bounds = tile_bounds(0, 0, 0)
+
+    # The equator is halfway down the tile, and 60 degrees north in the
+    # second row where degrees would put it in the first
+    assert tile_cell(0.0, 0.0, bounds, 4) == (2, 2)
+    assert tile_cell(60.0, -180.0, bounds, 4) == (0, 1)
+    assert tile_cell(LONDON[0], LONDON[1], bounds, 256) == (127, 85)
+
+
+def test_the_edges_of_the_tile_stay_in_its_grid():
+    bounds = tile_bounds(1, 0, 0)
+
+    assert tile_cell(bounds['south'], bounds['east'], bounds, 8) == (7, 7)
+    assert tile_cell(bounds['north'], bounds['west'], bounds, 8) == (0, 0)
+
+
+@pytest.fixture(scope='module')
+def postgis_session():
+    """A session on a PostGIS database holding four located stores"""
+    if not TEST_DATABASE_URL:
+        pytest.skip('TEST_DATABASE_URL is not set')
+    engine = create_engine(TEST_DATABASE_URL)
+    try:
+        with engine.begin() as conn:
+            conn.execute(text('CREATE EXTENSION IF NOT EXISTS postgis'))
+    except Exception as e:  # pylint: disable=broad-except
+        engine.dispose()
+        pytest.skip(f'PostGIS is unavailable: {e}')
+
+    tables = [model.__table__
+              for model in (Regions, Stores, StoreSections, Incidents)]
+    Regions.metadata.drop_all(engine, tables=tables)
+    Regions.metadata.create_all(engine, tables=tables)
+
+    region_id = uuid.uuid4()
+    stores = {name: uuid.uuid4()
+              for name in ('london', 'greenwich', 'paris', 'sydney', 'unknown')}
+    coordinates = {'london': LONDON, 'greenwich': GREENWICH, 'paris': PARIS,
+                   'sydney': SYDNEY, 'unknown': (None, None)}
+    with engine.begin() as conn:
+        conn.execute(text(
+            'INSERT INTO regions (region_id, region_name, created_at, '
+            "change_seq) VALUES (:id, 'r', now(), 0)"), {'id': region_id})
+        for name, store_id in stores.items():
+            conn.execute(text(
+                'INSERT INTO stores (store_id, store_name, store_latitude, '
+                'store_longitude, created_at, change_seq, region_id) '
+                'VALUES (:id, :name, :latitude, :longitude, now(), 0, '
+                ':region_id)'),
+                {'id': store_id, 'name': name, 'region_id': region_id,
+                 'latitude': coordinates[name][0],
+                 'longitude': coordinates[name][1]})
+        for name, created_at in (('london', '2026-01-10'),
+                                 ('london', '2026-03-10'),
+                                 ('greenwich', '2026-03-11'),
+                                 ('paris', '2026-03-12')):
+            conn.execute(text(
+                'INSERT INTO incidents (incident_id, incident_description, '
+                'employee_id, employee_name, employee_email, created_at, '
+                "change_seq, region_id, store_id) VALUES (:id, 'd', '1', "
+                "'e', 'e@x', :created_at, 0, :region_id, :store_id)"),
+                {'id': uuid.uuid4(), 'created_at': created_at,
+                 'region_id': region_id, 'store_id': stores[name]})
+
+    with Session(engine) as session:
+        yield session, stores
+    Regions.metadata.drop_all(engine, tables=tables)
+    engine.dispose()
+
+
+@pytest.mark.anyio
+async def test_stores_within_a_radius_come_nearest_first(postgis_session):
+    session, stores = postgis_session
+
+    within = await retrieve_stores_within_service(*LONDON, 20, 10, session)
+
+    assert [row.store_id for row in within] == [stores['london'],
+                                                stores['greenwich']]
+    assert within[0].distance_meters == pytest.approx(0, abs=1)
+    # Geodesic, so not the 9.4 km of a sphere to the metre
+    assert within[1].distance_meters == pytest.approx(9400, rel=0.02)
+
+
+@pytest.mark.anyio
+async def test_the_radius_and_the_limit_cut_the_stores(postgis_session):
+    session, stores = postgis_session
+
+    assert len(await retrieve_stores_within_service(
+        *LONDON, 400, 10, session)) == 3
+    assert [row.store_id for row in await retrieve_stores_within_service(
+        *LONDON, 400, 1, session)] == [stores['london']]
+
+
+@pytest.mark.anyio
+async def test_the_nearest_stores_skip_the_unlocated(postgis_session):
+    session, stores = postgis_session
+
+    nearest = await retrieve_nearest_stores_service(*PARIS, 10, session)
+
+    assert [row.store_id for row in nearest] == [
+        stores['paris'], stores['london'], stores['greenwich'],
+        stores['sydney']]
+    distances = [row.distance_meters for row in nearest]
+    assert distances == sorted(distances)
+
+
+@pytest.mark.anyio
+async def test_the_density_grid_counts_stores_and_incidents_per_cell(
+        postgis_session):
+    session, _ = postgis_session
+    bounds = tile_bounds(0, 0, 0)
+
+    tile = await retrieve_density_tile_service(0, 0, 0, 256, session)
+
+    expected_stores = Counter(tile_cell(*point, bounds, 256)
+                              for point in (LONDON, GREENWICH, PARIS, SYDNEY))
+    assert {(cell.column, cell.row): cell.store_count
+            for cell in tile.cells} == dict(expected_stores)
+    incidents = {(cell.column, cell.row): cell.incident_count
+                 for cell in tile.cells}
+    assert incidents[tile_cell(*SYDNEY, bounds, 256)] == 0
+    assert sum(incidents.values()) == 4
+
+
+@pytest.mark.anyio
+async def test_the_density_grid_filters_on_the_tile_and_the_range(
+        postgis_session):
+    session, _ = postgis_session
+    # The tile of London at zoom 6 holds neither Paris nor Sydney
+    z, x, y = 6, 31, 21
+    bounds = tile_bounds(z, x, y)
+    assert bounds['west'] <= LONDON[1] < bounds['east']
+    assert bounds['south'] < LONDON[0] <= bounds['north']
+
+    tile = await retrieve_density_tile_service(
+        z, x, y, 4, session, _start=datetime(2026, 3, 1))
+
+    assert sum(cell.store_count for cell in tile.cells) == 2
+    assert sum(cell.incident_count for cell in tile.cells) == 2